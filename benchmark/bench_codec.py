@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Body codec benchmark.
+
+Encode / decode time and payload size of every codec on number heavy and
+binary payloads. Pickle is measured even though it is not registered by
+default; msgpack only when it is installed.
+
+    $ python benchmark/bench_codec.py --items 10,1000,100000 --number 50
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pyxtcp.codec import JSONCodec, MsgpackCodec, PickleCodec, RawCodec, msgpack  # noqa: E402
+
+
+def _codecs():
+    codecs = [JSONCodec(), PickleCodec(), RawCodec()]
+    if msgpack is not None:
+        codecs.insert(1, MsgpackCodec())
+    return codecs
+
+
+def _payloads(items):
+    return [
+        ("floats", [i * 0.5 for i in range(items)]),
+        ("records", [{"id": i, "score": i * 1.5, "rank": -i} for i in range(items)]),
+        ("bytes", os.urandom(items * 8)),
+    ]
+
+
+def _timeit(func, arg, number):
+    start = time.time()
+    for _ in range(number):
+        func(arg)
+    return (time.time() - start) / number
+
+
+def run(item_counts, number):
+    results = []
+    for items in item_counts:
+        for payload_name, payload in _payloads(items):
+            for codec in _codecs():
+                try:
+                    data = codec.encode(payload)
+                    codec.decode(data)
+                except Exception:
+                    #: json can not send bytes, raw only sends bytes
+                    continue
+
+                results.append({
+                    "codec": codec.name, "payload": payload_name, "items": items,
+                    "size": len(data),
+                    "encode_seconds": _timeit(codec.encode, payload, number),
+                    "decode_seconds": _timeit(codec.decode, data, number),
+                })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", default="10,1000,100000",
+                        help="comma separated number of items per payload")
+    parser.add_argument("--number", type=int, default=20, help="iterations per measurement")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run([int(items) for items in args.items.split(",")], args.number)
+
+    print("{:<8} {:<8} {:>8} {:>10} {:>12} {:>12}".format(
+        "codec", "payload", "items", "size", "encode_us", "decode_us"))
+    for item in results:
+        print("{codec:<8} {payload:<8} {items:>8} {size:>10} {encode_us:>12.2f} {decode_us:>12.2f}".format(
+            encode_us=item["encode_seconds"] * 1e6, decode_us=item["decode_seconds"] * 1e6, **item))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
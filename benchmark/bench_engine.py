@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Tornado vs asyncio engine benchmark.
+
+Start an echo server on each engine in its own process and measure requests
+per second with a raw socket load generator sending pipelined version 2
+frames. The Tornado engine runs on Python 2 and the asyncio one on Python 3,
+so each can be started with its own interpreter.
+
+    $ python3 benchmark/bench_engine.py run --tornado-python python2 --requests 50000
+    $ python3 benchmark/bench_engine.py serve --engine asyncio --port 8001
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+ENGINES = ("tornado", "asyncio")
+
+
+def _echo(message):
+    return message.body
+
+
+def serve_tornado(port, uvloop=False):
+    from tornado.ioloop import IOLoop
+    from pyxtcp.tcp.tornado.server import RPCServer
+
+    RPCServer(_echo, keep_alive=True).listen(port, "127.0.0.1")
+    IOLoop.current().start()
+
+
+def serve_asyncio(port, uvloop=False):
+    from pyxtcp.tcp.asyncio import RPCServer
+
+    RPCServer(_echo, keep_alive=True).run(port, "127.0.0.1", use_uvloop=uvloop)
+
+
+def _request_frame(request_id, body):
+    return b"".join((b"+", str(request_id).encode(), b"\"t0\"t4\"techo\"t", str(len(body)).encode(),
+                     b"\"r\"n", body, b"\"r\"n"))
+
+
+def _count_responses(buffer_, offset):
+    """Skip the complete response frames from `offset`, return their count and the next offset."""
+    count = 0
+    while True:
+        header_end = buffer_.find(b"\"r\"n", offset)
+        if header_end < 0:
+            return count, offset
+        body_len = int(bytes(buffer_[buffer_.rfind(b"\"t", offset, header_end) + 2:header_end]))
+        frame_end = header_end + 4 + body_len + 4
+        if len(buffer_) < frame_end:
+            return count, offset
+        count += 1
+        offset = frame_end
+
+
+def _run_connection(port, requests, pipeline, body, results):
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    buffer_ = bytearray()
+    offset = sent = received = 0
+    while received < requests:
+        window = min(pipeline - (sent - received), requests - sent)
+        if window > 0:
+            sock.sendall(b"".join(_request_frame(sent + i + 1, body) for i in range(window)))
+            sent += window
+
+        data = sock.recv(65536)
+        if not data:
+            raise RuntimeError("server closed the connection")
+        buffer_ += data
+        count, offset = _count_responses(buffer_, offset)
+        received += count
+        if offset > 1024 * 1024:
+            del buffer_[:offset]
+            offset = 0
+
+    sock.close()
+    results.append(received)
+
+
+def _wait_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError("server on port {} did not start".format(port))
+
+
+def load(port, requests, connections, pipeline, body_size):
+    body = b"x" * body_size
+    results = []
+    threads = [threading.Thread(target=_run_connection, args=(port, requests // connections, pipeline, body, results))
+               for _ in range(connections)]
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+
+    total = sum(results)
+    return {"requests": total, "seconds": seconds, "requests_per_second": total / seconds}
+
+
+def run(args):
+    results = []
+    for engine in args.engines.split(","):
+        python = getattr(args, "{}_python".format(engine)) or sys.executable
+        command = [python, os.path.abspath(__file__), "serve", "--engine", engine, "--port", str(args.port)]
+        if args.uvloop:
+            command.append("--uvloop")
+
+        server = subprocess.Popen(command)
+        try:
+            _wait_port(args.port)
+            result = load(args.port, args.requests, args.connections, args.pipeline, args.body_size)
+        finally:
+            server.terminate()
+            server.wait()
+
+        result.update({"engine": engine, "uvloop": args.uvloop and engine == "asyncio", "python": python,
+                       "connections": args.connections, "pipeline": args.pipeline, "body_size": args.body_size})
+        results.append(result)
+        print("{engine:<8} {python:<12} {requests:>8} {requests_per_second:>12.0f} req/s".format(**result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve_parser = subparsers.add_parser("serve", help="run an echo server")
+    serve_parser.add_argument("--engine", choices=ENGINES, required=True)
+    serve_parser.add_argument("--port", type=int, default=8001)
+    serve_parser.add_argument("--uvloop", action="store_true", help="asyncio engine on uvloop")
+
+    run_parser = subparsers.add_parser("run", help="benchmark the engines")
+    run_parser.add_argument("--engines", default=",".join(ENGINES))
+    run_parser.add_argument("--tornado-python", help="interpreter of the Tornado server, default this one")
+    run_parser.add_argument("--asyncio-python", help="interpreter of the asyncio server, default this one")
+    run_parser.add_argument("--uvloop", action="store_true", help="asyncio engine on uvloop")
+    run_parser.add_argument("--port", type=int, default=8731)
+    run_parser.add_argument("--requests", type=int, default=20000)
+    run_parser.add_argument("--connections", type=int, default=4)
+    run_parser.add_argument("--pipeline", type=int, default=32, help="requests in flight per connection")
+    run_parser.add_argument("--body-size", type=int, default=64)
+    run_parser.add_argument("--output", help="write the results as JSON to this file")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        (serve_tornado if args.engine == "tornado" else serve_asyncio)(args.port, args.uvloop)
+    elif args.command == "run":
+        run(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
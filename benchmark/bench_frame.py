@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Frame write / read benchmark.
+
+Compare the formatting encoder and slicing decoder (before) with the
+`write_message` and `read_body` the connections use (after), over a stream
+recording what it is given: payload bytes copied, payload sized buffers
+allocated and time per message. Bodies under `MessageUtils.zero_copy_threshold`
+are still joined with the header and sliced from the suffix.
+
+    $ python benchmark/bench_frame.py --sizes 64,65536,4194304 --number 200
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from tornado.concurrent import Future
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pyxtcp.tcp.tornado.util import CONNECTION_PREFIX, CONNECTION_TYPE_IN_REQUEST  # noqa: E402
+from pyxtcp.tcp.tornado.util import RPCMessage, message_utils, read_body, write_message  # noqa: E402
+
+
+def _done_future(result=None):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class _RecordingStream(object):
+    """Stands for an IOStream: keeps the written buffers, reads from `data`.
+
+    The buffers returned by `read_bytes` are the ones the stream allocates
+    anyway, only the copies made from them are counted.
+    """
+
+    def __init__(self, data=b""):
+        self.data = data
+        self.offset = 0
+        self.written = []
+        self.read = []
+
+    def write(self, data):
+        self.written.append(data)
+        return _done_future()
+
+    def read_bytes(self, num_bytes):
+        data = self.data[self.offset:self.offset + num_bytes]
+        self.offset += num_bytes
+        self.read.append(data)
+        return _done_future(data)
+
+
+def write_before(stream, tube):
+    stream.write(b"{type_}{topic_len}{item_delimiter}{topic}{item_delimiter}{body_len}{header_delimiter}{body}"
+                 b"{body_suffix}".format(
+                     type_=CONNECTION_PREFIX[tube.type_], topic_len=len(tube.topic),
+                     item_delimiter=message_utils.header_item_delimiter, topic=tube.topic,
+                     body_len=len(tube.body), header_delimiter=message_utils.header_delimiter,
+                     body=tube.body, body_suffix=message_utils.body_suffix))
+
+
+def write_after(stream, tube):
+    write_message(stream, tube)
+
+
+def read_before(stream, body_len):
+    body_data = stream.read_bytes(body_len + message_utils.body_suffix_len).result()
+    return message_utils.parse_body(body_data)
+
+
+def read_after(stream, body_len):
+    #: every read is resolved at once, so is the coroutine
+    return read_body(stream, body_len).result()
+
+
+def _write_cost(stream, body):
+    """Payload bytes copied and buffers allocated, the original body is free."""
+    new_chunks = [chunk for chunk in stream.written if chunk is not body]
+    return sum(len(chunk) for chunk in new_chunks), len(new_chunks)
+
+
+def _read_cost(stream, body):
+    if any(body is data for data in stream.read):
+        return 0, 0
+    return len(body), 1
+
+
+def _timeit(func, number):
+    start = time.time()
+    for _ in range(number):
+        func()
+    return (time.time() - start) / number
+
+
+def run(sizes, number):
+    results = []
+    for size in sizes:
+        body = b"x" * size
+        tube = RPCMessage(CONNECTION_TYPE_IN_REQUEST, b"CompanyService.get_company_by_company_id", body)
+        body_data = body + message_utils.body_suffix
+
+        for name, writer in (("before", write_before), ("after", write_after)):
+            stream = _RecordingStream()
+            writer(stream, tube)
+            copied, allocations = _write_cost(stream, body)
+            results.append({
+                "op": "write", "impl": name, "body_size": size,
+                "bytes_copied": copied, "allocations": allocations,
+                "seconds": _timeit(lambda: writer(_RecordingStream(), tube), number),
+            })
+
+        for name, reader in (("before", read_before), ("after", read_after)):
+            stream = _RecordingStream(body_data)
+            read = reader(stream, size)
+            assert read == body
+            copied, allocations = _read_cost(stream, read)
+            results.append({
+                "op": "read", "impl": name, "body_size": size,
+                "bytes_copied": copied, "allocations": allocations,
+                "seconds": _timeit(lambda: reader(_RecordingStream(body_data), size), number),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="64,4096,65536,1048576,8388608",
+                        help="comma separated body sizes in bytes")
+    parser.add_argument("--number", type=int, default=100, help="iterations per measurement")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run([int(size) for size in args.sizes.split(",")], args.number)
+
+    print("{:<7} {:<7} {:>10} {:>14} {:>12} {:>12}".format(
+        "op", "impl", "body_size", "bytes_copied", "allocations", "us/message"))
+    for item in results:
+        print("{op:<7} {impl:<7} {body_size:>10} {bytes_copied:>14} {allocations:>12} {us:>12.2f}".format(
+            us=item["seconds"] * 1e6, **item))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
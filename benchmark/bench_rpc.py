@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Loopback benchmark of the TCP and HTTP RPC servers.
+
+Start the TCP or HTTP `RPCServer` (or the `TCPServer` of the raw engine of
+``raw/``, without Tornado) with an echo service in its own process, the TCP
+one on loopback or on a local transport (``unix``, ``shm``, see
+`pyxtcp.transport`),
+call it from `concurrency` coroutines for `duration` seconds and report the
+requests per second, the p50/p99/p999 latencies and the CPU and RSS of the
+server and the client. Every protocol, connection mode, concurrency and
+payload size combination is one case:
+
+- ``persistent``: the pooled keep-alive clients (``RPCClient`` / ``AsyncRPCClient``)
+- ``per-request``: a new connection per call, the TCP server without keep-alive
+- ``multiplex``: TCP only, every call over one ``MultiplexRPCClient`` connection
+- ``pipeline``: raw only, every call pipelined over one ``XTCPClient`` connection
+
+The results are written as JSON with the pyxtcp and Python versions, two
+result files are compared with ``compare``. CPU and RSS of the server are read
+from ``/proc`` (Linux only).
+
+    $ python benchmark/bench_rpc.py run --concurrency 1,16 --sizes 64,16384 --output 1.1.9.json
+    $ python benchmark/bench_rpc.py compare 1.1.9.json new.json --threshold 10
+"""
+
+import argparse
+import datetime
+import functools
+import json
+import math
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pyxtcp  # noqa: E402
+from pyxtcp.transport import parse_local_address  # noqa: E402
+
+PROTOCOLS = ("tcp", "http", "raw", "unix", "shm")
+
+#: the protocols of the TCP `RPCServer`
+TCP_PROTOCOLS = ("tcp", "unix", "shm")
+MODES = ("persistent", "per-request", "multiplex", "pipeline")
+
+#: the modes only some protocols have
+PROTOCOL_MODES = {
+    "multiplex": TCP_PROTOCOLS,
+    "pipeline": ("raw",),
+    "per-request": TCP_PROTOCOLS + ("http",),
+}
+
+RAW_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "raw")
+
+ECHO_TOPIC = "BenchService.echo"
+ECHO_PATH = "/BenchService/echo"
+
+#: monotonic clock of the latencies
+timer = getattr(time, "perf_counter", time.time)
+
+
+def local_address(protocol, port):
+    """The address of the TCP server of a local transport protocol, None on loopback."""
+    if protocol == "unix":
+        return "unix://{}".format(os.path.join(tempfile.gettempdir(), "pyxtcp-bench-{}.sock".format(port)))
+    if protocol == "shm":
+        return "shm://bench-{}".format(port)
+    return None
+
+
+def serve_tcp(port, keep_alive, address=None):
+    from tornado.ioloop import IOLoop
+    from pyxtcp.tcp.tornado.server import RPCServer
+    from pyxtcp.tcp.tornado.util import Service, server_callback_by_codec
+
+    service = Service()
+
+    class BenchService(object):
+
+        @staticmethod
+        @service.with_f_rpc
+        def echo(data):
+            return data
+
+    server = RPCServer(functools.partial(server_callback_by_codec, service), keep_alive=keep_alive)
+    if address is None:
+        server.listen(port, "127.0.0.1")
+    else:
+        server.listen(address)
+    IOLoop.current().start()
+
+
+def serve_http(port, keep_alive):
+    from pyxtcp.http import RPCServer, Service
+
+    service = Service()
+
+    class BenchService(object):
+
+        @staticmethod
+        @service.with_f_rpc
+        def echo(data):
+            return data
+
+    server = RPCServer(port, "127.0.0.1")
+    server.add_service(service)
+    server.run(shutdown_timeout=1)
+
+
+def serve_raw(port, keep_alive):
+    sys.path.insert(0, RAW_PATH)
+    from tcpserver import TCPServer
+
+    def _request_callback(method, params):
+        return params
+
+    server = TCPServer(_request_callback)
+    server.listen(port, "127.0.0.1")
+    server.start()
+
+
+def _wait_port(port, timeout=10, address=None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if address is None:
+                socket.create_connection(("127.0.0.1", port)).close()
+            else:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(parse_local_address(address).path)
+                sock.close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError("server on port {} did not start".format(port))
+
+
+def _process_usage(pid):
+    """CPU seconds and RSS bytes of the process `pid`, None when /proc is not there."""
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            #: the fields after the parenthesized command name, utime and stime are the 14th and 15th
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/{}/status".format(pid)) as f:
+            rss_kb = [int(line.split()[1]) for line in f if line.startswith("VmRSS:")][0]
+    except (IOError, OSError, IndexError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK")), rss_kb * 1024
+
+
+def _self_cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, int(math.ceil(fraction * len(sorted_values))) - 1)]
+
+
+def _make_call(protocol, mode, port, concurrency, payload):
+    """Return `(call, close)`, `call()` returns a Future of one echo call."""
+
+    from pyxtcp.http import AsyncRPCClient
+    from pyxtcp.tcp.tornado.multi_client import ClientConnectionItem, RPCClient
+    from pyxtcp.tcp.tornado.multiplex_client import MultiplexRPCClient
+    from pyxtcp.tcp.tornado.util import CONNECTION_TYPE_IN_REQUEST, RPCMessage
+
+    if protocol == "http":
+        if mode == "per-request":
+            def _call_once():
+                client = AsyncRPCClient("127.0.0.1:{}".format(port), max_connections=1)
+                future = client.post(ECHO_PATH, None, payload)
+                future.add_done_callback(lambda _: client.close())
+                return future
+            return _call_once, lambda: None
+
+        client = AsyncRPCClient("127.0.0.1:{}".format(port), max_connections=concurrency)
+        return functools.partial(client.post, ECHO_PATH, None, payload), client.close
+
+    body = json.dumps(payload)
+    host = local_address(protocol, port)
+    if host is None:
+        host = "127.0.0.1"
+    else:
+        port = None
+
+    def _item():
+        return ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, ECHO_TOPIC, body), waiting_timeout=60)
+
+    if mode == "multiplex":
+        client = MultiplexRPCClient(host, port, connect_timeout=5)
+        return lambda: client.fetch(_item()), client.close
+    if mode == "per-request":
+        def _fetch_once():
+            client = RPCClient(host, port, max_clients=1, connect_timeout=5)
+            future = client.fetch(_item())
+            future.add_done_callback(lambda _: client.close())
+            return future
+        return _fetch_once, lambda: None
+
+    client = RPCClient(host, port, max_clients=concurrency, connect_timeout=5)
+    return lambda: client.fetch(_item()), client.close
+
+
+def _is_error(protocol, response):
+    from pyxtcp.tcp.tornado.util import RESPONSE_ERROR_TAG
+
+    return protocol in TCP_PROTOCOLS and response.topic == RESPONSE_ERROR_TAG
+
+
+def run_case(protocol, mode, port, server_pid, concurrency, size, duration, warmup):
+    """Benchmark one case against the running server, return its result."""
+
+    from tornado import gen
+    from tornado.ioloop import IOLoop
+
+    call, close = _make_call(protocol, mode, port, concurrency, {"data": "x" * size})
+    latencies = []
+    counters = {"errors": 0}
+
+    @gen.coroutine
+    def _worker(end_time, record):
+        while timer() < end_time:
+            start_time = timer()
+            try:
+                response = yield call()
+            except Exception:
+                counters["errors"] += 1
+                continue
+            if _is_error(protocol, response):
+                counters["errors"] += 1
+            elif record:
+                latencies.append(timer() - start_time)
+
+    @gen.coroutine
+    def _run():
+        yield [_worker(timer() + warmup, False) for _ in range(concurrency)]
+        counters["errors"] = 0
+
+        server_usage, client_cpu, start_time = _process_usage(server_pid), _self_cpu(), timer()
+        yield [_worker(start_time + duration, True) for _ in range(concurrency)]
+        seconds = timer() - start_time
+        raise gen.Return((seconds, server_usage, _process_usage(server_pid), _self_cpu() - client_cpu))
+
+    io_loop = IOLoop.current()
+    try:
+        seconds, server_start, server_end, client_cpu = io_loop.run_sync(_run)
+    finally:
+        close()
+    return _result(protocol, mode, concurrency, size, latencies, counters["errors"], seconds,
+                   server_start, server_end, client_cpu)
+
+
+def run_raw_case(mode, port, server_pid, concurrency, size, duration, warmup):
+    """`run_case` of the raw engine, `concurrency` callback chains on the loop of `XTCPClient`."""
+
+    sys.path.insert(0, RAW_PATH)
+    from client import Context, XTCPClient
+
+    if mode == "pipeline":
+        client = XTCPClient(max_clients=1, max_pipeline=concurrency)
+    else:
+        client = XTCPClient(max_clients=concurrency, max_pipeline=1)
+    payload = {"data": "x" * size}
+    latencies = []
+    counters = {"errors": 0, "running": 0}
+
+    def _worker(end_time, record):
+        context = Context("127.0.0.1", port, connect_timeout=5, waiting_timeout=60, request_timeout=60)
+        context.concat("echo", payload)
+
+        def _call():
+            if timer() >= end_time:
+                counters["running"] -= 1
+                return
+            client.fetch(context, functools.partial(_on_response, timer()))
+
+        def _on_response(start_time, success, response):
+            if not success:
+                counters["errors"] += 1
+            elif record:
+                latencies.append(timer() - start_time)
+            _call()
+
+        counters["running"] += 1
+        _call()
+
+    def _run(seconds, record):
+        for _ in range(concurrency):
+            _worker(timer() + seconds, record)
+        client._io_loop.run_until(lambda: not counters["running"])
+
+    try:
+        _run(warmup, False)
+        counters["errors"] = 0
+
+        server_start, client_cpu, start_time = _process_usage(server_pid), _self_cpu(), timer()
+        _run(duration, True)
+        seconds = timer() - start_time
+        server_end, client_cpu = _process_usage(server_pid), _self_cpu() - client_cpu
+    finally:
+        client.close()
+    return _result("raw", mode, concurrency, size, latencies, counters["errors"], seconds,
+                   server_start, server_end, client_cpu)
+
+
+def _result(protocol, mode, concurrency, size, latencies, errors, seconds, server_start, server_end, client_cpu):
+    latencies.sort()
+    result = {
+        "protocol": protocol,
+        "mode": mode,
+        "concurrency": concurrency,
+        "size": size,
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": seconds,
+        "requests_per_second": len(latencies) / seconds,
+        "latency_ms": {
+            name: value * 1000 if value is not None else None for name, value in (
+                ("mean", sum(latencies) / len(latencies) if latencies else None),
+                ("p50", percentile(latencies, 0.5)),
+                ("p99", percentile(latencies, 0.99)),
+                ("p999", percentile(latencies, 0.999)),
+                ("max", latencies[-1] if latencies else None),
+            )
+        },
+        "client_cpu_percent": client_cpu / seconds * 100,
+        #: kilobytes on Linux
+        "client_max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "server_cpu_percent": None,
+        "server_rss_bytes": None,
+    }
+    if server_start is not None and server_end is not None:
+        result["server_cpu_percent"] = (server_end[0] - server_start[0]) / seconds * 100
+        result["server_rss_bytes"] = server_end[1]
+    return result
+
+
+def _split(value, type_=str):
+    return [type_(item) for item in value.split(",") if item]
+
+
+def _print_result(result):
+    latency = result["latency_ms"]
+    print("{protocol:<5} {mode:<12} c={concurrency:<4} size={size:<7} {requests_per_second:>9.0f} req/s "
+          "p50 {p50:>7.2f} p99 {p99:>7.2f} p999 {p999:>7.2f} ms  errors {errors}  server cpu {cpu} rss {rss}".format(
+              p50=latency["p50"] or 0, p99=latency["p99"] or 0, p999=latency["p999"] or 0,
+              cpu="{:.0f}%".format(result["server_cpu_percent"]) if result["server_cpu_percent"] is not None else "-",
+              rss="{:.1f}M".format(result["server_rss_bytes"] / 1048576.0) if result["server_rss_bytes"] else "-",
+              **result))
+
+
+def run(args):
+    import tornado
+
+    results = []
+    for protocol in _split(args.protocols):
+        for mode in _split(args.modes):
+            if protocol not in PROTOCOL_MODES.get(mode, PROTOCOLS):
+                continue
+
+            command = [sys.executable, os.path.abspath(__file__), "serve", "--protocol", protocol,
+                       "--port", str(args.port)]
+            if mode != "per-request":
+                command.append("--keep-alive")
+            server = subprocess.Popen(command)
+            try:
+                _wait_port(args.port, address=local_address(protocol, args.port))
+                for concurrency in _split(args.concurrency, int):
+                    for size in _split(args.sizes, int):
+                        if protocol == "raw":
+                            result = run_raw_case(mode, args.port, server.pid, concurrency, size,
+                                                  args.duration, args.warmup)
+                        else:
+                            result = run_case(protocol, mode, args.port, server.pid, concurrency, size,
+                                              args.duration, args.warmup)
+                        results.append(result)
+                        _print_result(result)
+            finally:
+                server.terminate()
+                server.wait()
+
+    report = {
+        "version": pyxtcp.__version__,
+        "python": platform.python_version(),
+        "tornado": tornado.version,
+        "platform": platform.platform(),
+        "date": datetime.datetime.now().isoformat(),
+        "parameters": {"duration": args.duration, "warmup": args.warmup},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+def _case_key(result):
+    return result["protocol"], result["mode"], result["concurrency"], result["size"]
+
+
+def compare(args):
+    """Print the change of the cases of `new` from `base`, exit 1 on a regression beyond `threshold` percent."""
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    base_results = dict((_case_key(result), result) for result in base["results"])
+
+    print("{} ({}) -> {} ({})".format(base["version"], base["python"], new["version"], new["python"]))
+    regressions = 0
+    for result in new["results"]:
+        base_result = base_results.get(_case_key(result))
+        if base_result is None:
+            continue
+
+        throughput_change = _change(base_result["requests_per_second"], result["requests_per_second"])
+        p99_change = _change(base_result["latency_ms"]["p99"], result["latency_ms"]["p99"])
+        is_regression = args.threshold is not None and (
+            throughput_change < -args.threshold or p99_change > args.threshold)
+        regressions += is_regression
+        print("{:<5} {:<12} c={:<4} size={:<7} req/s {:>+7.1f}%  p99 {:>+7.1f}%{}".format(
+            result["protocol"], result["mode"], result["concurrency"], result["size"],
+            throughput_change, p99_change, "  REGRESSION" if is_regression else ""))
+
+    if regressions:
+        sys.exit(1)
+
+
+def _change(base, new):
+    if not base or new is None:
+        return 0.0
+    return (new - base) / float(base) * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve_parser = subparsers.add_parser("serve", help="run an echo server")
+    serve_parser.add_argument("--protocol", choices=PROTOCOLS, required=True)
+    serve_parser.add_argument("--port", type=int, default=8001)
+    serve_parser.add_argument("--keep-alive", action="store_true", help="keep the TCP connections open")
+
+    run_parser = subparsers.add_parser("run", help="benchmark the servers")
+    run_parser.add_argument("--protocols", default=",".join(PROTOCOLS))
+    run_parser.add_argument("--modes", default=",".join(MODES))
+    run_parser.add_argument("--concurrency", default="1,16", help="comma separated calls in flight")
+    run_parser.add_argument("--sizes", default="64,4096", help="comma separated payload sizes in bytes")
+    run_parser.add_argument("--duration", type=float, default=5, help="seconds of every case")
+    run_parser.add_argument("--warmup", type=float, default=1, help="seconds before measuring every case")
+    run_parser.add_argument("--port", type=int, default=8732)
+    run_parser.add_argument("--output", help="write the results as JSON to this file")
+
+    compare_parser = subparsers.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, help="percent of throughput or p99 regression to fail")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        address = local_address(args.protocol, args.port)
+        if address is not None:
+            serve_tcp(args.port, args.keep_alive, address)
+        else:
+            serve = {"tcp": serve_tcp, "http": serve_http, "raw": serve_raw}[args.protocol]
+            serve(args.port, args.keep_alive)
+    elif args.command == "run":
+        run(args)
+    elif args.command == "compare":
+        compare(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
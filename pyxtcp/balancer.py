@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Client side load balancing over several server endpoints.
+
+`LoadBalancer` only picks endpoints and keeps their statistics, the
+balanced clients of `pyxtcp.http` and `pyxtcp.tcp.tornado` send the requests.
+"""
+
+import random
+import threading
+import time
+
+
+STRATEGY_P2C = "p2c"
+STRATEGY_LEAST_OUTSTANDING = "least_outstanding"
+
+
+class RPCNoEndpointError(Exception):
+    pass
+
+
+class Endpoint(object):
+    """A server address and what is known of it."""
+
+    def __init__(self, address):
+        self.address = address
+
+        #: requests sent and not answered yet
+        self.outstanding = 0
+        #: EWMA of the response time in seconds, None before the first response
+        self.latency = None
+        self.latency_time = None
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+
+        #: ejected until this time, `ejections` times in a row
+        self.ejected_until = None
+        self.ejections = 0
+
+    def is_ejected(self, now):
+        return self.ejected_until is not None and self.ejected_until > now
+
+    def stats(self):
+        return {
+            "address": self.address,
+            "outstanding": self.outstanding,
+            "latency": self.latency,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejected_until": self.ejected_until,
+        }
+
+
+class LoadBalancer(object):
+    """Pick one of `endpoints`, or of the addresses returned by `provider()`.
+
+    `provider` is called again every `refresh_interval` seconds, endpoints
+    keep their statistics as long as it returns them. `strategy` is
+    `STRATEGY_P2C` (the cheaper of two random endpoints, the cost is the
+    latency EWMA times the outstanding requests) or
+    `STRATEGY_LEAST_OUTSTANDING`. A latency not updated for `latency_ttl`
+    seconds is forgotten so that an endpoint once slow is tried again.
+
+    An endpoint failing `max_failures` times in a row, or whose latency is
+    above `slow_ratio` times the median of the others, is ejected for
+    `ejection_time` seconds, doubled every ejection in a row up to
+    `max_ejection_time`. At most `max_ejection_percent` of the endpoints are
+    ejected at the same time; when every endpoint is ejected they are all used.
+
+    The callbacks of `add_remove_callback` are called with the address of an
+    endpoint `provider` no longer returns, once its last request is finished.
+    """
+
+    def __init__(self, endpoints=None, provider=None, refresh_interval=30, strategy=STRATEGY_P2C,
+                 latency_alpha=0.3, latency_ttl=1, max_failures=3, slow_ratio=5, min_requests=10,
+                 ejection_time=10, max_ejection_time=300, max_ejection_percent=50,
+                 clock=time.time, random_=None):
+        if endpoints is None and provider is None:
+            raise ValueError("endpoints or provider is required")
+        if strategy not in (STRATEGY_P2C, STRATEGY_LEAST_OUTSTANDING):
+            raise ValueError("strategy must be `{}` or `{}`".format(STRATEGY_P2C, STRATEGY_LEAST_OUTSTANDING))
+
+        self.provider = provider
+        self.refresh_interval = refresh_interval
+        self.strategy = strategy
+        self.latency_alpha = latency_alpha
+        self.latency_ttl = latency_ttl
+        self.max_failures = max_failures
+        self.slow_ratio = slow_ratio
+        #: responses of an endpoint before it can be ejected for being slow
+        self.min_requests = min_requests
+        self.ejection_time = ejection_time
+        self.max_ejection_time = max_ejection_time
+        self.max_ejection_percent = max_ejection_percent
+
+        self._clock = clock
+        self._random = random_ or random.Random()
+        self._lock = threading.Lock()
+
+        #: address -> `Endpoint`, in the order given
+        self._endpoints = {}
+        self._addresses = []
+        #: address -> `Endpoint` dropped by the provider, until its requests are finished
+        self._removed_endpoints = {}
+        self._remove_callbacks = []
+        self._refresh_time = None
+        self._set_addresses(endpoints if endpoints is not None else provider())
+
+    def add_remove_callback(self, callback):
+        """Call `callback(address)` for every endpoint dropped from now on."""
+        self._remove_callbacks.append(callback)
+
+    def endpoints(self):
+        with self._lock:
+            self._refresh()
+            endpoints = [self._endpoints[address] for address in self._addresses]
+            removed = self._pop_removed_addresses()
+        self._run_remove_callbacks(removed)
+        return endpoints
+
+    def stats(self):
+        return [endpoint.stats() for endpoint in self.endpoints()]
+
+    def pick(self, exclude=()):
+        """Return the `Endpoint` for the next request, not one of the addresses in `exclude`
+        unless there is no other, and count it outstanding until `finish`."""
+
+        endpoint = None
+        with self._lock:
+            self._refresh()
+            removed = self._pop_removed_addresses()
+            if self._addresses:
+                now = self._clock()
+                candidates = [self._endpoints[address] for address in self._addresses if address not in exclude]
+                candidates = [endpoint for endpoint in candidates if not endpoint.is_ejected(now)] or candidates or [
+                    self._endpoints[address] for address in self._addresses]
+
+                endpoint = self._choose(candidates, now)
+                endpoint.outstanding += 1
+        self._run_remove_callbacks(removed)
+
+        if endpoint is None:
+            raise RPCNoEndpointError("no endpoint to send the request to")
+        return endpoint
+
+    def release(self, endpoint):
+        """The request picked for `endpoint` was given up without its answer, nothing is recorded."""
+
+        with self._lock:
+            endpoint.outstanding -= 1
+            removed = self._pop_removed_addresses()
+        self._run_remove_callbacks(removed)
+
+    def finish(self, endpoint, seconds, success=True):
+        """Record the response of a request sent to `endpoint` after `seconds`; a failure
+        is a request the endpoint did not answer (connection error, timeout)."""
+
+        with self._lock:
+            endpoint.outstanding -= 1
+            endpoint.requests += 1
+            if success:
+                self._record_latency(endpoint, seconds)
+            else:
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.max_failures:
+                    self._eject(endpoint)
+            removed = self._pop_removed_addresses()
+        self._run_remove_callbacks(removed)
+
+    def _record_latency(self, endpoint, seconds):
+        now = self._clock()
+        endpoint.consecutive_failures = 0
+        if endpoint.latency is None:
+            endpoint.latency = seconds
+        else:
+            endpoint.latency += self.latency_alpha * (seconds - endpoint.latency)
+        endpoint.latency_time = now
+
+        if endpoint.ejected_until is not None and not endpoint.is_ejected(now):
+            #: answered after its ejection, back to a fresh start
+            endpoint.ejected_until = None
+            endpoint.ejections = 0
+        elif endpoint.requests >= self.min_requests and self._is_slow(endpoint):
+            self._eject(endpoint)
+
+    def _choose(self, candidates, now):
+        if len(candidates) == 1:
+            return candidates[0]
+
+        if self.strategy == STRATEGY_LEAST_OUTSTANDING:
+            least = min(endpoint.outstanding for endpoint in candidates)
+            return self._random.choice([endpoint for endpoint in candidates if endpoint.outstanding == least])
+
+        first, second = self._random.sample(candidates, 2)
+        return first if self._cost(first, now) <= self._cost(second, now) else second
+
+    def _cost(self, endpoint, now):
+        #: endpoints without a recent response are tried first
+        if endpoint.latency is None or now - endpoint.latency_time > self.latency_ttl:
+            return 0
+        return (endpoint.outstanding + 1) * endpoint.latency
+
+    def _is_slow(self, endpoint):
+        latencies = sorted(
+            other.latency for other in self._endpoints.values()
+            if other is not endpoint and other.latency is not None and other.ejected_until is None)
+        #: one other endpoint is no reference, it may be the slow one
+        if len(latencies) < 2:
+            return False
+        median = latencies[len(latencies) // 2]
+        return endpoint.latency > median * self.slow_ratio
+
+    def _eject(self, endpoint):
+        now = self._clock()
+        if endpoint.is_ejected(now):
+            return
+
+        ejected_count = sum(1 for other in self._endpoints.values() if other.is_ejected(now))
+        if (ejected_count + 1) * 100 > len(self._endpoints) * self.max_ejection_percent:
+            return
+
+        endpoint.ejected_until = now + min(self.ejection_time * 2 ** endpoint.ejections, self.max_ejection_time)
+        endpoint.ejections += 1
+        endpoint.consecutive_failures = 0
+        #: the latency is measured again when it is back
+        endpoint.latency = None
+
+    def _refresh(self):
+        if self.provider is None or self._clock() < self._refresh_time + self.refresh_interval:
+            return
+        try:
+            addresses = self.provider()
+        except Exception:
+            #: keep the known endpoints, the provider is called again next interval
+            addresses = self._addresses
+        self._set_addresses(addresses)
+
+    def _set_addresses(self, addresses):
+        self._addresses = []
+        endpoints = {}
+        for address in addresses:
+            if address not in endpoints:
+                #: an address back before its requests finished keeps its endpoint
+                removed_endpoint = self._removed_endpoints.pop(address, None)
+                endpoints[address] = self._endpoints.get(address) or removed_endpoint or Endpoint(address)
+                self._addresses.append(address)
+        for address, endpoint in self._endpoints.items():
+            if address not in endpoints:
+                self._removed_endpoints[address] = endpoint
+        self._endpoints = endpoints
+        self._refresh_time = self._clock()
+
+    def _pop_removed_addresses(self):
+        """The dropped addresses without outstanding requests, forgotten from now on."""
+        addresses = [address for address, endpoint in self._removed_endpoints.items() if not endpoint.outstanding]
+        for address in addresses:
+            del self._removed_endpoints[address]
+        return addresses
+
+    def _run_remove_callbacks(self, addresses):
+        #: outside the lock, the callbacks may use the balancer
+        for address in addresses:
+            for callback in self._remove_callbacks:
+                callback(address)
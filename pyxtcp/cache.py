@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import collections
+import json
+import threading
+import time
+
+from tornado.concurrent import Future
+
+
+def make_cache_key(method, payload):
+    """`method` and its arguments canonicalized, equal kwargs in any order give the same key."""
+    return "{}:{}".format(method, json.dumps(payload, sort_keys=True, separators=(",", ":"), default=repr))
+
+
+def to_result_cache(cache):
+    """`cache` as a `ResultCache`, a number is the TTL of a new one."""
+    if cache is None or isinstance(cache, ResultCache):
+        return cache
+    return ResultCache(ttl=cache)
+
+
+def make_response_key(method, payload, codec_name):
+    """Key of the response of `method` encoded with `codec_name`."""
+    return "{}/{}".format(make_cache_key(method, payload), codec_name)
+
+
+def invalidate_responses(cache, method, payload=None):
+    """Drop the responses of `method` to `payload` in every codec, or all its responses."""
+    if payload is None:
+        cache.invalidate(prefix=method + ":")
+    else:
+        cache.invalidate(prefix=make_cache_key(method, payload) + "/")
+
+
+class _Call(object):
+    """A call in flight, the threads asking for the same key wait for its result."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class ResultCache(object):
+    """Bounded LRU cache of call results, every entry expires after its TTL in seconds.
+
+    At most `max_size` entries are kept, the least recently used is evicted
+    first. `call` and `call_async` run a call only once for concurrent
+    identical keys (coalescing), failed calls are not cached. Cached values
+    are shared, do not modify them. `hits`, `misses`, `coalesced` (misses
+    that waited for a call in flight) and `evictions` count what happened.
+    """
+
+    def __init__(self, max_size=1024, ttl=60, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        #: key -> (expire time, value), oldest used first
+        self._entries = collections.OrderedDict()
+        #: key -> `_Call` or Future of the call in flight
+        self._inflight = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return `(found, value)`."""
+        with self._lock:
+            return self._lookup(key)
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def invalidate(self, key=None, prefix=None):
+        """Drop the entry of `key`, the entries starting with `prefix`, or every entry."""
+        with self._lock:
+            if key is not None:
+                self._entries.pop(key, None)
+            elif prefix is not None:
+                for entry_key in [k for k in self._entries if k.startswith(prefix)]:
+                    del self._entries[entry_key]
+            else:
+                self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+        }
+
+    def call(self, key, func, ttl=None):
+        """Return the cached result of `key`, or of `func()` that is then cached."""
+
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                return value
+            waiter = self._inflight.get(key)
+            if waiter is not None:
+                self.coalesced += 1
+            else:
+                self._inflight[key] = call = _Call()
+
+        if waiter is not None:
+            return waiter.wait()
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        else:
+            self.set(key, call.result, ttl)
+            return call.result
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            call.event.set()
+
+    def call_async(self, key, func, ttl=None):
+        """`call` for a `func` returning a Future, returns a Future of the result.
+
+        Only to be used from the IOLoop thread.
+        """
+
+        found, value = self.get(key)
+        if found:
+            future = Future()
+            future.set_result(value)
+            return future
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return future
+
+        future = self._inflight[key] = func()
+
+        def _on_done(done_future):
+            self._inflight.pop(key, None)
+            if done_future.exception() is None:
+                self.set(key, done_future.result(), ttl)
+
+        future.add_done_callback(_on_done)
+        return future
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expire_time, value = entry
+            if expire_time > self._clock():
+                self.hits += 1
+                self._move_to_end(key)
+                return True, value
+            del self._entries[key]
+
+        self.misses += 1
+        return False, None
+
+    def _store(self, key, value, ttl):
+        self._entries.pop(key, None)
+        self._entries[key] = (self._clock() + (self.ttl if ttl is None else ttl), value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _move_to_end(self, key):
+        #: `OrderedDict.move_to_end` is Python 3 only
+        self._entries[key] = self._entries.pop(key)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import json
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class RPCCodecError(Exception):
+    pass
+
+
+def to_bytes(data):
+    """`data` as bytes, memoryviews and bytearrays of the frame readers are copied."""
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    if isinstance(data, bytearray):
+        return bytes(data)
+    return data
+
+
+class Codec(object):
+    """Serialize RPC arguments and results.
+
+    `codec_id` (0-255) travels in the TCP frame flags, `content_type` in the
+    HTTP headers. Ids from 16 on are free for user codecs.
+    """
+
+    codec_id = None
+    name = None
+    content_type = None
+
+    def encode(self, value):
+        raise NotImplementedError()
+
+    def decode(self, data):
+        raise NotImplementedError()
+
+
+class JSONCodec(Codec):
+    codec_id = 0
+    name = "json"
+    content_type = "application/json"
+
+    def encode(self, value):
+        return json.dumps(value)
+
+    def decode(self, data):
+        return json.loads(to_bytes(data))
+
+
+class RawCodec(Codec):
+    """Binary passthrough, the argument and the result are bytes."""
+
+    codec_id = 1
+    name = "raw"
+    content_type = "application/octet-stream"
+
+    def encode(self, value):
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            raise RPCCodecError("raw codec only sends bytes, got {}".format(type(value).__name__))
+        return value
+
+    def decode(self, data):
+        return data
+
+
+class MsgpackCodec(Codec):
+    codec_id = 2
+    name = "msgpack"
+    content_type = "application/x-msgpack"
+
+    def encode(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(to_bytes(data), raw=False)
+
+
+class PickleCodec(Codec):
+    """Highest pickle protocol of the running Python.
+
+    Unpickling runs arbitrary code, it is not registered by default:
+    `register_codec(PickleCodec())` only between trusted peers.
+    """
+
+    codec_id = 3
+    name = "pickle"
+    content_type = "application/x-python-pickle"
+
+    def encode(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(to_bytes(data))
+
+
+_codecs_by_id = {}
+_codecs_by_name = {}
+_codecs_by_content_type = {}
+
+
+def register_codec(codec):
+    if not 0 <= codec.codec_id <= 255:
+        raise RPCCodecError("codec id must be in 0-255, got {}".format(codec.codec_id))
+
+    _codecs_by_id[codec.codec_id] = codec
+    _codecs_by_name[codec.name] = codec
+    if codec.content_type:
+        _codecs_by_content_type[codec.content_type] = codec
+
+
+def get_codec(codec):
+    """Find a registered codec by id or name, a `Codec` is returned as is."""
+
+    if isinstance(codec, Codec):
+        return codec
+    found = _codecs_by_id.get(codec) if isinstance(codec, int) else _codecs_by_name.get(codec)
+    if found is None:
+        raise RPCCodecError("codec {!r} is not registered".format(codec))
+    return found
+
+
+def get_codec_by_content_type(content_type):
+    if not content_type:
+        return None
+    return _codecs_by_content_type.get(content_type.split(";", 1)[0].strip())
+
+
+def get_all_codecs():
+    return [_codecs_by_id[codec_id] for codec_id in sorted(_codecs_by_id)]
+
+
+DEFAULT_CODEC = JSONCodec()
+
+register_codec(DEFAULT_CODEC)
+register_codec(RawCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
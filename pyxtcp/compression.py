@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import zlib
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .codec import to_bytes
+
+
+class RPCCompressionError(Exception):
+    pass
+
+
+class Compressor(object):
+    """Compress RPC bodies.
+
+    `compression_id` (1-7) travels in the TCP frame flags. `decompress` raises
+    `RPCCompressionError` when the data expands beyond `max_size` bytes.
+    """
+
+    compression_id = None
+    name = None
+
+    def compress(self, data):
+        raise NotImplementedError()
+
+    def decompress(self, data, max_size=None):
+        raise NotImplementedError()
+
+
+class ZlibCompressor(Compressor):
+    compression_id = 1
+    name = "zlib"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(to_bytes(data), self.level)
+
+    def decompress(self, data, max_size=None):
+        decompressor = zlib.decompressobj()
+        try:
+            result = decompressor.decompress(to_bytes(data), 0 if max_size is None else max_size + 1)
+        except zlib.error as e:
+            raise RPCCompressionError("zlib: {}".format(e))
+
+        if max_size is not None and len(result) > max_size:
+            raise RPCCompressionError("Decompressed body larger than {}".format(max_size))
+        return result
+
+
+class LZ4Compressor(Compressor):
+    compression_id = 2
+    name = "lz4"
+
+    def compress(self, data):
+        return lz4_frame.compress(to_bytes(data))
+
+    def decompress(self, data, max_size=None):
+        decompressor = lz4_frame.LZ4FrameDecompressor()
+        try:
+            result = decompressor.decompress(to_bytes(data), -1 if max_size is None else max_size + 1)
+        except RuntimeError as e:
+            raise RPCCompressionError("lz4: {}".format(e))
+
+        if max_size is not None and len(result) > max_size:
+            raise RPCCompressionError("Decompressed body larger than {}".format(max_size))
+        return result
+
+
+class ZstdCompressor(Compressor):
+    compression_id = 3
+    name = "zstd"
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(to_bytes(data))
+
+    def decompress(self, data, max_size=None):
+        data = to_bytes(data)
+        try:
+            content_size = zstandard.frame_content_size(data)
+            if max_size is not None and content_size > max_size:
+                raise RPCCompressionError("Decompressed body larger than {}".format(max_size))
+            #: the output limit is only used when the frame does not record its size
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size or 0)
+        except zstandard.ZstdError as e:
+            raise RPCCompressionError("zstd: {}".format(e))
+
+
+_compressors_by_id = {}
+_compressors_by_name = {}
+
+
+def register_compressor(compressor):
+    if not 1 <= compressor.compression_id <= 7:
+        raise RPCCompressionError("compression id must be in 1-7, got {}".format(compressor.compression_id))
+
+    _compressors_by_id[compressor.compression_id] = compressor
+    _compressors_by_name[compressor.name] = compressor
+
+
+def get_compressor(compressor):
+    """Find a registered compressor by id or name, a `Compressor` is returned as is."""
+
+    if isinstance(compressor, Compressor):
+        return compressor
+    if isinstance(compressor, int):
+        found = _compressors_by_id.get(compressor)
+    else:
+        found = _compressors_by_name.get(compressor)
+    if found is None:
+        raise RPCCompressionError("compression {!r} is not available".format(compressor))
+    return found
+
+
+def get_all_compressors():
+    return [_compressors_by_id[compression_id] for compression_id in sorted(_compressors_by_id)]
+
+
+register_compressor(ZlibCompressor())
+if lz4_frame is not None:
+    register_compressor(LZ4Compressor())
+if zstandard is not None:
+    register_compressor(ZstdCompressor())
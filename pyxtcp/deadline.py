@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""End-to-end deadlines of the requests.
+
+A client sends with a request the seconds it still waits for the answer (the
+`X-RPC-Timeout` HTTP header, the `FLAG_DEADLINE` prefix of TCP frames), the
+server turns them into a deadline on its own clock and drops the request when
+it is over before the method runs. While a method runs `get_deadline()` is the
+deadline of its request, the clients called from it send what is left of it
+by default so a chain of calls stops with its first caller.
+"""
+
+import threading
+import time
+
+
+#: start of the error answered to a request dropped for its deadline
+DEADLINE_ERROR_PREFIX = "Deadline exceeded"
+
+
+class RPCDeadlineExceededError(Exception):
+    pass
+
+
+_local = threading.local()
+
+
+def get_deadline():
+    """`time.time()` deadline of the request the current thread serves, None without one.
+
+    A coroutine method only sees it until its first yield.
+    """
+    return getattr(_local, "deadline", None)
+
+
+def get_timeout(timeout=None):
+    """Seconds a new call may wait, `timeout` (None is unlimited) or less when the
+    deadline of the request being served is closer."""
+
+    deadline = get_deadline()
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.time()
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def call_with_deadline(deadline, method, args=(), kwargs=None):
+    """Call `method(*args, **kwargs)` with `deadline` as the current deadline.
+
+    Raises `RPCDeadlineExceededError` instead when it is over, e.g. after the
+    call waited for a free executor worker. Module level so that process pools
+    can run it.
+    """
+
+    if deadline is not None and time.time() >= deadline:
+        raise RPCDeadlineExceededError("{}: {:.3f}s ago".format(DEADLINE_ERROR_PREFIX, time.time() - deadline))
+
+    previous, _local.deadline = get_deadline(), deadline
+    try:
+        return method(*args, **(kwargs or {}))
+    finally:
+        _local.deadline = previous
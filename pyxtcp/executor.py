@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import functools
+import inspect
+import threading
+import traceback
+
+from concurrent import futures
+from tornado import gen
+from tornado.concurrent import is_future
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .deadline import call_with_deadline
+
+
+EXECUTOR_THREAD = "thread"
+EXECUTOR_PROCESS = "process"
+
+
+class RPCExecutorBusyError(Exception):
+    pass
+
+
+class RPCExecutorError(Exception):
+    pass
+
+
+#: id -> services and server callbacks registered with `CallbackExecutor.register`; the
+#: workers of a process pool are forked with them and look them up by id, as the
+#: registered methods themselves (staticmethods, decorated functions) can not be pickled
+_worker_targets = {}
+
+
+class CallbackExecutor(object):
+    """Bounded pool running service callbacks off the IOLoop thread.
+
+    At most `max_workers` callbacks run at the same time and at most
+    `max_queue_size` more wait for a free worker, further submits raise
+    `RPCExecutorBusyError` instead of growing the queue.
+
+    A process pool only accepts picklable (module level) callbacks, arguments
+    and results, anything else fails the call with `RPCExecutorError`.
+    `submit_call` runs the methods of the services and the server callbacks
+    registered before the pool started, by key. The pool starts with the first
+    call, so the workers of a pre-forking server get their own.
+
+    Coroutine methods are not sent to the pool, `submit_call` calls them on
+    the IOLoop; a method returning a Future in a worker fails the call.
+    """
+
+    def __init__(self, mode=EXECUTOR_THREAD, max_workers=None, max_queue_size=None):
+        if mode == EXECUTOR_THREAD:
+            self.max_workers = max_workers or 16
+        elif mode == EXECUTOR_PROCESS:
+            self.max_workers = max_workers or 4
+        else:
+            raise ValueError("executor mode must be `{}` or `{}`".format(EXECUTOR_THREAD, EXECUTOR_PROCESS))
+
+        self.mode = mode
+        self._executor = None
+        self.max_queue_size = max_queue_size if max_queue_size is not None else self.max_workers * 8
+        self.rejected_count = 0
+
+        #: submitted and not finished callbacks, running and queued
+        self._pending_count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending_count(self):
+        return self._pending_count
+
+    @property
+    def queue_depth(self):
+        """Callbacks waiting for a free worker."""
+        return max(0, self._pending_count - self.max_workers)
+
+    def is_saturated(self):
+        return self._pending_count >= self.max_workers + self.max_queue_size
+
+    def register(self, target):
+        """Make the service or server callback `target` callable by `submit_call` in the
+        workers of a process pool, return its key. Register before the first call."""
+
+        key = id(target)
+        if self.mode == EXECUTOR_PROCESS and _worker_targets.get(key) is not target:
+            if self._executor is not None:
+                raise RPCExecutorError("{!r} registered after the process pool started".format(target))
+            _worker_targets[key] = target
+        return key
+
+    def submit_call(self, deadline, method, args=(), kwargs=None, service=None, func_key=None):
+        """Submit `call_with_deadline(deadline, method, args, kwargs)`.
+
+        A process pool runs `method` as the function `func_key` of the
+        registered `service` when given, else as the registered callback.
+        """
+
+        #: a coroutine started in a worker would run on the IOLoop of that thread, which never runs
+        if is_coroutine_callable(method):
+            return call_with_deadline(deadline, method, args, kwargs)
+
+        if self.mode == EXECUTOR_THREAD:
+            return self.submit(call_in_worker, deadline, method, args, kwargs)
+        if func_key is not None:
+            return self.submit(call_service_function, self.register(service), func_key, deadline, args, kwargs)
+        return self.submit(call_registered, self.register(method), deadline, args, kwargs)
+
+    def submit(self, fn, *args, **kwargs):
+        if self.mode == EXECUTOR_PROCESS:
+            #: pickled here, what can not be fails now instead of in the feeder thread of the pool
+            try:
+                call = pickle.dumps((fn, args, kwargs), pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                raise RPCExecutorError("{} can not be sent to a process: {}".format(getattr(fn, "__name__", fn), e))
+            fn, args, kwargs = _call_pickled, (call,), {}
+
+        with self._lock:
+            if self.is_saturated():
+                self.rejected_count += 1
+                raise RPCExecutorBusyError("executor saturated: {} running, {} queued".format(
+                    self.max_workers, self.queue_depth))
+            self._pending_count += 1
+            if self._executor is None:
+                self._executor = self._create_executor()
+
+        future = self._executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._on_done)
+        if self.mode == EXECUTOR_PROCESS:
+            return _unpickle_result(future)
+        return future
+
+    def _create_executor(self):
+        if self.mode == EXECUTOR_THREAD:
+            return futures.ThreadPoolExecutor(self.max_workers)
+        return futures.ProcessPoolExecutor(self.max_workers)
+
+    def _on_done(self, future):
+        with self._lock:
+            self._pending_count -= 1
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+
+def call_in_worker(deadline, method, args=(), kwargs=None):
+    """Call `method` with a deadline in a pool worker, where a returned Future is never resolved."""
+
+    result = call_with_deadline(deadline, method, args, kwargs)
+    if is_awaitable(result):
+        raise RPCExecutorError("{} returned a Future in an executor worker, coroutines must run on the IOLoop".format(
+            getattr(method, "__name__", method)))
+    return result
+
+
+def call_registered(key, deadline, args=(), kwargs=None):
+    """Call the callback registered as `key` with a deadline, in a process pool worker."""
+    return call_in_worker(deadline, _get_worker_target(key), args, kwargs)
+
+
+def call_service_function(key, func_key, deadline, args=(), kwargs=None):
+    """Call the function `func_key` of the service registered as `key` with a deadline, in a process pool worker."""
+
+    method = _get_worker_target(key).get_rpc_function(func_key)
+    if not method:
+        raise RPCExecutorError("rpc function {} not exist".format(func_key))
+    return call_in_worker(deadline, method, args, kwargs)
+
+
+def _get_worker_target(key):
+    try:
+        return _worker_targets[key]
+    except KeyError:
+        raise RPCExecutorError("target {} was not registered when the worker started".format(key))
+
+
+def _call_pickled(call):
+    """Run a call pickled by `CallbackExecutor.submit` and return its result pickled, an
+    exception or result that can not be pickled fails the call instead of being lost by
+    the queues of the pool."""
+
+    fn, args, kwargs = pickle.loads(call)
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as e:
+        if _is_picklable(e):
+            raise
+        raise RPCExecutorError(traceback.format_exc())
+
+    try:
+        return pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        raise RPCExecutorError("result of {} can not be pickled: {}".format(getattr(fn, "__name__", fn), e))
+
+
+def _is_picklable(value):
+    try:
+        pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return False
+    return True
+
+
+def _unpickle_result(future):
+    result_future = futures.Future()
+
+    def _on_done(future):
+        if future.exception() is not None:
+            result_future.set_exception(future.exception())
+            return
+        #: e.g. a class of the result missing or changed in this process
+        try:
+            result = pickle.loads(future.result())
+        except Exception as e:
+            result_future.set_exception(RPCExecutorError("result can not be unpickled: {!r}".format(e)))
+        else:
+            result_future.set_result(result)
+    future.add_done_callback(_on_done)
+    return result_future
+
+
+def create_executor(executor, max_workers=None, max_queue_size=None):
+    """`executor` is None, a `CallbackExecutor` or one of the executor modes."""
+
+    if executor is None or isinstance(executor, CallbackExecutor):
+        return executor
+    return CallbackExecutor(executor, max_workers=max_workers, max_queue_size=max_queue_size)
+
+
+def is_coroutine_callable(method):
+    """True for `gen.coroutine` and native coroutine functions, also partially applied or
+    wrapped with `functools.wraps`."""
+
+    while True:
+        if isinstance(method, functools.partial):
+            method = method.func
+        elif hasattr(method, "__func__"):
+            method = method.__func__
+        elif gen.is_coroutine_function(method) or _is_native_coroutine_function(method):
+            return True
+        elif hasattr(method, "__wrapped__"):
+            method = method.__wrapped__
+        else:
+            return False
+
+
+def _is_native_coroutine_function(method):
+    #: Python 3.5+
+    return getattr(inspect, "iscoroutinefunction", lambda method: False)(method)
+
+
+def is_awaitable(result):
+    """Results of Future returning or native coroutine handlers are awaited."""
+    return is_future(result) or hasattr(result, "__await__")
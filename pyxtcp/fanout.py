@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Fan-out of calls: N calls sent together are answered in about one round
+trip instead of N, `map_calls` keeps at most `concurrency` of them in flight
+so a large fan-out does not exhaust the connections of the client.
+
+    companies = yield map_calls(lambda i: company.get_company_by_company_id(company_id=i), ids, concurrency=8)
+"""
+
+import functools
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+
+__all__ = [
+    "gather", "map_calls",
+]
+
+
+def gather(*futures):
+    """Wait for all the call Futures, the results are in the same order."""
+    return gen.multi(list(futures))
+
+
+def map_calls(method, items, concurrency=None, io_loop=None):
+    """Return a Future of the results of `method(item)` for every item, in order.
+
+    `method` returns a Future (or anything `yield` takes). At most
+    `concurrency` calls run at once, all of them when None. The first failed
+    call fails the Future and no further call is started, the running ones
+    are not cancelled.
+    """
+
+    if concurrency is not None and concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    return _MapCalls(method, list(items), concurrency, io_loop or IOLoop.current()).start()
+
+
+class _MapCalls(object):
+
+    def __init__(self, method, items, concurrency, io_loop):
+        self._method = method
+        self._items = items
+        self._concurrency = len(items) if concurrency is None else min(concurrency, len(items))
+        self._io_loop = io_loop
+
+        self.future = Future()
+        self._results = [None] * len(items)
+        self._next = 0
+        self._remaining = len(items)
+
+    def start(self):
+        if not self._items:
+            self.future.set_result([])
+            return self.future
+        for _ in range(self._concurrency):
+            self._start_call()
+        return self.future
+
+    def _start_call(self):
+        index, self._next = self._next, self._next + 1
+        try:
+            call_future = gen.convert_yielded(self._method(self._items[index]))
+        except Exception as e:
+            call_future = Future()
+            call_future.set_exception(e)
+        self._io_loop.add_future(call_future, functools.partial(self._on_call_done, index))
+
+    def _on_call_done(self, index, call_future):
+        if self.future.done():
+            return
+
+        error = call_future.exception()
+        if error is not None:
+            self.future.set_exception(error)
+            return
+
+        self._results[index] = call_future.result()
+        self._remaining -= 1
+        if not self._remaining:
+            self.future.set_result(self._results)
+        elif self._next < len(self._items):
+            self._start_call()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Hedged requests: a request still unanswered after most of the requests were
+answered is sent once more (to another connection or server) and the first
+answer wins, which cuts the tail latency for a few percent more requests.
+"""
+
+import collections
+import functools
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from .metrics import timer
+
+
+class HedgePolicy(object):
+    """When to send the duplicates of a request.
+
+    A duplicate is sent when no answer came after the `percentile` of the
+    response times of the last `window` requests (at least `min_delay`), at
+    most `max_hedges` per request and none before `min_samples` responses are
+    known. `methods` limits hedging to these methods (`"Topic.method"`), only
+    idempotent methods should be hedged. A policy measures the requests of the
+    clients it is given to, one policy per kind of call keeps the delay right.
+    """
+
+    def __init__(self, percentile=95, max_hedges=1, min_delay=0.001, window=1000, min_samples=20, methods=None):
+        self.percentile = percentile
+        self.max_hedges = max_hedges
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.methods = frozenset(methods) if methods is not None else None
+
+        #: requests sent through the policy and duplicates sent
+        self.requests = 0
+        self.hedges = 0
+
+        self._samples = collections.deque(maxlen=window)
+        #: the percentile is computed again every `_delay_interval` responses
+        self._delay = None
+        self._delay_interval = max(1, window // 20)
+        self._delay_age = 0
+
+    def should_hedge(self, method):
+        return self.methods is None or method in self.methods
+
+    def record(self, seconds):
+        self._samples.append(seconds)
+        self._delay_age += 1
+        if self._delay_age >= self._delay_interval:
+            self._delay = None
+
+    def get_delay(self):
+        """Seconds to wait for an answer before sending a duplicate, None to send none."""
+
+        if len(self._samples) < self.min_samples:
+            return None
+        if self._delay is None:
+            samples = sorted(self._samples)
+            index = min(len(samples) - 1, int(len(samples) * self.percentile / 100.0))
+            self._delay = max(self.min_delay, samples[index])
+            self._delay_age = 0
+        return self._delay
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "delay": self.get_delay(),
+        }
+
+
+def hedged_call(send, policy, io_loop=None):
+    """Return a Future resolved with the first answer of `send(attempt)`.
+
+    `send` returns a Future, it is called again with the next attempt number
+    each time `policy.get_delay()` passes without an answer. A failed attempt
+    fails the call once no other attempt is running, the late answers are
+    dropped.
+    """
+    return _HedgedCall(send, policy, io_loop or IOLoop.current()).start()
+
+
+class _HedgedCall(object):
+
+    def __init__(self, send, policy, io_loop):
+        self._send = send
+        self._policy = policy
+        self._io_loop = io_loop
+
+        self.future = Future()
+        self._attempts = 0
+        self._running = 0
+        self._hedge_handle = None
+
+    def start(self):
+        self._policy.requests += 1
+        self._start_attempt()
+        return self.future
+
+    def _start_attempt(self):
+        self._hedge_handle = None
+        if self._attempts:
+            self._policy.hedges += 1
+        attempt, self._attempts = self._attempts, self._attempts + 1
+
+        self._running += 1
+        try:
+            attempt_future = self._send(attempt)
+        except Exception as e:
+            attempt_future = Future()
+            attempt_future.set_exception(e)
+        self._io_loop.add_future(attempt_future, functools.partial(self._on_attempt_done, timer()))
+
+        delay = self._policy.get_delay()
+        if attempt < self._policy.max_hedges and delay is not None and not self.future.done():
+            self._hedge_handle = self._io_loop.call_later(delay, self._start_attempt)
+
+    def _on_attempt_done(self, start_time, attempt_future):
+        self._running -= 1
+        error = attempt_future.exception()
+        if error is None:
+            self._policy.record(timer() - start_time)
+        if self.future.done():
+            return
+
+        if error is None:
+            self._cancel_hedge()
+            self.future.set_result(attempt_future.result())
+        elif not self._running:
+            self._cancel_hedge()
+            self.future.set_exception(error)
+
+    def _cancel_hedge(self):
+        if self._hedge_handle is not None:
+            self._io_loop.remove_timeout(self._hedge_handle)
+            self._hedge_handle = None
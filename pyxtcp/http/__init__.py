@@ -5,3 +5,5 @@
 from .server import RPCServer
 from .service import Service
 from .client import RPCClient
+from .async_client import AsyncRPCClient
+from .balanced_client import BalancedRPCClient, AsyncBalancedRPCClient
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import collections
+import functools
+import socket
+
+from tornado import gen
+from tornado.http1connection import HTTP1Connection, HTTP1ConnectionParameters
+from tornado.httputil import HTTPHeaders, HTTPMessageDelegate, RequestStartLine
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.locks import Semaphore
+from tornado.tcpclient import TCPClient
+
+from ..cache import make_cache_key
+from ..codec import get_codec
+from ..deadline import DEADLINE_ERROR_PREFIX
+from ..fanout import gather, map_calls
+from ..hedge import hedged_call
+from ..metrics import get_default_metrics, timer
+from .util import BATCH_PATH, RPC_STATUS_HEADER, RPCConnectError, RPCRequestError, RPCServerBusyError
+from .util import RPCDeadlineExceededError, decode_response, encode_request, server_log
+from .util import get_batch_call, get_call_deadline, get_call_payload, get_call_timeout
+
+
+__all__ = [
+    "AsyncRPCClient", "RPCRequestError",
+]
+
+
+class AsyncRPCClient(object):
+    """Non-blocking `RPCClient`, the calls return Futures.
+
+        client = AsyncRPCClient("127.0.0.1:8000", max_connections=10)
+        service = client.service_name("CompanyService")
+        company = yield service.get_company_by_company_id(company_id=1)
+        companies = yield client.gather(*[service.get_company_by_company_id(company_id=i) for i in ids])
+        companies = yield client.map(lambda i: service.get_company_by_company_id(company_id=i), ids, concurrency=8)
+
+    Calls share at most `max_connections` keep-alive connections to the
+    server, the others wait for a free one. `request_timeout` covers the
+    wait, the connect (at most `connect_timeout`) and the response; the server
+    does not run a call once it (or the deadline of the request being served,
+    see `pyxtcp.deadline`) passed. With a `pyxtcp.hedge.HedgePolicy` a call
+    still unanswered after its delay is sent once more on another connection.
+    """
+
+    def __init__(self, address, max_connections=10, connect_timeout=1, request_timeout=10,
+                 max_body_size=None, io_loop=None, metrics=None, hedge_policy=None):
+        self.address = address
+        host, _, port = address.rpartition(":")
+        self.host = host or address
+        self.port = int(port) if host else 80
+
+        self.io_loop = io_loop or IOLoop.current()
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.max_body_size = max_body_size
+        self.hedge_policy = hedge_policy
+
+        self._tcp_client = TCPClient(io_loop=self.io_loop)
+        self._semaphore = Semaphore(max_connections)
+        self._idle_streams = collections.deque()
+
+        #: `pyxtcp.metrics.Metrics` of the pool and the requests, None measures nothing
+        self.metrics = metrics if metrics is not None else get_default_metrics()
+        self._metrics_labels = (("address", address), ("client", "http"))
+        #: (name, func, labels) of the gauges, they refer to the client until `close`
+        self._metrics_gauges = []
+        if self.metrics is not None:
+            self._metrics_gauges = [
+                ("pyxtcp_client_connections", lambda: len(self._idle_streams),
+                 self._metrics_labels + (("state", "idle"),)),
+            ]
+            for name, func, labels in self._metrics_gauges:
+                self.metrics.gauge_callback(name, func, labels)
+
+    def service_name(self, service_name, codec=None, cache=None, cache_methods=None):
+        """`codec` is a registered codec name or id, the JSON form param `v` by default.
+
+        With a `pyxtcp.cache.ResultCache` the results of `cache_methods` (names,
+        or a dict of name to TTL) are cached, of every method when not given.
+        """
+        return _AsyncRPCClientServiceHandler(self, service_name, codec, cache, cache_methods)
+
+    def batch(self, codec=None):
+        """Collect calls and send them in one POST, `yield batch.execute()`."""
+        return _AsyncRPCClientBatch(self, codec)
+
+    gather = staticmethod(gather)
+
+    #: `map(method, items, concurrency=None)`, see `pyxtcp.fanout.map_calls`
+    map = staticmethod(map_calls)
+
+    def post(self, path, codec, payload, deadline=None):
+        """POST `payload` to `path` and return the decoded result.
+
+        `deadline` is the `time.time()` the result is needed by, see `get_call_deadline`.
+        """
+
+        deadline = get_call_deadline(self.request_timeout, deadline)
+        if self.hedge_policy is not None and self.hedge_policy.should_hedge(path_to_method(path)):
+            return hedged_call(lambda attempt: self._post(path, codec, payload, deadline), self.hedge_policy,
+                               self.io_loop)
+        return self._post(path, codec, payload, deadline)
+
+    @gen.coroutine
+    def _post(self, path, codec, payload, call_deadline):
+        timeout = get_call_timeout(call_deadline, self.address)
+        body, headers = encode_request(codec, payload, timeout)
+        deadline = self.io_loop.time() + timeout
+        start_time = timer() if self.metrics is not None else None
+        try:
+            yield self._semaphore.acquire(deadline)
+        except gen.TimeoutError:
+            raise RPCRequestError("Request timeout, no free connection to {}".format(self.address))
+
+        status = "error"
+        try:
+            if start_time is not None:
+                self.metrics.observe("pyxtcp_client_queue_wait_seconds", timer() - start_time, self._metrics_labels)
+            code, response_headers, content = yield self._fetch(path, body, headers, deadline)
+            if code == 503:
+                raise RPCServerBusyError("Server busy {}".format(self.address))
+            if code == 504:
+                raise RPCDeadlineExceededError("{} on {}".format(DEADLINE_ERROR_PREFIX, self.address))
+            result = decode_response(codec, response_headers.get(RPC_STATUS_HEADER), content)
+            status = "ok"
+        finally:
+            self._semaphore.release()
+            if start_time is not None:
+                labels = self._metrics_labels + (("method", path),)
+                self.metrics.observe("pyxtcp_client_request_seconds", timer() - start_time, labels)
+                self.metrics.inc("pyxtcp_client_requests_total", labels + (("status", status),))
+        raise gen.Return(result)
+
+    def close(self):
+        for name, func, labels in self._metrics_gauges:
+            self.metrics.remove_gauge_callback(name, labels, func)
+        self._metrics_gauges = []
+
+        while self._idle_streams:
+            self._idle_streams.popleft().close()
+
+    @gen.coroutine
+    def _fetch(self, path, body, headers, deadline):
+        while True:
+            stream, is_reused = yield self._get_stream(deadline)
+            try:
+                response = yield gen.with_timeout(
+                    deadline, self._send(stream, path, body, headers),
+                    io_loop=self.io_loop, quiet_exceptions=StreamClosedError)
+            except StreamClosedError:
+                #: the server closed the idle connection meanwhile, try a new one
+                if is_reused:
+                    continue
+                raise RPCRequestError("Request invalid, connection closed by {}".format(self.address))
+            except gen.TimeoutError:
+                stream.close()
+                raise RPCRequestError("Request timeout {}{}".format(self.address, path))
+            raise gen.Return(response)
+
+    @gen.coroutine
+    def _get_stream(self, deadline):
+        while self._idle_streams:
+            stream = self._idle_streams.pop()
+            if not stream.closed():
+                raise gen.Return((stream, True))
+
+        start_time = timer() if self.metrics is not None else None
+        try:
+            stream = yield gen.with_timeout(
+                min(deadline, self.io_loop.time() + self.connect_timeout),
+                self._tcp_client.connect(self.host, self.port),
+                io_loop=self.io_loop, quiet_exceptions=(StreamClosedError, socket.error))
+        except (gen.TimeoutError, StreamClosedError, socket.error):
+            raise RPCConnectError("Connection Timeout {}".format(self.address))
+
+        if start_time is not None:
+            self.metrics.observe("pyxtcp_client_connect_seconds", timer() - start_time, self._metrics_labels)
+        stream.set_nodelay(True)
+        raise gen.Return((stream, False))
+
+    @gen.coroutine
+    def _send(self, stream, path, body, headers):
+        connection = HTTP1Connection(stream, True, HTTP1ConnectionParameters(max_body_size=self.max_body_size))
+        headers = HTTPHeaders(headers)
+        headers["Host"] = self.address
+        headers["Content-Length"] = str(len(body))
+
+        connection.write_headers(RequestStartLine("POST", path, "HTTP/1.1"), headers)
+        connection.write(body)
+        connection.finish()
+
+        delegate = _ResponseDelegate()
+        if not (yield connection.read_response(delegate)):
+            stream.close()
+            raise RPCRequestError("Request invalid, malformed response from {}".format(self.address))
+
+        #: keep-alive connections go back to the pool
+        stream = connection.detach()
+        if not stream.closed():
+            self._idle_streams.append(stream)
+        raise gen.Return((delegate.code, delegate.headers, b"".join(delegate.chunks)))
+
+
+def path_to_method(path):
+    """`"/Topic/method"` as the `"Topic.method"` of `HedgePolicy.methods`."""
+    return path.strip("/").replace("/", ".")
+
+
+class _ResponseDelegate(HTTPMessageDelegate):
+    def __init__(self):
+        self.code = None
+        self.headers = None
+        self.chunks = []
+
+    def headers_received(self, start_line, headers):
+        self.code = start_line.code
+        self.headers = headers
+
+    def data_received(self, chunk):
+        self.chunks.append(chunk)
+
+
+class _AsyncRPCClientBatch(object):
+    def __init__(self, client, codec=None):
+        self._client = client
+        self._codec = None if codec is None else get_codec(codec)
+        self.calls = []
+
+    def service_name(self, service_name):
+        return _AsyncRPCBatchServiceHandler(self, service_name)
+
+    def add(self, method, *args, **kwargs):
+        self.calls.append(get_batch_call(method, args, kwargs))
+        return len(self.calls) - 1
+
+    def execute(self):
+        server_log.debug("Batch Request To %s (%d calls)", self._client.address, len(self.calls))
+        return self._client.post(BATCH_PATH, self._codec, self.calls)
+
+
+class _AsyncRPCBatchServiceHandler(object):
+    def __init__(self, batch, service_name):
+        self._batch = batch
+        self._service_name = service_name
+
+    def __getattr__(self, func):
+        try:
+            return self.__dict__[func]
+        except KeyError:
+            return functools.partial(self._batch.add, "{}.{}".format(self._service_name, func))
+
+
+class _AsyncRPCClientServiceHandler(object):
+    def __init__(self, client, service_name, codec=None, cache=None, cache_methods=None):
+        self._client = client
+        self._service_name = service_name
+        self._codec = None if codec is None else get_codec(codec)
+
+        #: method name -> TTL (None for the cache default) of the cached methods, None caches all
+        self._cache = cache
+        if cache_methods is not None and not isinstance(cache_methods, dict):
+            cache_methods = dict.fromkeys(cache_methods)
+        self._cache_methods = cache_methods
+
+    def ___handler_request(self, func_name, *args, **kwargs):
+        #: codecs send a positional argument as the payload, the JSON form only keyword arguments
+        payload = get_call_payload(self._codec, args, kwargs)
+        server_log.debug("Request To %s.%s(%r)", self._service_name, func_name, payload)
+        path = "/{}/{}".format(self._service_name, func_name)
+        if self._cache is None or (self._cache_methods is not None and func_name not in self._cache_methods):
+            return self._client.post(path, self._codec, payload)
+
+        method = "{}.{}/{}".format(self._service_name, func_name, self._codec and self._codec.name)
+        key = make_cache_key(method, payload)
+        ttl = self._cache_methods.get(func_name) if self._cache_methods is not None else None
+        return self._cache.call_async(key, functools.partial(self._client.post, path, self._codec, payload), ttl)
+
+    def __getattr__(self, func):
+        try:
+            return self.__dict__[func]
+        except KeyError:
+            return functools.partial(self.___handler_request, func)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import threading
+
+from tornado import gen
+
+from ..balancer import LoadBalancer
+from ..metrics import timer
+from ..hedge import hedged_call
+from .async_client import AsyncRPCClient, _AsyncRPCClientBatch, _AsyncRPCClientServiceHandler, path_to_method
+from .client import RPCClient, _RPCClientBatch, _RPCClientServiceHandler
+from .util import RPCCallError, RPCConnectError, RPCDeadlineExceededError, RPCServerBusyError, get_call_deadline
+
+
+__all__ = [
+    "BalancedRPCClient", "AsyncBalancedRPCClient",
+]
+
+
+class _BalancedClientMixin(object):
+    """Endpoint clients and the errors deciding retries, shared by both balanced clients."""
+
+    def _init_balancer(self, endpoints, provider, max_retries, balancer, balancer_options):
+        self.balancer = balancer or LoadBalancer(endpoints, provider, **balancer_options)
+        self.max_retries = max_retries
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self.balancer.add_remove_callback(self._remove_client)
+
+    @property
+    def address(self):
+        return ",".join(str(endpoint.address) for endpoint in self.balancer.endpoints())
+
+    def _get_client(self, address):
+        client = self._clients.get(address)
+        if client is None:
+            with self._clients_lock:
+                client = self._clients.get(address)
+                if client is None:
+                    client = self._clients[address] = self._create_client(address)
+        return client
+
+    def _remove_client(self, address):
+        """Close the client of an endpoint the provider dropped."""
+        with self._clients_lock:
+            client = self._clients.pop(address, None)
+        if client is not None:
+            client.close()
+
+    def _on_error(self, endpoint, start_time, error, retries):
+        """Record the failed request, return True when it can be sent to another endpoint."""
+
+        #: the call ran and failed, the endpoint is fine
+        if isinstance(error, RPCCallError):
+            self.balancer.finish(endpoint, timer() - start_time, True)
+            return False
+
+        #: given up by the client
+        if isinstance(error, RPCDeadlineExceededError):
+            self.balancer.release(endpoint)
+            return False
+
+        self.balancer.finish(endpoint, timer() - start_time, False)
+        #: not run by the server, safe to send again
+        return isinstance(error, (RPCConnectError, RPCServerBusyError)) and retries < self.max_retries
+
+    def close(self):
+        with self._clients_lock:
+            clients, self._clients = self._clients, {}
+        for client in clients.values():
+            client.close()
+
+
+class BalancedRPCClient(_BalancedClientMixin):
+    """`RPCClient` spreading the calls over several servers.
+
+        client = BalancedRPCClient(["10.0.0.1:8001", "10.0.0.2:8001"])
+        company = client.service_name("CompanyService")
+
+    `endpoints` is a list of addresses, or `provider` a function returning
+    it (see `pyxtcp.balancer.LoadBalancer` for the other options). A call that
+    could not be sent or that a busy server refused is sent to another server,
+    at most `max_retries` times; timeouts are not retried.
+    """
+
+    def __init__(self, endpoints=None, provider=None, timeout=None, max_connections=10, max_retries=1,
+                 balancer=None, **balancer_options):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._init_balancer(endpoints, provider, max_retries, balancer, balancer_options)
+
+    def service_name(self, service_name, codec=None, cache=None, cache_methods=None):
+        return _RPCClientServiceHandler(self, service_name, codec, cache, cache_methods)
+
+    def batch(self, codec=None):
+        return _RPCClientBatch(self, codec)
+
+    def post(self, path, codec, payload, deadline=None):
+        deadline = get_call_deadline(self.timeout, deadline)
+        tried = []
+        while True:
+            endpoint = self.balancer.pick(tried)
+            tried.append(endpoint.address)
+            start_time = timer()
+            try:
+                result = self._get_client(endpoint.address).post(path, codec, payload, deadline)
+            except Exception as e:
+                if self._on_error(endpoint, start_time, e, len(tried) - 1):
+                    continue
+                raise
+            self.balancer.finish(endpoint, timer() - start_time)
+            return result
+
+    def _create_client(self, address):
+        return RPCClient(address, timeout=self.timeout, max_connections=self.max_connections)
+
+
+class AsyncBalancedRPCClient(_BalancedClientMixin):
+    """`AsyncRPCClient` spreading the calls over several servers, see `BalancedRPCClient`.
+
+    `client_options` are passed to the `AsyncRPCClient` of every server. With a
+    `pyxtcp.hedge.HedgePolicy` a call still unanswered after its delay is sent
+    to another server too.
+    """
+
+    def __init__(self, endpoints=None, provider=None, max_retries=1, client_options=None,
+                 balancer=None, hedge_policy=None, **balancer_options):
+        self.client_options = client_options or {}
+        self.hedge_policy = hedge_policy
+        self._init_balancer(endpoints, provider, max_retries, balancer, balancer_options)
+
+    def service_name(self, service_name, codec=None, cache=None, cache_methods=None):
+        return _AsyncRPCClientServiceHandler(self, service_name, codec, cache, cache_methods)
+
+    def batch(self, codec=None):
+        return _AsyncRPCClientBatch(self, codec)
+
+    gather = staticmethod(AsyncRPCClient.gather)
+    map = staticmethod(AsyncRPCClient.map)
+
+    def post(self, path, codec, payload, deadline=None):
+        #: the deadline of the request being served is only known now, not when a hedge is sent
+        deadline = get_call_deadline(None, deadline)
+        #: the attempts of a call share the servers they went to
+        tried = []
+        if self.hedge_policy is not None and self.hedge_policy.should_hedge(path_to_method(path)):
+            return hedged_call(lambda attempt: self._post(path, codec, payload, deadline, tried), self.hedge_policy)
+        return self._post(path, codec, payload, deadline, tried)
+
+    @gen.coroutine
+    def _post(self, path, codec, payload, deadline, tried):
+        retries = 0
+        while True:
+            endpoint = self.balancer.pick(tried)
+            tried.append(endpoint.address)
+            start_time = timer()
+            try:
+                result = yield self._get_client(endpoint.address).post(path, codec, payload, deadline)
+            except Exception as e:
+                if self._on_error(endpoint, start_time, e, retries):
+                    retries += 1
+                    continue
+                raise
+            self.balancer.finish(endpoint, timer() - start_time)
+            raise gen.Return(result)
+
+    def _create_client(self, address):
+        return AsyncRPCClient(address, **self.client_options)
@@ -1,58 +1,146 @@
 #!/usr/bin/env python
 # coding=utf-8
 
-import json
 import functools
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 
-from .util import server_log
+from ..cache import make_cache_key
+from ..codec import get_codec
+from .util import BATCH_PATH, RPC_STATUS_HEADER, RPCConnectError, RPCRequestError, RPCServerBusyError
+from .util import RPCDeadlineExceededError, decode_response, encode_request, server_log
+from .util import get_batch_call, get_call_deadline, get_call_payload, get_call_timeout
+from ..deadline import DEADLINE_ERROR_PREFIX
 
 
-class RPCRequestError(Exception):
-    pass
+__all__ = [
+    "RPCClient", "RPCRequestError",
+]
 
 
 class RPCClient(object):
-    def __init__(self, address):
+    """Blocking client, calls share the keep-alive connections of one `requests.Session`.
+
+    `max_connections` is the size of the connection pool, `timeout` the
+    connect and read timeout of every call in seconds. The server does not run
+    a call once `timeout` (or the deadline of the request being served, see
+    `pyxtcp.deadline`) passed.
+    """
+
+    def __init__(self, address, timeout=None, max_connections=10):
         self.address = address
         self.address_prefix = "http://" + self.address
+        self.timeout = timeout
 
-    def service_name(self, service_name):
-        return _RPCClientServiceHandler(self, service_name)
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=max_connections))
 
+    def service_name(self, service_name, codec=None, cache=None, cache_methods=None):
+        """`codec` is a registered codec name or id, the JSON form param `v` by default.
 
-class _RPCClientServiceHandler(object):
-    def __init__(self, client, service_name):
-        self._client = client
-        self._service_name = service_name
-        self._server_address_prefix = self._client.address_prefix + "/" + self._service_name
+        With a `pyxtcp.cache.ResultCache` the results of `cache_methods` (names,
+        or a dict of name to TTL) are cached, of every method when not given.
+        """
+        return _RPCClientServiceHandler(self, service_name, codec, cache, cache_methods)
 
-    def ___handler_request(self, func_name, **kwargs):
+    def batch(self, codec=None):
+        """Collect calls and send them in one POST.
 
-        kwargs_v = ""
-        if kwargs:
-            kwargs_v = json.dumps(kwargs)
+            batch = client.batch()
+            batch.service_name("CompanyService").get_company_by_company_id(company_id=1)
+            results = batch.execute()  # [{"s": True, "v": ...}]
+        """
+        return _RPCClientBatch(self, codec)
 
-        server_log.debug("Request To {}.{}({})".format(self._service_name, func_name, kwargs))
+    def post(self, path, codec, payload, deadline=None):
+        """POST `payload` to `path` and return the decoded result.
 
-        request_params = {
-            "v": kwargs_v
-        }
+        `deadline` is the `time.time()` the result is needed by, see `get_call_deadline`.
+        """
 
+        timeout = get_call_timeout(get_call_deadline(self.timeout, deadline), self.address)
+        body, headers = encode_request(codec, payload, timeout)
         try:
-            content = requests.post(
-                self._server_address_prefix + "/" + func_name,
-                data=request_params
-            ).json()
-
-            result = content["v"]
-            status = content["s"]
+            response = self.session.post(self.address_prefix + path, data=body, headers=headers, timeout=timeout)
+        except requests.ConnectionError as e:
+            if _is_connect_error(e):
+                raise RPCConnectError("Connection error {}".format(self.address))
+            raise RPCRequestError("Request invalid")
         except:
             raise RPCRequestError("Request invalid")
 
-        if status:
-            return result
-        raise RPCRequestError("Request Error, %s " % (result,))
+        if response.status_code == 503:
+            raise RPCServerBusyError("Server busy {}".format(self.address))
+        if response.status_code == 504:
+            raise RPCDeadlineExceededError("{} on {}".format(DEADLINE_ERROR_PREFIX, self.address))
+        return decode_response(codec, response.headers.get(RPC_STATUS_HEADER), response.content)
+
+    def close(self):
+        self.session.close()
+
+
+def _is_connect_error(error):
+    """True when the connection could not be opened, the request was not sent."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class _RPCClientBatch(object):
+    def __init__(self, client, codec=None):
+        self._client = client
+        self._codec = None if codec is None else get_codec(codec)
+        self.calls = []
+
+    def service_name(self, service_name):
+        return _RPCBatchServiceHandler(self, service_name)
+
+    def add(self, method, *args, **kwargs):
+        self.calls.append(get_batch_call(method, args, kwargs))
+        return len(self.calls) - 1
+
+    def execute(self):
+        server_log.debug("Batch Request To %s (%d calls)", self._client.address, len(self.calls))
+        return self._client.post(BATCH_PATH, self._codec, self.calls)
+
+
+class _RPCBatchServiceHandler(object):
+    def __init__(self, batch, service_name):
+        self._batch = batch
+        self._service_name = service_name
+
+    def __getattr__(self, func):
+        try:
+            return self.__dict__[func]
+        except KeyError:
+            return functools.partial(self._batch.add, "{}.{}".format(self._service_name, func))
+
+
+class _RPCClientServiceHandler(object):
+    def __init__(self, client, service_name, codec=None, cache=None, cache_methods=None):
+        self._client = client
+        self._service_name = service_name
+        self._codec = None if codec is None else get_codec(codec)
+
+        #: method name -> TTL (None for the cache default) of the cached methods, None caches all
+        self._cache = cache
+        if cache_methods is not None and not isinstance(cache_methods, dict):
+            cache_methods = dict.fromkeys(cache_methods)
+        self._cache_methods = cache_methods
+
+    def ___handler_request(self, func_name, *args, **kwargs):
+        payload = get_call_payload(self._codec, args, kwargs)
+        server_log.debug("Request To %s.%s(%r)", self._service_name, func_name, payload)
+        path = "/{}/{}".format(self._service_name, func_name)
+        if self._cache is None or (self._cache_methods is not None and func_name not in self._cache_methods):
+            return self._client.post(path, self._codec, payload)
+
+        method = "{}.{}/{}".format(self._service_name, func_name, self._codec and self._codec.name)
+        key = make_cache_key(method, payload)
+        ttl = self._cache_methods.get(func_name) if self._cache_methods is not None else None
+        return self._cache.call(key, functools.partial(self._client.post, path, self._codec, payload), ttl)
 
     def __getattr__(self, func):
         try:
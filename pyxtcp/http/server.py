@@ -1,14 +1,25 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+import inspect
 import json
+import time
 import tornado.httpserver
-import tornado.ioloop
 import tornado.web
 import traceback
+from tornado import gen
 from tornado.util import ObjectDict
 
-from .util import server_log
+from ..cache import make_response_key
+from ..codec import get_codec_by_content_type
+from ..deadline import RPCDeadlineExceededError, call_with_deadline
+from ..executor import RPCExecutorBusyError, create_executor, is_awaitable
+from ..metrics import MetricsHandler, get_default_metrics, timer
+from ..process import bind_server_sockets, run_workers, serve_forever
+from .util import BATCH_PATH, METRICS_PATH, RPC_STATUS_HEADER, RPC_TIMEOUT_HEADER, server_log
+
+
+_getargspec = getattr(inspect, "getfullargspec", None) or inspect.getargspec
 
 
 class RPCInputError(Exception):
@@ -19,80 +30,359 @@ class RPCMethodError(Exception):
     pass
 
 
+class _RPCEntry(object):
+    """A registered method and what serving it needs, built once by `RPCServer.add_service`."""
+
+    __slots__ = ("key", "method", "service", "cache", "metrics_labels", "check_arguments")
+
+    def __init__(self, key, method, service=None, cache=None):
+        self.key = key
+        self.method = method
+        #: process pools look `key` up in it
+        self.service = service
+        self.cache = cache
+        self.metrics_labels = (("method", key),)
+        self.check_arguments = _make_arguments_check(key, method)
+
+
+def _make_arguments_check(key, method):
+    """Return `check(args, kwargs)` raising `RPCInputError` when `method` can not take them,
+    None when it is not a plain function."""
+
+    if not inspect.isfunction(method):
+        return None
+    spec = _getargspec(method)
+
+    keywords = getattr(spec, "keywords", None) or getattr(spec, "varkw", None)
+    names = frozenset(spec.args)
+    required = spec.args[:len(spec.args) - len(spec.defaults or ())]
+
+    def _check(args, kwargs):
+        if args:
+            if not (spec.args or spec.varargs) or len(required) > len(args):
+                raise RPCInputError("{}() takes {} arguments, 1 given".format(key, len(required)))
+            return
+        if not keywords:
+            unexpected = [name for name in kwargs if name not in names]
+            if unexpected:
+                raise RPCInputError("{}() got unexpected arguments {}".format(key, ", ".join(sorted(unexpected))))
+        missing = [name for name in required if name not in kwargs]
+        if missing:
+            raise RPCInputError("{}() missing arguments {}".format(key, ", ".join(missing)))
+    return _check
+
+
+#: metrics status of the failed requests by HTTP status
+_ERROR_STATUSES = {503: "busy", 504: "expired"}
+
+
 class _ServerHandler(tornado.web.RequestHandler):
 
-    def initialize(self, service=None):
-        if not service:
-            raise RPCMethodError("service is empty. Please run `RPCServer.add_service`")
+    def initialize(self, routes=None, entries=None, executor=None, rpc_server=None):
+        #: (topic, method) -> `_RPCEntry`, and "Topic.method" -> `_RPCEntry`
+        self._routes = routes
+        self._entries = entries
+        self._executor = executor
+        self._rpc_server = rpc_server
 
-        self._all_service = service
+    def prepare(self):
+        if self._rpc_server is not None:
+            self._rpc_server.start_request()
 
+        #: on the clock of the server from the start of the request
+        self._deadline = None
+        timeout = self.request.headers.get(RPC_TIMEOUT_HEADER)
+        if timeout is not None:
+            try:
+                self._deadline = time.time() + float(timeout)
+            except ValueError:
+                raise RPCInputError("{} header format error".format(RPC_TIMEOUT_HEADER))
+
+    def on_finish(self):
+        if self._rpc_server is not None:
+            self._rpc_server.finish_request()
+
+    @gen.coroutine
     def get(self, topic=None, method=None):
-        kwargs = self.get_argument("v", None)
-        if kwargs is None:
-            raise RPCInputError("params v is required")
+        entry = self._routes.get((topic, method)) or self._rpc_server.index_method("{}.{}".format(topic, method))
+        if entry is None:
+            raise RPCInputError("{}.{} not exist".format(topic, method))
 
-        if kwargs:
-            try:
-                kwargs = json.loads(kwargs)
-            except ValueError as e:
-                raise RPCInputError("params v({}) format error".format(e))
+        #: a body sent with a registered codec content type is the payload itself,
+        #: otherwise the payload is the JSON form param `v`
+        codec = get_codec_by_content_type(self.request.headers.get("Content-Type"))
+        args, kwargs = self._get_payload(codec)
+        server_log.debug("%s(%s)", entry.key, kwargs or args)
 
-        server_log.debug("{topic}.{method}({kwargs})".format(topic=topic, method=method, kwargs=kwargs))
-        exec_method_key = "{}.{}".format(topic, method)
-        exec_method = self._all_service.get_rpc_function(exec_method_key)
+        metrics = self._rpc_server.metrics if self._rpc_server is not None else None
 
-        if not exec_method:
-            raise RPCInputError("{} not exist".format(exec_method_key))
+        #: the responses of cached methods are kept encoded
+        cache = entry.cache
+        if cache is not None:
+            cache_key = make_response_key(entry.key, args[0] if args else kwargs, codec and codec.name)
+            found, body = cache.get(cache_key)
+            if found:
+                if metrics is not None:
+                    metrics.inc("pyxtcp_http_requests_total", entry.metrics_labels + (("status", "cached"),))
+                self._write_body(codec, body, True)
+                return
 
-        def _func():
-            result = None
-            status = True
+        result = None
+        status = True
 
-            try:
-                if kwargs:
-                    result = exec_method(**kwargs)
-                else:
-                    result = exec_method()
-            except:
-                result = traceback.format_exc()
-                status = False
-
-            data = {
+        start_time = timer() if metrics is not None else None
+        try:
+            result = yield self._execute_entry(entry, args, kwargs)
+        except RPCExecutorBusyError as e:
+            self.set_status(503)
+            result = "Server busy: {}".format(e)
+            status = False
+        except RPCDeadlineExceededError as e:
+            #: the client does not wait for the answer anymore
+            self.set_status(504)
+            result = str(e)
+            status = False
+        except:
+            result = traceback.format_exc()
+            status = False
+
+        if metrics is not None:
+            metrics.observe("pyxtcp_http_callback_seconds", timer() - start_time, entry.metrics_labels)
+            metrics.inc("pyxtcp_http_requests_total", entry.metrics_labels + (
+                ("status", "ok" if status else _ERROR_STATUSES.get(self.get_status(), "error")),))
+
+        body = self._encode_result(codec, result, status)
+        if cache is not None and status:
+            cache.set(cache_key, body)
+        self._write_body(codec, body, status)
+
+    def _write_result(self, codec, result, status):
+        self._write_body(codec, self._encode_result(codec, result, status), status)
+
+    def _encode_result(self, codec, result, status):
+        if codec is None:
+            return json.dumps({
                 "v": result,
                 "s": status
-            }
+            })
+        if not status:
+            return result
+
+        body = codec.encode(result)
+        return body if isinstance(body, bytes) else bytes(bytearray(body))
+
+    def _write_body(self, codec, body, status):
+        if codec is not None:
+            self.set_header(RPC_STATUS_HEADER, "1" if status else "0")
+            if status:
+                self.set_header("Content-Type", codec.content_type)
+            else:
+                self.set_header("Content-Type", "text/plain; charset=UTF-8")
+        self.write(body)
+
+    def _get_payload(self, codec):
+        if codec is not None:
+            if not self.request.body:
+                return (), {}
+            try:
+                payload = codec.decode(self.request.body)
+            except Exception as e:
+                raise RPCInputError("{} body format error({})".format(codec.name, e))
+            if isinstance(payload, dict):
+                return (), payload
+            return (payload,), {}
+
+        kwargs = self.get_argument("v", None)
+        if kwargs is None:
+            raise RPCInputError("params v is required")
+        if not kwargs:
+            return (), {}
+
+        try:
+            kwargs = json.loads(kwargs)
+        except ValueError as e:
+            raise RPCInputError("params v({}) format error".format(e))
+        return (), kwargs or {}
 
-            return json.dumps(data)
+    @gen.coroutine
+    def _execute_entry(self, entry, args, kwargs):
+        if entry.check_arguments is not None:
+            entry.check_arguments(args, kwargs)
 
-        return self.write(_func())
+        #: a call past its deadline, also after waiting for a worker, is not run
+        if self._executor is not None:
+            result = yield self._executor.submit_call(
+                self._deadline, entry.method, args, kwargs, service=entry.service, func_key=entry.key)
+        else:
+            result = call_with_deadline(self._deadline, entry.method, args, kwargs)
+
+        if is_awaitable(result):
+            result = yield result
+        raise gen.Return(result)
 
     def post(self, topic=None, method=None):
         return self.get(topic, method)
 
 
+class _BatchHandler(_ServerHandler):
+    """`/__batch__` runs a list of `{"method": "Topic.method", "kwargs": {...}}` calls.
+
+    The calls run in parallel on the executor (the coroutines among them
+    concurrently in any case), the result is the list of their
+    `{"s": status, "v": result or error}`.
+    """
+
+    @gen.coroutine
+    def get(self):
+        codec = get_codec_by_content_type(self.request.headers.get("Content-Type"))
+        args, kwargs = self._get_payload(codec)
+        calls = args[0] if args else kwargs
+        if not isinstance(calls, list):
+            raise RPCInputError("batch payload must be a list of calls")
+
+        server_log.debug("batch of %d calls", len(calls))
+        results = yield [self._execute_call(call) for call in calls]
+        self._write_result(codec, results, True)
+
+    @gen.coroutine
+    def _execute_call(self, call):
+        try:
+            entry = self._entries.get(call["method"]) or self._rpc_server.index_method(call["method"])
+            if entry is None:
+                raise RPCInputError("{} not exist".format(call["method"]))
+            result = yield self._execute_entry(entry, (), call.get("kwargs") or {})
+        except Exception:
+            raise gen.Return({"s": False, "v": traceback.format_exc()})
+        raise gen.Return({"s": True, "v": result})
+
+    def post(self):
+        return self.get()
+
+
 class RPCServer:
-    def __init__(self, port, address="0.0.0.0", debug=False):
+    def __init__(self, port, address="0.0.0.0", debug=False,
+                 executor=None, executor_max_workers=None, executor_max_queue_size=None, metrics=None):
         self._server_host = address
         self._server_port = port
 
+        #: run service methods in a "thread" or "process" pool instead of on the IOLoop
+        self.executor = create_executor(
+            executor, max_workers=executor_max_workers, max_queue_size=executor_max_queue_size)
+
         self.settings = ObjectDict(dict(
             debug=debug,
             gzip=True))
 
+        self._server = None
+        self._inflight_count = 0
+
+        self._services = []
+        #: dispatch index of the methods of every service, see `add_service`
+        self._routes = {}
+        self._entries = {}
+
+        #: `pyxtcp.metrics.Metrics` of the requests, served at `METRICS_PATH`; None measures nothing
+        self.metrics = metrics if metrics is not None else get_default_metrics()
+        if self.metrics is not None:
+            self.metrics.gauge_callback("pyxtcp_http_requests_inflight", lambda: self._inflight_count)
+
     def add_service(self, service):
-        self._server_urls = [
-            ("/([^/]*)/([^/]*)", _ServerHandler, dict(service=service)),
-            ("/", _ServerHandler, dict(service=service)),
+        """Serve the methods of `service`, several services can be added.
+
+        The methods are indexed once here, the ones registered later (or
+        lazily, see `Service.register_lazy`) on their first call. A method
+        registered by two services is an error.
+        """
+
+        if any(added is service for added in self._services):
+            return
+
+        entries = {}
+        for key in service.get_all_rpc_functions():
+            if key in self._entries:
+                raise RPCMethodError("{} is registered by two services".format(key))
+            entries[key] = _RPCEntry(key, service.get_rpc_function(key), service, service.get_rpc_cache(key))
+
+        if self.executor is not None:
+            self.executor.register(service)
+        self._services.append(service)
+        for entry in entries.values():
+            self._add_entry(entry)
+
+    def index_method(self, key):
+        """Index and return the entry of the method `key` not indexed yet, None when no service has it."""
+
+        for service in self._services:
+            method = service.get_rpc_function(key)
+            if method is not None:
+                entry = _RPCEntry(key, method, service, service.get_rpc_cache(key))
+                self._add_entry(entry)
+                return entry
+
+    def _add_entry(self, entry):
+        topic, _, method = entry.key.rpartition(".")
+        self._entries[entry.key] = entry
+        self._routes[(topic, method)] = entry
+
+    def _get_server_urls(self):
+        if not self._services:
+            raise RPCMethodError("service is empty. Please run `RPCServer.add_service`")
+
+        handler_kwargs = dict(routes=self._routes, entries=self._entries, executor=self.executor, rpc_server=self)
+        server_urls = [] if self.metrics is None else [
+            (METRICS_PATH, MetricsHandler, dict(metrics=self.metrics)),
+        ]
+        return server_urls + [
+            (BATCH_PATH, _BatchHandler, handler_kwargs),
+            ("/([^/]*)/([^/]*)", _ServerHandler, handler_kwargs),
+            ("/", _ServerHandler, handler_kwargs),
         ]
 
     def _get_application(self):
-        return tornado.web.Application(self._server_urls, **self.settings)
+        return tornado.web.Application(self._get_server_urls(), **self.settings)
+
+    def start_request(self):
+        self._inflight_count += 1
+
+    def finish_request(self):
+        self._inflight_count -= 1
+
+    def start_draining(self):
+        """Stop accepting connections, running requests finish."""
+        self._server.stop()
+
+    def is_drained(self):
+        return self._inflight_count <= 0
+
+    def run(self, num_workers=1, reuse_port=False, max_restarts=100, shutdown_timeout=30):
+        """Start the server, optionally in `num_workers` pre-forked processes.
+
+        The sockets are bound once in the parent and shared by the workers, or
+        bound by every worker with SO_REUSEPORT when `reuse_port` is set.
+        `num_workers` None or 0 starts one worker per CPU. Crashed workers are
+        restarted; SIGTERM/SIGINT stop accepting connections and let running
+        requests finish for at most `shutdown_timeout` seconds.
+        """
+
+        server_log.debug("Start(Debug: {}, Workers: {}) : {}:{}".format(
+            self.settings.debug, num_workers, self._server_host, self._server_port))
+
+        if num_workers == 1:
+            self._serve(bind_server_sockets(self._server_port, self._server_host, reuse_port), shutdown_timeout)
+            return
+
+        if self.settings.debug:
+            raise RPCMethodError("debug mode (autoreload) can not run multiple workers")
+
+        sockets = None if reuse_port else bind_server_sockets(self._server_port, self._server_host)
+
+        def _worker(task_id):
+            worker_sockets = sockets or bind_server_sockets(self._server_port, self._server_host, reuse_port=True)
+            self._serve(worker_sockets, shutdown_timeout)
 
-    def run(self):
-        server = tornado.httpserver.HTTPServer(self._get_application())
-        server.listen(port=self._server_port, address=self._server_host)
+        run_workers(num_workers, _worker, max_restarts=max_restarts)
 
-        server_log.debug("Start(Debug: {}) : {}:{}".format(
-            self.settings.debug, self._server_host, self._server_port))
-        tornado.ioloop.IOLoop.current().start()
+    def _serve(self, sockets, shutdown_timeout):
+        self._server = tornado.httpserver.HTTPServer(self._get_application())
+        self._server.add_sockets(sockets)
+        serve_forever(self.start_draining, self.is_drained, shutdown_timeout)
@@ -1,7 +1,140 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+import json
 import logging
+import time
+
+from .. import deadline
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
 log = logging.getLogger("pyxtcp")
 server_log = logging.getLogger("pyxtcp.server")
 service_log = logging.getLogger("pyxtcp.service")
+
+#: "1" or "0", answers to codec encoded requests carry the bare result
+RPC_STATUS_HEADER = "X-RPC-Status"
+
+#: seconds the client still waits for the answer, the server does not run the call
+#: once they are over and answers 504 (see `pyxtcp.deadline`)
+RPC_TIMEOUT_HEADER = "X-RPC-Timeout"
+
+#: POSTed a list of calls, see `pyxtcp.http.server._BatchHandler`
+BATCH_PATH = "/__batch__"
+
+#: Prometheus text of `RPCServer.metrics`, when it has metrics
+METRICS_PATH = "/__metrics__"
+
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded"
+
+
+class RPCRequestError(Exception):
+    pass
+
+
+class RPCCallError(RPCRequestError):
+    """The server ran the call and it failed."""
+
+
+class RPCConnectError(RPCRequestError):
+    """The request was not sent, no connection to the server could be opened."""
+
+
+class RPCServerBusyError(RPCRequestError):
+    """The server answered 503 without running the call, it can be sent to another server."""
+
+
+class RPCDeadlineExceededError(RPCRequestError, deadline.RPCDeadlineExceededError):
+    """The deadline of the call passed before it was sent or before the server ran it (504)."""
+
+
+def get_call_deadline(timeout, call_deadline=None):
+    """`time.time()` deadline of a call: the earliest of `call_deadline`, `timeout`
+    seconds from now and the deadline of the request being served, None without any."""
+
+    timeout = deadline.get_timeout(timeout)
+    if timeout is not None:
+        timeout_deadline = time.time() + timeout
+        call_deadline = timeout_deadline if call_deadline is None else min(call_deadline, timeout_deadline)
+    return call_deadline
+
+
+def get_call_timeout(call_deadline, address):
+    """Seconds left before `call_deadline`, raise `RPCDeadlineExceededError` when it passed."""
+
+    if call_deadline is None:
+        return None
+    timeout = call_deadline - time.time()
+    if timeout <= 0:
+        raise RPCDeadlineExceededError("{} before sending to {}".format(deadline.DEADLINE_ERROR_PREFIX, address))
+    return timeout
+
+
+def get_call_payload(codec, args, kwargs):
+    """Payload of a call: its keyword arguments, or with `codec` its only positional
+    argument; anything else raises `TypeError` rather than being dropped."""
+
+    if not args:
+        return kwargs
+    if codec is None:
+        raise TypeError("positional arguments need a codec, the JSON form only sends keyword arguments")
+    if len(args) > 1 or kwargs:
+        raise TypeError("a call takes one positional argument (the payload) or keyword arguments, not both")
+    return args[0]
+
+
+def get_batch_call(method, args, kwargs):
+    """A call of a batch, which only sends keyword arguments."""
+
+    if args:
+        raise TypeError("batch calls take keyword arguments only, {} got positional ones".format(method))
+    return {"method": method, "kwargs": kwargs}
+
+
+def encode_request(codec, payload, timeout=None):
+    """Return the body and headers POSTing `payload`, as the JSON form param `v` when `codec` is None.
+
+    `timeout` is sent as the `RPC_TIMEOUT_HEADER`.
+    """
+
+    if codec is None:
+        body = urlencode({"v": json.dumps(payload) if payload else ""}).encode("ascii")
+        headers = {"Content-Type": FORM_CONTENT_TYPE}
+    else:
+        body = b"" if payload == {} else codec.encode(payload)
+        headers = {"Content-Type": codec.content_type}
+
+    if timeout is not None:
+        headers[RPC_TIMEOUT_HEADER] = "{:.3f}".format(timeout)
+    return body, headers
+
+
+def decode_response(codec, status, content):
+    """Return the result in the response `content`, raise `RPCRequestError` on a failed call.
+
+    `status` is the `RPC_STATUS_HEADER` of the response, only used with a codec.
+    """
+
+    if codec is None:
+        try:
+            data = json.loads(content)
+            result, status = data["v"], data["s"]
+        except:
+            raise RPCRequestError("Request invalid")
+
+        if status:
+            return result
+        raise RPCCallError("Request Error, %s " % (result,))
+
+    if status == "1":
+        try:
+            return codec.decode(content)
+        except:
+            raise RPCRequestError("Request invalid")
+    if status == "0":
+        raise RPCCallError("Request Error, %s " % (content.decode("utf-8", "replace"),))
+    raise RPCRequestError("Request invalid")
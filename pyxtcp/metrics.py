@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Counters, gauges and latency histograms of the servers and clients.
+
+Nothing is measured unless a `Metrics` is given to a server or client
+(``metrics=``) or made the default with `enable_metrics` before they are
+created; the hot paths then only test ``metrics is not None``.
+"""
+
+import bisect
+import threading
+import time
+
+import tornado.httpserver
+import tornado.web
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+
+#: seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#: label values beyond `Metrics.max_label_sets` of one metric are replaced by it
+OTHER_LABEL = "__other__"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+#: help of the metrics of the servers and clients
+METRICS_HELP = {
+    "pyxtcp_server_connections": "Open connections of the TCP server",
+    "pyxtcp_server_rejected_connections_total": "TCP connections over max_connections answered busy",
+    "pyxtcp_server_requests_inflight": "TCP requests running the server callback",
+    "pyxtcp_server_read_pauses_total": "Pauses of the TCP request reads for a full write buffer",
+    "pyxtcp_server_requests_total": "TCP requests by method and status",
+    "pyxtcp_server_header_read_seconds": "Header read time of the first request of the TCP connections",
+    "pyxtcp_server_body_read_seconds": "TCP request body read time",
+    "pyxtcp_server_callback_seconds": "TCP server callback time",
+    "pyxtcp_server_write_seconds": "Time to flush the TCP responses",
+    "pyxtcp_http_requests_inflight": "HTTP requests being served",
+    "pyxtcp_http_requests_total": "HTTP requests by method and status",
+    "pyxtcp_http_callback_seconds": "HTTP service method time",
+    "pyxtcp_client_connections": "Client connections by state",
+    "pyxtcp_client_queued_requests": "Client requests waiting for a connection",
+    "pyxtcp_client_queue_wait_seconds": "Time waiting for a free connection",
+    "pyxtcp_client_connect_seconds": "Time to open a connection",
+    "pyxtcp_client_requests_total": "Client requests by method and status",
+    "pyxtcp_client_request_seconds": "Client request time, from the call to the response",
+}
+
+#: monotonic clock of the durations
+timer = getattr(time, "perf_counter", time.time)
+
+
+class _Histogram(object):
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Metrics(object):
+    """Registry of metrics by name and labels.
+
+    `labels` are a tuple of `(name, value)` pairs. A metric keeps at most
+    `max_label_sets` distinct label sets, the values of the next ones become
+    `OTHER_LABEL` (topics come from the peers).
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, max_label_sets=1000):
+        self.buckets = tuple(buckets)
+        self.max_label_sets = max_label_sets
+
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = dict(METRICS_HELP)
+        #: name -> {labels: value}
+        self._values = {}
+        #: name -> {labels: function returning the value}
+        self._callbacks = {}
+
+    def describe(self, name, type_, help_):
+        self._types[name] = type_
+        self._help[name] = help_
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            values = self._metric_values(name, "counter")
+            labels = self._check_labels(values, labels)
+            values[labels] = values.get(labels, 0) + value
+
+    def set_gauge(self, name, value, labels=()):
+        with self._lock:
+            values = self._metric_values(name, "gauge")
+            values[self._check_labels(values, labels)] = value
+
+    def gauge_callback(self, name, func, labels=()):
+        """The gauge is `func()` when collected, until `remove_gauge_callback`."""
+        with self._lock:
+            self._types.setdefault(name, "gauge")
+            self._callbacks.setdefault(name, {})[labels] = func
+
+    def remove_gauge_callback(self, name, labels=(), func=None):
+        """Forget the gauge, when given only while it is still `func` (another
+        object may have registered the same labels since)."""
+        with self._lock:
+            funcs = self._callbacks.get(name, {})
+            if labels in funcs and (func is None or funcs[labels] is func):
+                del funcs[labels]
+                if not funcs:
+                    del self._callbacks[name]
+
+    def observe(self, name, value, labels=()):
+        with self._lock:
+            values = self._metric_values(name, "histogram")
+            labels = self._check_labels(values, labels)
+            histogram = values.get(labels)
+            if histogram is None:
+                histogram = values[labels] = _Histogram(len(self.buckets) + 1)
+            histogram.counts[bisect.bisect_left(self.buckets, value)] += 1
+            histogram.sum += value
+            histogram.count += 1
+
+    def snapshot(self):
+        """Return `{name: [(labels dict, value)]}`, a histogram value is a dict of
+        its cumulative `buckets` (upper bound -> count), `sum` and `count`."""
+
+        with self._lock:
+            items = [(name, list(values.items())) for name, values in self._values.items()]
+            callbacks = [(name, list(funcs.items())) for name, funcs in self._callbacks.items()]
+
+        result = {}
+        for name, values in items:
+            result[name] = [(dict(labels), self._snapshot_value(value)) for labels, value in values]
+        for name, funcs in callbacks:
+            result.setdefault(name, []).extend((dict(labels), func()) for labels, func in funcs)
+        return result
+
+    def render_prometheus(self):
+        """The metrics in the Prometheus text format."""
+
+        lines = []
+        for name, samples in sorted(self.snapshot().items()):
+            type_ = self._types.get(name, "untyped")
+            if name in self._help:
+                lines.append("# HELP {} {}".format(name, self._help[name]))
+            lines.append("# TYPE {} {}".format(name, type_))
+
+            for labels, value in samples:
+                if type_ != "histogram":
+                    lines.append("{}{} {}".format(name, _format_labels(labels), value))
+                    continue
+                for upper_bound, count in value["buckets"]:
+                    lines.append("{}_bucket{} {}".format(
+                        name, _format_labels(labels, ("le", upper_bound)), count))
+                lines.append("{}_sum{} {}".format(name, _format_labels(labels), value["sum"]))
+                lines.append("{}_count{} {}".format(name, _format_labels(labels), value["count"]))
+        return "\n".join(lines) + "\n"
+
+    def _metric_values(self, name, type_):
+        values = self._values.get(name)
+        if values is None:
+            values = self._values[name] = {}
+            self._types.setdefault(name, type_)
+        return values
+
+    def _check_labels(self, values, labels):
+        if labels in values or len(values) < self.max_label_sets:
+            return labels
+        return tuple((key, OTHER_LABEL) for key, _ in labels)
+
+    def _snapshot_value(self, value):
+        if not isinstance(value, _Histogram):
+            return value
+
+        buckets = []
+        count = 0
+        for upper_bound, bucket_count in zip(self.buckets + ("+Inf",), value.counts):
+            count += bucket_count
+            buckets.append((upper_bound, count))
+        return {"buckets": buckets, "sum": value.sum, "count": value.count}
+
+
+def _format_labels(labels, extra=None):
+    items = sorted(labels.items())
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, _escape_label_value(value)) for key, value in items) + "}"
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+_default_metrics = None
+
+
+def enable_metrics(metrics=None):
+    """Make `metrics` (a new `Metrics` by default) the one of the servers and clients created next."""
+    global _default_metrics
+    _default_metrics = metrics if metrics is not None else Metrics()
+    return _default_metrics
+
+
+def disable_metrics():
+    global _default_metrics
+    _default_metrics = None
+
+
+def get_default_metrics():
+    return _default_metrics
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Serves `Metrics.render_prometheus`."""
+
+    def initialize(self, metrics):
+        self._metrics = metrics
+
+    def get(self):
+        self.set_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.write(self._metrics.render_prometheus())
+
+
+def start_metrics_server(metrics, port, address=""):
+    """Serve `metrics` at `http://address:port/metrics` from the current IOLoop."""
+
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([
+        ("/metrics", MetricsHandler, dict(metrics=metrics)),
+    ]))
+    server.listen(port, address)
+    return server
+
+
+class PeriodicExporter(object):
+    """Calls `callback(metrics.snapshot())` every `interval` seconds, to push them elsewhere."""
+
+    def __init__(self, metrics, callback, interval=10, io_loop=None):
+        self.metrics = metrics
+        self.callback = callback
+        self._periodic_callback = PeriodicCallback(
+            self._export, interval * 1000, io_loop=io_loop or IOLoop.current())
+
+    def start(self):
+        self._periodic_callback.start()
+
+    def stop(self):
+        self._periodic_callback.stop()
+
+    def _export(self):
+        self.callback(self.metrics.snapshot())
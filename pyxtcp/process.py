@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import errno
+import logging
+import os
+import signal
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.process import cpu_count
+
+from .transport import bind_local_socket, is_local_address
+
+log = logging.getLogger("pyxtcp")
+
+_SHUTDOWN_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+def bind_server_sockets(port, address=None, reuse_port=False):
+    """Bind the listening sockets once, before the workers are forked.
+
+    With `reuse_port` every worker binds its own socket after the fork instead
+    and the kernel balances new connections between them (SO_REUSEPORT).
+    `port` may be a local address (``unix:///path``, ``shm://name``), whose
+    socket is always shared.
+    """
+    if is_local_address(port):
+        return [bind_local_socket(port)]
+    return bind_sockets(port, address=address or None, reuse_port=reuse_port)
+
+
+def run_workers(num_workers, worker_main, max_restarts=100):
+    """Fork `num_workers` processes running `worker_main(task_id)` and supervise them.
+
+    A worker exiting with an error or killed by a signal is restarted (at most
+    `max_restarts` times in total), a worker exiting cleanly is not. SIGTERM and
+    SIGINT are forwarded to the workers, which drain and exit; the call returns
+    once every worker is gone. `num_workers` None or 0 is one worker per CPU.
+    """
+
+    num_workers = num_workers or cpu_count()
+    children = {}
+    state = {"stopping": False, "restarts": 0}
+
+    def _start_worker(task_id):
+        pid = os.fork()
+        if pid == 0:
+            for signum in _SHUTDOWN_SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+
+            exit_code = 0
+            try:
+                worker_main(task_id)
+            except Exception:
+                log.exception("Worker {} failed".format(task_id))
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        children[pid] = task_id
+
+    def _on_stop_signal(signum, frame):
+        state["stopping"] = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    old_handlers = dict((signum, signal.signal(signum, _on_stop_signal)) for signum in _SHUTDOWN_SIGNALS)
+    try:
+        for task_id in range(num_workers):
+            _start_worker(task_id)
+
+        while children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            if pid not in children:
+                continue
+            task_id = children.pop(pid)
+
+            if state["stopping"]:
+                continue
+
+            if os.WIFSIGNALED(status):
+                log.warning("Worker {} (pid {}) killed by signal {}, restarting".format(
+                    task_id, pid, os.WTERMSIG(status)))
+            elif os.WEXITSTATUS(status) != 0:
+                log.warning("Worker {} (pid {}) exited with status {}, restarting".format(
+                    task_id, pid, os.WEXITSTATUS(status)))
+            else:
+                log.info("Worker {} (pid {}) exited normally".format(task_id, pid))
+                continue
+
+            state["restarts"] += 1
+            if state["restarts"] > max_restarts:
+                _on_stop_signal(signal.SIGTERM, None)
+                raise RuntimeError("Too many worker restarts, giving up")
+            _start_worker(task_id)
+    finally:
+        for signum, handler in old_handlers.items():
+            signal.signal(signum, handler)
+
+
+def serve_forever(stop_accepting, is_drained, shutdown_timeout=30, io_loop=None):
+    """Start the IOLoop until SIGTERM or SIGINT, then shut down gracefully.
+
+    `stop_accepting()` is called first, the loop keeps running until
+    `is_drained()` is true or `shutdown_timeout` seconds passed.
+    """
+
+    io_loop = io_loop or IOLoop.current()
+    state = {"stopping": False}
+
+    def _stop():
+        if state["stopping"]:
+            return
+        state["stopping"] = True
+
+        log.info("Shutting down (pid {}), draining requests".format(os.getpid()))
+        stop_accepting()
+        io_loop.add_future(_drain(is_drained, shutdown_timeout, io_loop), lambda f: io_loop.stop())
+
+    def _on_stop_signal(signum, frame):
+        io_loop.add_callback_from_signal(_stop)
+
+    for signum in _SHUTDOWN_SIGNALS:
+        signal.signal(signum, _on_stop_signal)
+
+    io_loop.start()
+
+
+@gen.coroutine
+def _drain(is_drained, timeout, io_loop, interval=0.05):
+    deadline = io_loop.time() + timeout
+    while not is_drained() and io_loop.time() < deadline:
+        yield gen.sleep(interval)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""The registry of the service methods, the servers of `pyxtcp.http` and
+`pyxtcp.tcp.tornado` look the called methods up in it."""
+
+import functools
+import importlib
+import inspect
+import logging
+import threading
+
+from .cache import invalidate_responses, to_result_cache
+
+log = logging.getLogger("pyxtcp.service")
+
+SERVICE_NAME_SUFFIX = "Service"
+
+
+class RPCServiceError(Exception):
+    pass
+
+
+class Service(object):
+    """Registry of the RPC methods by `<Name>Service.<method>` key, shared by both engines."""
+
+    def __init__(self):
+        self._rpc = dict()
+        #: method key -> `ResultCache` of its encoded responses
+        self._rpc_caches = dict()
+        #: service name -> (import path, cache) of the classes imported on their first call
+        self._lazy_rpc = dict()
+        self._lazy_lock = threading.Lock()
+
+    def _is_valid_service_name(self, service_name):
+        if len(service_name) <= len(SERVICE_NAME_SUFFIX):
+            return False
+        return service_name.endswith(SERVICE_NAME_SUFFIX)
+
+    def _get_rpc_class_name(self, frame):
+        """Name of the innermost `*Service` class body (or function) running in `frame` or its callers."""
+        while frame is not None:
+            if self._is_valid_service_name(frame.f_code.co_name):
+                return frame.f_code.co_name
+            frame = frame.f_back
+
+    def with_f_rpc(self, method=None, cache=None):
+        """Register `method` as `<Name>Service.<method>`.
+
+        `@service.with_f_rpc(cache=60)` also keeps its encoded responses for 60
+        seconds (or in the given `pyxtcp.cache.ResultCache`), keyed on the
+        arguments, hits skip the call and the encoding. `Service.invalidate` or
+        `method.invalidate(**kwargs)` drop them.
+        """
+
+        if method is None:
+            def _decorator(method):
+                return self._register_rpc(method, cache, inspect.currentframe().f_back)
+            return _decorator
+        return self._register_rpc(method, cache, inspect.currentframe().f_back)
+
+    def _register_rpc(self, method, cache, _last_frame):
+        _rpc_class_name = self._get_rpc_class_name(_last_frame)
+        if not _rpc_class_name:
+            raise RPCServiceError("rpc class name must reg r'^(.{1,})Service$', method must is staticmethod or classmethod")
+
+        func_key = "{}.{}".format(_rpc_class_name, method.func_name)
+        self._add_rpc(func_key, method, cache)
+
+        @functools.wraps(method)
+        def _wrapper(*args, **kwrags):
+            return method(*args, **kwrags)
+        _wrapper.invalidate = functools.partial(self.invalidate, func_key)
+        return _wrapper
+
+    def register(self, cls=None, name=None, cache=None):
+        """Register the public staticmethods and classmethods of `cls` as `<name>.<method>`.
+
+            @service.register
+            class CompanyService(object):
+                ...
+
+        `name` is the class name by default, `cache` maps method names to the
+        `cache` of `with_f_rpc`: `@service.register(cache={"get_company": 60})`.
+        Unlike `with_f_rpc` the class is registered without looking at the stack.
+        """
+
+        if cls is None:
+            return functools.partial(self.register, name=name, cache=cache)
+
+        service_name = name or cls.__name__
+        if not self._is_valid_service_name(service_name):
+            raise RPCServiceError("rpc class name must reg r'^(.{1,})Service$'")
+
+        cache = cache or {}
+        for method_name in _get_rpc_method_names(cls):
+            self._add_rpc("{}.{}".format(service_name, method_name), getattr(cls, method_name), cache.get(method_name))
+        return cls
+
+    def register_lazy(self, service_name, import_path, cache=None):
+        """Register the class at `import_path` (`"package.module:ClassName"`, the class
+        is `service_name` without it) with `register` when one of its methods is
+        first looked up, its module is not imported before."""
+
+        self._lazy_rpc[service_name] = (import_path, cache)
+
+    def _add_rpc(self, func_key, method, cache):
+        log.debug("Key: `%s` to rpc list", func_key)
+        self._rpc[func_key] = method
+        if cache is not None:
+            self._rpc_caches[func_key] = to_result_cache(cache)
+
+    def _load_lazy_rpc(self, service_name):
+        with self._lazy_lock:
+            if service_name not in self._lazy_rpc:
+                return
+            import_path, cache = self._lazy_rpc[service_name]
+            module_name, _, class_name = import_path.partition(":")
+            cls = getattr(importlib.import_module(module_name), class_name or service_name)
+            #: the module may have registered the class itself
+            if not any(key.startswith(service_name + ".") for key in self._rpc):
+                self.register(cls, service_name, cache)
+            del self._lazy_rpc[service_name]
+
+    def get_rpc_cache(self, func_key):
+        return self._rpc_caches.get(func_key)
+
+    def invalidate(self, func_key, *args, **kwargs):
+        """Drop the cached responses of `func_key` to these arguments, or all of them without any."""
+
+        cache = self._rpc_caches.get(func_key)
+        if cache is not None:
+            invalidate_responses(cache, func_key, args[0] if args else (kwargs or None))
+
+    def get_rpc_function(self, func_key):
+        if func_key in self._rpc:
+            return self._rpc[func_key]
+
+        if self._lazy_rpc:
+            self._load_lazy_rpc(func_key.rpartition(".")[0])
+            return self._rpc.get(func_key)
+
+    def get_all_rpc_functions(self):
+        return sorted(self._rpc.keys())
+
+
+def _get_rpc_method_names(cls):
+    """Public staticmethods and classmethods of `cls` and its bases."""
+    names = set()
+    for klass in inspect.getmro(cls):
+        for name, value in vars(klass).items():
+            if not name.startswith("_") and isinstance(value, (staticmethod, classmethod)):
+                names.add(name)
+    return sorted(names)
@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+# coding=utf-8
+# flake8: noqa
+
+from .server import RPCServer
+from .client import RPCClient
+from .util import CONNECTION_TYPE_IN_REQUEST, CONNECTION_TYPE_IN_RESPONSE, RPCMessage, install_uvloop
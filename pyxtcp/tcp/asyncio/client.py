@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import asyncio
+import itertools
+
+from ...compression import get_compressor
+from ...transport import ShmChannel, parse_local_address
+from .util import CONNECTION_TYPE_IN_RESPONSE, FRAME_FORMAT_BINARY, FRAME_FORMAT_TEXT, MAX_REQUEST_ID
+from .util import FlowControlMixin, FrameDecoder, RPCConnectionError, RPCInputError, RPCMessage, ShmProtocol
+from .util import add_message_deadline, compress_message, decompress_body, encode_frame, log
+
+
+__all__ = [
+    "RPCClient",
+]
+
+
+class _RPCClientConfig(object):
+    def __init__(self, host, port, connect_timeout=0.2, header_max_bytes=None, body_max_bytes=None,
+                 frame_format=FRAME_FORMAT_TEXT, compression_id=0, compression_threshold=None):
+        self.host = host
+        self.port = port
+        self.address_str = "{},{}".format(self.host, self.port)
+        self.connect_timeout = connect_timeout
+        self.header_max_bytes = header_max_bytes or 1 * 1024  # 1K
+        self.body_max_bytes = body_max_bytes or 10 * 1024 * 1024  # 10M
+        self.frame_format = frame_format
+        self.compression_id = compression_id
+        self.compression_threshold = compression_threshold if compression_threshold is not None else 1024
+
+
+class RPCClient(object):
+    """Send many requests over one persistent connection, like `MultiplexRPCClient`.
+
+        client = RPCClient("127.0.0.1", 8001)
+        response = await client.fetch(RPCMessage(CONNECTION_TYPE_IN_REQUEST, b"topic", b"body"))
+
+    The connection is opened on the first request and again after it closed.
+    `host` may be a local address without `port`, ``unix:///path`` or
+    ``shm://name`` (see `pyxtcp.transport`).
+    """
+
+    def __init__(self, host, port=None, loop=None, connect_timeout=0.2, header_max_bytes=None,
+                 body_max_bytes=None, binary_header=False, compression=None, compression_threshold=None):
+
+        self._loop = loop
+        self.client_config = _RPCClientConfig(
+            host=host,
+            port=port,
+            connect_timeout=connect_timeout,
+            header_max_bytes=header_max_bytes,
+            body_max_bytes=body_max_bytes,
+            frame_format=FRAME_FORMAT_BINARY if binary_header else FRAME_FORMAT_TEXT,
+            compression_id=get_compressor(compression).compression_id if compression else 0,
+            compression_threshold=compression_threshold
+        )
+
+        self._protocol = None
+        self._connect_future = None
+        self._request_ids = itertools.count(1)
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    async def fetch(self, message, timeout=None):
+        """Send `message` and return the response `RPCMessage`, its request id is set here.
+
+        A `timeout` is also sent to the server, which drops the request once it is over.
+        """
+
+        protocol = await self._connect()
+        request_id = self._next_request_id()
+        tube = RPCMessage(message.type_, message.topic, message.body, request_id, message.flags)
+        if self.client_config.compression_id:
+            tube = compress_message(tube, self.client_config.compression_id, self.client_config.compression_threshold)
+        if timeout is not None:
+            tube = add_message_deadline(tube, timeout)
+
+        future = protocol.send(tube)
+        await protocol.drain()
+        if timeout is None:
+            return await future
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            protocol.forget(request_id)
+            raise
+
+    def close(self):
+        if self._protocol is not None:
+            self._protocol.close()
+            self._protocol = None
+
+    def _next_request_id(self):
+        request_id = next(self._request_ids)
+        if request_id > MAX_REQUEST_ID:
+            self._request_ids = itertools.count(1)
+            request_id = next(self._request_ids)
+        return request_id
+
+    async def _connect(self):
+        if self._protocol is not None and not self._protocol.is_closed():
+            return self._protocol
+
+        #: concurrent first requests share one connection attempt
+        if self._connect_future is None:
+            self._connect_future = self.loop.create_task(self._open_connection())
+        try:
+            return await asyncio.shield(self._connect_future)
+        finally:
+            if self._connect_future is not None and self._connect_future.done():
+                self._connect_future = None
+
+    async def _open_connection(self):
+        local_address = parse_local_address(self.client_config.host)
+        channel = None
+        if local_address is None:
+            connection = self.loop.create_connection(
+                lambda: _ClientProtocol(self.client_config), self.client_config.host, self.client_config.port)
+        else:
+            channel = ShmChannel.for_address(local_address)
+            connection = self.loop.create_unix_connection(
+                lambda: _create_local_protocol(self.client_config, channel), local_address.path)
+        try:
+            _, protocol = await asyncio.wait_for(connection, self.client_config.connect_timeout)
+        except (asyncio.TimeoutError, OSError):
+            if channel is not None:
+                channel.close()
+            raise RPCConnectionError("Connection Timeout {}".format(self.client_config.address_str))
+
+        if isinstance(protocol, ShmProtocol):
+            protocol = protocol.protocol
+
+        log.debug(u"Connection Success {}".format(self.client_config.address_str))
+        self._protocol = protocol
+        return protocol
+
+
+def _create_local_protocol(client_config, channel):
+    if channel is None:
+        return _ClientProtocol(client_config)
+    return ShmProtocol(_ClientProtocol(client_config), channel)
+
+
+class _ClientProtocol(FlowControlMixin, asyncio.Protocol):
+    def __init__(self, client_config):
+        self.client_config = client_config
+
+        self.transport = None
+        self._decoder = FrameDecoder(
+            CONNECTION_TYPE_IN_RESPONSE, client_config.header_max_bytes, client_config.body_max_bytes,
+            frame_format=client_config.frame_format)
+        self._is_closed = False
+
+        #: request id -> Future of the response
+        self._pending = {}
+
+    def is_closed(self):
+        return self._is_closed
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        log.debug("Connection close {}".format(self.client_config.address_str))
+        self._fail_pending(RPCConnectionError("Connection closed {}".format(self.client_config.address_str)))
+        self._wake_drain_waiter(RPCConnectionError("Connection closed {}".format(self.client_config.address_str)))
+
+    def data_received(self, data):
+        try:
+            messages = self._decoder.feed(data)
+        except RPCInputError as e:
+            log.error(e.error)
+            self._fail_pending(RPCConnectionError(e.error))
+            return
+
+        for message in messages:
+            future = self._pending.pop(message.request_id, None)
+            if future is None or future.done():
+                log.debug("Response for unknown request id %s", message.request_id)
+                continue
+            try:
+                message.body = decompress_body(message.body, message.flags, self.client_config.body_max_bytes)
+            except RPCInputError as e:
+                future.set_exception(RPCConnectionError(e.error))
+            else:
+                future.set_result(message)
+
+    def send(self, tube):
+        future = asyncio.get_event_loop().create_future()
+        if self._is_closed:
+            future.set_exception(RPCConnectionError("Connection closed {}".format(self.client_config.address_str)))
+            return future
+
+        self._pending[tube.request_id] = future
+        for chunk in encode_frame(tube, self.client_config.frame_format):
+            self.transport.write(chunk)
+        return future
+
+    def forget(self, request_id):
+        self._pending.pop(request_id, None)
+
+    def _fail_pending(self, error):
+        self.close()
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def close(self):
+        if not self._is_closed:
+            self._is_closed = True
+            self.transport.close()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import asyncio
+import collections
+import inspect
+import signal
+import traceback
+
+from .util import CONNECTION_TYPE_IN_REQUEST, CONNECTION_TYPE_IN_RESPONSE, FLAG_CODEC_MASK, FLAG_COMPRESSION_MASK
+from .util import PING_TOPIC, RESPONSE_ERROR_TAG, RESPONSE_SUCCESS_TAG
+from .util import FrameDecoder, RPCInputError, RPCMessage, ShmProtocol
+from .util import compress_message, decompress_body, encode_frame, install_uvloop, log
+from ...deadline import RPCDeadlineExceededError, call_with_deadline
+from ...transport import ShmChannel, bind_local_socket, is_local_address
+
+
+__all__ = [
+    "RPCServer", "RPCInputError",
+]
+
+
+class _ServerConfig(object):
+    def __init__(self, header_max_bytes=None, body_max_bytes=None,
+                 keep_alive=False, keep_alive_timeout=None, compression_threshold=None):
+        self.header_max_bytes = header_max_bytes or 1 * 1024  # 1K
+        self.body_max_bytes = body_max_bytes or 10 * 1024 * 1024  # 10M
+        self.keep_alive = keep_alive
+        self.keep_alive_timeout = keep_alive_timeout or 60  # 60s
+        self.compression_threshold = compression_threshold if compression_threshold is not None else 1024
+
+
+class RPCServer(object):
+    """`asyncio.Protocol` server speaking the frame format of the Tornado `RPCServer`.
+
+    `server_callback(message)` gets an `RPCMessage` with bytes topic and body
+    and returns the response body, or an awaitable of it. Version 1 requests
+    are answered in order, version 2 and binary ones concurrently. A
+    `concurrent.futures` `executor` runs the callbacks off the event loop.
+    Requests sent with a deadline (`FLAG_DEADLINE`) are answered with a
+    "Deadline exceeded" error instead of running once it is over.
+    """
+
+    def __init__(self, server_callback, loop=None, read_header_max_bytes=None, read_body_max_bytes=None,
+                 keep_alive=False, keep_alive_timeout=None, executor=None, compression_threshold=None):
+
+        self._loop = loop
+        self.server_callback = server_callback
+        self.server_config = _ServerConfig(
+            header_max_bytes=read_header_max_bytes,
+            body_max_bytes=read_body_max_bytes,
+            keep_alive=keep_alive,
+            keep_alive_timeout=keep_alive_timeout,
+            compression_threshold=compression_threshold
+        )
+        self.executor = executor
+
+        self._server = None
+        self._connections = set()
+        self._is_draining = False
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    async def listen(self, port, address=None, reuse_port=None, sock=None):
+        """`port` may be a local address (``unix:///path``, ``shm://name``, see `pyxtcp.transport`)."""
+        if is_local_address(port):
+            self._server = await self.loop.create_unix_server(
+                lambda: ShmProtocol(_ServerProtocol(self), ShmChannel(False)), sock=bind_local_socket(port))
+        elif sock is not None:
+            self._server = await self.loop.create_server(lambda: _ServerProtocol(self), sock=sock)
+        else:
+            self._server = await self.loop.create_server(
+                lambda: _ServerProtocol(self), host=address or None, port=port, reuse_port=reuse_port)
+        return self._server
+
+    def run(self, port, address=None, use_uvloop=True, shutdown_timeout=30):
+        """Listen and run the event loop until SIGTERM or SIGINT, then drain.
+
+        Runs on uvloop when `use_uvloop` is set and uvloop is installed.
+        """
+
+        if use_uvloop and install_uvloop():
+            log.debug("Running on uvloop")
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+        loop = self._loop
+        loop.run_until_complete(self.listen(port, address))
+
+        stop_event = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop_event.set)
+        loop.run_until_complete(stop_event.wait())
+
+        self.start_draining()
+        loop.run_until_complete(self._drain(shutdown_timeout))
+
+    def start_draining(self):
+        """Stop accepting connections and close the idle ones, running requests finish."""
+
+        self._is_draining = True
+        if self._server is not None:
+            self._server.close()
+        for connection in list(self._connections):
+            connection.close_if_idle()
+
+    def is_draining(self):
+        return self._is_draining
+
+    def is_drained(self):
+        return not self._connections
+
+    async def _drain(self, timeout, interval=0.05):
+        deadline = self.loop.time() + timeout
+        while not self.is_drained() and self.loop.time() < deadline:
+            await asyncio.sleep(interval)
+
+
+class _ServerProtocol(asyncio.Protocol):
+
+    def __init__(self, server):
+        self.server = server
+        self.server_config = server.server_config
+        self._loop = server.loop
+
+        self.transport = None
+        self._decoder = FrameDecoder(
+            CONNECTION_TYPE_IN_REQUEST, self.server_config.header_max_bytes, self.server_config.body_max_bytes)
+        self._is_closing = False
+        self._inflight_count = 0
+        self._idle_handle = None
+        self._last_activity = None
+
+        #: version 1 requests have no id, they are answered one after another
+        self._serial_messages = collections.deque()
+        self._serial_task = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server._connections.add(self)
+        self._last_activity = self._loop.time()
+        self._schedule_idle_timeout(self.server_config.keep_alive_timeout)
+
+    def connection_lost(self, exc):
+        self._is_closing = True
+        self.server._connections.discard(self)
+        self._cancel_idle_timeout()
+
+    def pause_writing(self):
+        #: the peer does not read its responses, stop reading its requests
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def data_received(self, data):
+        if self._is_closing:
+            return
+        self._last_activity = self._loop.time()
+
+        try:
+            messages = self._decoder.feed(data)
+        except RPCInputError as e:
+            log.error(e.error)
+            self._write(RPCMessage(CONNECTION_TYPE_IN_RESPONSE, RESPONSE_ERROR_TAG, e.error))
+            self.close()
+            return
+
+        for message in messages:
+            if message.request_id is not None:
+                pending = self._on_request(message)
+                if pending is not None:
+                    self._loop.create_task(pending)
+            else:
+                self._serial_messages.append(message)
+                if self._serial_task is None:
+                    self._serial_task = self._loop.create_task(self._handle_serial_messages())
+
+    async def _handle_serial_messages(self):
+        try:
+            while self._serial_messages and not self._is_closing:
+                pending = self._on_request(self._serial_messages.popleft())
+                if pending is not None:
+                    await pending
+                if not self.server_config.keep_alive or self.server.is_draining():
+                    self.close()
+        finally:
+            self._serial_task = None
+
+    def _on_request(self, message):
+        """Answer `message`, returns a coroutine to run when the callback is asynchronous.
+
+        Synchronous callbacks are answered right away, without scheduling a task.
+        """
+
+        if message.topic == PING_TOPIC:
+            self._write(RPCMessage(CONNECTION_TYPE_IN_RESPONSE, RESPONSE_SUCCESS_TAG, b"", message.request_id))
+            return None
+
+        try:
+            message.body = decompress_body(message.body, message.flags, self.server_config.body_max_bytes)
+
+            #: a request past its deadline, also after waiting for a worker, is not run
+            if self.server.executor is not None:
+                result = self._loop.run_in_executor(
+                    self.server.executor, call_with_deadline, message.deadline, self.server.server_callback, (message,))
+            else:
+                result = call_with_deadline(message.deadline, self.server.server_callback, (message,))
+        except RPCDeadlineExceededError as e:
+            self._write_error(message, str(e))
+            return None
+        except Exception:
+            self._write_error(message)
+            return None
+
+        if inspect.isawaitable(result):
+            return self._finish_request(message, result)
+        self._write_response(message, result)
+        return None
+
+    async def _finish_request(self, message, result):
+        self._inflight_count += 1
+        try:
+            result = await result
+        except RPCDeadlineExceededError as e:
+            self._write_error(message, str(e))
+        except Exception:
+            self._write_error(message)
+        else:
+            self._write_response(message, result)
+        finally:
+            self._inflight_count -= 1
+            self._last_activity = self._loop.time()
+
+        if self.server.is_draining():
+            self.close_if_idle()
+
+    def _write_response(self, message, result):
+        response = RPCMessage(CONNECTION_TYPE_IN_RESPONSE, RESPONSE_SUCCESS_TAG, result or b"",
+                              message.request_id, message.flags & FLAG_CODEC_MASK)
+        self._write(compress_message(
+            response, message.flags & FLAG_COMPRESSION_MASK, self.server_config.compression_threshold))
+
+    def _write_error(self, message, error=None):
+        self._write(RPCMessage(CONNECTION_TYPE_IN_RESPONSE, RESPONSE_ERROR_TAG,
+                               error or traceback.format_exc(), message.request_id))
+
+    def _write(self, tube):
+        if self._is_closing or self.transport is None:
+            return
+        for chunk in encode_frame(tube, self._decoder.frame_format):
+            self.transport.write(chunk)
+
+    def _is_idle(self):
+        return not self._inflight_count and not self._serial_messages and not self._decoder.has_buffered_data()
+
+    def _schedule_idle_timeout(self, delay):
+        self._idle_handle = self._loop.call_later(delay, self._on_idle_timeout)
+
+    def _on_idle_timeout(self):
+        #: one timer per connection, pushed back by the activity since it was set
+        idle_time = self._loop.time() - self._last_activity
+        if idle_time >= self.server_config.keep_alive_timeout and self._is_idle():
+            self.close()
+        else:
+            self._schedule_idle_timeout(max(self.server_config.keep_alive_timeout - idle_time, 0.1))
+
+    def _cancel_idle_timeout(self):
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def close_if_idle(self):
+        if self._is_idle():
+            self.close()
+
+    def close(self):
+        if not self._is_closing:
+            self._is_closing = True
+            self._cancel_idle_timeout()
+            self.transport.close()
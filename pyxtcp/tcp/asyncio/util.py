@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Frame format of `pyxtcp.tcp.tornado.util`, for Python 3 and asyncio."""
+
+import asyncio
+import logging
+import struct
+import time
+
+from ...compression import RPCCompressionError, get_compressor
+from ...transport import RPCTransportError
+
+log = logging.getLogger("pyxtcp")
+
+
+CONNECTION_TYPE_IN_REQUEST = "req"
+CONNECTION_TYPE_IN_RESPONSE = "res"
+CONNECTION_PREFIX = {
+    CONNECTION_TYPE_IN_REQUEST: b"-",
+    CONNECTION_TYPE_IN_RESPONSE: b"="
+}
+MULTIPLEX_CONNECTION_PREFIX = {
+    CONNECTION_TYPE_IN_REQUEST: b"+",
+    CONNECTION_TYPE_IN_RESPONSE: b"*"
+}
+
+HEADER_DELIMITER = b"\"r\"n"
+HEADER_ITEM_DELIMITER = b"\"t"
+BODY_SUFFIX = b"\"r\"n"
+
+MAX_REQUEST_ID = 2 ** 32 - 1
+
+FRAME_FORMAT_TEXT = "text"
+FRAME_FORMAT_BINARY = "binary"
+
+BINARY_MAGIC = b"\xb7X"
+BINARY_PROTOCOL_VERSION = 1
+BINARY_CONNECTION_TYPE = {
+    CONNECTION_TYPE_IN_REQUEST: 0,
+    CONNECTION_TYPE_IN_RESPONSE: 1
+}
+BINARY_HEADER = struct.Struct("!2sBBHIHI")
+BINARY_HEADER_SIZE = BINARY_HEADER.size
+
+FLAG_CODEC_MASK = 0xff00
+FLAG_COMPRESSION_MASK = 0x07
+FLAG_COMPRESSED = 0x08
+
+#: a request whose body starts with `DEADLINE_HEADER`, the milliseconds the client
+#: still waits for the answer, outside of the compressed body (see `pyxtcp.deadline`)
+FLAG_DEADLINE = 0x80
+DEADLINE_HEADER = struct.Struct("!I")
+MAX_DEADLINE_MILLISECONDS = 2 ** 32 - 1
+
+RESPONSE_SUCCESS_TAG = b"S"
+RESPONSE_ERROR_TAG = b"E"
+
+PING_TOPIC = b"__ping__"
+
+#: bodies from this size on are written as their own buffer
+ZERO_COPY_THRESHOLD = 4 * 1024  # 4K
+
+
+class RPCInputError(Exception):
+    def __init__(self, error):
+        super(RPCInputError, self).__init__(error)
+        self.error = error
+
+
+class RPCConnectionError(Exception):
+    def __init__(self, error):
+        super(RPCConnectionError, self).__init__(error)
+        self.error = error
+
+
+class RPCMessage(object):
+    def __init__(self, type_, topic, body, request_id=None, flags=0):
+        self.type_ = type_
+        self.topic = topic
+        self.body = body
+
+        #: a message with a request id is sent as a version 2 (multiplexed) frame
+        self.request_id = request_id
+        self.flags = flags
+
+        #: `time.time()` deadline of a received `FLAG_DEADLINE` request, None without one
+        self.deadline = None
+
+
+def _to_bytes(value):
+    return value.encode("utf-8") if isinstance(value, str) else value
+
+
+def encode_frame(tube, frame_format=FRAME_FORMAT_TEXT):
+    """Encode `tube` as a list of buffers, large bodies are not copied."""
+
+    topic = _to_bytes(tube.topic)
+    body = _to_bytes(tube.body)
+
+    if frame_format == FRAME_FORMAT_BINARY:
+        header = BINARY_HEADER.pack(
+            BINARY_MAGIC, BINARY_PROTOCOL_VERSION, BINARY_CONNECTION_TYPE[tube.type_], tube.flags,
+            tube.request_id or 0, len(topic), len(body)
+        ) + topic
+        suffix = b""
+    elif tube.request_id is not None:
+        header = b"".join((
+            MULTIPLEX_CONNECTION_PREFIX[tube.type_], b"%d" % tube.request_id, HEADER_ITEM_DELIMITER,
+            b"%d" % tube.flags, HEADER_ITEM_DELIMITER, b"%d" % len(topic), HEADER_ITEM_DELIMITER,
+            topic, HEADER_ITEM_DELIMITER, b"%d" % len(body), HEADER_DELIMITER
+        ))
+        suffix = BODY_SUFFIX
+    else:
+        header = b"".join((
+            CONNECTION_PREFIX[tube.type_], b"%d" % len(topic), HEADER_ITEM_DELIMITER,
+            topic, HEADER_ITEM_DELIMITER, b"%d" % len(body), HEADER_DELIMITER
+        ))
+        suffix = BODY_SUFFIX
+
+    if len(body) < ZERO_COPY_THRESHOLD:
+        return [header + body + suffix]
+    return [header, body, suffix] if suffix else [header, body]
+
+
+class FrameDecoder(object):
+    """Incremental decoder of the frames received on one connection.
+
+    The format of the connection is sniffed from its first byte, like the
+    Tornado server does.
+    """
+
+    def __init__(self, connection_type, header_max_bytes=None, body_max_bytes=None, frame_format=None):
+        self.connection_type = connection_type
+        self.header_max_bytes = header_max_bytes or 1 * 1024  # 1K
+        self.body_max_bytes = body_max_bytes or 10 * 1024 * 1024  # 10M
+        self.frame_format = frame_format
+
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def has_buffered_data(self):
+        return len(self._buffer) > self._offset
+
+    def feed(self, data):
+        """Return the messages completed by `data`."""
+
+        self._buffer += data
+        if self.frame_format is None:
+            self.frame_format = FRAME_FORMAT_BINARY if self._buffer[:1] == BINARY_MAGIC[:1] else FRAME_FORMAT_TEXT
+
+        messages = []
+        while True:
+            if self.frame_format == FRAME_FORMAT_BINARY:
+                message = self._decode_binary_frame()
+            else:
+                message = self._decode_text_frame()
+            if message is None:
+                break
+            messages.append(message)
+
+        #: compact once per read instead of once per frame
+        if self._offset:
+            del self._buffer[:self._offset]
+            self._offset = 0
+        return messages
+
+    def _check_body_len(self, body_len):
+        if body_len > self.body_max_bytes:
+            raise RPCInputError(u"Body too large: {}".format(body_len))
+
+    def _decode_binary_frame(self):
+        header_end = self._offset + BINARY_HEADER_SIZE
+        if len(self._buffer) < header_end:
+            return None
+
+        magic, version, type_, flags, request_id, topic_len, body_len = BINARY_HEADER.unpack_from(
+            self._buffer, self._offset)
+        if magic != BINARY_MAGIC or version != BINARY_PROTOCOL_VERSION:
+            raise RPCInputError(u"Malformed jx message. unknown binary header")
+        if type_ != BINARY_CONNECTION_TYPE[self.connection_type]:
+            raise RPCInputError(u"Malformed jx message. unexpected type {}".format(type_))
+        if topic_len <= 0:
+            raise RPCInputError("Malformed jx message. message is empty")
+        self._check_body_len(body_len)
+
+        body_start = header_end + topic_len
+        body_end = body_start + body_len
+        if len(self._buffer) < body_end:
+            return None
+
+        topic = bytes(self._buffer[header_end:body_start])
+        body = bytes(self._buffer[body_start:body_end])
+        self._offset = body_end
+        return self._create_message(topic, body, request_id, flags)
+
+    def _decode_text_frame(self):
+        header_end = self._buffer.find(HEADER_DELIMITER, self._offset)
+        if header_end < 0:
+            if len(self._buffer) - self._offset > self.header_max_bytes:
+                raise RPCInputError("Malformed jx message. header too large")
+            return None
+
+        header = bytes(self._buffer[self._offset:header_end])
+        if header[:1] == MULTIPLEX_CONNECTION_PREFIX[self.connection_type]:
+            request_id, flags, topic, body_len = self._parse_multiplex_header(header)
+        elif header[:1] == CONNECTION_PREFIX[self.connection_type]:
+            request_id, flags = None, 0
+            topic, body_len = self._parse_header(header)
+        else:
+            raise RPCInputError(u"Malformed jx message from {!r}".format(header))
+        self._check_body_len(body_len)
+
+        body_start = header_end + len(HEADER_DELIMITER)
+        body_end = body_start + body_len
+        frame_end = body_end + len(BODY_SUFFIX)
+        if len(self._buffer) < frame_end:
+            return None
+        if self._buffer[body_end:frame_end] != BODY_SUFFIX:
+            raise RPCInputError(u"Malformed js body message")
+
+        body = bytes(self._buffer[body_start:body_end])
+        self._offset = frame_end
+        return self._create_message(topic, body, request_id, flags)
+
+    def _create_message(self, topic, body, request_id, flags):
+        deadline = None
+        if flags & FLAG_DEADLINE and self.connection_type == CONNECTION_TYPE_IN_REQUEST:
+            #: on the clock of the server from the end of the read
+            timeout, body = pop_message_deadline(body)
+            deadline = time.time() + timeout
+
+        message = RPCMessage(self.connection_type, topic, body, request_id, flags)
+        message.deadline = deadline
+        return message
+
+    def _parse_header(self, header):
+        try:
+            topic_len, topic, body_len = header[1:].split(HEADER_ITEM_DELIMITER)
+            topic_len = int(topic_len)
+            body_len = int(body_len)
+        except ValueError:
+            raise RPCInputError(u"Malformed jx message from {!r}".format(header))
+
+        if topic_len <= 0 or len(topic) != topic_len:
+            raise RPCInputError(u"Multiple unequal topic length: {!r}, {}".format(topic, topic_len))
+        return topic, body_len
+
+    def _parse_multiplex_header(self, header):
+        try:
+            request_id, flags, topic_len, topic_and_body_len = header[1:].split(HEADER_ITEM_DELIMITER, 3)
+            request_id = int(request_id)
+            flags = int(flags)
+            topic_len = int(topic_len)
+
+            #: the topic is length-prefixed, so it may contain the item delimiter
+            topic = topic_and_body_len[:topic_len]
+            body_len_msg = topic_and_body_len[topic_len:]
+            if not body_len_msg.startswith(HEADER_ITEM_DELIMITER):
+                raise ValueError()
+            body_len = int(body_len_msg[len(HEADER_ITEM_DELIMITER):])
+        except ValueError:
+            raise RPCInputError(u"Malformed jx message from {!r}".format(header))
+
+        if topic_len <= 0 or len(topic) != topic_len:
+            raise RPCInputError(u"Multiple unequal topic length: {!r}, {}".format(topic, topic_len))
+        if not 0 <= request_id <= MAX_REQUEST_ID:
+            raise RPCInputError(u"Malformed jx message. request id out of range: {}".format(request_id))
+        return request_id, flags, topic, body_len
+
+
+def add_message_deadline(tube, timeout):
+    """Same as `pyxtcp.tcp.tornado.util.add_message_deadline`, after the compression."""
+    milliseconds = min(MAX_DEADLINE_MILLISECONDS, max(0, int(timeout * 1000)))
+    return RPCMessage(tube.type_, tube.topic, DEADLINE_HEADER.pack(milliseconds) + _to_bytes(tube.body),
+                      tube.request_id, tube.flags | FLAG_DEADLINE)
+
+
+def pop_message_deadline(body):
+    """Split the body of a request flagged `FLAG_DEADLINE`, return the timeout in seconds and the body."""
+    if len(body) < DEADLINE_HEADER.size:
+        raise RPCInputError("Malformed jx message. deadline is truncated")
+    milliseconds, = DEADLINE_HEADER.unpack_from(body)
+    return milliseconds / 1000.0, body[DEADLINE_HEADER.size:]
+
+
+def compress_message(tube, compression_id, threshold):
+    """Same as `pyxtcp.tcp.tornado.util.compress_message`."""
+
+    try:
+        compressor = get_compressor(compression_id) if compression_id else None
+    except RPCCompressionError:
+        compressor, compression_id = None, 0
+
+    flags = (tube.flags & ~(FLAG_COMPRESSION_MASK | FLAG_COMPRESSED)) | compression_id
+    body = _to_bytes(tube.body)
+    if compressor is not None and len(body) >= threshold:
+        compressed = compressor.compress(body)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= FLAG_COMPRESSED
+    return RPCMessage(tube.type_, tube.topic, body, tube.request_id, flags)
+
+
+def decompress_body(body, flags, max_size=None):
+    if not flags & FLAG_COMPRESSED:
+        return body
+    try:
+        return get_compressor(flags & FLAG_COMPRESSION_MASK).decompress(body, max_size)
+    except RPCCompressionError as e:
+        raise RPCInputError(u"Malformed compressed body: {}".format(e))
+
+
+def install_uvloop():
+    """Run the new event loops on uvloop when it is installed, return whether it is."""
+    try:
+        import uvloop
+    except ImportError:
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+class FlowControlMixin(object):
+    """`drain()` waits while the transport buffer is above its high-water mark."""
+
+    _is_writing_paused = False
+    _drain_waiter = None
+
+    def pause_writing(self):
+        self._is_writing_paused = True
+
+    def resume_writing(self):
+        self._is_writing_paused = False
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def _wake_drain_waiter(self, error):
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_exception(error)
+
+    async def drain(self):
+        if not self._is_writing_paused:
+            return
+        if self._drain_waiter is None:
+            self._drain_waiter = asyncio.get_event_loop().create_future()
+        await self._drain_waiter
+
+
+class ShmProtocol(asyncio.Protocol):
+    """Protocol of a local connection, `protocol` gets the data decoded by the
+    `pyxtcp.transport.ShmChannel` and a transport writing through it."""
+
+    def __init__(self, protocol, channel):
+        self.protocol = protocol
+        self.channel = channel
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.protocol.connection_made(_ShmTransport(transport, self.channel))
+
+    def connection_lost(self, exc):
+        self.channel.close()
+        self.protocol.connection_lost(exc)
+
+    def data_received(self, data):
+        try:
+            chunks = self.channel.feed(data)
+        except RPCTransportError as e:
+            log.error(e)
+            self.transport.close()
+            return
+        for chunk in chunks:
+            self.protocol.data_received(chunk)
+
+    def eof_received(self):
+        return self.protocol.eof_received()
+
+    def pause_writing(self):
+        self.protocol.pause_writing()
+
+    def resume_writing(self):
+        self.protocol.resume_writing()
+
+
+class _ShmTransport(object):
+
+    def __init__(self, transport, channel):
+        self._transport = transport
+        self._channel = channel
+
+    def write(self, data):
+        for chunk in self._channel.encode(data):
+            self._transport.write(chunk)
+
+    def writelines(self, list_of_data):
+        for data in list_of_data:
+            self.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
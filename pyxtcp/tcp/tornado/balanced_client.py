@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from ...balancer import LoadBalancer
+from ...deadline import RPCDeadlineExceededError
+from ...metrics import timer
+from ...transport import is_local_address
+from .multi_client import RPCClient, can_hedge, hedged_fetch
+from .util import RPCConnectError, is_busy_response, is_stream_source
+
+
+__all__ = [
+    "BalancedRPCClient",
+]
+
+
+class BalancedRPCClient(object):
+    """Pooled `RPCClient`s to several servers, every request goes to one of them.
+
+        client = BalancedRPCClient([("10.0.0.1", 8001), ("10.0.0.2", 8001)])
+        response = yield client.fetch(ClientConnectionItem(RPCMessage(...)))
+
+    `endpoints` is a list of `(host, port)`, `"host:port"` or local addresses
+    (`"unix:///path"`, `"shm://name"`), or `provider` a function returning it
+    (see `pyxtcp.balancer.LoadBalancer` for the other options);
+    `client_options` are passed to the `RPCClient` of every server.
+    A request that could not be sent or that a busy server refused (see
+    `is_busy_response`) is sent to another server, at most `max_retries`
+    times; streamed requests are not retried. With a `pyxtcp.hedge.HedgePolicy`
+    a request still unanswered after its delay is sent to another server too.
+    The `RPCClient` of a server the provider dropped is closed.
+    """
+
+    def __init__(self, endpoints=None, provider=None, max_clients=5, max_retries=1, io_loop=None,
+                 client_options=None, balancer=None, hedge_policy=None, **balancer_options):
+        self._io_loop = io_loop or IOLoop.current()
+        self.max_clients = max_clients
+        self.max_retries = max_retries
+        self.hedge_policy = hedge_policy
+        self.client_options = client_options or {}
+        self.balancer = balancer or LoadBalancer(endpoints, provider, **balancer_options)
+
+        #: address -> `RPCClient`
+        self._clients = {}
+        self.balancer.add_remove_callback(self._remove_client)
+
+    def fetch(self, item):
+        if self.hedge_policy is not None and can_hedge(item, self.hedge_policy):
+            #: the attempts of a request share the servers they went to
+            tried = []
+            return hedged_fetch(lambda item: self._fetch(item, tried), item, self.hedge_policy, self._io_loop)
+        return self._fetch(item, [])
+
+    @gen.coroutine
+    def _fetch(self, item, tried):
+        can_retry = not is_stream_source(item.item.body)
+        retries = 0
+        while True:
+            endpoint = self.balancer.pick(tried)
+            tried.append(endpoint.address)
+            start_time = timer()
+            try:
+                response_message = yield self._get_client(endpoint.address).fetch(item)
+            except RPCDeadlineExceededError:
+                #: given up by the client, not the fault of the server
+                self.balancer.release(endpoint)
+                raise
+            except Exception as e:
+                self.balancer.finish(endpoint, timer() - start_time, False)
+                #: a request that was not sent can go to another server
+                if can_retry and isinstance(e, RPCConnectError) and retries < self.max_retries:
+                    retries += 1
+                    continue
+                raise
+
+            is_busy = is_busy_response(response_message)
+            self.balancer.finish(endpoint, timer() - start_time, not is_busy)
+            if is_busy and can_retry and retries < self.max_retries:
+                retries += 1
+                continue
+            raise gen.Return(response_message)
+
+    def close(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            client.close()
+
+    def _get_client(self, address):
+        client = self._clients.get(address)
+        if client is None:
+            if is_local_address(address):
+                host, port = address, None
+            else:
+                host, port = address if isinstance(address, tuple) else address.rsplit(":", 1)
+                port = int(port)
+            client = self._clients[address] = RPCClient(
+                host, port, max_clients=self.max_clients, io_loop=self._io_loop, **self.client_options)
+        return client
+
+    def _remove_client(self, address):
+        client = self._clients.pop(address, None)
+        if client is not None:
+            client.close()
@@ -1,37 +1,41 @@
 #!/usr/bin/env python
 # coding=utf-8
 
-import Queue
+import collections
+import copy
 import functools
-import threading
-import traceback
+import time
 
 from tornado import gen
+from tornado.concurrent import Future
 from tornado.tcpclient import TCPClient
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.iostream import StreamClosedError
 
-from util import CONNECTION_TYPE_IN_REQUEST
-from util import BasicConnection, RPCMessage, RPCConnectionError, RPCInputError
-from util import log, message_utils
+from .util import CONNECTION_TYPE_IN_REQUEST, CONNECTION_TYPE_IN_RESPONSE, PING_TOPIC
+from .util import BasicConnection, RPCMessage, RPCConnectError, RPCConnectionError, RPCInputError
+from .util import FRAME_FORMAT_BINARY, FRAME_FORMAT_TEXT
+from .util import FLAG_STREAM, FLAG_STREAM_END, RESPONSE_ERROR_TAG, STREAM_CHUNK_SIZE, STREAM_STALL_TIMEOUT
+from .util import BodyStream, is_stream_source, read_stream_source, write_stream
+from .util import add_message_deadline, compress_message, connect_stream, decompress_body
+from .util import log, message_utils, read_frame_body, read_header_data, write_message
+from ...compression import get_compressor
+from ...deadline import DEADLINE_ERROR_PREFIX, RPCDeadlineExceededError, get_timeout
+from ...hedge import hedged_call
+from ...metrics import get_default_metrics, timer
 
 
-class _ClientContext(object):
-
-    def __init__(self, connect_timeout=0.2, request_timeout=2):
-        self.connect_timeout = connect_timeout
-        self.request_timeout = request_timeout
-
-    def set_handler_callback(self, callback):
-        self._handler_callback = callback
-
-    def get_handler_callback(self):
-        return self._handler_callback
+__all__ = [
+    "RPCClient", "ClientConnectionItem",
+]
 
 
 class _RPCClientConfig(object):
     def __init__(self, host, port, max_clients=5,
-                 max_buffer_size=None, max_response_size=None, connect_timeout=0.2):
+                 max_buffer_size=None, max_response_size=None, connect_timeout=0.2,
+                 health_check_interval=None, frame_format=FRAME_FORMAT_TEXT,
+                 compression_id=0, compression_threshold=None, stream_chunk_size=None,
+                 stream_stall_timeout=None):
         self.host = host
         self.port = port
         self.address_str = "{},{}".format(self.host, self.port)
@@ -39,278 +43,492 @@ class _RPCClientConfig(object):
         self.max_buffer_size = max_buffer_size
         self.max_response_size = max_response_size
         self.connect_timeout = connect_timeout
+        self.health_check_interval = health_check_interval
+        self.frame_format = frame_format
+        self.compression_id = compression_id
+        self.compression_threshold = compression_threshold if compression_threshold is not None else 1024
+        self.stream_chunk_size = stream_chunk_size or STREAM_CHUNK_SIZE
+        self.stream_stall_timeout = stream_stall_timeout or STREAM_STALL_TIMEOUT
 
 
 class RPCClient(object):
+    """Pooled client, keeps up to `max_clients` persistent connections to one server.
+
+    Requests are served in FIFO order by the first idle connection; when every
+    connection is busy they wait in the queue for at most their
+    ``waiting_timeout``. ``fetch`` returns a Future resolved with the response
+    ``RPCMessage``. The server should run with ``keep_alive=True``, otherwise
+    every connection is transparently reconnected after its response.
+    ``binary_header`` sends frames with the fixed size binary header.
+    ``compression`` ("zlib", "lz4" or "zstd") compresses request and response
+    bodies of at least ``compression_threshold`` bytes, requests are then sent
+    as version 2 frames.
+
+    A request body given as a generator, a file or a ``BodyStream`` is
+    streamed in chunks of ``stream_chunk_size`` bytes; the streamed response
+    of a ``stream_response`` item resolves the Future with a ``BodyStream``
+    body as soon as its first chunk arrives, the connection returns to the
+    pool once the stream is read (other items get the joined body). A
+    stream closed by its reader, or not read for ``stream_stall_timeout``
+    seconds, fails and its connection is closed.
+
+    With a ``pyxtcp.hedge.HedgePolicy`` a request still unanswered after its
+    delay is sent once more on another connection, the first response wins;
+    streamed requests and responses are not hedged.
+
+    `host` may be a local address without `port`, ``unix:///path`` or
+    ``shm://name`` (see `pyxtcp.transport`).
+    """
+
+    def __init__(self, host, port=None, max_clients=5, io_loop=None, max_buffer_size=None,
+                 max_response_size=None, connect_timeout=0.2, health_check_interval=None,
+                 binary_header=False, compression=None, compression_threshold=None,
+                 stream_chunk_size=None, stream_stall_timeout=None, metrics=None, hedge_policy=None):
 
-    def __init__(self, host, port, max_clients=5, max_buffer_size=None,
-                 max_response_size=None, connect_timeout=0.2):
-
-        self._io_loop = IOLoop.current()
+        self._io_loop = io_loop or IOLoop.current()
         self.client_config = _RPCClientConfig(
             host=host,
             port=port,
             max_clients=max_clients,
             max_buffer_size=max_buffer_size,
             max_response_size=max_response_size,
-            connect_timeout=connect_timeout
+            connect_timeout=connect_timeout,
+            health_check_interval=health_check_interval,
+            frame_format=FRAME_FORMAT_BINARY if binary_header else FRAME_FORMAT_TEXT,
+            compression_id=get_compressor(compression).compression_id if compression else 0,
+            compression_threshold=compression_threshold,
+            stream_chunk_size=stream_chunk_size,
+            stream_stall_timeout=stream_stall_timeout
         )
 
         self.tcp_client = TCPClient(io_loop=self._io_loop)
-        self._create_new_connection()
+        self.hedge_policy = hedge_policy
 
-    def _create_new_connection(self):
-        self._connection = _ClientConnection(
-            client=self,
-            io_loop=self._io_loop)
-        self._connection.connect()
-        # self._io_loop.start()
+        self.queue = collections.deque()
+        self.waiting = {}
+        self._connections = set()
+        self._idle_connections = collections.deque()
+        self._client_closed = False
+
+        #: `pyxtcp.metrics.Metrics` of the pool and the requests, None measures nothing
+        self.metrics = metrics if metrics is not None else get_default_metrics()
+        self._metrics_labels = (("address", self.client_config.address_str), ("client", "pool"))
+        #: (name, func, labels) of the gauges, they refer to the client until `close`
+        self._metrics_gauges = []
+        if self.metrics is not None:
+            self._metrics_gauges = [
+                ("pyxtcp_client_connections", lambda: len(self._connections) - len(self._idle_connections),
+                 self._metrics_labels + (("state", "active"),)),
+                ("pyxtcp_client_connections", lambda: len(self._idle_connections),
+                 self._metrics_labels + (("state", "idle"),)),
+                ("pyxtcp_client_queued_requests", lambda: len(self.queue), self._metrics_labels),
+            ]
+            for name, func, labels in self._metrics_gauges:
+                self.metrics.gauge_callback(name, func, labels)
+
+        self._health_check_callback = None
+        if health_check_interval:
+            self._health_check_callback = PeriodicCallback(
+                self._health_check, health_check_interval * 1000, io_loop=self._io_loop)
+            self._health_check_callback.start()
 
-    def reset_connect(self):
-        if self._connection:
-            self._connection.close_connection()
-        self._create_new_connection()
+    def fetch(self, item):
+        if self.hedge_policy is not None and can_hedge(item, self.hedge_policy):
+            return hedged_fetch(self._fetch, item, self.hedge_policy, self._io_loop)
+        return self._fetch(item)
 
-    def ping(self):
-        def _func():
-            log.warn("here!!!!!!!!!!!!!")
+    def _fetch(self, item):
+        future = Future()
+        if self._client_closed:
+            future.set_exception(RPCConnectionError("Client closed {}".format(self.client_config.address_str)))
+            return future
 
-        self.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "ping", ""), _func))
+        if self.metrics is not None:
+            future.add_done_callback(functools.partial(self._on_request_done, item.item.topic, timer()))
 
-    def fetch(self, item):
-        self._connection.add_item(item)
+        key = object()
+        self.queue.append(key)
 
+        if not self._has_free_connection():
+            waiting_timeout_handle = self._io_loop.add_timeout(
+                deadline=self._io_loop.time() + item.waiting_timeout,
+                callback=functools.partial(self._on_waiting_timeout, key))
+        else:
+            waiting_timeout_handle = None
 
-class _ClientConnection(BasicConnection):
-    def __init__(self, client, io_loop=None):
-        self.client = client
-        self.client_config = client.client_config
-        self._io_loop = io_loop or IOLoop.current()
+        queued_time = timer() if self.metrics is not None else None
+        self.waiting[key] = (item, future, waiting_timeout_handle, queued_time)
+        self._process_queue()
+        return future
 
-        self.stream = None
-        self._connection_timeout_handler = None
-        self._client_connection_tubes = _ClientConnectionTubes(self, self._io_loop)
-        # self._client_connection_tubes.thread.start()
+    def _on_request_done(self, topic, start_time, future):
+        labels = self._metrics_labels + (("method", topic),)
+        self.metrics.observe("pyxtcp_client_request_seconds", timer() - start_time, labels)
+        is_error = future.exception() is not None or future.result().topic == RESPONSE_ERROR_TAG
+        self.metrics.inc("pyxtcp_client_requests_total", labels + (("status", "error" if is_error else "ok"),))
 
-    def add_item(self, item):
-        self._client_connection_tubes.append(item)
+    def ping(self):
+        return self.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, PING_TOPIC, "")))
 
-    def is_avaliable_stream(self):
-        return bool(self.stream is not None and not self.stream.closed())
+    def close(self):
+        if self._client_closed:
+            return
+        self._client_closed = True
 
-    def set_connection_timeout_handler(self, func):
-        self._connection_timeout_handler = func
+        if self._health_check_callback is not None:
+            self._health_check_callback.stop()
 
-    def _off_connection_timeout_handler(self):
-        if self._connection_timeout_handler is not None:
-            self._io_loop.remove_timeout(self._connection_timeout_handler)
-            self.set_connection_timeout_handler(None)
+        for name, func, labels in self._metrics_gauges:
+            self.metrics.remove_gauge_callback(name, labels, func)
 
-    def connect(self):
-        self.set_connection_timeout_handler(self._io_loop.add_timeout(
-            deadline=self._io_loop.time() + self.client_config.connect_timeout,
-            callback=self._on_connection_timeout))
+        for key in list(self.waiting):
+            _, future, _, _ = self.waiting[key]
+            self._remove_waiting(key)
+            future.set_exception(RPCConnectionError("Client closed {}".format(self.client_config.address_str)))
+        self.queue.clear()
 
-        def _connect():
-            return self.client.tcp_client.connect(
-                host=self.client_config.host, port=self.client_config.port,
-                max_buffer_size=self.client_config.max_buffer_size, callback=self._on_connection_success)
+        for connection in list(self._connections):
+            connection.close()
+        self._connections.clear()
+        self._idle_connections.clear()
+        self.tcp_client.close()
 
-        #: tcp_client callback
-        self._io_loop.run_sync(_connect)
+    def _has_free_connection(self):
+        return bool(self._idle_connections) or len(self._connections) < self.client_config.max_clients
 
-    def _on_connection_timeout(self):
-        raise RPCConnectionError("Connection Timeout {}".format(self.client_config.address_str))
+    def _on_waiting_timeout(self, key):
+        if key in self.waiting:
+            item, future, _, _ = self.waiting.pop(key)
+            self.queue.remove(key)
+            future.set_exception(RPCConnectionError("Timeout waiting for a free connection to {}".format(
+                self.client_config.address_str)))
+
+    def _remove_waiting(self, key):
+        _, _, waiting_timeout_handle, _ = self.waiting.pop(key)
+        if waiting_timeout_handle is not None:
+            self._io_loop.remove_timeout(waiting_timeout_handle)
+
+    def _process_queue(self):
+        while self.queue and self._has_free_connection():
+            key = self.queue.popleft()
+            if key not in self.waiting:
+                continue
 
-    def _on_connection_success(self, stream):
-        self._off_connection_timeout_handler()
-        log.debug(u"Connection Success {}".format(self.client_config.address_str))
+            item, future, _, queued_time = self.waiting[key]
+            self._remove_waiting(key)
 
-        self.stream = stream
-        self.stream.set_close_callback(self._on_connection_close)
+            #: the deadline passed while waiting for a free connection
+            timeout = item.get_timeout()
+            if timeout is not None and timeout <= 0:
+                future.set_exception(RPCDeadlineExceededError("{} waiting for a free connection to {}".format(
+                    DEADLINE_ERROR_PREFIX, self.client_config.address_str)))
+                continue
 
-        # Nagle’s algorithm
-        self.stream.set_nodelay(True)
+            connection = self._acquire_connection()
+            if queued_time is not None:
+                self.metrics.observe("pyxtcp_client_queue_wait_seconds", timer() - queued_time, self._metrics_labels)
 
-        #: test
-        self.client.ping()
+            _run_future = self._run_item(connection, item, future)
+            self._io_loop.add_future(_run_future, lambda f: f.result())
 
-    def _on_connection_close(self):
-        log.info("Connection Timeout {}".format(self.client_config.address_str))
+    def _acquire_connection(self):
+        if self._idle_connections:
+            return self._idle_connections.pop()
 
-    def close(self):
-        if self.is_avaliable_stream():
-            self.stream.close()
-            self.stream = None
+        connection = _ClientConnection(self, io_loop=self._io_loop)
+        self._connections.add(connection)
+        return connection
 
-    def communicate(self, item):
-        if self.is_avaliable_stream():
-            self.stream.write(message_utils.encrypt(item))
+    def _release_connection(self, connection):
+        if self._client_closed:
+            connection.close()
+        elif connection.is_avaliable_stream():
+            self._idle_connections.append(connection)
+        else:
+            self._discard_connection(connection)
+        self._process_queue()
 
+    def _discard_connection(self, connection):
+        connection.close()
+        self._connections.discard(connection)
+        if connection in self._idle_connections:
+            self._idle_connections.remove(connection)
 
-class _ClientConnectionTubes(object):
+    @gen.coroutine
+    def _run_item(self, connection, item, future):
+        try:
+            response_message = yield connection.send_item(item)
+        except Exception as e:
+            self._discard_connection(connection)
+            self._process_queue()
+            future.set_exception(e)
+            return
+
+        if connection.body_stream_future is None:
+            self._release_connection(connection)
+        try:
+            if item.callback is not None:
+                item.callback(response_message)
+        finally:
+            future.set_result(response_message)
 
-    def __init__(self, connection, io_loop=None):
-        self.connection = connection
-        self._io_loop = io_loop or IOLoop.current()
-        self.client_config = self.connection.client_config
+        #: the rest of a streamed response is read before the connection is reused
+        if connection.body_stream_future is not None:
+            try:
+                yield connection.body_stream_future
+            except Exception:
+                self._discard_connection(connection)
+                self._process_queue()
+            else:
+                self._release_connection(connection)
 
-        self.queue = Queue.Queue(self.client_config.max_clients)
-        self.active = {}
-        self.waiting = {}
-        self.thread = _ConnectionThreadingHandler(self._run_item)
+    def _health_check(self):
+        """Drop idle connections closed by the server and ping the others."""
 
-    def _on_waiting_timeout(self, key):
-        log.debug("_on_waiting_timeout : {}".format(self.waiting[key]))
-        connection_item, waiting_timeout_handle = self.waiting[key]
-        self.queue.remove((key, connection_item))
-        del self.waiting[key]
+        for connection in list(self._idle_connections):
+            if not connection.is_avaliable_stream():
+                self._discard_connection(connection)
 
-    def _off_waiting_timeout(self, key):
-        if key in self.waiting:
-            _, func = self.waiting[key]
-            if func is not None:
-                self._io_loop.remove_timeout(func)
-            del self.waiting[key]
+        for _ in range(len(self._idle_connections)):
+            self.ping().add_done_callback(self._on_health_check_done)
 
-    def append(self, connection_item):
-        key = object()
-        self.queue.put_nowait((key, connection_item))
+    def _on_health_check_done(self, future):
+        if future.exception() is not None:
+            log.info("Health check failed {}: {}".format(self.client_config.address_str, future.exception()))
 
-        if not len(self.active) < self.client_config.max_clients:
-            waiting_timeout_handle = self._io_loop.add_timeout(
-                deadline=self._io_loop.time() + self.connection_item.waiting_timeout,
-                callback=functools.partial(self._on_waiting_timeout, key))
-        else:
-            waiting_timeout_handle = None
 
-        self.waiting[key] = (connection_item, waiting_timeout_handle)
+class _ClientConnection(BasicConnection):
+    def __init__(self, client, io_loop=None):
+        self.client = client
+        self.client_config = client.client_config
+        self._io_loop = io_loop or IOLoop.current()
 
-        self._run_item()
+        self.stream = None
+        self._is_response_started = False
 
-    def _run_item(self):
-        while self.queue and len(self.active) < self.client_config.max_clients:
-            log.warn("^&^^^^^^^^^^^^^^^^^")
-            key, connection_item = self.queue.get()
-            log.warn((key, connection_item))
-            if key not in self.waiting:
-                continue
+        #: resolved once the last chunk of a streamed response was read
+        self.body_stream_future = None
 
-            log.warn("9999999999")
-            self._off_waiting_timeout(key)
-            self.active[key] = connection_item
-            self._handle_connection_item(connection_item, functools.partial(self._release_connection_item, key))
+    def is_avaliable_stream(self):
+        return bool(self.stream is not None and not self.stream.closed())
 
-    def _release_connection_item(self, key):
-        del self.active[key]
-        self._run_item()
+    @gen.coroutine
+    def send_item(self, connection_item):
+        #: a reused stream may have been closed by the server while idle,
+        #: no response was started in that case so it is safe to send again
+        is_reused = self.is_avaliable_stream()
+        if not is_reused:
+            yield self.connect()
+
+        self.body_stream_future = None
+        item = connection_item.item
+        timeout = connection_item.get_timeout()
+        if timeout is not None and timeout <= 0:
+            raise RPCDeadlineExceededError("{} before sending to {}".format(
+                DEADLINE_ERROR_PREFIX, self.client_config.address_str))
+
+        if is_stream_source(item.body):
+            #: a stream can not be sent twice, it is not retried on a fresh connection
+            try:
+                yield write_stream(
+                    self.stream, self._prepare_item(RPCMessage(item.type_, item.topic, b"", item.request_id, item.flags)),
+                    item.body, self.client_config.frame_format, chunk_size=self.client_config.stream_chunk_size,
+                    compression_id=self.client_config.compression_id,
+                    compression_threshold=self.client_config.compression_threshold)
+                response_message = yield self._read_message(connection_item)
+            except StreamClosedError:
+                raise RPCConnectionError("Connection closed {}".format(self.client_config.address_str))
+        else:
+            if connection_item.stream_response:
+                item = self._prepare_item(item)
+            try:
+                self.communicate(item, timeout)
+                response_message = yield self._read_message(connection_item)
+            except StreamClosedError:
+                if not is_reused or self._is_response_started:
+                    raise RPCConnectionError("Connection closed {}".format(self.client_config.address_str))
+                yield self.connect()
+                self.communicate(item, connection_item.get_timeout())
+                response_message = yield self._read_message(connection_item)
+
+        if response_message.flags & FLAG_STREAM:
+            body_stream = BodyStream()
+            self.body_stream_future = self._read_body_stream(connection_item, response_message, body_stream)
+            self._io_loop.add_future(self.body_stream_future, lambda f: f.exception())
+            body, flags = body_stream, response_message.flags
+            if not connection_item.stream_response:
+                #: sent as a version 2 frame for its deadline or compression, joined all the same
+                body = yield read_stream_source(body_stream)
+                flags &= ~(FLAG_STREAM | FLAG_STREAM_END)
+            response_message = RPCMessage(
+                response_message.type_, response_message.topic, body, response_message.request_id, flags)
+
+        raise gen.Return(response_message)
 
-    def _handle_connection_item(self, connection_item, release_callback):
-        connection_item.set_release_callback(release_callback)
-        # self._io_loop.run_sync(functools.partial(self._on_sending, connection_item))
-        _sending_future = self._on_sending(connection_item)
-        self._io_loop.add_future(_sending_future, lambda f: f.result())
+    @gen.coroutine
+    def _read_body_stream(self, connection_item, chunk_message, body_stream):
+        try:
+            while True:
+                if chunk_message.topic == RESPONSE_ERROR_TAG:
+                    raise RPCConnectionError(chunk_message.body)
+                if chunk_message.body:
+                    is_fed = yield body_stream.feed(chunk_message.body, self.client_config.stream_stall_timeout)
+                    if not is_fed:
+                        #: closing the connection is cheaper than reading the rest for nobody
+                        raise RPCConnectionError("Stream closed {}".format(self.client_config.address_str))
+                if chunk_message.flags & FLAG_STREAM_END:
+                    break
+                chunk_message = yield self._read_message(connection_item)
+        except StreamClosedError:
+            body_stream.finish(RPCConnectionError("Connection closed {}".format(self.client_config.address_str)))
+            raise
+        except Exception as e:
+            body_stream.finish(e)
+            raise
+        body_stream.finish()
 
     @gen.coroutine
-    def _on_sending(self, connection_item):
+    def connect(self):
+        self.close()
+        metrics = self.client.metrics
+        start_time = timer() if metrics is not None else None
         try:
+            self.stream = yield gen.with_timeout(
+                timeout=self._io_loop.time() + self.client_config.connect_timeout,
+                future=connect_stream(
+                    self.client.tcp_client, self.client_config.host, self.client_config.port,
+                    self.client_config.max_buffer_size, self._io_loop),
+                io_loop=self._io_loop,
+                quiet_exceptions=StreamClosedError
+            )
+        except (gen.TimeoutError, StreamClosedError, IOError):
+            raise RPCConnectError("Connection Timeout {}".format(self.client_config.address_str))
 
-            #: send request
-            self._sending_connection_item(connection_item)
-            content = yield self._read_message(connection_item)
-            log.warn(content)
+        if metrics is not None:
+            metrics.observe("pyxtcp_client_connect_seconds", timer() - start_time, self.client._metrics_labels)
 
-        except Exception:
-            traceback.print_exc()
+        log.debug(u"Connection Success {}".format(self.client_config.address_str))
+        self.stream.set_close_callback(self._on_connection_close)
 
-    def _sending_connection_item(self, connection_item):
-        log.warn(("_send_request", connection_item.item.__dict__))
-        self.connection.communicate(connection_item.item)
+        # Nagle’s algorithm
+        self.stream.set_nodelay(True)
 
     @gen.coroutine
     def _read_message(self, connection_item):
-        try:
+        self._is_response_started = False
 
-            if not self.connection.is_avaliable_stream():
-                log.error("Malformed Client Request stream closed")
-                raise gen.Return(False)
+        #: read header data, no longer than the deadline of the request
+        header_data_future = read_header_data(
+            self.stream, self.client_config.frame_format, connection_item.header_max_bytes)
 
-            #: read header data
-            header_data_future = self.connection.stream.read_until_regex(
-                regex=message_utils.header_delimiter,
-                max_bytes=connection_item.header_max_bytes
-            )
+        header_timeout = connection_item.header_timeout
+        timeout = connection_item.get_timeout()
+        if timeout is not None:
+            header_timeout = max(0, min(header_timeout, timeout))
 
-            if connection_item.header_timeout is None:
-                self._header_data = yield header_data_future
-            else:
-                try:
-                    self._header_data = yield gen.with_timeout(
-                        timeout=self._io_loop.time() + connection_item.header_timeout,
-                        future=header_data_future,
-                        io_loop=self._io_loop
-                    )
-                except gen.TimeoutError:
-                    log.error("Timeout reading header from {}".format(self.client_config.address_str))
-                    raise gen.Return(False)
-
-            #: parse header data
+        if header_timeout is None:
+            header_data = yield header_data_future
+        else:
             try:
-                header_tube = message_utils.parse_header(
-                    CONNECTION_TYPE_IN_REQUEST, self._header_data)
-
-            except RPCInputError as e:
-                log.warn(e.error)
-                raise gen.Return(False)
+                header_data = yield gen.with_timeout(
+                    timeout=self._io_loop.time() + header_timeout,
+                    future=header_data_future,
+                    io_loop=self._io_loop,
+                    quiet_exceptions=StreamClosedError
+                )
+            except gen.TimeoutError:
+                raise RPCConnectionError("Timeout reading header from {}".format(self.client_config.address_str))
+
+        self._is_response_started = True
+
+        #: parse header data
+        try:
+            header_tube = message_utils.parse_any_header(
+                CONNECTION_TYPE_IN_RESPONSE, self.client_config.frame_format, header_data)
+        except RPCInputError as e:
+            raise RPCConnectionError(e.error)
 
-            self._message.topic = header_tube.topic
+        if header_tube.body_len > connection_item.body_max_bytes:
+            raise RPCConnectionError(u"Body too large: {}".format(header_tube.body_len))
 
-            #: read body data
-            body_data_future = self.connection.stream.read_bytes(
-                header_tube.body_len + len(message_utils.body_suffix))
+        #: read body data, the suffix is checked while reading
+        body_data_future = read_frame_body(self.stream, header_tube)
 
+        try:
             if connection_item.body_timeout is None:
-                self._body_data = yield body_data_future
+                body_msg = yield body_data_future
             else:
-                try:
-                    self._body_data = yield gen.with_timeout(
-                        timeout=self._io_loop.time() + connection_item.body_timeout,
-                        future=body_data_future,
-                        io_loop=self._io_loop
-                    )
-                except gen.TimeoutError:
-                    log.error("Timeout reading body from {}".format(self.client_config.address_str))
-                    raise gen.Return(False)
-
-            #: parse body data
-            try:
-                body_msg = message_utils.parse_body(self._body_data)
-            except RPCInputError as e:
-                log.error(e.error)
-                raise gen.Return(False)
+                body_msg = yield gen.with_timeout(
+                    timeout=self._io_loop.time() + connection_item.body_timeout,
+                    future=body_data_future,
+                    io_loop=self._io_loop,
+                    quiet_exceptions=StreamClosedError
+                )
+            body_msg = decompress_body(body_msg, header_tube.flags, connection_item.body_max_bytes)
+        except gen.TimeoutError:
+            raise RPCConnectionError("Timeout reading body from {}".format(self.client_config.address_str))
+        except RPCInputError as e:
+            raise RPCConnectionError(e.error)
+
+        raise gen.Return(RPCMessage(
+            CONNECTION_TYPE_IN_RESPONSE, header_tube.topic, body_msg,
+            header_tube.request_id, header_tube.flags))
 
-            self._message.body = body_msg
+    def _on_connection_close(self):
+        log.debug("Connection close {}".format(self.client_config.address_str))
 
-        except StreamClosedError:
-            raise gen.Return(False)
-        raise gen.Return(True)
+    def close(self):
+        if self.is_avaliable_stream():
+            self.stream.close()
+        self.stream = None
+
+    def communicate(self, item, timeout=None):
+        if not self.is_avaliable_stream():
+            raise StreamClosedError()
+
+        if self.client_config.compression_id:
+            item = compress_message(
+                self._prepare_item(item), self.client_config.compression_id, self.client_config.compression_threshold)
+        if timeout is not None:
+            item = add_message_deadline(self._prepare_item(item), timeout)
+        write_message(self.stream, item, self.client_config.frame_format)
 
+    def _prepare_item(self, item):
+        #: only version 2 frames have flags, one request at a time keeps id 0
+        if item.request_id is None:
+            return RPCMessage(item.type_, item.topic, item.body, 0, item.flags)
+        return item
 
-class _ConnectionThreadingHandler(threading.Thread):
 
-    def __init__(self, func, group=None, target=None, name=None):
-        super(_ConnectionThreadingHandler, self).__init__(group=group, target=target, name=name)
-        self.func = func
+def can_hedge(item, hedge_policy):
+    """Streams can not be sent twice nor left unread, their requests are not hedged."""
+    return (hedge_policy.should_hedge(item.item.topic)
+            and not item.stream_response and not is_stream_source(item.item.body))
 
-    def run(self):
-        self.func()
+
+def hedged_fetch(fetch, item, hedge_policy, io_loop):
+    """`fetch(item)` hedged by `hedge_policy`, the callback of `item` gets the first response only."""
+
+    attempt_item = copy.copy(item)
+    attempt_item.callback = None
+    future = hedged_call(lambda attempt: fetch(attempt_item), hedge_policy, io_loop)
+    if item.callback is not None:
+        future.add_done_callback(lambda f: f.exception() is None and item.callback(f.result()))
+    return future
 
 
 class ClientConnectionItem(object):
+    """A request to send and how long to wait for its response.
+
+    `timeout` is the seconds the caller waits for the response, the server
+    drops the request once they are over (see `pyxtcp.deadline`); it is what
+    is left of the deadline of the request being served by default. Requests
+    with a deadline are sent as version 2 frames.
+    """
 
-    def __init__(self, item, callback, header_max_bytes=None, header_timeout=None,
-                 body_max_bytes=None, body_timeout=None, waiting_timeout=0.2):
-        assert callback is not None
+    def __init__(self, item, callback=None, header_max_bytes=None, header_timeout=None,
+                 body_max_bytes=None, body_timeout=None, waiting_timeout=0.2, stream_response=False,
+                 timeout=None):
 
         self.item = item
         self.callback = callback
@@ -318,9 +536,17 @@ class ClientConnectionItem(object):
         self.header_timeout = header_timeout or 10  # 10s
         self.body_max_bytes = body_max_bytes or 10 * 1024 * 1024  # 10M
         self.body_timeout = body_timeout
+        self.waiting_timeout = waiting_timeout
 
-    def set_release_callback(self, callback):
-        self._release_callback = callback
+        #: send a version 2 frame so the server can stream the response,
+        #: streamed requests always are
+        self.stream_response = stream_response
 
+        timeout = get_timeout(timeout)
+        self.deadline = None if timeout is None else time.time() + timeout
 
-rpc_client = RPCClient(host="127.0.0.1", port=8001)
+    def get_timeout(self):
+        """Seconds left before the deadline, None without one."""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
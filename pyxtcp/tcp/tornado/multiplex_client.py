@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import functools
+import itertools
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.tcpclient import TCPClient
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+
+from .util import CONNECTION_TYPE_IN_RESPONSE, MAX_REQUEST_ID, RESPONSE_ERROR_TAG
+from .util import BasicConnection, RPCConnectError, RPCConnectionError, RPCInputError, RPCMessage
+from .util import FRAME_FORMAT_BINARY, FRAME_FORMAT_TEXT
+from .util import FLAG_STREAM, FLAG_STREAM_END, STREAM_CHUNK_SIZE, STREAM_STALL_TIMEOUT
+from .util import BodyStream, is_stream_source, write_stream
+from .util import compress_message, connect_stream, decompress_body
+from .util import log, message_utils, read_frame_body, read_header_data, write_message
+from ...compression import get_compressor
+from ...metrics import get_default_metrics, timer
+
+
+__all__ = [
+    "MultiplexRPCClient",
+]
+
+
+class _RPCClientConfig(object):
+    def __init__(self, host, port, max_buffer_size=None, connect_timeout=0.2,
+                 header_max_bytes=None, body_max_bytes=None, frame_format=FRAME_FORMAT_TEXT,
+                 compression_id=0, compression_threshold=None, stream_chunk_size=None, stream_stall_timeout=None):
+        self.host = host
+        self.port = port
+        self.address_str = "{},{}".format(self.host, self.port)
+        self.max_buffer_size = max_buffer_size
+        self.connect_timeout = connect_timeout
+        self.header_max_bytes = header_max_bytes or 1 * 1024  # 1K
+        self.body_max_bytes = body_max_bytes or 10 * 1024 * 1024  # 10M
+        self.frame_format = frame_format
+        self.compression_id = compression_id
+        self.compression_threshold = compression_threshold if compression_threshold is not None else 1024
+        self.stream_chunk_size = stream_chunk_size or STREAM_CHUNK_SIZE
+        self.stream_stall_timeout = stream_stall_timeout or STREAM_STALL_TIMEOUT
+
+
+class MultiplexRPCClient(object):
+    """Send many requests over one persistent connection.
+
+    Every request is framed with a request id (protocol version 2), the
+    server may answer them in any order and the responses are matched back
+    by id. ``fetch`` returns a Future resolved with the response
+    ``RPCMessage``; the item callback is called with it as well.
+    ``binary_header`` sends frames with the fixed size binary header.
+    ``compression`` ("zlib", "lz4" or "zstd") compresses request and response
+    bodies of at least ``compression_threshold`` bytes.
+
+    A request body given as a generator, a file or a ``BodyStream`` is
+    streamed in chunks of ``stream_chunk_size`` bytes; a streamed response
+    resolves the Future with a ``BodyStream`` body as soon as its first chunk
+    arrives. Streamed requests and ``stream_response`` items are sent over a
+    connection of their own, closed once they are answered, so that a slow
+    reader does not hold up the other responses. A response body nobody reads
+    for ``stream_stall_timeout`` seconds is failed and its connection closed,
+    one streamed on the shared connection unasked is only failed.
+
+    `host` may be a local address without `port`, ``unix:///path`` or
+    ``shm://name`` (see `pyxtcp.transport`).
+    """
+
+    def __init__(self, host, port=None, io_loop=None, max_buffer_size=None, connect_timeout=0.2,
+                 header_max_bytes=None, body_max_bytes=None, binary_header=False,
+                 compression=None, compression_threshold=None, stream_chunk_size=None, stream_stall_timeout=None,
+                 metrics=None):
+
+        self._io_loop = io_loop or IOLoop.current()
+        self.client_config = _RPCClientConfig(
+            host=host,
+            port=port,
+            max_buffer_size=max_buffer_size,
+            connect_timeout=connect_timeout,
+            header_max_bytes=header_max_bytes,
+            body_max_bytes=body_max_bytes,
+            frame_format=FRAME_FORMAT_BINARY if binary_header else FRAME_FORMAT_TEXT,
+            compression_id=get_compressor(compression).compression_id if compression else 0,
+            compression_threshold=compression_threshold,
+            stream_chunk_size=stream_chunk_size,
+            stream_stall_timeout=stream_stall_timeout
+        )
+
+        self.tcp_client = TCPClient(io_loop=self._io_loop)
+        self._connection = None
+
+        #: `pyxtcp.metrics.Metrics` of the requests, None measures nothing
+        self.metrics = metrics if metrics is not None else get_default_metrics()
+        self._metrics_labels = (("address", self.client_config.address_str), ("client", "multiplex"))
+        #: (name, func, labels) of the gauges, they refer to the client until `close`
+        self._metrics_gauges = []
+        if self.metrics is not None:
+            self._metrics_gauges = [
+                ("pyxtcp_client_connections", self._count_connections, self._metrics_labels + (("state", "active"),)),
+            ]
+            for name, func, labels in self._metrics_gauges:
+                self.metrics.gauge_callback(name, func, labels)
+
+    def fetch(self, item):
+        if item.stream_response or is_stream_source(item.item.body):
+            future = _MultiplexClientConnection(self, io_loop=self._io_loop, is_dedicated=True).fetch(item)
+        else:
+            if self._connection is None or self._connection.is_closed():
+                self._connection = _MultiplexClientConnection(self, io_loop=self._io_loop)
+            future = self._connection.fetch(item)
+        if self.metrics is not None:
+            future.add_done_callback(functools.partial(self._on_request_done, item.item.topic, timer()))
+        return future
+
+    def _count_connections(self):
+        return int(self._connection is not None and not self._connection.is_closed())
+
+    def _on_request_done(self, topic, start_time, future):
+        labels = self._metrics_labels + (("method", topic),)
+        self.metrics.observe("pyxtcp_client_request_seconds", timer() - start_time, labels)
+        is_error = future.exception() is not None or future.result().topic == RESPONSE_ERROR_TAG
+        self.metrics.inc("pyxtcp_client_requests_total", labels + (("status", "error" if is_error else "ok"),))
+
+    def close(self):
+        for name, func, labels in self._metrics_gauges:
+            self.metrics.remove_gauge_callback(name, labels, func)
+        self._metrics_gauges = []
+
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        self.tcp_client.close()
+
+
+class _MultiplexClientConnection(BasicConnection):
+    def __init__(self, client, io_loop, is_dedicated=False):
+        self.client = client
+        self.client_config = client.client_config
+        self._io_loop = io_loop
+
+        #: the connection of one streamed call, closed once it is answered
+        self._is_dedicated = is_dedicated
+
+        self.stream = None
+        self._is_connection_close = False
+        self._connect_future = None
+        self._request_ids = itertools.count(1)
+
+        #: request id -> (future, connection item, timeout handle)
+        self._pending = {}
+
+        #: request id -> `BodyStream` of the streamed responses still receiving chunks
+        self._body_streams = {}
+
+    def is_closed(self):
+        return self._is_connection_close
+
+    def is_avaliable_stream(self):
+        return bool(self.stream is not None and not self.stream.closed())
+
+    def _next_request_id(self):
+        request_id = next(self._request_ids)
+        if request_id > MAX_REQUEST_ID:
+            self._request_ids = itertools.count(1)
+            request_id = next(self._request_ids)
+        return request_id
+
+    def fetch(self, connection_item):
+        future = Future()
+        if self._is_connection_close:
+            future.set_exception(RPCConnectionError("Connection closed {}".format(self.client_config.address_str)))
+            return future
+
+        request_id = self._next_request_id()
+        timeout_handle = None
+        if connection_item.header_timeout is not None:
+            timeout_handle = self._io_loop.add_timeout(
+                deadline=self._io_loop.time() + connection_item.header_timeout,
+                callback=functools.partial(self._on_request_timeout, request_id)
+            )
+        self._pending[request_id] = (future, connection_item, timeout_handle)
+
+        item = connection_item.item
+        request_message = RPCMessage(item.type_, item.topic, item.body, request_id, item.flags)
+        if is_stream_source(item.body):
+            send = functools.partial(self._send_stream, request_message)
+        else:
+            if self.client_config.compression_id:
+                request_message = compress_message(
+                    request_message, self.client_config.compression_id, self.client_config.compression_threshold)
+            send = functools.partial(self.communicate, request_message)
+
+        if self.is_avaliable_stream():
+            send()
+        else:
+            self._connect().add_done_callback(lambda f: send())
+        return future
+
+    def _send_stream(self, request_message):
+        if not self.is_avaliable_stream():
+            return
+
+        _write_future = write_stream(
+            self.stream, request_message, request_message.body, self.client_config.frame_format,
+            chunk_size=self.client_config.stream_chunk_size,
+            compression_id=self.client_config.compression_id,
+            compression_threshold=self.client_config.compression_threshold)
+        self._io_loop.add_future(_write_future, functools.partial(self._on_stream_sent, request_message.request_id))
+
+    def _on_stream_sent(self, request_id, future):
+        if future.exception() is not None and request_id in self._pending:
+            request_future, _, timeout_handle = self._pending.pop(request_id)
+            if timeout_handle is not None:
+                self._io_loop.remove_timeout(timeout_handle)
+            request_future.set_exception(future.exception())
+            self._close_if_done()
+
+    def _connect(self):
+        if self._connect_future is None:
+            self._connect_future = self._on_connect()
+            self._io_loop.add_future(self._connect_future, lambda f: f.result())
+        return self._connect_future
+
+    @gen.coroutine
+    def _on_connect(self):
+        metrics = self.client.metrics
+        start_time = timer() if metrics is not None else None
+        try:
+            self.stream = yield gen.with_timeout(
+                timeout=self._io_loop.time() + self.client_config.connect_timeout,
+                future=connect_stream(
+                    self.client.tcp_client, self.client_config.host, self.client_config.port,
+                    self.client_config.max_buffer_size, self._io_loop),
+                io_loop=self._io_loop,
+                quiet_exceptions=StreamClosedError
+            )
+        except (gen.TimeoutError, StreamClosedError, IOError):
+            self.close(RPCConnectError("Connection Timeout {}".format(self.client_config.address_str)))
+            return
+
+        if metrics is not None:
+            metrics.observe("pyxtcp_client_connect_seconds", timer() - start_time, self.client._metrics_labels)
+
+        log.debug(u"Connection Success {}".format(self.client_config.address_str))
+        self.stream.set_close_callback(self._on_connection_close)
+        self.stream.set_nodelay(True)
+
+        _read_future = self._read_loop()
+        self._io_loop.add_future(_read_future, lambda f: f.result())
+
+    @gen.coroutine
+    def _read_loop(self):
+        try:
+            while self.is_avaliable_stream():
+
+                #: read header data
+                header_data = yield read_header_data(
+                    self.stream, self.client_config.frame_format, self.client_config.header_max_bytes)
+                header_tube = message_utils.parse_any_header(
+                    CONNECTION_TYPE_IN_RESPONSE, self.client_config.frame_format, header_data)
+
+                if header_tube.body_len > self.client_config.body_max_bytes:
+                    raise RPCInputError(u"Body too large: {}".format(header_tube.body_len))
+
+                #: read body data, the suffix is checked while reading
+                body_msg = yield read_frame_body(self.stream, header_tube)
+                body_msg = decompress_body(body_msg, header_tube.flags, self.client_config.body_max_bytes)
+
+                response_message = RPCMessage(
+                    CONNECTION_TYPE_IN_RESPONSE, header_tube.topic, body_msg,
+                    header_tube.request_id, header_tube.flags)
+                if header_tube.flags & FLAG_STREAM:
+                    yield self._on_stream_chunk(response_message)
+                else:
+                    self._on_response(response_message)
+                self._close_if_done()
+
+        except StreamClosedError:
+            self.close()
+        except RPCInputError as e:
+            log.error(e.error)
+            self.close(RPCConnectionError(e.error))
+
+    @gen.coroutine
+    def _on_stream_chunk(self, response_message):
+        request_id = response_message.request_id
+        body_stream = self._body_streams.get(request_id)
+        if body_stream is None:
+            if request_id not in self._pending:
+                log.debug("Stream chunk for unknown request id %s", request_id)
+                return
+            body_stream = BodyStream()
+            self._on_response(RPCMessage(
+                response_message.type_, response_message.topic, body_stream,
+                request_id, response_message.flags))
+            self._body_streams[request_id] = body_stream
+
+        if response_message.body:
+            is_fed = yield body_stream.feed(response_message.body, self.client_config.stream_stall_timeout)
+            if not is_fed and self._body_streams.pop(request_id, None) is not None and self._is_dedicated:
+                #: the server stops sending once the connection is closed
+                self.close()
+                return
+        if response_message.flags & FLAG_STREAM_END:
+            self._body_streams.pop(request_id, None)
+            body_stream.finish()
+
+    def _on_response(self, response_message):
+        #: an error frame ends a streamed response early
+        body_stream = self._body_streams.pop(response_message.request_id, None)
+        if body_stream is not None:
+            body_stream.finish(RPCConnectionError(response_message.body))
+            return
+
+        if response_message.request_id not in self._pending:
+            log.debug("Response for unknown request id %s", response_message.request_id)
+            return
+
+        future, connection_item, timeout_handle = self._pending.pop(response_message.request_id)
+        if timeout_handle is not None:
+            self._io_loop.remove_timeout(timeout_handle)
+        try:
+            if connection_item.callback is not None:
+                connection_item.callback(response_message)
+        finally:
+            future.set_result(response_message)
+
+    def _on_request_timeout(self, request_id):
+        if request_id in self._pending:
+            future, _, _ = self._pending.pop(request_id)
+            future.set_exception(RPCConnectionError("Timeout waiting response from {}".format(
+                self.client_config.address_str)))
+            self._close_if_done()
+
+    def _close_if_done(self):
+        if self._is_dedicated and not self._pending and not self._body_streams:
+            self.close()
+
+    def _on_connection_close(self):
+        log.debug("Connection close {}".format(self.client_config.address_str))
+        self.close()
+
+    def close(self, error=None):
+        self._is_connection_close = True
+        if self.is_avaliable_stream():
+            self.stream.close()
+
+        #: fail every request still waiting on this connection
+        body_streams, self._body_streams = self._body_streams, {}
+        for body_stream in body_streams.values():
+            body_stream.finish(error or RPCConnectionError(
+                "Connection closed {}".format(self.client_config.address_str)))
+
+        pending, self._pending = self._pending, {}
+        for future, _, timeout_handle in pending.values():
+            if timeout_handle is not None:
+                self._io_loop.remove_timeout(timeout_handle)
+            future.set_exception(error or RPCConnectionError(
+                "Connection closed {}".format(self.client_config.address_str)))
+
+    def communicate(self, item):
+        if self.is_avaliable_stream():
+            write_message(self.stream, item, self.client_config.frame_format)
@@ -11,7 +11,7 @@ from tornado.iostream import StreamClosedError
 
 from util import CONNECTION_TYPE_IN_RESPONSE
 from util import BasicConnection, RPCConnectionError, RPCInputError, Storage, RPCMessage
-from util import log, message_utils
+from util import log, message_utils, read_body, write_message
 
 
 class _RPCClientConfig(object):
@@ -167,9 +167,8 @@ class _ClientConnection(BasicConnection):
 
             self._message.topic = header_tube.topic
 
-            #: read body data
-            body_data_future = self.stream.read_bytes(
-                header_tube.body_len + len(message_utils.body_suffix))
+            #: read body data, the suffix is checked while reading
+            body_data_future = read_body(self.stream, header_tube.body_len)
 
             if connection_item.body_timeout is None:
                 self._body_data = yield body_data_future
@@ -184,15 +183,11 @@ class _ClientConnection(BasicConnection):
                     log.error("Timeout reading body from {}".format(self.client_config.address_str))
                     raise gen.Return(False)
 
-            #: parse body data
-            try:
-                body_msg = message_utils.parse_body(self._body_data)
-            except RPCInputError as e:
-                log.error(e.error)
-                raise gen.Return(False)
-
-            self._message.body = body_msg
+            self._message.body = self._body_data
 
+        except RPCInputError as e:
+            log.error(e.error)
+            raise gen.Return(False)
         except StreamClosedError:
             raise gen.Return(False)
         raise gen.Return(True)
@@ -208,7 +203,7 @@ class _ClientConnection(BasicConnection):
 
     def communicate(self, item):
         if self.is_avaliable_stream():
-            self.stream.write(message_utils.encrypt(item))
+            write_message(self.stream, item)
 
 
 class RPCClientItem(object):
@@ -223,3 +218,4 @@ class RPCClientItem(object):
         self.header_timeout = header_timeout or 10  # 10s
         self.body_max_bytes = body_max_bytes or 10 * 1024 * 1024  # 10M
         self.body_timeout = body_timeout
+        self.waiting_timeout = waiting_timeout
@@ -1,32 +1,80 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+import functools
+import socket
+import time
 import traceback
 
 from tornado import gen
-from tornado.ioloop import IOLoop
+from tornado.locks import Condition
 from tornado.tcpserver import TCPServer
 from tornado.iostream import StreamClosedError
 
-from .util import CONNECTION_TYPE_IN_REQUEST
-from .util import BasicConnection, RPCInputError, Storage, RPCMessage
-from .util import log, message_utils
+from ...deadline import RPCDeadlineExceededError, call_with_deadline
+from ...executor import RPCExecutorBusyError, create_executor, is_awaitable
+from ...metrics import get_default_metrics, timer
+from ...process import bind_server_sockets, run_workers, serve_forever
+from ...transport import ShmChannel, is_local_address
+from .util import CONNECTION_TYPE_IN_REQUEST, CONNECTION_TYPE_IN_RESPONSE, RESPONSE_SUCCESS_TAG
+from .util import FLAG_CODEC_MASK, FLAG_COMPRESSION_MASK, FLAG_DEADLINE, FRAME_FORMAT_TEXT, PING_TOPIC
+from .util import FLAG_STREAM, FLAG_STREAM_END, STREAM_STALL_TIMEOUT
+from .util import BodyStream, is_stream_source, read_stream_source, write_stream
+from .util import BasicConnection, RPCConnectionError, RPCInputError, RPCServerBusyError, Storage, RPCMessage
+from .util import ShmIOStream
+from .util import compress_message, decompress_body, pop_message_deadline
+from .util import log, message_utils, read_frame_body, read_header_data, write_message
 
 
 __all__ = [
     "RPCServer", "RPCInputError",
 ]
 
+#: seconds a connection over `max_connections` has to send the request answered busy
+REJECTED_CONNECTION_TIMEOUT = 1
+
 
 class _ServerConfig(object):
     def __init__(self, header_max_bytes=None,
-                 header_timeout=None, body_max_bytes=None, body_timeout=None):
+                 header_timeout=None, body_max_bytes=None, body_timeout=None,
+                 keep_alive=False, keep_alive_timeout=None, keep_alive_max_requests=None,
+                 compression_threshold=None, stream_chunk_size=None, stream_stall_timeout=None,
+                 max_connections=None, max_inflight_requests=None,
+                 write_buffer_high_watermark=None, write_buffer_low_watermark=None):
 
         self.header_max_bytes = header_max_bytes or 1 * 1024  # 1K
         self.header_timeout = header_timeout
         self.body_max_bytes = body_max_bytes or 10 * 1024 * 1024  # 10M
         self.body_timeout = body_timeout
 
+        #: keep reading requests from the same stream until the peer closes it,
+        #: the connection is idle for `keep_alive_timeout` seconds or
+        #: `keep_alive_max_requests` requests were served (None is unlimited)
+        self.keep_alive = keep_alive
+        self.keep_alive_timeout = keep_alive_timeout or 60  # 60s
+        self.keep_alive_max_requests = keep_alive_max_requests
+
+        #: responses to peers using compression are compressed from this size
+        self.compression_threshold = compression_threshold if compression_threshold is not None else 1024
+
+        #: chunk size of streamed responses
+        self.stream_chunk_size = stream_chunk_size
+
+        #: a streamed request body its handler does not read for this long is failed,
+        #: the other requests of the connection are read again
+        self.stream_stall_timeout = stream_stall_timeout or STREAM_STALL_TIMEOUT
+
+        #: requests beyond these limits (None is unlimited) are answered busy without running,
+        #: the first request of a connection over `max_connections` too and the connection closed
+        self.max_connections = max_connections
+        self.max_inflight_requests = max_inflight_requests
+
+        #: a connection stops reading requests while more than `write_buffer_high_watermark`
+        #: bytes of its responses are not sent, until they are down to `write_buffer_low_watermark`
+        self.write_buffer_high_watermark = write_buffer_high_watermark or 4 * 1024 * 1024  # 4M
+        self.write_buffer_low_watermark = min(
+            write_buffer_low_watermark or 1024 * 1024, self.write_buffer_high_watermark)  # 1M
+
     def set_connection(self, host, port):
         self.host = host
         self.port = port
@@ -37,7 +85,12 @@ class RPCServer(TCPServer):
 
     def __init__(self, server_callback, io_loop=None, max_buffer_size=None, read_chunk_size=None,
                  read_header_max_bytes=None, read_header_timeout=None,
-                 read_body_max_bytes=None, read_body_timeout=None):
+                 read_body_max_bytes=None, read_body_timeout=None,
+                 keep_alive=False, keep_alive_timeout=None, keep_alive_max_requests=None,
+                 executor=None, executor_max_workers=None, executor_max_queue_size=None,
+                 compression_threshold=None, max_connections=None, max_inflight_requests=None,
+                 write_buffer_high_watermark=None, write_buffer_low_watermark=None, stream_stall_timeout=None,
+                 metrics=None):
 
         #: default 100M
         max_buffer_size = max_buffer_size or 104857600
@@ -46,7 +99,8 @@ class RPCServer(TCPServer):
         #: default 64KB
         read_chunk_size = min(read_chunk_size or 65536, max_buffer_size // 2)
 
-        self._io_loop = io_loop or IOLoop.instance()
+        #: resolved when the sockets are added, so workers forked by `run` get their own IOLoop
+        self._io_loop = io_loop
         TCPServer.__init__(self, io_loop=self._io_loop,
                            max_buffer_size=max_buffer_size, read_chunk_size=read_chunk_size)
 
@@ -55,20 +109,114 @@ class RPCServer(TCPServer):
             header_max_bytes=read_header_max_bytes,
             header_timeout=read_header_timeout,
             body_max_bytes=read_body_max_bytes,
-            body_timeout=read_body_timeout
+            body_timeout=read_body_timeout,
+            keep_alive=keep_alive,
+            keep_alive_timeout=keep_alive_timeout,
+            keep_alive_max_requests=keep_alive_max_requests,
+            compression_threshold=compression_threshold,
+            stream_chunk_size=read_chunk_size,
+            stream_stall_timeout=stream_stall_timeout,
+            max_connections=max_connections,
+            max_inflight_requests=max_inflight_requests,
+            write_buffer_high_watermark=write_buffer_high_watermark,
+            write_buffer_low_watermark=write_buffer_low_watermark
         )
 
+        #: run `server_callback` in a "thread" or "process" pool instead of on the IOLoop
+        self.executor = create_executor(
+            executor, max_workers=executor_max_workers, max_queue_size=executor_max_queue_size)
+        if self.executor is not None:
+            self.executor.register(server_callback)
+
         self._connections = set()
+        self._is_draining = False
+
+        #: requests running the server callback, of every connection
+        self.inflight_count = 0
+
+        #: `pyxtcp.metrics.Metrics` of the requests, None measures nothing
+        self.metrics = metrics if metrics is not None else get_default_metrics()
+        if self.metrics is not None:
+            self.metrics.gauge_callback("pyxtcp_server_connections", lambda: len(self._connections))
+            self.metrics.gauge_callback("pyxtcp_server_requests_inflight", lambda: self.inflight_count)
+
+    def listen(self, port, address=""):
+        """Listen on `port` of `address`, or on the local address `port` (``unix:///path``,
+        ``shm://name``, see `pyxtcp.transport`)."""
+        self.add_sockets(bind_server_sockets(port, address))
+
+    def add_sockets(self, sockets):
+        TCPServer.add_sockets(self, sockets)
+        self._io_loop = self.io_loop
+
+    def run(self, port, address="", num_workers=1, reuse_port=False, max_restarts=100, shutdown_timeout=30):
+        """Listen and start the IOLoop, optionally in `num_workers` pre-forked processes.
+
+        The sockets are bound once in the parent and shared by the workers, or
+        bound by every worker with SO_REUSEPORT when `reuse_port` is set.
+        `num_workers` None or 0 starts one worker per CPU. Crashed workers are
+        restarted; SIGTERM/SIGINT stop accepting connections and let running
+        requests finish for at most `shutdown_timeout` seconds. `port` may be
+        a local address, see `listen`.
+        """
+
+        #: the workers share the socket of a local address, one bound after another would replace it
+        reuse_port = reuse_port and not is_local_address(port)
+        if num_workers == 1:
+            self._serve(bind_server_sockets(port, address, reuse_port), shutdown_timeout)
+            return
+
+        sockets = None if reuse_port else bind_server_sockets(port, address)
+
+        def _worker(task_id):
+            worker_sockets = sockets or bind_server_sockets(port, address, reuse_port=True)
+            self._serve(worker_sockets, shutdown_timeout)
+
+        run_workers(num_workers, _worker, max_restarts=max_restarts)
+
+    def _serve(self, sockets, shutdown_timeout):
+        self.add_sockets(sockets)
+        serve_forever(self.start_draining, self.is_drained, shutdown_timeout, io_loop=self._io_loop)
+
+    def start_draining(self):
+        """Stop accepting connections and close the idle keep-alive ones, running requests finish."""
+
+        self._is_draining = True
+        self.stop()
+        for connection in list(self._connections):
+            connection.close_if_idle()
+
+    def is_draining(self):
+        return self._is_draining
+
+    def is_drained(self):
+        return not self._connections
 
     def handle_stream(self, stream, address):
+        if stream.socket.family == getattr(socket, "AF_UNIX", None):
+            #: a local connection, of a ``unix://`` or ``shm://`` client (whose first record tells)
+            address = (stream.socket.getsockname(), None)
+            stream = ShmIOStream(stream.socket, ShmChannel(False), io_loop=self._io_loop,
+                                 max_buffer_size=self.max_buffer_size, read_chunk_size=self.read_chunk_size)
 
         #: set connection information
         self.server_config.set_connection(address[0], address[1])
 
-        log.debug("Connection start {}".format(address))
+        #: a response body larger than `zero_copy_threshold` is written after its header,
+        #: Nagle's algorithm would hold it back until the header is acknowledged
+        stream.set_nodelay(True)
+
+        log.debug("Connection start %s", address)
         conn = _ServerConnection(self, stream, io_loop=self._io_loop)
-        log.debug("Connection end {}".format(address))
-        conn.start_service()
+        log.debug("Connection end %s", address)
+
+        max_connections = self.server_config.max_connections
+        if max_connections is not None and len(self._connections) >= max_connections:
+            if self.metrics is not None:
+                self.metrics.inc("pyxtcp_server_rejected_connections_total")
+            conn.start_reject("{} connections".format(max_connections))
+        else:
+            conn.start_service()
 
     def start_request(self, connection):
         self._connections.add(connection)
@@ -86,6 +234,18 @@ class _ServerConnection(BasicConnection):
         self._io_loop = io_loop
 
         self._is_connection_close = False
+        self.frame_format = None
+        self._request_count = 0
+        self._is_idle = False
+        self._inflight_count = 0
+        self._inflight_condition = Condition()
+
+        #: body bytes of the responses written and not flushed to the socket yet
+        self._unsent_bytes = 0
+        self._unsent_condition = Condition()
+
+        #: request id -> `BodyStream` of the streamed requests still receiving chunks
+        self._body_streams = {}
         self.stream.set_close_callback(self._on_connection_close)
 
     def _on_connection_close(self):
@@ -98,10 +258,52 @@ class _ServerConnection(BasicConnection):
             self.stream.close()
             self.stream.set_close_callback(None)
 
+    def close_if_idle(self):
+        """Close between two requests, once the responses are sent; a multiplexed connection also
+        waits for its requests running or receiving chunks."""
+        if self._is_idle_between_requests():
+            self._io_loop.add_future(self._close_when_flushed(), lambda f: f.result())
+
+    def _is_idle_between_requests(self):
+        return self._is_idle and not self._inflight_count and not self._body_streams
+
+    @gen.coroutine
+    def _close_when_flushed(self):
+        try:
+            #: resolved once everything written before is flushed
+            yield self.stream.write(b"")
+        except StreamClosedError:
+            return
+        #: a request may have come in the meantime, it closes the connection when done
+        if self._is_idle_between_requests():
+            self.close()
+
     def start_service(self):
         _service_future = self._service()
         self._io_loop.add_future(_service_future, lambda f: f.result())
 
+    def start_reject(self, reason):
+        _reject_future = self._reject(reason)
+        self._io_loop.add_future(_reject_future, lambda f: f.result())
+
+    @gen.coroutine
+    def _reject(self, reason):
+        """Answer the first request busy and close, the server has too many connections."""
+
+        try:
+            client_request = _ConnectionUtils(self, io_loop=self._io_loop)
+            read_status = yield gen.with_timeout(
+                self._io_loop.time() + REJECTED_CONNECTION_TIMEOUT, client_request.read(),
+                io_loop=self._io_loop)
+            if read_status:
+                write_future = self.send_busy_response(reason, client_request.get_message()["request_id"])
+                if write_future is not None:
+                    yield write_future
+        except (gen.TimeoutError, StreamClosedError):
+            pass
+        finally:
+            self.close()
+
     @gen.coroutine
     def _service(self):
         try:
@@ -109,37 +311,197 @@ class _ServerConnection(BasicConnection):
             #: start request
             self.server.start_request(self)
 
-            client_request = _ConnectionUtils(self, io_loop=self._io_loop)
+            while True:
+                #: stop reading requests while the peer does not read the responses
+                if self._unsent_bytes > self.server_config.write_buffer_high_watermark:
+                    yield self._wait_write_buffer()
 
-            #: read content
-            read_status = yield client_request.read()
+                client_request = _ConnectionUtils(self, io_loop=self._io_loop)
 
-            if read_status:
+                #: read content, the connection is idle between two keep-alive requests
+                self._is_idle = self._request_count > 0
+                read_status = yield client_request.read(idle=self._is_idle)
+                self._is_idle = False
+
+                if not read_status:
+                    if not client_request.is_idle_close:
+                        log.error("Malformed Client Request")
+                    break
 
                 #: get request message
                 request_message = client_request.get_message()
 
-                #: execute
-                response_message = self._handle_server_callback(RPCMessage(
-                    CONNECTION_TYPE_IN_REQUEST, request_message["topic"], request_message["body"]))
-                self.send_success_response(response_message)
+                #: the next chunks of a streamed request go to its body stream
+                if request_message["flags"] & FLAG_STREAM:
+                    is_first_chunk = yield self._feed_body_stream(request_message)
+                    if not is_first_chunk:
+                        continue
 
-            else:
-                log.error("Malformed Client Request")
+                self._request_count += 1
+
+                #: execute, multiplexed requests are answered as soon as they are done
+                #: while the next ones are read
+                if request_message["request_id"] is None:
+                    yield self._handle_request(request_message)
+                else:
+                    self._io_loop.add_future(self._handle_request(request_message), lambda f: f.result())
+
+                if not self._is_keep_alive(request_message):
+                    break
+
+            self._abort_body_streams()
+
+            #: wait for the multiplexed requests still running
+            while self._inflight_count:
+                yield self._inflight_condition.wait()
 
         except Exception:
             traceback_info = traceback.format_exc()
             self.send_error_response(traceback_info)
         finally:
+            self._abort_body_streams()
             self.close()
             self.server.close_request(self)
 
-    def _handle_server_callback(self, request_message):
-        if self.server.server_callback is not None:
-            return self.server.server_callback(request_message)
+    @gen.coroutine
+    def _wait_write_buffer(self):
+        if self.server.metrics is not None:
+            self.server.metrics.inc("pyxtcp_server_read_pauses_total")
+        #: the write Futures are resolved, failed if the stream closes, as the responses are flushed
+        while self._unsent_bytes > self.server_config.write_buffer_low_watermark:
+            yield self._unsent_condition.wait()
+
+    def _on_response_flushed(self, body_len, future):
+        self._unsent_bytes -= body_len
+        if self._unsent_bytes <= self.server_config.write_buffer_low_watermark:
+            self._unsent_condition.notify_all()
+
+    @gen.coroutine
+    def _feed_body_stream(self, request_message):
+        """Returns True for the first chunk, the request is then handled with a `BodyStream` body."""
+
+        request_id = request_message["request_id"]
+        body_stream = self._body_streams.get(request_id)
+        is_first_chunk = body_stream is None
+        if is_first_chunk:
+            body_stream = self._body_streams[request_id] = BodyStream()
+
+        #: a failed or closed stream stays until its last chunk, the chunks still coming are dropped
+        if request_message["body"]:
+            yield body_stream.feed(request_message["body"], self.server_config.stream_stall_timeout)
+        if request_message["flags"] & FLAG_STREAM_END:
+            del self._body_streams[request_id]
+            body_stream.finish()
+
+        request_message["body"] = body_stream
+        raise gen.Return(is_first_chunk)
+
+    def _abort_body_streams(self):
+        body_streams, self._body_streams = self._body_streams, {}
+        for body_stream in body_streams.values():
+            body_stream.finish(RPCConnectionError("Connection closed {}".format(self.server_config.address_str)))
+
+    def _is_keep_alive(self, request_message):
+        if self._is_connection_close or self.server.is_draining():
+            return False
+
+        #: multiplexed peers pipeline requests, their connection is always kept open
+        if not self.server_config.keep_alive and request_message["request_id"] is None:
+            return False
+        max_requests = self.server_config.keep_alive_max_requests
+        return max_requests is None or self._request_count < max_requests
+
+    @gen.coroutine
+    def _handle_request(self, request_message):
+        request_id = request_message["request_id"]
+        if request_message["topic"] == PING_TOPIC:
+            self.send_success_response("", request_id)
+            return
+
+        metrics = self.server.metrics
+        status = "ok"
+        labels = (("method", request_message["topic"]),)
+
+        self._inflight_count += 1
+        self.server.inflight_count += 1
+        try:
+            max_inflight_requests = self.server_config.max_inflight_requests
+            if max_inflight_requests is not None and self.server.inflight_count > max_inflight_requests:
+                raise RPCServerBusyError("{} requests in flight".format(max_inflight_requests))
+
+            start_time = timer() if metrics is not None else None
+            response_message = yield self._handle_server_callback(RPCMessage(
+                CONNECTION_TYPE_IN_REQUEST, request_message["topic"], request_message["body"],
+                request_id=request_id, flags=request_message["flags"]), request_message["deadline"])
+            if metrics is not None:
+                write_start_time = timer()
+                metrics.observe("pyxtcp_server_callback_seconds", write_start_time - start_time, labels)
+            compression_id = request_message["flags"] & FLAG_COMPRESSION_MASK
+            response_tube = RPCMessage(CONNECTION_TYPE_IN_RESPONSE, RESPONSE_SUCCESS_TAG, response_message,
+                                       request_id, request_message["flags"] & FLAG_CODEC_MASK)
+
+            if is_stream_source(response_message) and request_id is not None:
+                yield write_stream(
+                    self.stream, response_tube, response_message, self.frame_format,
+                    chunk_size=self.server_config.stream_chunk_size, compression_id=compression_id,
+                    compression_threshold=self.server_config.compression_threshold)
+                if metrics is not None:
+                    metrics.observe("pyxtcp_server_write_seconds", timer() - write_start_time, labels)
+            else:
+                #: version 1 frames can not be streamed
+                if is_stream_source(response_message):
+                    response_tube.body = yield read_stream_source(response_message)
+                write_future = self.communicate(compress_message(
+                    response_tube, compression_id, self.server_config.compression_threshold))
+                if metrics is not None and write_future is not None:
+                    #: until the response is flushed to the socket
+                    write_future.add_done_callback(lambda f: metrics.observe(
+                        "pyxtcp_server_write_seconds", timer() - write_start_time, labels))
+        except (RPCExecutorBusyError, RPCServerBusyError) as e:
+            status = "busy"
+            self.send_busy_response(str(e), request_id)
+        except RPCDeadlineExceededError as e:
+            #: the client does not wait for the answer anymore
+            status = "expired"
+            self.send_error_response(str(e), request_id)
+        except Exception:
+            status = "error"
+            traceback_info = traceback.format_exc()
+            self.send_error_response(traceback_info, request_id)
+        finally:
+            if metrics is not None:
+                metrics.inc("pyxtcp_server_requests_total", labels + (("status", status),))
+            if isinstance(request_message["body"], BodyStream):
+                request_message["body"].close()
+            self._inflight_count -= 1
+            self.server.inflight_count -= 1
+            self._inflight_condition.notify_all()
+            if self.server.is_draining():
+                self.close_if_idle()
+
+    @gen.coroutine
+    def _handle_server_callback(self, request_message, deadline=None):
+        server_callback = self.server.server_callback
+        if server_callback is None:
+            return
+
+        #: a request past its deadline, also after waiting for a worker, is not run
+        if self.server.executor is not None:
+            result = yield self.server.executor.submit_call(deadline, server_callback, (request_message,))
+        else:
+            result = call_with_deadline(deadline, server_callback, (request_message,))
+
+        if is_awaitable(result):
+            result = yield result
+        raise gen.Return(result)
 
     def communicate(self, item):
-        self.stream.write(message_utils.encrypt(item))
+        if self.stream is not None and not self.stream.closed():
+            write_future = write_message(self.stream, item, self.frame_format or FRAME_FORMAT_TEXT)
+            #: streamed responses are not counted, they wait for every chunk to be flushed
+            self._unsent_bytes += len(item.body)
+            write_future.add_done_callback(functools.partial(self._on_response_flushed, len(item.body)))
+            return write_future
 
 
 class _ConnectionUtils(object):
@@ -155,51 +517,68 @@ class _ConnectionUtils(object):
         self._body_data = None
         self._message = Storage()
 
+        #: the peer closed or the idle keep-alive timeout fired before a new request started
+        self.is_idle_close = False
+
     def get_message(self):
         return self._message
 
-    def read(self):
-        _read_message_future = self._read_message()
+    def read(self, idle=False):
+        _read_message_future = self._read_message(idle)
         self._io_loop.add_future(_read_message_future, lambda f: f.result())
         return _read_message_future
 
     @gen.coroutine
-    def _read_message(self):
+    def _read_message(self, idle=False):
+        metrics = self.server.metrics
+        start_time = timer() if metrics is not None else None
         try:
 
-            #: read header data
-            header_data_future = self.stream.read_until_regex(
-                regex=message_utils.header_delimiter,
-                max_bytes=self.server_config.header_max_bytes
-            )
+            #: read header data, a fixed size binary header needs no delimiter search
+            if self.connection.frame_format is None:
+                header_data_future = self._read_first_header_data()
+            else:
+                header_data_future = read_header_data(
+                    self.stream, self.connection.frame_format, self.server_config.header_max_bytes)
+
+            header_timeout = self.server_config.header_timeout
+            if idle:
+                header_timeout = self.server_config.keep_alive_timeout
 
-            if self.server_config.header_timeout is None:
+            if header_timeout is None:
                 self._header_data = yield header_data_future
             else:
                 try:
                     self._header_data = yield gen.with_timeout(
-                        timeout=self._io_loop.time() + self.server_config.header_timeout,
+                        timeout=self._io_loop.time() + header_timeout,
                         future=header_data_future,
-                        io_loop=self._io_loop
+                        io_loop=self._io_loop,
+                        quiet_exceptions=StreamClosedError
                     )
                 except gen.TimeoutError:
-                    self.connection.send_error_response("Timeout reading header from {}".format(self.server_config.address_str))
+                    if idle:
+                        self.is_idle_close = True
+                    else:
+                        self.connection.send_error_response("Timeout reading header from {}".format(self.server_config.address_str))
                     raise gen.Return(False)
 
+            header_time = timer() if metrics is not None else None
+
             #: parse header data
             try:
-                header_tube = message_utils.parse_header(
-                    CONNECTION_TYPE_IN_REQUEST, self._header_data)
+                header_tube = message_utils.parse_any_header(
+                    CONNECTION_TYPE_IN_REQUEST, self.connection.frame_format, self._header_data)
 
             except RPCInputError as e:
                 self.connection.send_error_response(e.error)
                 raise gen.Return(False)
 
-            self._message.topic = header_tube.topic
+            self._message.request_id = header_tube.request_id
+            self._message.flags = header_tube.flags
+            self._message.deadline = None
 
-            #: read body data
-            body_data_future = self.stream.read_bytes(
-                header_tube.body_len + len(message_utils.body_suffix))
+            #: read body data, the suffix is checked while reading
+            body_data_future = read_frame_body(self.stream, header_tube)
 
             if self.server_config.body_timeout is None:
                 self._body_data = yield body_data_future
@@ -214,15 +593,38 @@ class _ConnectionUtils(object):
                     self.connection.send_error_response("Timeout reading body from {}".format(self.server_config.address_str))
                     raise gen.Return(False)
 
-            #: parse body data
-            try:
-                body_msg = message_utils.parse_body(self._body_data)
-            except RPCInputError as e:
-                self.connection.send_error_response(e.error)
-                raise gen.Return(False)
+            #: the deadline is on the clock of the server from the end of the read
+            body_data = self._body_data
+            if header_tube.flags & FLAG_DEADLINE:
+                timeout, body_data = pop_message_deadline(body_data)
+                self._message.deadline = time.time() + timeout
+
+            self._message.topic = header_tube.topic
+            self._message.body = decompress_body(body_data, header_tube.flags, self.server_config.body_max_bytes)
 
-            self._message.body = body_msg
+            if metrics is not None:
+                labels = (("method", header_tube.topic),)
+                #: the header read of a keep-alive connection includes the wait for the request
+                if not idle:
+                    metrics.observe("pyxtcp_server_header_read_seconds", header_time - start_time, labels)
+                metrics.observe("pyxtcp_server_body_read_seconds", timer() - header_time, labels)
 
+        except RPCInputError as e:
+            self.connection.send_error_response(e.error)
+            raise gen.Return(False)
         except StreamClosedError:
+            if idle and self._header_data is None:
+                self.is_idle_close = True
             raise gen.Return(False)
         raise gen.Return(True)
+
+    @gen.coroutine
+    def _read_first_header_data(self):
+        #: the first byte of a connection tells the frame format used on it
+        first_byte = yield self.stream.read_bytes(1)
+        self.connection.frame_format = message_utils.sniff_frame_format(first_byte)
+
+        header_data = yield read_header_data(
+            self.stream, self.connection.frame_format, self.server_config.header_max_bytes, read_bytes=1)
+        raise gen.Return(first_byte + header_data)
+
@@ -1,18 +1,22 @@
 #!/usr/bin/env python
 # coding=utf-8
 
-import json
 import functools
 import traceback
 
 from tornado import gen
+from tornado.concurrent import Future
 from tornado.tcpclient import TCPClient
 from tornado.ioloop import IOLoop
 from tornado.iostream import StreamClosedError
 
-from util import CONNECTION_TYPE_IN_RESPONSE, CONNECTION_TYPE_IN_REQUEST, RESPONSE_ERROR_TAG
-from util import BasicConnection, RPCConnectionError, RPCInputError, Storage, RPCMessage
-from util import log, message_utils
+from .util import CONNECTION_TYPE_IN_RESPONSE, CONNECTION_TYPE_IN_REQUEST, RESPONSE_ERROR_TAG
+from .util import BasicConnection, RPCBatch, RPCConnectError, RPCConnectionError, RPCInputError, RPCServiceError
+from .util import Storage, RPCMessage
+from .util import connect_stream, log, message_utils, read_body, set_flags_codec_id, write_message
+from .multi_client import ClientConnectionItem
+from ...codec import DEFAULT_CODEC, get_codec
+from ...fanout import gather, map_calls
 
 
 class _RPCClientConfig(object):
@@ -29,7 +33,7 @@ class _RPCClientConfig(object):
 
 class SimpleRPCClient(object):
 
-    def __init__(self, host, port, max_clients=5, max_buffer_size=None,
+    def __init__(self, host, port=None, max_clients=5, max_buffer_size=None,
                  max_response_size=None, connect_timeout=0.2):
 
         self._io_loop = IOLoop.current()
@@ -45,10 +49,20 @@ class SimpleRPCClient(object):
         self.tcp_client = TCPClient(io_loop=self._io_loop)
 
     def fetch(self, item):
+        """Send `item` on a new connection, return a Future of the response `RPCMessage`.
+
+        The callback of `item`, when given, gets the response too.
+        """
+        future = Future()
         connection = _ClientConnection(
             client=self,
             io_loop=self._io_loop)
-        return connection.connect(item)
+        connection.connect(item, future)
+        return future
+
+    def close(self):
+        #: the connections share the resolver of `tcp_client`
+        self.tcp_client.close()
 
 
 class _ClientConnection(BasicConnection):
@@ -59,14 +73,12 @@ class _ClientConnection(BasicConnection):
 
         self.stream = None
         self._connection_timeout_handler = None
+        self._future = None
 
         self._header_data = None
         self._body_data = None
         self._message = Storage()
 
-    def add_item(self, item):
-        self._client_connection_tubes.append(item)
-
     def is_avaliable_stream(self):
         return bool(self.stream is not None and not self.stream.closed())
 
@@ -78,7 +90,9 @@ class _ClientConnection(BasicConnection):
             self._io_loop.remove_timeout(self._connection_timeout_handler)
             self.set_connection_timeout_handler(None)
 
-    def connect(self, connection_item):
+    def connect(self, connection_item, future):
+        self._future = future
+
         #: set connection timeout handler
         self.set_connection_timeout_handler(
             self._io_loop.add_timeout(
@@ -88,23 +102,30 @@ class _ClientConnection(BasicConnection):
         )
 
         #: wait tcp_client callback
-        # self._io_loop.run_sync(functools.partial(self._on_connection_success, connection_item))
-        return self.client.tcp_client.connect(
-            host=self.client_config.host, port=self.client_config.port,
-            max_buffer_size=self.client_config.max_buffer_size,
-            callback=functools.partial(self._on_connection_success_item, connection_item)
-        )
+        self._io_loop.add_future(
+            connect_stream(
+                self.client.tcp_client, self.client_config.host, self.client_config.port,
+                self.client_config.max_buffer_size, self._io_loop),
+            functools.partial(self._on_connect, connection_item))
+
+    def _on_connect(self, connection_item, connect_future):
+        if self._future.done():
+            #: the connect timed out
+            if connect_future.exception() is None:
+                connect_future.result().close()
+            return
+
+        error = connect_future.exception()
+        if error is not None:
+            self._off_connection_timeout_handler()
+            log.error("Connection Error {}: {}".format(self.client_config.address_str, error))
+            self._future.set_exception(RPCConnectError("Connection Error {}".format(self.client_config.address_str)))
+            return
+        self._on_connection_success_item(connection_item, connect_future.result())
 
     def _on_connection_timeout(self):
-        raise RPCConnectionError("Connection Timeout {}".format(self.client_config.address_str))
-
-    @gen.coroutine
-    def _on_connection_success(self, connection_item):
-        stream = yield self.client.tcp_client.connect(
-            host=self.client_config.host, port=self.client_config.port,
-            max_buffer_size=self.client_config.max_buffer_size
-        )
-        yield self._on_connection_success_item(connection_item, stream)
+        self.set_connection_timeout_handler(None)
+        self._future.set_exception(RPCConnectError("Connection Timeout {}".format(self.client_config.address_str)))
 
     @gen.coroutine
     def _on_connection_success_item(self, connection_item, stream):
@@ -121,15 +142,20 @@ class _ClientConnection(BasicConnection):
 
             #: fetch message
             read_status = yield self._read_message(connection_item)
-            if read_status:
-                connection_item.callback(RPCMessage(
-                    CONNECTION_TYPE_IN_RESPONSE, self._message.topic, self._message.body))
-            else:
+            if not read_status:
                 log.error("Malformed Client Request")
+                raise RPCConnectionError("Malformed Client Request {}".format(self.client_config.address_str))
+
+            response_message = RPCMessage(CONNECTION_TYPE_IN_RESPONSE, self._message.topic, self._message.body)
+            self._future.set_result(response_message)
+            if connection_item.callback is not None:
+                connection_item.callback(response_message)
 
         except Exception as e:
             log.error(e)
             traceback.print_exc()
+            if not self._future.done():
+                self._future.set_exception(e)
         finally:
             self.close()
 
@@ -173,9 +199,8 @@ class _ClientConnection(BasicConnection):
 
             self._message.topic = header_tube.topic
 
-            #: read body data
-            body_data_future = self.stream.read_bytes(
-                header_tube.body_len + len(message_utils.body_suffix))
+            #: read body data, the suffix is checked while reading
+            body_data_future = read_body(self.stream, header_tube.body_len)
 
             if connection_item.body_timeout is None:
                 self._body_data = yield body_data_future
@@ -190,15 +215,11 @@ class _ClientConnection(BasicConnection):
                     log.error("Timeout reading body from {}".format(self.client_config.address_str))
                     raise gen.Return(False)
 
-            #: parse body data
-            try:
-                body_msg = message_utils.parse_body(self._body_data)
-            except RPCInputError as e:
-                log.error(e.error)
-                raise gen.Return(False)
-
-            self._message.body = body_msg
+            self._message.body = self._body_data
 
+        except RPCInputError as e:
+            log.error(e.error)
+            raise gen.Return(False)
         except StreamClosedError:
             raise gen.Return(False)
         raise gen.Return(True)
@@ -210,69 +231,133 @@ class _ClientConnection(BasicConnection):
         if self.is_avaliable_stream():
             self.stream.close()
             self.stream = None
-            self.client.tcp_client.close()
 
     def communicate(self, item):
         if self.is_avaliable_stream():
-            self.stream.write(message_utils.encrypt(item))
+            write_message(self.stream, item)
 
 
 class RPCClientItem(object):
 
-    def __init__(self, item, callback, header_max_bytes=None, header_timeout=None,
+    def __init__(self, item, callback=None, header_max_bytes=None, header_timeout=None,
                  body_max_bytes=None, body_timeout=None, waiting_timeout=0.2):
-        assert callback is not None
-
         self.item = item
         self.callback = callback
         self.header_max_bytes = header_max_bytes or 1 * 1024  # 1K
         self.header_timeout = header_timeout or 10  # 10s
         self.body_max_bytes = body_max_bytes or 10 * 1024 * 1024  # 10M
         self.body_timeout = body_timeout
+        self.waiting_timeout = waiting_timeout
 
 
 class RPCClientHandler(object):
+    """Service proxies over `SimpleRPCClient` or the pooled `multi_client.RPCClient`.
+
+        handler = RPCClientHandler(client)
+        company = handler.service_name("CompanyService")
+        result = yield company.get_company_by_company_id(company_id=1)
+        results = yield handler.map(lambda i: company.get_company_by_company_id(company_id=i), ids)
+
+    The calls return Futures of the decoded results and raise `RPCServiceError`
+    with the error of a failed call. `gather` waits for calls already sent,
+    `map` sends them itself, at most `concurrency` (the `max_clients` of the
+    client by default) at once.
+    """
+
+    gather = staticmethod(gather)
+
     def __init__(self, client):
         self._client = client
 
-    def service_name(self, service_name):
-        return _RPCClientServiceHandler(self._client, service_name)
+    def map(self, method, items, concurrency=None):
+        if concurrency is None:
+            concurrency = self._client.client_config.max_clients
+        return map_calls(method, items, concurrency)
 
+    def service_name(self, service_name, codec=None):
+        """`codec` is a registered codec name or id, JSON by default."""
+        return _RPCClientServiceHandler(self._client, service_name, codec)
 
-class _RPCClientServiceHandler(object):
-    def __init__(self, client, service_name):
+    def batch(self, codec=None):
+        """Collect calls and send them in one request, see `_RPCClientBatchHandler`."""
+        return _RPCClientBatchHandler(self._client, codec)
+
+
+class _RPCClientBatchHandler(object):
+    """
+        batch = handler.batch()
+        batch.service_name("CompanyService").get_company_by_company_id(company_id=1)
+        results = yield batch.execute()  # [{"s": True, "v": ...}]
+    """
+
+    def __init__(self, client, codec=None):
         self._client = client
-        self._service_name = service_name
+        self._batch = RPCBatch(codec)
+
+    def service_name(self, service_name):
+        return _RPCBatchServiceHandler(self._batch, service_name)
 
     @gen.coroutine
-    def ___handler_request(self, func_name, **kwargs):
-        topic_name = "{}.{}".format(self._service_name, func_name)
-        body = ""
-        if kwargs:
-            body = json.dumps(kwargs)
+    def execute(self):
+        response_message = yield self._client.fetch(ClientConnectionItem(self._batch.to_message()))
+        raise gen.Return(self._batch.parse_response(response_message))
 
-        log.debug("{}({})".format(topic_name, body))
-        request_message = RPCMessage(CONNECTION_TYPE_IN_REQUEST, topic_name, body)
 
-        def _f(_message):
-            log.debug("Request Message {}".format(_message.__dict__))
+class _RPCBatchServiceHandler(object):
+    def __init__(self, batch, service_name):
+        self._batch = batch
+        self._service_name = service_name
 
-            status = _message.topic
-            content = _message.body
-            if status == RESPONSE_ERROR_TAG:
-                raise gen.Return(content)
+    def __getattr__(self, func):
+        try:
+            return self.__dict__[func]
+        except KeyError:
+            return functools.partial(self._batch.add, "{}.{}".format(self._service_name, func))
 
-            if not content:
-                raise gen.Return(content)
 
-            v = content
-            try:
-                v = Storage(json.loads(content))
-            except:
-                v = content
-            raise gen.Return(v)
+class _RPCClientServiceHandler(object):
+    def __init__(self, client, service_name, codec=None):
+        self._client = client
+        self._service_name = service_name
+        self._codec = DEFAULT_CODEC if codec is None else get_codec(codec)
 
-        yield self._client.fetch(RPCClientItem(request_message, _f))
+    @gen.coroutine
+    def ___handler_request(self, func_name, *args, **kwargs):
+        topic_name = "{}.{}".format(self._service_name, func_name)
+        body = ""
+        if args:
+            body = self._codec.encode(args[0])
+        elif kwargs:
+            body = self._codec.encode(kwargs)
+
+        log.debug("%s(%r)", topic_name, body)
+        if self._codec is DEFAULT_CODEC:
+            request_message = RPCMessage(CONNECTION_TYPE_IN_REQUEST, topic_name, body)
+        else:
+            #: only version 2 frames carry the codec id in their flags
+            request_message = RPCMessage(
+                CONNECTION_TYPE_IN_REQUEST, topic_name, body,
+                request_id=0, flags=set_flags_codec_id(0, self._codec.codec_id))
+
+        response_message = yield self._client.fetch(ClientConnectionItem(request_message))
+        log.debug("Request Message %s", response_message.__dict__)
+
+        status = response_message.topic
+        content = response_message.body
+        if status == RESPONSE_ERROR_TAG:
+            raise RPCServiceError(content)
+
+        if not content:
+            raise gen.Return(content)
+
+        v = content
+        try:
+            v = self._codec.decode(content)
+        except:
+            v = content
+        if isinstance(v, dict):
+            v = Storage(v)
+        raise gen.Return(v)
 
     def __getattr__(self, func):
         try:
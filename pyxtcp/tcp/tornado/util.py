@@ -1,9 +1,25 @@
 #!/usr/bin/env python
 # coding=utf-8
 
-import inspect
-import functools
+import collections
+import datetime
 import logging
+import socket
+import struct
+import traceback
+import types
+
+from tornado import gen
+from tornado.iostream import IOStream
+from tornado.locks import Condition
+
+from ...cache import make_response_key
+from ...codec import get_codec
+from ...compression import RPCCompressionError, get_compressor
+from ...deadline import get_deadline
+from ...executor import is_awaitable
+from ...service import SERVICE_NAME_SUFFIX, RPCServiceError, Service  # noqa: F401
+from ...transport import ShmChannel, parse_local_address
 
 #: logging handler
 log = logging.getLogger("pyxtcp")
@@ -20,9 +36,88 @@ CONNECTION_PREFIX = {
     CONNECTION_TYPE_IN_RESPONSE: "="
 }
 
+#: version 2 frames carry a request id, so many requests can share one connection
+#: and responses may come back out of order
+MULTIPLEX_CONNECTION_PREFIX = {
+    CONNECTION_TYPE_IN_REQUEST: "+",
+    CONNECTION_TYPE_IN_RESPONSE: "*"
+}
+
+PROTOCOL_VERSION_1 = 1
+PROTOCOL_VERSION_2 = 2
+
+#: request ids are unsigned 32 bit integers
+MAX_REQUEST_ID = 2 ** 32 - 1
+
+#: frames start with either a text header (`{type}..."r"n`) or a fixed size
+#: binary header, a connection keeps the format of its first frame
+FRAME_FORMAT_TEXT = "text"
+FRAME_FORMAT_BINARY = "binary"
+
+#: binary header: magic, version, type, flags, request id, topic length, body length;
+#: it is followed by the topic and the body, without delimiters
+BINARY_MAGIC = b"\xb7X"
+BINARY_PROTOCOL_VERSION = 1
+BINARY_CONNECTION_TYPE = {
+    CONNECTION_TYPE_IN_REQUEST: 0,
+    CONNECTION_TYPE_IN_RESPONSE: 1
+}
+BINARY_HEADER = struct.Struct("!2sBBHIHI")
+BINARY_HEADER_SIZE = BINARY_HEADER.size
+
 RESPONSE_SUCCESS_TAG = "S"
 RESPONSE_ERROR_TAG = "E"
 
+#: the high byte of the frame flags is the id of the body codec, 0 is JSON;
+#: the server answers with the codec of the request
+FLAG_CODEC_SHIFT = 8
+FLAG_CODEC_MASK = 0xff00
+
+#: bits 0-2 of the frame flags are the compression the peer uses (0 is none),
+#: bit 3 is set when this body is compressed with it; the server answers with
+#: the compression of the request
+FLAG_COMPRESSION_MASK = 0x07
+FLAG_COMPRESSED = 0x08
+
+#: bit 4 marks a frame carrying one chunk of a streamed body, bit 5 the last
+#: one; the chunks of a request share its request id
+FLAG_STREAM = 0x10
+FLAG_STREAM_END = 0x20
+
+#: bit 6 marks the error response of a server over one of its limits, the
+#: request was not run and can be retried on another server
+FLAG_BUSY = 0x40
+
+#: start of the body of busy error responses, version 1 frames have no flags
+BUSY_ERROR_PREFIX = "Server busy"
+
+#: bit 7 marks a request whose body starts with `DEADLINE_HEADER`, the milliseconds
+#: the client still waits for the answer (see `pyxtcp.deadline`); it is outside
+#: of the compressed body
+FLAG_DEADLINE = 0x80
+DEADLINE_HEADER = struct.Struct("!I")
+MAX_DEADLINE_MILLISECONDS = 2 ** 32 - 1
+
+#: default size of the chunks of a streamed body, 64K
+STREAM_CHUNK_SIZE = 64 * 1024
+
+#: seconds a connection waits for the reader of a full `BodyStream` before failing the stream
+STREAM_STALL_TIMEOUT = 30
+
+#: answered by the server itself, used by clients to check idle connections
+PING_TOPIC = "__ping__"
+
+#: the body of a request to this topic is a list of calls,
+#: `{"method": "Topic.method", "kwargs": {...}}`, answered in one response with
+#: a list of `{"s": status, "v": result or error}`
+BATCH_TOPIC = "__batch__"
+
+
+try:
+    _StopAsyncIteration = StopAsyncIteration
+except NameError:
+    _StopAsyncIteration = StopIteration
+
 
 class RPCInputError(Exception):
     def __init__(self, error):
@@ -36,7 +131,11 @@ class RPCConnectionError(Exception):
         self.error = error
 
 
-class RPCServiceError(Exception):
+class RPCConnectError(RPCConnectionError):
+    """The request was not sent, no connection to the server could be opened."""
+
+
+class RPCServerBusyError(Exception):
     pass
 
 
@@ -53,11 +152,15 @@ class Storage(dict):
 
 
 class RPCMessage(object):
-    def __init__(self, type_, topic, body):
+    def __init__(self, type_, topic, body, request_id=None, flags=0):
         self.type_ = type_
         self.topic = topic
         self.body = body
 
+        #: a message with a request id is sent as a version 2 (multiplexed) frame
+        self.request_id = request_id
+        self.flags = flags
+
 
 class MessageUtils(object):
     def __init__(self):
@@ -70,21 +173,89 @@ class MessageUtils(object):
         self.body_suffix = b"\"r\"n"
         self.body_suffix_len = len(self.body_suffix)
 
+        #: bodies from this size on are written and read as their own buffer
+        #: instead of being concatenated with the header or sliced from the suffix
+        self.zero_copy_threshold = 4 * 1024  # 4K
+
     def encrypt(self, tube):
-        connection_prefix = CONNECTION_PREFIX[tube.type_]
-        return b"{type_}{topic_len}{item_delimiter}{topic}{item_delimiter}{body_len}{header_delimiter}{body}{body_suffix}"\
-            .format(
-                type_=connection_prefix, topic_len=len(tube.topic),
-                item_delimiter=self.header_item_delimiter, topic=tube.topic,
-                body_len=len(tube.body), header_delimiter=self.header_delimiter,
-                body=tube.body, body_suffix=self.body_suffix
-            )
+        return b"".join(self.encrypt_chunks(tube))
+
+    def encrypt_chunks(self, tube):
+        """Encode `tube` as a list of buffers to write one after another.
+
+        Large bodies are not copied, the original body object is returned
+        between the header and the suffix.
+        """
+        header = self.encrypt_header(tube)
+        if len(tube.body) < self.zero_copy_threshold:
+            return [header + tube.body + self.body_suffix]
+        return [header, tube.body, self.body_suffix]
+
+    def encrypt_header(self, tube):
+        if tube.request_id is not None:
+            return self._encrypt_multiplex_header(tube)
+
+        return b"".join((
+            CONNECTION_PREFIX[tube.type_], str(len(tube.topic)), self.header_item_delimiter,
+            tube.topic, self.header_item_delimiter, str(len(tube.body)), self.header_delimiter
+        ))
+
+    def _encrypt_multiplex_header(self, tube):
+        return b"".join((
+            MULTIPLEX_CONNECTION_PREFIX[tube.type_], str(tube.request_id), self.header_item_delimiter,
+            str(tube.flags), self.header_item_delimiter, str(len(tube.topic)), self.header_item_delimiter,
+            tube.topic, self.header_item_delimiter, str(len(tube.body)), self.header_delimiter
+        ))
+
+    def encrypt_binary_chunks(self, tube):
+        """Like `encrypt_chunks`, with a binary header."""
+        header = BINARY_HEADER.pack(
+            BINARY_MAGIC, BINARY_PROTOCOL_VERSION, BINARY_CONNECTION_TYPE[tube.type_], tube.flags,
+            tube.request_id or 0, len(tube.topic), len(tube.body)
+        )
+        if len(tube.body) < self.zero_copy_threshold:
+            return [header + tube.topic + tube.body]
+        return [header + tube.topic, tube.body]
+
+    def sniff_frame_format(self, first_byte):
+        if first_byte == BINARY_MAGIC[:1]:
+            return FRAME_FORMAT_BINARY
+        return FRAME_FORMAT_TEXT
+
+    def parse_binary_header(self, connection_type, message):
+        """Parse a binary header, the topic is read after it and left to None."""
+        if len(message) != BINARY_HEADER_SIZE:
+            raise RPCInputError("Malformed jx message. binary header is truncated")
+
+        magic, version, type_, flags, request_id, topic_len, body_len = BINARY_HEADER.unpack(message)
+        if magic != BINARY_MAGIC or version != BINARY_PROTOCOL_VERSION:
+            raise RPCInputError(u"Malformed jx message. unknown binary header {!r}".format(message))
+        if type_ != BINARY_CONNECTION_TYPE[connection_type]:
+            raise RPCInputError(u"Malformed jx message. unexpected type {}".format(type_))
+        if topic_len <= 0:
+            raise RPCInputError("Malformed jx message. message is empty")
 
-    def parse_header(self, connection_type, message):
-        connection_prefix = CONNECTION_PREFIX[connection_type]
+        return Storage({
+            "version": BINARY_PROTOCOL_VERSION,
+            "request_id": request_id,
+            "flags": flags,
+            "topic": None,
+            "topic_len": topic_len,
+            "body_len": body_len
+        })
 
+    def parse_any_header(self, connection_type, frame_format, message):
+        if frame_format == FRAME_FORMAT_BINARY:
+            return self.parse_binary_header(connection_type, message)
+        return self.parse_header(connection_type, message)
+
+    def parse_header(self, connection_type, message):
         if not message or len(message) <= self.header_delimiter_len:
             raise RPCInputError("Malformed jx message. message is empty")
+        if message[0] == MULTIPLEX_CONNECTION_PREFIX[connection_type]:
+            return self._parse_multiplex_header(message)
+
+        connection_prefix = CONNECTION_PREFIX[connection_type]
         if message[0] != connection_prefix:
             raise RPCInputError(u"Malformed jx message from {}".format(message))
 
@@ -103,6 +274,40 @@ class MessageUtils(object):
             raise RPCInputError("Malformed jx message. message is empty")
 
         return Storage({
+            "version": PROTOCOL_VERSION_1,
+            "request_id": None,
+            "flags": 0,
+            "topic": topic_msg,
+            "body_len": body_len
+        })
+
+    def _parse_multiplex_header(self, message):
+        real_message = message[1:-self.header_delimiter_len]
+        try:
+            request_id, flags, topic_len, topic_and_body_len = real_message.split(self.header_item_delimiter, 3)
+            request_id = int(request_id)
+            flags = int(flags)
+            topic_len = int(topic_len)
+
+            #: the topic is length-prefixed, so it may contain the item delimiter
+            topic_msg = topic_and_body_len[:topic_len]
+            body_len_msg = topic_and_body_len[topic_len:]
+            if not body_len_msg.startswith(self.header_item_delimiter):
+                raise ValueError()
+            body_len = int(body_len_msg[len(self.header_item_delimiter):])
+        except ValueError:
+            raise RPCInputError(u"Malformed jx message from {}".format(message))
+
+        if topic_len <= 0 or len(topic_msg) != topic_len:
+            raise RPCInputError(u"Multiple unequal topic length: {}, {}".format(topic_msg, topic_len))
+
+        if not 0 <= request_id <= MAX_REQUEST_ID:
+            raise RPCInputError(u"Malformed jx message. request id out of range: {}".format(request_id))
+
+        return Storage({
+            "version": PROTOCOL_VERSION_2,
+            "request_id": request_id,
+            "flags": flags,
             "topic": topic_msg,
             "body_len": body_len
         })
@@ -118,6 +323,214 @@ class MessageUtils(object):
 message_utils = MessageUtils()
 
 
+@gen.coroutine
+def read_body(stream, body_len):
+    """Read a body and its suffix from `stream`.
+
+    Large bodies are read apart from the suffix, so they are returned as read
+    instead of being sliced (copied) once more by `parse_body`.
+    """
+    if body_len < message_utils.zero_copy_threshold:
+        body_data = yield stream.read_bytes(body_len + message_utils.body_suffix_len)
+        raise gen.Return(message_utils.parse_body(body_data))
+
+    body_data = yield stream.read_bytes(body_len)
+    body_suffix = yield stream.read_bytes(message_utils.body_suffix_len)
+    if body_suffix != message_utils.body_suffix:
+        raise RPCInputError(u"Malformed js body message")
+    raise gen.Return(body_data)
+
+
+def read_header_data(stream, frame_format, max_bytes, read_bytes=0):
+    """Read a header, `read_bytes` of it were already consumed to sniff the format."""
+    if frame_format == FRAME_FORMAT_BINARY:
+        return stream.read_bytes(BINARY_HEADER_SIZE - read_bytes)
+    return stream.read_until_regex(regex=message_utils.header_delimiter, max_bytes=max_bytes - read_bytes)
+
+
+def read_frame_body(stream, header_tube):
+    """Read the body following a parsed header of either frame format.
+
+    The topic of a binary frame is read first and set on `header_tube`.
+    """
+    if header_tube.topic is None:
+        return _read_binary_topic_and_body(stream, header_tube)
+    return read_body(stream, header_tube.body_len)
+
+
+@gen.coroutine
+def _read_binary_topic_and_body(stream, header_tube):
+    if header_tube.body_len < message_utils.zero_copy_threshold:
+        data = yield stream.read_bytes(header_tube.topic_len + header_tube.body_len)
+        header_tube.topic = data[:header_tube.topic_len]
+        raise gen.Return(data[header_tube.topic_len:])
+
+    header_tube.topic = yield stream.read_bytes(header_tube.topic_len)
+    body_data = yield stream.read_bytes(header_tube.body_len)
+    raise gen.Return(body_data)
+
+
+def write_message(stream, tube, frame_format=FRAME_FORMAT_TEXT):
+    """Write `tube` to `stream` without concatenating large bodies with the header.
+
+    Returns a Future resolved once the frame is flushed to the socket.
+    """
+    if frame_format == FRAME_FORMAT_BINARY:
+        chunks = message_utils.encrypt_binary_chunks(tube)
+    else:
+        chunks = message_utils.encrypt_chunks(tube)
+
+    future = None
+    for chunk in chunks:
+        future = stream.write(chunk)
+    return future
+
+
+class BodyStream(object):
+    """Body of a streamed message, its chunks in the order they were received.
+
+    At most `max_buffered_chunks` chunks wait for the reader, the connection
+    stops reading the socket until it catches up or, after the `stall_timeout`
+    of `feed`, fails and closes the stream. On Python 3.5+ the stream is an
+    async iterator as well.
+    """
+
+    def __init__(self, max_buffered_chunks=4):
+        self.max_buffered_chunks = max_buffered_chunks
+
+        self._chunks = collections.deque()
+        self._is_finished = False
+        self._is_closed = False
+        self._error = None
+        self._readable = Condition()
+        self._writable = Condition()
+
+    @gen.coroutine
+    def feed(self, chunk, stall_timeout=None):
+        """Add `chunk` once there is room, resolved with False when the stream is closed
+        instead: by the reader, or here when it took no chunk for `stall_timeout` seconds."""
+
+        while len(self._chunks) >= self.max_buffered_chunks and not self._is_closed:
+            if stall_timeout is None:
+                yield self._writable.wait()
+            elif not (yield self._writable.wait(datetime.timedelta(seconds=stall_timeout))):
+                self.finish(RPCConnectionError("Stream reader stalled for {}s".format(stall_timeout)))
+                self.close()
+
+        #: nobody reads a closed stream anymore, its chunks are dropped
+        if self._is_closed:
+            raise gen.Return(False)
+        self._chunks.append(chunk)
+        self._readable.notify_all()
+        raise gen.Return(True)
+
+    def finish(self, error=None):
+        """The last chunk was fed; with `error` the reader gets it once the chunks are read."""
+        if not self._is_finished:
+            self._is_finished = True
+            self._error = error
+            self._readable.notify_all()
+
+    def close(self):
+        """Stop reading, the chunks still arriving are dropped."""
+        self._is_closed = True
+        self._chunks.clear()
+        self._writable.notify_all()
+
+    @gen.coroutine
+    def read_chunk(self):
+        """Resolved with the next chunk, None after the last one."""
+        while not self._chunks and not self._is_finished:
+            yield self._readable.wait()
+
+        if self._chunks:
+            chunk = self._chunks.popleft()
+            self._writable.notify_all()
+            raise gen.Return(chunk)
+        if self._error is not None:
+            raise self._error
+        raise gen.Return(None)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self._read_next_chunk()
+
+    @gen.coroutine
+    def _read_next_chunk(self):
+        chunk = yield self.read_chunk()
+        if chunk is None:
+            raise _StopAsyncIteration()
+        raise gen.Return(chunk)
+
+
+def is_stream_source(value):
+    """Generators, files and `BodyStream` are sent as streamed bodies."""
+    return isinstance(value, (BodyStream, types.GeneratorType)) or hasattr(value, "read")
+
+
+def _iter_source_chunks(source, chunk_size):
+    if hasattr(source, "read"):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for chunk in source:
+            for offset in range(0, len(chunk), chunk_size):
+                yield chunk[offset:offset + chunk_size]
+
+
+@gen.coroutine
+def _read_source_chunk(source, chunks):
+    if isinstance(source, BodyStream):
+        chunk = yield source.read_chunk()
+        raise gen.Return(chunk)
+    raise gen.Return(next(chunks, None))
+
+
+@gen.coroutine
+def read_stream_source(source, chunk_size=STREAM_CHUNK_SIZE):
+    """The whole body of a stream source, for peers that can not stream."""
+    chunks = None if isinstance(source, BodyStream) else _iter_source_chunks(source, chunk_size)
+    data = []
+    while True:
+        chunk = yield _read_source_chunk(source, chunks)
+        if chunk is None:
+            break
+        data.append(chunk)
+    raise gen.Return(b"".join(data))
+
+
+@gen.coroutine
+def write_stream(stream, tube, source, frame_format=FRAME_FORMAT_TEXT, chunk_size=None,
+                 compression_id=0, compression_threshold=1024):
+    """Send the chunks of `source` as the body of `tube`, a version 2 or binary frame.
+
+    Every chunk of at most `chunk_size` bytes is its own frame flagged
+    `FLAG_STREAM`, an empty frame flagged `FLAG_STREAM_END` as well ends the
+    body. The next chunk is only read once the previous one is flushed.
+    """
+
+    chunk_size = chunk_size or STREAM_CHUNK_SIZE
+    chunks = None if isinstance(source, BodyStream) else _iter_source_chunks(source, chunk_size)
+    flags = tube.flags | FLAG_STREAM
+
+    while True:
+        chunk = yield _read_source_chunk(source, chunks)
+        if chunk is None:
+            break
+        if chunk:
+            yield write_message(stream, compress_message(
+                RPCMessage(tube.type_, tube.topic, chunk, tube.request_id, flags),
+                compression_id, compression_threshold), frame_format)
+
+    yield write_message(stream, RPCMessage(
+        tube.type_, tube.topic, b"", tube.request_id, flags | FLAG_STREAM_END), frame_format)
+
+
 class BasicConnection(object):
 
     def _on_connection_close(self):
@@ -126,67 +539,81 @@ class BasicConnection(object):
     def close(self):
         raise NotImplementedError()
 
-    def send_success_response(self, message):
-        self.communicate(RPCMessage(CONNECTION_TYPE_IN_RESPONSE, RESPONSE_SUCCESS_TAG, message))
+    def send_success_response(self, message, request_id=None, flags=0):
+        self.communicate(RPCMessage(CONNECTION_TYPE_IN_RESPONSE, RESPONSE_SUCCESS_TAG, message, request_id, flags))
 
-    def send_error_response(self, message):
-        self.communicate(RPCMessage(CONNECTION_TYPE_IN_RESPONSE, RESPONSE_ERROR_TAG, message))
+    def send_error_response(self, message, request_id=None, flags=0):
+        self.communicate(RPCMessage(CONNECTION_TYPE_IN_RESPONSE, RESPONSE_ERROR_TAG, message, request_id, flags))
 
-    def send_request(self, topic, message):
-        self.communicate(RPCMessage(CONNECTION_TYPE_IN_REQUEST, topic, message))
+    def send_busy_response(self, reason, request_id=None):
+        """Answer a request that was not run, returns the write Future."""
+        return self.communicate(RPCMessage(
+            CONNECTION_TYPE_IN_RESPONSE, RESPONSE_ERROR_TAG, "{}: {}".format(BUSY_ERROR_PREFIX, reason),
+            request_id, FLAG_BUSY))
+
+    def send_request(self, topic, message, request_id=None):
+        self.communicate(RPCMessage(CONNECTION_TYPE_IN_REQUEST, topic, message, request_id))
 
     def communicate(self, item):
         raise NotImplementedError()
 
 
-SERVICE_NAME_SUFFIX = "Service"
-
+class ShmIOStream(IOStream):
+    """`IOStream` of a local connection writing and reading the records of a
+    `pyxtcp.transport.ShmChannel` instead of the bytes, see `pyxtcp.transport`."""
 
-class Service(object):
-    def __init__(self):
-        self._rpc = dict()
+    def __init__(self, socket, channel, *args, **kwargs):
+        self.channel = channel
+        IOStream.__init__(self, socket, *args, **kwargs)
 
-    def _get_rpc_service_name(self, frames):
-        log.warn(inspect.getframeinfo(inspect.currentframe()))
+    def read_from_fd(self):
+        chunk = IOStream.read_from_fd(self)
+        if chunk is None:
+            return None
+        #: None until a record is complete
+        return b"".join(self.channel.feed(chunk)) or None
 
-    def _is_valid_service_name(self, service_name):
-        if len(service_name) <= len(SERVICE_NAME_SUFFIX):
-            return False
-        return service_name.endswith(SERVICE_NAME_SUFFIX)
+    def write(self, data, callback=None):
+        #: the flush Futures of empty writes need no record
+        if not data:
+            return IOStream.write(self, data, callback)
+        chunks = self.channel.encode(data)
+        for chunk in chunks[:-1]:
+            IOStream.write(self, chunk)
+        return IOStream.write(self, chunks[-1], callback)
 
-    def _get_rpc_class_name_by_frames(self, frames):
-        for item in frames:
-            if self._is_valid_service_name(item[3]):
-                return item[3]
+    def close_fd(self):
+        IOStream.close_fd(self)
+        self.channel.close()
 
-    def with_f_rpc(self, method):
 
-        _last_frame = inspect.currentframe().f_back
-        _last_frame_info = inspect.getframeinfo(_last_frame)
-        _rpc_class_name = None
-        if self._is_valid_service_name(_last_frame_info.function):
-            _rpc_class_name = _last_frame_info.function
-        else:
-            _rpc_class_name = self._get_rpc_class_name_by_frames(inspect.getouterframes(_last_frame))
+def connect_stream(tcp_client, host, port, max_buffer_size=None, io_loop=None):
+    """Future of a stream connected to `host`:`port` with `tcp_client`, or to
+    the local address `host` (``unix:///path``, ``shm://name``) without a port."""
 
-        if not _rpc_class_name:
-            raise RPCServiceError("rpc class name must reg r'^(.{1,})Service$', method must is staticmethod or classmethod")
+    local_address = parse_local_address(host)
+    if local_address is None:
+        return tcp_client.connect(host=host, port=port, max_buffer_size=max_buffer_size)
 
-        self._rpc["{}.{}".format(_rpc_class_name, method.func_name)] = method
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    channel = ShmChannel.for_address(local_address)
+    if channel is None:
+        stream = IOStream(sock, io_loop=io_loop, max_buffer_size=max_buffer_size)
+    else:
+        stream = ShmIOStream(sock, channel, io_loop=io_loop, max_buffer_size=max_buffer_size)
+    return stream.connect(local_address.path)
 
-        @functools.wraps(method)
-        def _wrapper(*args, **kwrags):
-            return method(*args, **kwrags)
-        return _wrapper
 
-    def get_rpc_function(self, func_key):
-        if func_key in self._rpc:
-            return self._rpc[func_key]
+def is_busy_response(message):
+    """True for the busy error response of a server over its limits, the request was not run."""
+    if message.topic != RESPONSE_ERROR_TAG:
+        return False
+    return bool(message.flags & FLAG_BUSY) or message.body[:len(BUSY_ERROR_PREFIX)] == BUSY_ERROR_PREFIX
 
 
 def server_callback_by_json(service, message):
     import json
-    log.debug("Request Message {}".format(message.__dict__))
+    log.debug("Request Message %s", message.__dict__)
 
     method_name = message.topic
     kwargs = {}
@@ -201,3 +628,188 @@ def server_callback_by_json(service, message):
     if not result:
         result = ""
     return result
+
+
+def add_message_deadline(tube, timeout):
+    """Return `tube` flagged `FLAG_DEADLINE`, the client waits `timeout` seconds for the answer.
+
+    Only version 2 and binary frames have flags.
+    """
+    milliseconds = min(MAX_DEADLINE_MILLISECONDS, max(0, int(timeout * 1000)))
+    return RPCMessage(tube.type_, tube.topic, DEADLINE_HEADER.pack(milliseconds) + tube.body,
+                      tube.request_id, tube.flags | FLAG_DEADLINE)
+
+
+def pop_message_deadline(body):
+    """Split the body of a request flagged `FLAG_DEADLINE`, return the timeout in seconds and the body."""
+    if len(body) < DEADLINE_HEADER.size:
+        raise RPCInputError("Malformed jx message. deadline is truncated")
+    milliseconds, = DEADLINE_HEADER.unpack_from(body)
+    return milliseconds / 1000.0, body[DEADLINE_HEADER.size:]
+
+
+def get_flags_codec_id(flags):
+    return (flags & FLAG_CODEC_MASK) >> FLAG_CODEC_SHIFT
+
+
+def set_flags_codec_id(flags, codec_id):
+    return (flags & ~FLAG_CODEC_MASK) | (codec_id << FLAG_CODEC_SHIFT)
+
+
+def compress_message(tube, compression_id, threshold):
+    """Tag `tube` with the compression and compress bodies of at least `threshold` bytes.
+
+    The body is sent as is when compressing does not make it smaller. Only
+    version 2 and binary frames have flags.
+    """
+
+    try:
+        compressor = get_compressor(compression_id) if compression_id else None
+    except RPCCompressionError:
+        #: answer a peer using a compression not installed here uncompressed
+        compressor, compression_id = None, 0
+
+    flags = (tube.flags & ~(FLAG_COMPRESSION_MASK | FLAG_COMPRESSED)) | compression_id
+    body = tube.body
+    if compressor is not None and len(body) >= threshold:
+        compressed = compressor.compress(body)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= FLAG_COMPRESSED
+    return RPCMessage(tube.type_, tube.topic, body, tube.request_id, flags)
+
+
+def decompress_body(body, flags, max_size=None):
+    if not flags & FLAG_COMPRESSED:
+        return body
+    try:
+        return get_compressor(flags & FLAG_COMPRESSION_MASK).decompress(body, max_size)
+    except RPCCompressionError as e:
+        raise RPCInputError(u"Malformed compressed body: {}".format(e))
+
+
+def server_callback_by_codec(service, message, executor=None):
+    """Like `server_callback_by_json`, with the codec named by the frame flags.
+
+    A dict payload is passed as keyword arguments, anything else (raw bytes,
+    a list...) as the only positional argument. A streamed body is passed as
+    its `BodyStream` and a returned stream source is streamed back as is.
+    Methods registered with a cache answer from their encoded responses.
+
+    With `executor` the calls run on it (the `RPCServer` itself should then
+    run without one), those of a `BATCH_TOPIC` request in parallel; coroutine
+    methods run on the IOLoop in any case. Under an `RPCServer` running with
+    an executor this function runs in a worker, its coroutine methods fail.
+    """
+    log.debug("Request Message %s", message.__dict__)
+
+    codec = get_codec(get_flags_codec_id(message.flags))
+    if message.topic == BATCH_TOPIC:
+        return _run_batch(service, codec, codec.decode(message.body), executor)
+
+    method = service.get_rpc_function(message.topic)
+    if not method:
+        raise RPCServiceError("rpc function {} not exist".format(message.topic))
+
+    cache = cache_key = None
+    if isinstance(message.body, BodyStream):
+        result = method(message.body)
+    else:
+        payload = codec.decode(message.body) if message.body else {}
+
+        #: the responses of cached methods are kept encoded
+        cache = service.get_rpc_cache(message.topic)
+        if cache is not None:
+            cache_key = make_response_key(message.topic, payload, codec.name)
+            found, body = cache.get(cache_key)
+            if found:
+                return body
+
+        args, kwargs = ((), payload) if isinstance(payload, dict) else ((payload,), None)
+        if executor is not None:
+            result = executor.submit_call(
+                get_deadline(), method, args, kwargs, service=service, func_key=message.topic)
+        else:
+            result = method(*args, **(kwargs or {}))
+
+    if is_awaitable(result):
+        return _encode_awaitable_result(codec, result, cache, cache_key)
+    return _encode_result(codec, result, cache, cache_key)
+
+
+def _encode_result(codec, result, cache=None, cache_key=None):
+    if is_stream_source(result):
+        return result
+
+    body = codec.encode(result)
+    if cache is not None:
+        cache.set(cache_key, body)
+    return body
+
+
+@gen.coroutine
+def _encode_awaitable_result(codec, result, cache, cache_key):
+    result = yield result
+    raise gen.Return(_encode_result(codec, result, cache, cache_key))
+
+
+@gen.coroutine
+def _run_batch(service, codec, calls, executor):
+    if not isinstance(calls, list):
+        raise RPCServiceError("batch body must be a list of calls")
+    results = yield [_run_batch_call(service, call, executor) for call in calls]
+    raise gen.Return(codec.encode(results))
+
+
+@gen.coroutine
+def _run_batch_call(service, call, executor):
+    try:
+        method = service.get_rpc_function(call["method"])
+        if not method:
+            raise RPCServiceError("rpc function {} not exist".format(call["method"]))
+
+        kwargs = call.get("kwargs") or {}
+        if executor is not None:
+            result = yield executor.submit_call(None, method, (), kwargs, service=service, func_key=call["method"])
+        else:
+            result = method(**kwargs)
+        if is_awaitable(result):
+            result = yield result
+    except Exception:
+        raise gen.Return({"s": False, "v": traceback.format_exc()})
+    raise gen.Return({"s": True, "v": result})
+
+
+class RPCBatch(object):
+    """Calls collected to be sent as one `BATCH_TOPIC` request.
+
+        batch = RPCBatch()
+        batch.add("CompanyService.get_company_by_company_id", company_id=1)
+        response = yield client.fetch(ClientConnectionItem(batch.to_message()))
+        results = batch.parse_response(response)
+
+    `parse_response` returns the `{"s": status, "v": result or error}` of
+    every call, in order.
+    """
+
+    def __init__(self, codec=None):
+        self.codec = get_codec(codec if codec is not None else 0)
+        self.calls = []
+
+    def add(self, method, **kwargs):
+        self.calls.append({"method": method, "kwargs": kwargs})
+        return len(self.calls) - 1
+
+    def to_message(self):
+        body = self.codec.encode(self.calls)
+        if not self.codec.codec_id:
+            return RPCMessage(CONNECTION_TYPE_IN_REQUEST, BATCH_TOPIC, body)
+
+        #: only version 2 frames carry the codec id in their flags
+        return RPCMessage(CONNECTION_TYPE_IN_REQUEST, BATCH_TOPIC, body,
+                          request_id=0, flags=set_flags_codec_id(0, self.codec.codec_id))
+
+    def parse_response(self, response_message):
+        if response_message.topic == RESPONSE_ERROR_TAG:
+            raise RPCServiceError(response_message.body)
+        return [Storage(result) for result in self.codec.decode(response_message.body)]
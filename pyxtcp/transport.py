@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Local transports of the TCP engines, for clients on the host of the server.
+
+``unix:///path/to/rpc.sock`` is a Unix domain socket instead of the TCP
+loopback. ``shm://name`` is the Unix domain socket ``pyxtcp-name.sock`` of the
+temporary directory whose large writes go through shared memory: the client
+maps a segment file of two rings (one per direction) and the writes of at
+least `threshold` bytes are copied into them, only the record of where they
+are travels over the socket. Both take ``?ring_size=...&threshold=...``.
+
+The frames are the same on every transport. A server listening on a Unix
+domain socket serves plain and ``shm://`` clients, which must run as the same
+user. Windows has no local transport.
+"""
+
+import collections
+import errno
+import mmap
+import os
+import re
+import socket
+import stat
+import struct
+import tempfile
+
+try:
+    from urllib.parse import parse_qsl
+except ImportError:
+    from urlparse import parse_qsl
+
+
+__all__ = [
+    "RPCTransportError", "LocalAddress", "ShmChannel",
+    "bind_local_socket", "is_local_address", "parse_local_address",
+]
+
+LOCAL_SCHEMES = ("unix", "shm")
+
+#: bytes of each ring of a ``shm://`` connection, 8M
+SHM_RING_SIZE = 8 * 1024 * 1024
+
+#: writes from this size on go through the rings, 64K
+SHM_THRESHOLD = 64 * 1024
+
+SHM_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+SHM_SEGMENT_PREFIX = "pyxtcp-shm-"
+
+#: the bytes of a ``shm://`` connection are records: type, ring position, length;
+#: `RECORD_DATA` and `RECORD_ATTACH` records are followed by their `length` bytes
+RECORD_HEADER = struct.Struct("!BQI")
+RECORD_DATA = 0
+RECORD_SHM = 1
+#: first record of a client, the path of its segment
+RECORD_ATTACH = 2
+
+#: ring header: magic, version, data size, read position (set by the reader)
+RING_HEADER = struct.Struct("!4sB3xQQ")
+RING_HEADER_SIZE = 64
+RING_MAGIC = b"PXSH"
+RING_VERSION = 1
+RING_READ_POSITION = struct.Struct("!Q")
+RING_READ_POSITION_OFFSET = 16
+
+
+class RPCTransportError(Exception):
+    pass
+
+
+#: `path` of the socket; `ring_size` and `threshold` of ``shm://``
+LocalAddress = collections.namedtuple("LocalAddress", "scheme path ring_size threshold")
+
+
+def parse_local_address(address):
+    """`LocalAddress` of a ``unix://`` or ``shm://`` address, None for any other address."""
+
+    if not hasattr(address, "partition"):
+        return None
+    scheme, delimiter, rest = address.partition("://")
+    if not delimiter or scheme not in LOCAL_SCHEMES:
+        return None
+
+    location, _, query = rest.partition("?")
+    options = dict(parse_qsl(query))
+    try:
+        ring_size = int(options.get("ring_size", SHM_RING_SIZE))
+        threshold = int(options.get("threshold", SHM_THRESHOLD))
+    except ValueError:
+        raise RPCTransportError("Malformed local address {}".format(address))
+
+    if scheme == "unix":
+        path = location
+    elif SHM_NAME_PATTERN.match(location):
+        path = os.path.join(tempfile.gettempdir(), "pyxtcp-{}.sock".format(location))
+    else:
+        path = None
+    if not path or ring_size <= 0:
+        raise RPCTransportError("Malformed local address {}".format(address))
+    return LocalAddress(scheme, path, ring_size, threshold)
+
+
+def is_local_address(address):
+    return parse_local_address(address) is not None
+
+
+def bind_local_socket(address, backlog=128):
+    """Listening Unix domain socket of a local address, replacing the socket file of a previous server."""
+
+    path = parse_local_address(address).path
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+        else:
+            raise RPCTransportError("File {} exists and is not a socket".format(path))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    sock.bind(path)
+    #: the ``shm://`` clients run as the user of the server
+    os.chmod(path, 0o600)
+    sock.listen(backlog)
+    return sock
+
+
+def _segment_directory():
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class _Ring(object):
+    """One direction of a segment, written in order by one side and read in order by the other."""
+
+    def __init__(self, buffer_, offset, size):
+        self._buffer = buffer_
+        self._offset = offset
+        self._data_offset = offset + RING_HEADER_SIZE
+        self.size = size
+        self._write_position = 0
+
+    def write(self, data):
+        """Copy `data` into the ring and return its position, None when it does not fit now."""
+
+        length = len(data)
+        position = self._write_position
+        start = position % self.size
+        if start + length > self.size:
+            #: the data is not split, the end of the ring is skipped
+            position += self.size - start
+            start = 0
+        read_position, = RING_READ_POSITION.unpack_from(self._buffer, self._offset + RING_READ_POSITION_OFFSET)
+        if position + length - read_position > self.size:
+            return None
+
+        self._buffer[self._data_offset + start:self._data_offset + start + length] = data
+        self._write_position = position + length
+        return position
+
+    def read(self, position, length):
+        """Copy the data written at `position` out of the ring, its space is free again."""
+
+        start = position % self.size
+        if start + length > self.size:
+            raise RPCTransportError("Shared memory record out of the ring")
+        data = self._buffer[self._data_offset + start:self._data_offset + start + length]
+        RING_READ_POSITION.pack_into(self._buffer, self._offset + RING_READ_POSITION_OFFSET, position + length)
+        return data
+
+
+class ShmChannel(object):
+    """Records of one side of a local connection, see the module.
+
+    `encode(data)` returns the buffers to write instead of `data`, `feed(data)`
+    the data read decoded. A client channel creates the segment and attaches it
+    with its first write. A server channel passes the bytes through as they are
+    unless the first one starts an attach record, so a plain client needs no
+    records.
+    """
+
+    def __init__(self, is_client, ring_size=SHM_RING_SIZE, threshold=SHM_THRESHOLD):
+        self.is_client = is_client
+        self.threshold = threshold
+
+        self._mmap = None
+        self._path = None
+        self._send_ring = None
+        self._receive_ring = None
+        self._read_buffer = bytearray()
+
+        #: None until the first byte of the peer shows whether it sends records
+        self._is_shm = True if is_client else None
+        self._attach_record = None
+        if is_client:
+            self._create_segment(ring_size)
+
+    @classmethod
+    def for_address(cls, local_address):
+        """The client channel of a ``shm://`` `LocalAddress`, None for ``unix://``."""
+        if local_address.scheme != "shm":
+            return None
+        return cls(True, local_address.ring_size, local_address.threshold)
+
+    def encode(self, data):
+        if not self._is_shm:
+            return [data]
+
+        chunks = []
+        if self._attach_record is not None:
+            chunks.append(self._attach_record)
+            self._attach_record = None
+
+        if self._send_ring is not None and len(data) >= self.threshold:
+            position = self._send_ring.write(data)
+            if position is not None:
+                chunks.append(RECORD_HEADER.pack(RECORD_SHM, position, len(data)))
+                return chunks
+        chunks.append(RECORD_HEADER.pack(RECORD_DATA, 0, len(data)))
+        chunks.append(data)
+        return chunks
+
+    def feed(self, data):
+        if self._is_shm is None:
+            self._is_shm = bytearray(data[:1]) == bytearray([RECORD_ATTACH])
+        if not self._is_shm:
+            return [data]
+
+        self._read_buffer += data
+        chunks = []
+        offset = 0
+        while len(self._read_buffer) - offset >= RECORD_HEADER.size:
+            type_, position, length = RECORD_HEADER.unpack_from(self._read_buffer, offset)
+            if type_ == RECORD_SHM:
+                if self._receive_ring is None:
+                    raise RPCTransportError("Shared memory record before the segment")
+                chunks.append(self._receive_ring.read(position, length))
+                offset += RECORD_HEADER.size
+                continue
+
+            end = offset + RECORD_HEADER.size + length
+            if len(self._read_buffer) < end:
+                break
+            payload = bytes(self._read_buffer[offset + RECORD_HEADER.size:end])
+            if type_ == RECORD_DATA:
+                chunks.append(payload)
+            elif type_ == RECORD_ATTACH and not self.is_client and self._mmap is None:
+                self._attach_segment(payload.decode("utf-8"))
+            else:
+                raise RPCTransportError("Malformed record {}".format(type_))
+            offset = end
+
+        del self._read_buffer[:offset]
+        return chunks
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._path is not None:
+            #: removed by the server once mapped, unless it never was
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+            self._path = None
+
+    def _create_segment(self, ring_size):
+        fd, self._path = tempfile.mkstemp(prefix=SHM_SEGMENT_PREFIX, dir=_segment_directory())
+        try:
+            os.ftruncate(fd, 2 * (RING_HEADER_SIZE + ring_size))
+            self._mmap = mmap.mmap(fd, 2 * (RING_HEADER_SIZE + ring_size))
+        finally:
+            os.close(fd)
+
+        for offset in (0, RING_HEADER_SIZE + ring_size):
+            RING_HEADER.pack_into(self._mmap, offset, RING_MAGIC, RING_VERSION, ring_size, 0)
+        self._send_ring = _Ring(self._mmap, 0, ring_size)
+        self._receive_ring = _Ring(self._mmap, RING_HEADER_SIZE + ring_size, ring_size)
+
+        path = self._path.encode("utf-8")
+        self._attach_record = RECORD_HEADER.pack(RECORD_ATTACH, 0, len(path)) + path
+
+    def _attach_segment(self, path):
+        #: only the segments of the clients, a peer could name any file of the server otherwise
+        if (os.path.dirname(path) != _segment_directory()
+                or not os.path.basename(path).startswith(SHM_SEGMENT_PREFIX)):
+            raise RPCTransportError("Shared memory segment {} refused".format(path))
+
+        fd = os.open(path, os.O_RDWR | getattr(os, "O_NOFOLLOW", 0))
+        try:
+            file_stat = os.fstat(fd)
+            if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_uid != os.geteuid():
+                raise RPCTransportError("Shared memory segment {} refused".format(path))
+            if file_stat.st_size < RING_HEADER_SIZE:
+                raise RPCTransportError("Shared memory segment {} is truncated".format(path))
+            self._mmap = mmap.mmap(fd, file_stat.st_size)
+        finally:
+            os.close(fd)
+        #: both sides keep their mapping
+        os.unlink(path)
+
+        magic, version, ring_size, _ = RING_HEADER.unpack_from(self._mmap, 0)
+        if magic != RING_MAGIC or version != RING_VERSION or file_stat.st_size != 2 * (RING_HEADER_SIZE + ring_size):
+            raise RPCTransportError("Malformed shared memory segment {}".format(path))
+        self._receive_ring = _Ring(self._mmap, 0, ring_size)
+        self._send_ring = _Ring(self._mmap, RING_HEADER_SIZE + ring_size, ring_size)
@@ -2,18 +2,11 @@
 # coding=utf-8
 
 import collections
+import errno
 import functools
 import socket
-import sys
-import traceback
 
-from tornado import gen
-from tornado.concurrent import Future
-from tornado.ioloop import IOLoop
-from tornado.iostream import StreamClosedError
-from tornado.tcpclient import TCPClient
-
-from util import RequestContext, ResponseContext
+from util import EventLoop, BufferedSocket, RequestContext, ResponseContext
 from util import Storage
 from util import XTCPConnectionException, XTCPContextException
 from util import xtcp_logger
@@ -34,11 +27,15 @@ class Context(object):
         self._request_callback = None
         self._user_request_callback = None
 
-    def concat(self, method, params, callback):
+    def concat(self, method, params, callback=None):
         self.request_message.method = method
         self.request_message.params = params
         self._user_request_callback = callback
 
+    @property
+    def address(self):
+        return self.host, self.port, self.af
+
     @property
     def user_request_callback(self):
         return self._user_request_callback
@@ -53,18 +50,36 @@ class Context(object):
 
 
 class XTCPClient(object):
-
-    def __init__(self, io_loop=None, max_clients=10, max_buffer_size=None, max_response_size=None):
-        self._io_loop = io_loop or IOLoop.instance()
+    """Client of `tcpserver.TCPServer` on its own `EventLoop`, without Tornado.
+
+        client = XTCPClient(max_clients=4, max_pipeline=16)
+        context = Context("localhost", 8001)
+        context.concat("toupper", "xiaoxiao")
+        name = client.acquire(context)
+        names = client.acquire_many(contexts)
+
+    Keeps up to `max_clients` persistent connections per server, each with up
+    to `max_pipeline` requests sent before their responses (pipelining). A
+    request waits at most its `waiting_timeout` for a connection, `acquire_many`
+    requests beyond the connections should get a longer one. `fetch` calls
+    `callback(success, response or error)` from the loop instead of blocking.
+    """
+
+    def __init__(self, io_loop=None, max_clients=10, max_pipeline=16, max_buffer_size=None, max_response_size=None):
+        self._own_io_loop = io_loop is None
+        self._io_loop = io_loop or EventLoop()
         self.max_clients = max_clients
+        self.max_pipeline = max_pipeline
         self.max_buffer_size = max_buffer_size or 104857600  # 100M
         self.max_response_size = max_response_size or 10 * 1024 * 1024  # 10M
+        self.read_chunk_size = 64 * 1024  # 64K
 
-        self.queue = collections.deque()
-        self.active = {}
+        #: address -> deque of the requests waiting for a connection
+        self.queue = collections.defaultdict(collections.deque)
+        #: address -> connections
+        self.connections = collections.defaultdict(list)
         self.waiting = {}
         self._client_closed = False
-        self.tcp_client = TCPClient(io_loop=self._io_loop)
 
     def __del__(self):
         self.close()
@@ -72,64 +87,107 @@ class XTCPClient(object):
     def close(self):
         if not self._client_closed:
             self._client_closed = True
-            self.tcp_client.close()
-            self._io_loop.close()
+            for connections in list(self.connections.values()):
+                for connection in list(connections):
+                    connection.close()
+            if self._own_io_loop:
+                self._io_loop.close()
 
     def acquire(self, request):
-        response = self._io_loop.run_sync(functools.partial(self._acquire_by_request, request))
-        return response
+        return self.acquire_many([request])[0]
+
+    def acquire_many(self, requests):
+        """Send `requests` pipelined over the connections and return their responses in order,
+        raise the error of the first failed one."""
+
+        responses = [None] * len(requests)
+        remaining = [len(requests)]
+
+        def _handle_response(index, success, response):
+            responses[index] = (success, response)
+            remaining[0] -= 1
+
+        for index, request in enumerate(requests):
+            self.fetch(request, functools.partial(_handle_response, index))
+        self._io_loop.run_until(lambda: not remaining[0])
+
+        for success, response in responses:
+            if not success:
+                raise response
+        return [response for _, response in responses]
 
-    def _acquire_by_request(self, request):
-        future = Future()
+    def fetch(self, request, callback):
+        """Queue `request`, `callback(success, response)` gets the response (transformed by
+        the callback of `Context.concat`) or the error."""
 
         def _handle_response(success, response=None):
-            if success is True:
-                response_message = response
-                if request.user_request_callback is not None:
-                    response_message = request.user_request_callback(response)
-                future.set_result(response_message)
-            else:
-                future.set_exc_info(response)
+            if success is True and request.user_request_callback is not None:
+                try:
+                    response = request.user_request_callback(response)
+                except Exception as e:
+                    success, response = False, e
+            callback(success, response)
+
         request.request_callback = _handle_response
+        if self._client_closed:
+            _handle_response(False, XTCPConnectionException("Client closed"))
+            return
         self._acquire_loop_by_request(request)
-        return future
 
     def _acquire_loop_by_request(self, request):
         key = object()
-        self.queue.append((key, request))
-        if not len(self.active) < self.max_clients:
+        queue = self.queue[request.address]
+        queue.append((key, request))
+        if len(queue) > 1 or not self._has_free_connection(request.address):
             waiting_timeout_handle = self._io_loop.add_timeout(
-                self._io_loop.time() + self.request.waiting_timeout, functools.partial(self._on_waiting_timeout, key))
+                self._io_loop.time() + request.waiting_timeout, functools.partial(self._on_waiting_timeout, key))
         else:
             waiting_timeout_handle = None
         self.waiting[key] = (request, waiting_timeout_handle)
-        self._process_queue()
-        if self.queue:
-            xtcp_logger.debug("max_clients limits reached. {} active, {} queued requests".format(len(self.active), len(self.queue)))
+        self._process_queue(request.address)
+        if queue:
+            xtcp_logger.debug("max_clients limits reached. {} queued requests".format(len(queue)))
 
     def _on_waiting_timeout(self, key):
-        xtcp_logger.debug("_on_waiting_timeout : {}".format(self.waiting[key]))
-        request, callback, waiting_timeout_handle = self.waiting[key]
-        self.queue.remove((key, request, callback))
-        del self.waiting[key]
-
-    def _process_queue(self):
-        while self.queue and len(self.active) < self.max_clients:
-            key, request = self.queue.popleft()
-            if key not in self.waiting:
-                continue
+        request, _ = self.waiting.pop(key)
+        self.queue[request.address].remove((key, request))
+        request.request_callback(False, XTCPConnectionException("XTCP Client: Timeout waiting for a connection"))
+
+    def _process_queue(self, address):
+        queue = self.queue[address]
+        while queue and self._has_free_connection(address):
+            key, request = queue.popleft()
+            connection = self._get_connection(address, request.connect_timeout)
             self._remove_waiting_timeout_request(key)
-            self.active[key] = request
-            self._handle_request(request, functools.partial(self._release_request, key))
-
-    def _handle_request(self, request, release_callback):
-        connection = _ClientConnection(
-            self, io_loop=self._io_loop, request=request, release_callback=release_callback)
-        connection.connect()
-
-    def _release_request(self, key):
-        del self.active[key]
-        self._process_queue()
+            connection.send_request(request)
+
+    def _has_free_connection(self, address):
+        connections = self.connections[address]
+        return len(connections) < self.max_clients or any(
+            len(connection.pending) < self.max_pipeline for connection in connections)
+
+    def _get_connection(self, address, connect_timeout):
+        """An idle connection, else a new one, else the least busy one below `max_pipeline`."""
+
+        connections = self.connections[address]
+        best = None
+        for connection in connections:
+            if not connection.pending:
+                return connection
+            if best is None or len(connection.pending) < len(best.pending):
+                best = connection
+
+        if len(connections) < self.max_clients:
+            connection = _ClientConnection(self, address, connect_timeout, self._io_loop)
+            connections.append(connection)
+            return connection
+        return best
+
+    def _release_connection(self, connection):
+        """`connection` is closed, its requests failed."""
+        self.connections[connection.address].remove(connection)
+        if not self._client_closed:
+            self._process_queue(connection.address)
 
     def _remove_waiting_timeout_request(self, key):
         if key in self.waiting:
@@ -139,111 +197,98 @@ class XTCPClient(object):
             del self.waiting[key]
 
 
-class _ClientConnection(object):
+class _PendingRequest(object):
+    __slots__ = ("request", "timeout_handle", "abandoned")
 
-    def __init__(self, client, request, release_callback, io_loop):
-        self.client = client
+    def __init__(self, request):
         self.request = request
-        self.release_callback = release_callback
-        self._io_loop = io_loop
-        self.stream = None
+        self.timeout_handle = None
+        #: timed out, its response is dropped when it comes
+        self.abandoned = False
 
-        self._connection_timeout_handle = None
 
-    def connect(self):
-        self._connection_timeout_handle = self._io_loop.add_timeout(
-            self._io_loop.time() + self.request.connect_timeout, self._on_connection_timeout)
-        self.client.tcp_client.connect(
-            self.request.host, self.request.port, self.request.af,
-            max_buffer_size=self.client.max_buffer_size, callback=self.on_connect)
+class _ClientConnection(BufferedSocket):
 
-    def close(self):
-        if self.stream is not None and not self.stream.closed():
-            self.stream.close()
-
-    def on_connect(self, stream):
-        self._remove_connection_timeout()
-        _on_connect_future = self._on_connect(stream)
-        self._io_loop.add_future(_on_connect_future, lambda f: f.result())
-
-    @gen.coroutine
-    def _on_connect(self, stream):
-        try:
-            if self.request.request_callback is None:
-                stream.close()
-                self.release_callback()
-                return
-            self.stream = stream
-            self.stream.set_close_callback(self._on_connection_close)
-            self.stream.set_nodelay(True)
-            self._handle_send_request()
-
-            response = _ClientResponse(self, self.client, self.request, self.stream, self._io_loop)
-            future = response.read()
-            if self.request.request_timeout is None:
-                yield future
-            else:
-                try:
-                    yield gen.with_timeout(
-                        self._io_loop.time() + self.request.request_timeout,
-                        future, io_loop=self._io_loop)
-                except gen.TimeoutError:
-                    raise XTCPConnectionException("XTCP Client: Request Overtime")
-        except Exception:
-            traceback.print_exc()
-        finally:
-            self.close()
-            self.release_callback()
-
-    def _handle_send_request(self):
-        if self.stream is not None and not self.stream.closed():
-            request_context = RequestContext()
-            self.stream.write(request_context.encrypt(self.request.request_message))
-
-    def _on_connection_close(self):
-        pass
-
-    def _remove_connection_timeout(self):
-        if self._connection_timeout_handle is not None:
-            self._io_loop.remove_timeout(self._connection_timeout_handle)
-            self._connection_timeout_handle = None
-
-    def _on_connection_timeout(self):
-        raise XTCPConnectionException("ClientConnection: Connection Timeout")
-
-
-class _ClientResponse(object):
-
-    def __init__(self, connection, client, request, stream, io_loop):
-        self.connection = connection
+    def __init__(self, client, address, connect_timeout, io_loop):
         self.client = client
-        self.request = request
-        self.stream = stream
-        self._io_loop = io_loop
-
-        self._read_delimiter = "\r\n\r\n"
-
-    def read(self):
-        future = self._read_response()
-        return future
+        self.address = address
+        self._connect_timeout_handle = None
+        host, port, af = address
+
+        #: requests sent and not answered, in order
+        self.pending = collections.deque()
+        self._request_context = RequestContext()
+        self._response_context = ResponseContext()
+
+        sock = socket.socket(af, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        if af in (socket.AF_INET, getattr(socket, "AF_INET6", None)):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        error = sock.connect_ex((host, port))
+        BufferedSocket.__init__(
+            self, io_loop, sock, client.max_response_size, client.read_chunk_size, connecting=True)
+
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            io_loop.add_timeout(io_loop.time(), functools.partial(
+                self.close, XTCPConnectionException("ClientConnection: Connection failed")))
+        else:
+            self._connect_timeout_handle = io_loop.add_timeout(
+                io_loop.time() + connect_timeout, self._on_connection_timeout)
+
+    def send_request(self, request):
+        pending_request = _PendingRequest(request)
+        if request.request_timeout is not None:
+            pending_request.timeout_handle = self.io_loop.add_timeout(
+                self.io_loop.time() + request.request_timeout,
+                functools.partial(self._on_request_timeout, pending_request))
+        self.pending.append(pending_request)
+        self.write(self._request_context.encrypt(request.request_message))
+
+    def on_connect(self):
+        if self._connect_timeout_handle is not None:
+            self.io_loop.remove_timeout(self._connect_timeout_handle)
+
+    def on_messages(self, messages):
+        for message in messages:
+            if not self.pending:
+                self.close(XTCPContextException("Response without request"))
+                return
 
-    @gen.coroutine
-    def _read_response(self):
-        try:
-            future = self.stream.read_until_regex(
-                self._read_delimiter, max_bytes=self.client.max_response_size)
-            response_message = yield future
+            pending_request = self.pending.popleft()
+            if pending_request.abandoned:
+                continue
+            if pending_request.timeout_handle is not None:
+                self.io_loop.remove_timeout(pending_request.timeout_handle)
+
+            try:
+                success, response = True, self._response_context.decrypt(message)
+            except XTCPContextException as e:
+                success, response = False, e
+            pending_request.request.request_callback(success, response)
+
+        #: a slot of the pipeline is free
+        self.client._process_queue(self.address)
+
+    def on_close(self, error):
+        if self.connecting and self._connect_timeout_handle is not None:
+            self.io_loop.remove_timeout(self._connect_timeout_handle)
+        error = error or XTCPConnectionException("Connection closed")
+        pending, self.pending = self.pending, collections.deque()
+        for pending_request in pending:
+            if not pending_request.abandoned:
+                if pending_request.timeout_handle is not None:
+                    self.io_loop.remove_timeout(pending_request.timeout_handle)
+                pending_request.request.request_callback(False, error)
+        self.client._release_connection(self)
 
-            response_context = ResponseContext()
-            real_response_message = response_context.decrypt(response_message)
+    def _on_connection_timeout(self):
+        if self.connecting:
+            self.close(XTCPConnectionException("ClientConnection: Connection Timeout"))
 
-            self.request.request_callback(True, real_response_message)
-        except StreamClosedError:
-            raise XTCPContextException("Response Content not regex or over max response size")
-        except Exception:
-            self.request.request_callback(False, sys.exc_info())
-        finally:
-            self.connection.close()
+    def _on_request_timeout(self, pending_request):
+        #: the request keeps its place in the pipeline, the connection stays usable
+        pending_request.abandoned = True
+        pending_request.request.request_callback(False, XTCPConnectionException("XTCP Client: Request Overtime"))
 
 
 if __name__ == "__main__":
@@ -260,8 +305,11 @@ if __name__ == "__main__":
     name = client.acquire(context)
     logging.info("name: {}".format(name))
 
-    # test1
-    context = Context("localhost", 8001)
-    context.concat("toupper", "wo men dou shi hao hai zi", handler_response)
-    name2 = client.acquire(context)
-    logging.info("name2: {}".format(name2))
+    # test2, pipelined
+    contexts = []
+    for index in range(100):
+        context = Context("localhost", 8001, waiting_timeout=2)
+        context.concat("toupper", "wo men dou shi hao hai zi {}".format(index), handler_response)
+        contexts.append(context)
+    names = client.acquire_many(contexts)
+    logging.info("names: {}".format(names[-1]))
@@ -1,18 +1,35 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+import errno
+import socket
+import traceback
 
-# TODO
-from tornado.ioloop import IOLoop
+from util import EventLoop, BufferedSocket, RequestContext, ResponseContext
+from util import READ, WOULD_BLOCK, XTCPContextException, bind_sockets, xtcp_logger
 
 
 class TCPServer(object):
+    r"""Server of the `"\r\n\r\n"` delimited messages of `util`, on one `EventLoop` thread.
 
-    def __init__(self, io_loop=None, max_buffer_size=None, read_chunk_size=None):
+        def request_callback(method, params):
+            return params.upper()
+
+        server = TCPServer(request_callback)
+        server.listen(8001)
+        server.start()
+
+    Connections stay open until the client closes them; the requests read
+    together (pipelined) are answered in order with one write.
+    """
+
+    def __init__(self, request_callback, io_loop=None, max_buffer_size=None, read_chunk_size=None):
+        self.request_callback = request_callback
         self.io_loop = io_loop
         self._sockets = {}
-        self.max_buffer_size = max_buffer_size
-        self.read_chunk_size = read_chunk_size
+        self._connections = set()
+        self.max_buffer_size = max_buffer_size or 10 * 1024 * 1024  # 10M
+        self.read_chunk_size = read_chunk_size or 64 * 1024  # 64K
 
     def listen(self, port, address=""):
         sockets = bind_sockets(port, address)
@@ -20,7 +37,80 @@ class TCPServer(object):
 
     def add_sockets(self, sockets):
         if self.io_loop is None:
-            self.io_loop = IOLoop.current()
+            self.io_loop = EventLoop()
 
         for sock in sockets:
+            sock.setblocking(False)
             self._sockets[sock.fileno()] = sock
+            self.io_loop.add_handler(sock.fileno(), self._on_accept, READ)
+
+    def start(self):
+        self.io_loop.start()
+
+    def stop(self):
+        """Stop listening and close the connections."""
+        for fd, sock in list(self._sockets.items()):
+            self.io_loop.remove_handler(fd)
+            sock.close()
+        self._sockets.clear()
+        for connection in list(self._connections):
+            connection.close()
+
+    def _on_accept(self, fd, events):
+        sock = self._sockets[fd]
+        while True:
+            try:
+                connection, address = sock.accept()
+            except (IOError, OSError, socket.error) as e:
+                if getattr(e, "errno", None) in WOULD_BLOCK + (errno.ECONNABORTED,):
+                    return
+                raise
+
+            if connection.family in (socket.AF_INET, getattr(socket, "AF_INET6", None)):
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            xtcp_logger.debug("Connection from %s", address)
+            self._connections.add(_ServerConnection(self, connection))
+
+    def _remove_connection(self, connection):
+        self._connections.discard(connection)
+
+
+class _ServerConnection(BufferedSocket):
+
+    def __init__(self, server, sock):
+        self.server = server
+        self._request_context = RequestContext()
+        self._response_context = ResponseContext()
+        BufferedSocket.__init__(self, server.io_loop, sock, server.max_buffer_size, server.read_chunk_size)
+
+    def on_messages(self, messages):
+        responses = []
+        for message in messages:
+            try:
+                request = self._request_context.decrypt(message)
+                result = self.server.request_callback(request.method, request.params)
+                responses.append(self._response_context.encrypt(result))
+            except XTCPContextException as e:
+                responses.append(self._response_context.encrypt(str(e), False))
+            except Exception:
+                responses.append(self._response_context.encrypt(traceback.format_exc(), False))
+        self.write(b"".join(responses))
+
+    def on_close(self, error):
+        if error is not None:
+            xtcp_logger.debug("Connection closed: %s", error)
+        self.server._remove_connection(self)
+
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.DEBUG)
+
+    def handler_request(method, params):
+        if method == "toupper":
+            return params.upper()
+        raise XTCPContextException("method {} not exist".format(method))
+
+    server = TCPServer(handler_request)
+    server.listen(8001)
+    server.start()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+r"""Messages and event loop of the raw engine, without Tornado.
+
+A message is the compact JSON of a request (``{"method": ..., "params": ...}``)
+or of a response (``{"s": status, "v": result or error}``) followed by
+``"\r\n\r\n"``; JSON escapes the line breaks of strings, so the delimiter
+never occurs inside a message. Connections are persistent and a client may
+send the next requests before the responses (pipelining), they are answered
+in order.
+"""
+
+import errno
+import heapq
+import itertools
+import json
+import logging
+import os
+import select
+import socket
+import time
+
+xtcp_logger = logging.getLogger("xtcp")
+
+DELIMITER = b"\r\n\r\n"
+
+#: events of `EventLoop.add_handler`, the values of epoll
+READ = 0x001
+WRITE = 0x004
+ERROR = 0x008 | 0x010
+
+#: errors of non-blocking sockets that only mean "try again later"
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+#: monotonic clock of the timeouts
+timer = getattr(time, "monotonic", time.time)
+
+
+class XTCPConnectionException(Exception):
+    pass
+
+
+class XTCPContextException(Exception):
+    pass
+
+
+class Storage(dict):
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+def _encode(data):
+    message = json.dumps(data, separators=(",", ":"))
+    if not isinstance(message, bytes):
+        message = message.encode("utf-8")
+    return message + DELIMITER
+
+
+def _decode(message):
+    try:
+        return json.loads(message.decode("utf-8"))
+    except ValueError as e:
+        raise XTCPContextException("Malformed message: {}".format(e))
+
+
+class RequestContext(object):
+
+    def encrypt(self, request_message):
+        return _encode({"method": request_message.method, "params": request_message.params})
+
+    def decrypt(self, message):
+        data = _decode(message)
+        if not isinstance(data, dict) or "method" not in data:
+            raise XTCPContextException("Malformed request: method is required")
+        return Storage(method=data["method"], params=data.get("params"))
+
+
+class ResponseContext(object):
+
+    def encrypt(self, result, status=True):
+        return _encode({"s": status, "v": result})
+
+    def decrypt(self, message):
+        """Return the result, raise `XTCPContextException` with the error of a failed request."""
+        data = _decode(message)
+        try:
+            result, status = data["v"], data["s"]
+        except (KeyError, TypeError):
+            raise XTCPContextException("Malformed response")
+        if not status:
+            raise XTCPContextException(result)
+        return result
+
+
+class MessageBuffer(object):
+    """Receive buffer, splits the data read from a socket into messages."""
+
+    def __init__(self, max_message_size):
+        self.max_message_size = max_message_size
+        self._buffer = bytearray()
+        self._search_start = 0
+
+    def feed(self, data):
+        """Add `data` and return the messages it completed, without their delimiter."""
+        self._buffer += data
+
+        messages = []
+        offset = 0
+        while True:
+            end = self._buffer.find(DELIMITER, max(offset, self._search_start))
+            if end < 0:
+                break
+            messages.append(bytes(self._buffer[offset:end]))
+            offset = end + len(DELIMITER)
+
+        if offset:
+            del self._buffer[:offset]
+        #: the delimiter may start in the last bytes searched
+        self._search_start = max(0, len(self._buffer) - len(DELIMITER) + 1)
+        if len(self._buffer) > self.max_message_size:
+            raise XTCPContextException("Message over max size {}".format(self.max_message_size))
+        return messages
+
+
+class _SelectPoller(object):
+    """`select.epoll` interface over `select.select`, for the platforms without epoll."""
+
+    def __init__(self):
+        self._events = {}
+
+    def register(self, fd, events):
+        self._events[fd] = events
+
+    def modify(self, fd, events):
+        self._events[fd] = events
+
+    def unregister(self, fd):
+        self._events.pop(fd, None)
+
+    def poll(self, timeout=-1):
+        readable = [fd for fd, events in self._events.items() if events & READ]
+        writable = [fd for fd, events in self._events.items() if events & WRITE]
+        #: errors show as readable, the recv fails
+        readable, writable, _ = select.select(readable, writable, [], None if timeout < 0 else timeout)
+
+        events = {}
+        for fds, event in ((readable, READ), (writable, WRITE)):
+            for fd in fds:
+                events[fd] = events.get(fd, 0) | event
+        return list(events.items())
+
+    def close(self):
+        self._events.clear()
+
+
+class EventLoop(object):
+    """Single threaded loop of socket handlers and timeouts, on epoll when available.
+
+    `handler(fd, events)` is called with the `READ`, `WRITE` and `ERROR`
+    events of its file descriptor; `run_until(predicate)` runs the loop until
+    the predicate is true, `start()` until `stop()`.
+    """
+
+    def __init__(self):
+        self._poller = select.epoll() if hasattr(select, "epoll") else _SelectPoller()
+        self._handlers = {}
+        self._timeouts = []
+        self._timeout_counter = itertools.count()
+        self._stopped = False
+
+    def time(self):
+        return timer()
+
+    def add_handler(self, fd, handler, events):
+        self._handlers[fd] = handler
+        self._poller.register(fd, events | ERROR)
+
+    def update_handler(self, fd, events):
+        self._poller.modify(fd, events | ERROR)
+
+    def remove_handler(self, fd):
+        if self._handlers.pop(fd, None) is not None:
+            try:
+                self._poller.unregister(fd)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def add_timeout(self, deadline, callback):
+        """Call `callback()` at `deadline` of `time()`, returns a handle for `remove_timeout`."""
+        timeout = [deadline, next(self._timeout_counter), callback]
+        heapq.heappush(self._timeouts, timeout)
+        return timeout
+
+    def remove_timeout(self, timeout):
+        #: cancelled timeouts stay in the heap until they are due
+        timeout[2] = None
+
+    def stop(self):
+        self._stopped = True
+
+    def start(self):
+        self._stopped = False
+        self.run_until(lambda: self._stopped)
+
+    def run_until(self, predicate, timeout=None):
+        """Run the loop until `predicate()` is true, at most `timeout` seconds; return the predicate."""
+
+        deadline = None if timeout is None else self.time() + timeout
+        while not predicate():
+            now = self.time()
+            if deadline is not None and now >= deadline:
+                break
+
+            poll_timeout = self._run_timeouts(now)
+            if deadline is not None:
+                poll_timeout = deadline - now if poll_timeout < 0 else min(poll_timeout, deadline - now)
+            #: the timeouts may have satisfied the predicate
+            if predicate():
+                break
+
+            try:
+                events = self._poller.poll(poll_timeout)
+            except (IOError, OSError, select.error) as e:
+                if _error_code(e) == errno.EINTR:
+                    continue
+                raise
+
+            for fd, fd_events in events:
+                handler = self._handlers.get(fd)
+                if handler is not None:
+                    handler(fd, fd_events)
+        return predicate()
+
+    def _run_timeouts(self, now):
+        """Run the due timeouts, return the seconds to the next one (-1 without)."""
+        while self._timeouts:
+            deadline, _, callback = self._timeouts[0]
+            if callback is not None and deadline > now:
+                return deadline - now
+            heapq.heappop(self._timeouts)
+            if callback is not None:
+                callback()
+        return -1
+
+    def close(self):
+        self._poller.close()
+
+
+def _error_code(error):
+    return getattr(error, "errno", None) or (error.args[0] if error.args else None)
+
+
+def bind_sockets(port, address=None, backlog=128, family=socket.AF_UNSPEC):
+    """Non-blocking listening sockets for `port` on every address of `address` (all interfaces by default)."""
+
+    sockets = []
+    for af, socktype, proto, _, sockaddr in socket.getaddrinfo(
+            address or None, port, family, socket.SOCK_STREAM, 0, socket.AI_PASSIVE):
+        sock = socket.socket(af, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if af == getattr(socket, "AF_INET6", None) and hasattr(socket, "IPPROTO_IPV6"):
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(False)
+        sock.bind(sockaddr)
+        sock.listen(backlog)
+        sockets.append(sock)
+    return sockets
+
+
+class BufferedSocket(object):
+    """Non-blocking socket of an `EventLoop` with a write buffer, base of both connection sides.
+
+    Subclasses handle the complete messages in `on_messages` and the end of
+    the connection in `on_close`. A `connecting` socket buffers the writes
+    until its non-blocking connect succeeds and `on_connect` is called.
+    """
+
+    def __init__(self, io_loop, sock, max_message_size, read_chunk_size, connecting=False):
+        self.io_loop = io_loop
+        self.socket = sock
+        self.read_chunk_size = read_chunk_size
+        self.connecting = connecting
+
+        self._read_buffer = MessageBuffer(max_message_size)
+        self._write_buffer = bytearray()
+        self._events = READ | WRITE if connecting else READ
+        self.closed = False
+
+        self.socket.setblocking(False)
+        self.io_loop.add_handler(self.socket.fileno(), self._on_events, self._events)
+
+    def write(self, data):
+        """Send `data` now as far as the socket takes it, the rest once it is writable."""
+        if self.closed:
+            raise XTCPConnectionException("Connection closed")
+        self._write_buffer += data
+        if not self._events & WRITE:
+            self._flush()
+
+    def on_connect(self):
+        pass
+
+    def on_messages(self, messages):
+        raise NotImplementedError()
+
+    def on_close(self, error):
+        raise NotImplementedError()
+
+    def close(self, error=None):
+        if self.closed:
+            return
+        self.closed = True
+        self.io_loop.remove_handler(self.socket.fileno())
+        self.socket.close()
+        self.on_close(error)
+
+    def _set_events(self, events):
+        if events != self._events and not self.closed:
+            self._events = events
+            self.io_loop.update_handler(self.socket.fileno(), events)
+
+    def _on_events(self, fd, events):
+        if self.connecting:
+            if not events & (WRITE | ERROR):
+                return
+            error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self.close(XTCPConnectionException("Connection failed: {}".format(os.strerror(error))))
+                return
+            self.connecting = False
+            self.on_connect()
+
+        if events & READ:
+            self._read()
+        if events & WRITE and not self.closed:
+            self._flush()
+        #: a hang up with data left is closed by the read of its end
+        if events & ERROR and not events & READ and not self.closed:
+            self.close(XTCPConnectionException("Connection error"))
+
+    def _read(self):
+        try:
+            data = self.socket.recv(self.read_chunk_size)
+        except (IOError, OSError, socket.error) as e:
+            if _error_code(e) not in WOULD_BLOCK:
+                self.close(XTCPConnectionException("Connection error: {}".format(e)))
+            return
+        if not data:
+            self.close()
+            return
+
+        try:
+            messages = self._read_buffer.feed(data)
+        except XTCPContextException as e:
+            self.close(e)
+            return
+        if messages:
+            self.on_messages(messages)
+
+    def _flush(self):
+        while self._write_buffer:
+            try:
+                sent = self.socket.send(self._write_buffer)
+            except (IOError, OSError, socket.error) as e:
+                if _error_code(e) in WOULD_BLOCK:
+                    break
+                self.close(XTCPConnectionException("Connection error: {}".format(e)))
+                return
+            del self._write_buffer[:sent]
+        self._set_events(READ | WRITE if self._write_buffer else READ)
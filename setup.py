@@ -30,6 +30,7 @@ def get_version():
 install_requires = [
     'tornado',
     'requests',
+    'futures; python_version < "3"',
 ]
 
 # tests_require = ['mock', 'nose', 'unittest2', 'python-snappy']
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""The asyncio engine with its own client, on Python 3 only; no ``async``
+syntax here so that Python 2 still imports this module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+if asyncio is not None:
+    from pyxtcp.tcp.asyncio.client import RPCClient
+    from pyxtcp.tcp.asyncio.server import RPCServer
+    from pyxtcp.tcp.asyncio.util import (
+        CONNECTION_TYPE_IN_REQUEST, FRAME_FORMAT_BINARY, RESPONSE_ERROR_TAG, RESPONSE_SUCCESS_TAG, FrameDecoder,
+        RPCConnectionError, RPCInputError, RPCMessage, add_message_deadline, encode_frame,
+    )
+    from pyxtcp.transport import parse_local_address
+
+
+def _request(topic, body, request_id=None, flags=0):
+    return RPCMessage(CONNECTION_TYPE_IN_REQUEST, topic, body, request_id, flags)
+
+
+@unittest.skipIf(asyncio is None, "asyncio needs Python 3")
+class FrameDecoderTest(unittest.TestCase):
+
+    def _decode(self, frames, frame_format=None):
+        data = b"".join(b"".join(encode_frame(tube, frame_format)) for tube in frames)
+        decoder = FrameDecoder(CONNECTION_TYPE_IN_REQUEST)
+        #: one byte at a time, every frame is cut everywhere
+        messages = []
+        for index in range(len(data)):
+            messages.extend(decoder.feed(data[index:index + 1]))
+        self.assertFalse(decoder.has_buffered_data())
+        return messages
+
+    def test_text_frames(self):
+        messages = self._decode([_request(b"echo", b"xtcp"), _request(b"a\"tb", b"x" * 5000, request_id=7, flags=3)])
+        self.assertEqual([(m.topic, m.body, m.request_id, m.flags) for m in messages],
+                         [(b"echo", b"xtcp", None, 0), (b"a\"tb", b"x" * 5000, 7, 3)])
+
+    def test_binary_frames(self):
+        messages = self._decode([_request(b"echo", b"xtcp", request_id=1), _request(b"echo", b"", request_id=2)],
+                                FRAME_FORMAT_BINARY)
+        self.assertEqual([(m.body, m.request_id) for m in messages], [(b"xtcp", 1), (b"", 2)])
+
+    def test_deadline(self):
+        [message] = self._decode([add_message_deadline(_request(b"echo", b"xtcp", request_id=1), 5)])
+        self.assertEqual(message.body, b"xtcp")
+        self.assertIsNotNone(message.deadline)
+
+    def test_malformed(self):
+        for data in (b"xxxx\"r\"n", b"x" * 2048):
+            with self.assertRaises(RPCInputError):
+                FrameDecoder(CONNECTION_TYPE_IN_REQUEST).feed(data)
+        with self.assertRaises(RPCInputError):
+            FrameDecoder(CONNECTION_TYPE_IN_REQUEST, body_max_bytes=10).feed(
+                b"".join(encode_frame(_request(b"echo", b"x" * 11))))
+
+
+@unittest.skipIf(asyncio is None, "asyncio needs Python 3")
+class AsyncioEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.calls = []
+
+    def _callback(self, message):
+        self.calls.append(message.topic)
+        if message.topic == b"fail":
+            raise ValueError("failed")
+        if message.topic == b"sleep":
+            return asyncio.sleep(float(message.body), result=message.body)
+        return message.body
+
+    def _serve(self, port=0, **kwargs):
+        server = RPCServer(self._callback, loop=self.loop, **kwargs)
+        listening = self.loop.run_until_complete(server.listen(port, "127.0.0.1"))
+        self.addCleanup(self.loop.run_until_complete, listening.wait_closed())
+        self.addCleanup(server.start_draining)
+        return server
+
+    def _client(self, host, port=None, **kwargs):
+        client = RPCClient(host, port, loop=self.loop, connect_timeout=5, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def _port(self, server):
+        return server._server.sockets[0].getsockname()[1]
+
+    def test_concurrent_requests(self):
+        server = self._serve(keep_alive=True)
+        client = self._client("127.0.0.1", self._port(server))
+        responses = self.loop.run_until_complete(asyncio.gather(
+            client.fetch(_request(b"sleep", b"0.2")), client.fetch(_request(b"echo", b"xtcp")),
+            client.fetch(_request(b"fail", b""))))
+
+        self.assertEqual([(r.topic, r.body) for r in responses[:2]],
+                         [(RESPONSE_SUCCESS_TAG, b"0.2"), (RESPONSE_SUCCESS_TAG, b"xtcp")])
+        self.assertEqual(responses[2].topic, RESPONSE_ERROR_TAG)
+        self.assertIn(b"failed", responses[2].body)
+        #: the slow request did not hold up the others on the same connection
+        self.assertEqual(self.calls, [b"sleep", b"echo", b"fail"])
+        self.assertEqual(len(server._connections), 1)
+
+    def test_client_options(self):
+        server = self._serve(keep_alive=True, compression_threshold=0)
+        for kwargs in ({"binary_header": True}, {"compression": "zlib", "compression_threshold": 0}):
+            client = self._client("127.0.0.1", self._port(server), **kwargs)
+            response = self.loop.run_until_complete(client.fetch(_request(b"echo", b"xtcp" * 1000)))
+            self.assertEqual(response.body, b"xtcp" * 1000, kwargs)
+
+    def test_timeout(self):
+        server = self._serve(keep_alive=True)
+        client = self._client("127.0.0.1", self._port(server))
+        with self.assertRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(client.fetch(_request(b"sleep", b"0.3"), timeout=0.05))
+        #: the late response is dropped, the connection is still used
+        response = self.loop.run_until_complete(client.fetch(_request(b"echo", b"xtcp"), timeout=5))
+        self.assertEqual(response.body, b"xtcp")
+        #: the server finishes the slow request before the loop is closed
+        self.loop.run_until_complete(asyncio.sleep(0.3))
+
+    def test_local_address(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        name = "test-{}".format(uuid.uuid4().hex[:8])
+        self.addCleanup(os.remove, parse_local_address("shm://{}".format(name)).path)
+        for address in ("unix://{}".format(os.path.join(path, "xtcp.sock")), "shm://{}".format(name)):
+            self._serve(address, keep_alive=True)
+            client = self._client(address)
+            response = self.loop.run_until_complete(client.fetch(_request(b"echo", b"xtcp")))
+            self.assertEqual(response.body, b"xtcp", address)
+
+    def test_connect_error(self):
+        server = self._serve()
+        port = self._port(server)
+        server.start_draining()
+        client = self._client("127.0.0.1", port)
+        with self.assertRaises(RPCConnectionError):
+            self.loop.run_until_complete(client.fetch(_request(b"echo", b"xtcp")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import gc
+import random
+import socket
+import unittest
+import weakref
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from pyxtcp.balancer import STRATEGY_LEAST_OUTSTANDING, LoadBalancer, RPCNoEndpointError
+from pyxtcp.metrics import Metrics
+from pyxtcp.tcp.tornado.balanced_client import BalancedRPCClient
+from pyxtcp.tcp.tornado.multi_client import ClientConnectionItem
+from pyxtcp.tcp.tornado.server import RPCServer
+from pyxtcp.tcp.tornado.util import CONNECTION_TYPE_IN_REQUEST, RPCConnectError, RPCMessage, is_busy_response
+
+
+class _Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class LoadBalancerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = _Clock()
+
+    def _balancer(self, addresses=("a:1", "b:1", "c:1"), **kwargs):
+        return LoadBalancer(list(addresses), clock=self.clock, random_=random.Random(1), **kwargs)
+
+    def _fail(self, balancer, address, count):
+        for _ in range(count):
+            balancer.finish(balancer.pick(exclude=[other for other in ("a:1", "b:1", "c:1") if other != address]),
+                            0, False)
+
+    def test_options(self):
+        with self.assertRaises(ValueError):
+            LoadBalancer()
+        with self.assertRaises(ValueError):
+            LoadBalancer(["a:1"], strategy="random")
+        with self.assertRaises(RPCNoEndpointError):
+            LoadBalancer([]).pick()
+
+    def test_least_outstanding(self):
+        balancer = self._balancer(strategy=STRATEGY_LEAST_OUTSTANDING)
+        picked = [balancer.pick().address for _ in range(3)]
+        self.assertEqual(sorted(picked), ["a:1", "b:1", "c:1"])
+        self.assertEqual([endpoint.outstanding for endpoint in balancer.endpoints()], [1, 1, 1])
+
+    def test_p2c_prefers_fast(self):
+        balancer = self._balancer(addresses=("a:1", "b:1"))
+        balancer.finish(balancer.pick(exclude=["b:1"]), 0.01)
+        balancer.finish(balancer.pick(exclude=["a:1"]), 0.5)
+        self.assertEqual(set(balancer.pick().address for _ in range(5)), set(["a:1"]))
+
+        #: a latency not updated for `latency_ttl` is forgotten
+        self.clock.now += 2
+        self.assertEqual(set(balancer.pick().address for _ in range(20)), set(["a:1", "b:1"]))
+
+    def test_exclude(self):
+        balancer = self._balancer()
+        self.assertEqual(balancer.pick(exclude=["a:1", "b:1"]).address, "c:1")
+        self.assertIn(balancer.pick(exclude=["a:1", "b:1", "c:1"]).address, ["a:1", "b:1", "c:1"])
+
+    def test_ejected_after_failures(self):
+        balancer = self._balancer(max_failures=2, ejection_time=10, max_ejection_percent=50)
+        self._fail(balancer, "a:1", 2)
+        self.assertEqual(set(balancer.pick().address for _ in range(10)), set(["b:1", "c:1"]))
+
+        self.clock.now += 10
+        self.assertEqual(balancer.pick(exclude=["b:1", "c:1"]).address, "a:1")
+        #: ejected again in a row, for twice as long
+        self._fail(balancer, "a:1", 2)
+        self.assertEqual(balancer.endpoints()[0].ejected_until, self.clock.now + 20)
+
+    def test_max_ejection_percent(self):
+        balancer = self._balancer(max_failures=1, max_ejection_percent=50)
+        self._fail(balancer, "a:1", 1)
+        self._fail(balancer, "b:1", 1)
+        self.assertEqual([endpoint.ejected_until is not None for endpoint in balancer.endpoints()],
+                         [True, False, False])
+
+    def test_all_ejected_used(self):
+        balancer = self._balancer(addresses=("a:1",), max_failures=1, max_ejection_percent=100)
+        self._fail(balancer, "a:1", 1)
+        self.assertTrue(balancer.endpoints()[0].is_ejected(self.clock.now))
+        self.assertEqual(balancer.pick().address, "a:1")
+
+    def test_slow_endpoint_ejected(self):
+        balancer = self._balancer(min_requests=1, slow_ratio=5)
+        for address, seconds in (("a:1", 0.01), ("b:1", 0.02), ("c:1", 1)):
+            others = [other for other in ("a:1", "b:1", "c:1") if other != address]
+            balancer.finish(balancer.pick(exclude=others), seconds)
+        self.assertEqual([endpoint.is_ejected(self.clock.now) for endpoint in balancer.endpoints()],
+                         [False, False, True])
+
+
+class RemovedEndpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addresses = ["a:1", "b:1"]
+        self.removed = []
+        self.balancer = LoadBalancer(provider=lambda: self.addresses, refresh_interval=0)
+        self.balancer.add_remove_callback(self.removed.append)
+
+    def test_removed_after_last_request(self):
+        endpoint = self.balancer.pick(exclude=["b:1"])
+        self.addresses = ["b:1"]
+        self.assertEqual([e.address for e in self.balancer.endpoints()], ["b:1"])
+        self.assertEqual(self.removed, [])
+
+        self.balancer.finish(endpoint, 0.01)
+        self.assertEqual(self.removed, ["a:1"])
+        self.balancer.endpoints()
+        self.assertEqual(self.removed, ["a:1"])
+
+    def test_back_before_last_request(self):
+        endpoint = self.balancer.pick(exclude=["b:1"])
+        self.addresses = ["b:1"]
+        self.balancer.endpoints()
+        self.addresses = ["a:1", "b:1"]
+        self.assertIs(self.balancer.endpoints()[0], endpoint)
+
+        self.balancer.finish(endpoint, 0.01)
+        self.assertEqual(self.removed, [])
+
+
+class BalancedClientTest(unittest.TestCase):
+
+    def test_dropped_client_closed(self):
+        io_loop = IOLoop()
+        ports = []
+        for _ in range(2):
+            server = RPCServer(lambda message: message.body, io_loop=io_loop, keep_alive=True)
+            server.listen(0, "127.0.0.1")
+            ports.append(list(server._sockets.values())[0].getsockname()[1])
+        addresses = [("127.0.0.1", ports[0])]
+        metrics = Metrics()
+        client = BalancedRPCClient(provider=lambda: list(addresses), refresh_interval=0, io_loop=io_loop,
+                                   client_options={"connect_timeout": 5, "metrics": metrics})
+
+        @gen.coroutine
+        def _call():
+            yield client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", "xtcp")))
+            dropped = weakref.ref(client._clients[addresses[0]])
+
+            addresses[:] = [("127.0.0.1", ports[1])]
+            yield client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", "xtcp")))
+            self.assertEqual(list(client._clients), addresses)
+
+            #: its gauges are gone and nothing else refers to it
+            gauges = metrics.snapshot()["pyxtcp_client_connections"]
+            self.assertEqual(set(dict(labels)["address"] for labels, _ in gauges),
+                             set(["127.0.0.1,{}".format(ports[1])]))
+            gc.collect()
+            self.assertIsNone(dropped())
+
+        try:
+            io_loop.run_sync(_call, timeout=5)
+        finally:
+            client.close()
+            io_loop.close(all_fds=True)
+
+    def _servers(self, io_loop, *options):
+        ports = []
+        for kwargs in options:
+            server = RPCServer(lambda message: message.body, io_loop=io_loop, keep_alive=True, **kwargs)
+            server.listen(0, "127.0.0.1")
+            self.addCleanup(server.stop)
+            ports.append(list(server._sockets.values())[0].getsockname()[1])
+        return ports
+
+    def _fetch(self, io_loop, client):
+        return io_loop.run_sync(lambda: client.fetch(ClientConnectionItem(
+            RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", "xtcp"))), timeout=5)
+
+    def test_busy_server_retried(self):
+        io_loop = IOLoop()
+        self.addCleanup(io_loop.close, all_fds=True)
+        busy_port, port = self._servers(io_loop, {"max_inflight_requests": 0}, {})
+        for max_retries, busy in ((1, False), (0, True)):
+            client = BalancedRPCClient([("127.0.0.1", busy_port), ("127.0.0.1", port)], max_retries=max_retries,
+                                       io_loop=io_loop, client_options={"connect_timeout": 5},
+                                       strategy=STRATEGY_LEAST_OUTSTANDING)
+            try:
+                #: the first request goes to the busy server, it has no outstanding requests either
+                client.balancer.pick(exclude=[("127.0.0.1", busy_port)])
+                response = self._fetch(io_loop, client)
+            finally:
+                client.close()
+            self.assertEqual(is_busy_response(response), busy)
+
+    def test_connect_error_retried(self):
+        io_loop = IOLoop()
+        self.addCleanup(io_loop.close, all_fds=True)
+        [port] = self._servers(io_loop, {})
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        closed_port = sock.getsockname()[1]
+        sock.close()
+
+        for max_retries, retried in ((1, True), (0, False)):
+            client = BalancedRPCClient(["127.0.0.1:{}".format(closed_port), "127.0.0.1:{}".format(port)],
+                                       max_retries=max_retries, io_loop=io_loop, client_options={"connect_timeout": 5},
+                                       strategy=STRATEGY_LEAST_OUTSTANDING)
+            try:
+                #: the first request goes to the closed port, it has no outstanding requests either
+                client.balancer.pick(exclude=["127.0.0.1:{}".format(closed_port)])
+                if retried:
+                    self.assertEqual(self._fetch(io_loop, client).body, "xtcp")
+                else:
+                    with self.assertRaises(RPCConnectError):
+                        self._fetch(io_loop, client)
+            finally:
+                client.close()
+
+if __name__ == "__main__":
+    unittest.main()
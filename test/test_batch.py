@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import functools
+import threading
+import time
+import unittest
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from pyxtcp.codec import get_all_codecs
+from pyxtcp.executor import CallbackExecutor
+from pyxtcp.service import RPCServiceError, Service
+from pyxtcp.tcp.tornado.multi_client import RPCClient
+from pyxtcp.tcp.tornado.server import RPCServer
+from pyxtcp.tcp.tornado.simple_client import RPCClientHandler, SimpleRPCClient
+from pyxtcp.tcp.tornado.util import (
+    BATCH_TOPIC, CONNECTION_TYPE_IN_RESPONSE, RESPONSE_ERROR_TAG, RESPONSE_SUCCESS_TAG, RPCBatch, RPCMessage,
+    get_flags_codec_id, server_callback_by_codec,
+)
+
+service = Service()
+
+#: msgpack is optional
+HAS_MSGPACK = "msgpack" in [codec.name for codec in get_all_codecs()]
+
+
+class CompanyService(object):
+
+    @staticmethod
+    @service.with_f_rpc
+    def get_company(company_id):
+        if company_id < 0:
+            raise ValueError("company {} not found".format(company_id))
+        return {"company_id": company_id}
+
+    @staticmethod
+    @service.with_f_rpc
+    def get_thread(seconds):
+        time.sleep(seconds)
+        return threading.current_thread().name
+
+    @staticmethod
+    @service.with_f_rpc
+    @gen.coroutine
+    def sleep(seconds):
+        yield gen.sleep(seconds)
+        raise gen.Return(seconds)
+
+
+def _batch(codec=None):
+    batch = RPCBatch(codec)
+    batch.add("CompanyService.get_company", company_id=1)
+    batch.add("CompanyService.get_company", company_id=-1)
+    batch.add("CompanyService.missing")
+    return batch
+
+
+class RPCBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+
+    def tearDown(self):
+        self.io_loop.close(all_fds=True)
+
+    def _call(self, batch, executor=None):
+        @gen.coroutine
+        def _run():
+            body = yield server_callback_by_codec(service, batch.to_message(), executor)
+            raise gen.Return(batch.parse_response(RPCMessage(CONNECTION_TYPE_IN_RESPONSE, RESPONSE_SUCCESS_TAG, body)))
+
+        return self.io_loop.run_sync(_run, timeout=5)
+
+    def test_message(self):
+        batch = _batch()
+        self.assertEqual(batch.add("CompanyService.sleep", seconds=0), 3)
+        message = batch.to_message()
+        self.assertEqual((message.topic, message.request_id), (BATCH_TOPIC, None))
+
+    @unittest.skipUnless(HAS_MSGPACK, "msgpack is not installed")
+    def test_codec_message(self):
+        message = _batch("msgpack").to_message()
+        self.assertEqual((message.request_id, get_flags_codec_id(message.flags)), (0, 2))
+
+    def test_results_in_order(self):
+        for codec in ("json", "msgpack") if HAS_MSGPACK else ("json",):
+            results = self._call(_batch(codec))
+            self.assertEqual([result.s for result in results], [True, False, False], codec)
+            self.assertEqual(results[0].v, {"company_id": 1})
+            self.assertIn("company -1 not found", results[1].v)
+            self.assertIn("rpc function CompanyService.missing not exist", results[2].v)
+
+    def test_coroutines_concurrent(self):
+        batch = RPCBatch()
+        for _ in range(5):
+            batch.add("CompanyService.sleep", seconds=0.1)
+
+        start_time = time.time()
+        self.assertEqual([result.v for result in self._call(batch)], [0.1] * 5)
+        self.assertLess(time.time() - start_time, 0.4)
+
+    def test_executor(self):
+        executor = CallbackExecutor(max_workers=4)
+        batch = RPCBatch()
+        for _ in range(4):
+            batch.add("CompanyService.get_thread", seconds=0.1)
+
+        try:
+            results = self._call(batch, executor)
+        finally:
+            executor.shutdown()
+        #: every call ran in its own worker
+        self.assertEqual(len(set(result.v for result in results)), 4)
+        self.assertNotIn(threading.current_thread().name, [result.v for result in results])
+
+    def test_malformed_batch(self):
+        with self.assertRaises(RPCServiceError):
+            RPCBatch().parse_response(RPCMessage(CONNECTION_TYPE_IN_RESPONSE, RESPONSE_ERROR_TAG, "failed"))
+
+        batch = RPCBatch()
+        message = batch.to_message()
+        message.body = batch.codec.encode({"method": "CompanyService.get_company"})
+        with self.assertRaises(RPCServiceError):
+            self.io_loop.run_sync(lambda: server_callback_by_codec(service, message), timeout=5)
+
+
+class BatchCallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+        self.server = RPCServer(functools.partial(server_callback_by_codec, service), io_loop=self.io_loop)
+        self.server.listen(0, "127.0.0.1")
+        self.port = list(self.server._sockets.values())[0].getsockname()[1]
+
+    def tearDown(self):
+        self.server.stop()
+        self.io_loop.clear_current()
+        self.io_loop.close(all_fds=True)
+
+    def _execute(self, client, codec=None):
+        batch = RPCClientHandler(client).batch(codec)
+        company = batch.service_name("CompanyService")
+        company.get_company(company_id=1)
+        company.get_company(company_id=-1)
+        company.sleep(seconds=0.01)
+        with self.assertRaises(TypeError):
+            company.get_company(1)
+
+        try:
+            return self.io_loop.run_sync(batch.execute, timeout=5)
+        finally:
+            client.close()
+
+    def test_simple_client(self):
+        results = self._execute(SimpleRPCClient("127.0.0.1", self.port, connect_timeout=5))
+        self.assertEqual([result.s for result in results], [True, False, True])
+        self.assertEqual([results[0].v, results[2].v], [{"company_id": 1}, 0.01])
+
+    def test_pooled_client(self):
+        client = RPCClient("127.0.0.1", self.port, io_loop=self.io_loop, connect_timeout=5)
+        results = self._execute(client, "msgpack" if HAS_MSGPACK else None)
+        self.assertEqual([result.s for result in results], [True, False, True])
+        self.assertEqual(results[0].v, {"company_id": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import threading
+import time
+import unittest
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from pyxtcp.cache import ResultCache, make_cache_key
+from pyxtcp.http.async_client import AsyncRPCClient
+
+
+class _Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = _Clock()
+        self.cache = ResultCache(max_size=2, ttl=10, clock=self.clock)
+
+    def test_ttl(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2, ttl=1)
+        self.clock.now += 5
+        self.assertEqual(self.cache.get("a"), (True, 1))
+        self.assertEqual(self.cache.get("b"), (False, None))
+        self.clock.now += 5
+        self.assertEqual(self.cache.get("a"), (False, None))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_lru(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertEqual(self.cache.get("b"), (False, None))
+        self.assertEqual(self.cache.get("a"), (True, 1))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_invalidate(self):
+        self.cache.set("Service.method:1", 1)
+        self.cache.set("Service.other:1", 2)
+        self.cache.invalidate(prefix="Service.method:")
+        self.assertEqual(self.cache.get("Service.method:1"), (False, None))
+        self.cache.invalidate("Service.other:1")
+        self.assertEqual(len(self.cache), 0)
+
+    def test_call(self):
+        calls = []
+        self.assertEqual(self.cache.call("a", lambda: calls.append(1) or "result"), "result")
+        self.assertEqual(self.cache.call("a", lambda: calls.append(1) or "result"), "result")
+        self.assertEqual(calls, [1])
+
+    def test_failed_call_not_cached(self):
+        def _fail():
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            self.cache.call("a", _fail)
+        self.assertEqual(self.cache.call("a", lambda: "result"), "result")
+
+    def test_coalesced_threads(self):
+        calls = []
+        started = threading.Event()
+        results = []
+
+        def _slow():
+            calls.append(1)
+            started.set()
+            time.sleep(0.1)
+            return "result"
+
+        def _waiter():
+            started.wait()
+            results.append(self.cache.call("a", _slow))
+
+        threads = [threading.Thread(target=_waiter) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        results.append(self.cache.call("a", _slow))
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ["result"] * 4)
+        self.assertEqual(calls, [1])
+
+    def test_cache_key(self):
+        self.assertEqual(make_cache_key("m", {"a": 1, "b": 2}), make_cache_key("m", {"b": 2, "a": 1}))
+        self.assertNotEqual(make_cache_key("m", {"a": 1}), make_cache_key("n", {"a": 1}))
+
+
+class _CountingClient(AsyncRPCClient):
+    """Answers every call itself after a while, counting them."""
+
+    def __init__(self, *args, **kwargs):
+        super(_CountingClient, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    @gen.coroutine
+    def post(self, path, codec, payload):
+        self.calls.append((path, payload))
+        yield gen.sleep(0.01)
+        raise gen.Return(payload)
+
+
+class AsyncClientCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.client = _CountingClient("127.0.0.1:1", io_loop=self.io_loop, metrics=None)
+
+    def tearDown(self):
+        self.client.close()
+        self.io_loop.close(all_fds=True)
+
+    def test_coalesced_and_cached(self):
+        company = self.client.service_name("CompanyService", cache=ResultCache())
+
+        @gen.coroutine
+        def _call():
+            first = yield [company.get_company(company_id=1), company.get_company(company_id=1)]
+            second = yield company.get_company(company_id=1)
+            other = yield company.get_company(company_id=2)
+            raise gen.Return(first + [second, other])
+
+        results = self.io_loop.run_sync(_call, timeout=5)
+        self.assertEqual(results, [{"company_id": 1}] * 3 + [{"company_id": 2}])
+        self.assertEqual(len(self.client.calls), 2)
+
+    def test_cache_methods(self):
+        company = self.client.service_name("CompanyService", cache=ResultCache(), cache_methods=["get_company"])
+
+        @gen.coroutine
+        def _call():
+            for _ in range(2):
+                yield company.get_company(company_id=1)
+                yield company.update_company(company_id=1)
+
+        self.io_loop.run_sync(_call, timeout=5)
+        self.assertEqual([path for path, _ in self.client.calls],
+                         ["/CompanyService/get_company", "/CompanyService/update_company",
+                          "/CompanyService/update_company"])
+
+
+if __name__ == "__main__":
+    unittest.main()
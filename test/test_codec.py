@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import unittest
+
+from pyxtcp.codec import PickleCodec, get_all_codecs, get_codec, to_bytes
+from pyxtcp.compression import get_all_compressors
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_to_bytes(self):
+        self.assertEqual(to_bytes(memoryview(b"xtcp")), b"xtcp")
+        self.assertEqual(to_bytes(bytearray(b"xtcp")), b"xtcp")
+        self.assertIs(to_bytes(b"xtcp"), b"xtcp")
+
+    def test_decode_views(self):
+        value = {"name": "xtcp", "ids": [1, 2]}
+        for codec in get_all_codecs() + [PickleCodec()]:
+            if codec.name == "raw":
+                continue
+            body = codec.encode(value)
+            self.assertEqual(codec.decode(memoryview(body)), value, codec.name)
+            self.assertEqual(codec.decode(bytearray(body)), value, codec.name)
+        self.assertEqual(get_codec("raw").decode(memoryview(b"xtcp")), b"xtcp")
+
+    def test_compress_views(self):
+        data = b"xtcp" * 1024
+        for compressor in get_all_compressors():
+            compressed = compressor.compress(memoryview(data))
+            self.assertEqual(compressor.decompress(bytearray(compressed)), data, compressor.name)
+
+
+if __name__ == "__main__":
+    unittest.main()
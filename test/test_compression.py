@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import unittest
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from pyxtcp.compression import (
+    RPCCompressionError, ZlibCompressor, get_all_compressors, get_compressor, register_compressor,
+)
+from pyxtcp.tcp.tornado.multi_client import ClientConnectionItem, RPCClient
+from pyxtcp.tcp.tornado.multiplex_client import MultiplexRPCClient
+from pyxtcp.tcp.tornado.server import RPCServer
+from pyxtcp.tcp.tornado.util import (
+    CONNECTION_TYPE_IN_REQUEST, FLAG_COMPRESSED, FLAG_COMPRESSION_MASK, RPCInputError, RPCMessage,
+    compress_message, decompress_body,
+)
+
+
+class CompressorTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = b"xtcp" * 1024
+        for compressor in get_all_compressors():
+            self.assertEqual(compressor.decompress(compressor.compress(data)), data, compressor.name)
+
+    def test_max_size(self):
+        compressed_data = [(compressor, compressor.compress(b"\0" * 100000)) for compressor in get_all_compressors()]
+        for compressor, compressed in compressed_data:
+            self.assertEqual(len(compressor.decompress(compressed, 100000)), 100000, compressor.name)
+            with self.assertRaises(RPCCompressionError):
+                compressor.decompress(compressed, 1000)
+
+    def test_malformed(self):
+        for compressor in get_all_compressors():
+            with self.assertRaises(RPCCompressionError):
+                compressor.decompress(b"not compressed")
+
+    def test_get_compressor(self):
+        zlib = get_compressor("zlib")
+        self.assertIs(get_compressor(zlib.compression_id), zlib)
+        self.assertIs(get_compressor(zlib), zlib)
+        with self.assertRaises(RPCCompressionError):
+            get_compressor("unknown")
+
+    def test_register_id_range(self):
+        compressor = ZlibCompressor()
+        compressor.compression_id = 8
+        with self.assertRaises(RPCCompressionError):
+            register_compressor(compressor)
+
+
+class CompressMessageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.compression_id = get_compressor("zlib").compression_id
+
+    def _message(self, body):
+        return RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", body, 1)
+
+    def test_threshold(self):
+        tube = compress_message(self._message(b"x" * 100), self.compression_id, 1024)
+        self.assertEqual(tube.body, b"x" * 100)
+        self.assertEqual(tube.flags, self.compression_id)
+
+        tube = compress_message(self._message(b"x" * 2048), self.compression_id, 1024)
+        self.assertEqual(tube.flags, self.compression_id | FLAG_COMPRESSED)
+        self.assertLess(len(tube.body), 2048)
+        self.assertEqual(decompress_body(tube.body, tube.flags), b"x" * 2048)
+
+    def test_incompressible(self):
+        body = os.urandom(2048)
+        tube = compress_message(self._message(body), self.compression_id, 1024)
+        self.assertEqual((tube.body, tube.flags & FLAG_COMPRESSED), (body, 0))
+
+    def test_unknown_compression(self):
+        #: ids 4-7 are not registered, the body is sent uncompressed
+        tube = compress_message(self._message(b"x" * 2048), 7, 1024)
+        self.assertEqual((tube.body, tube.flags & (FLAG_COMPRESSED | FLAG_COMPRESSION_MASK)), (b"x" * 2048, 0))
+
+    def test_malformed_body(self):
+        with self.assertRaises(RPCInputError):
+            decompress_body(b"not compressed", self.compression_id | FLAG_COMPRESSED)
+        with self.assertRaises(RPCInputError):
+            decompress_body(b"x" * 100, 7 | FLAG_COMPRESSED)
+
+
+class CompressedCallTest(unittest.TestCase):
+
+    def test_echo(self):
+        io_loop = IOLoop()
+        bodies = []
+
+        def _callback(message):
+            bodies.append(message.body)
+            return message.body
+
+        server = RPCServer(_callback, io_loop=io_loop, compression_threshold=0)
+        server.listen(0, "127.0.0.1")
+        port = list(server._sockets.values())[0].getsockname()[1]
+        body = "xtcp" * 10000
+
+        @gen.coroutine
+        def _call(client):
+            response = yield client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", body)))
+            raise gen.Return(response)
+
+        try:
+            for client_class in (RPCClient, MultiplexRPCClient):
+                client = client_class("127.0.0.1", port, io_loop=io_loop, connect_timeout=5, compression="zlib",
+                                      compression_threshold=1024)
+                try:
+                    response = io_loop.run_sync(lambda: _call(client), timeout=5)
+                finally:
+                    client.close()
+                self.assertEqual(response.body, body, client_class.__name__)
+                #: the flags of the frame read, the server compressed the response
+                self.assertTrue(response.flags & FLAG_COMPRESSED)
+        finally:
+            server.stop()
+            io_loop.close(all_fds=True)
+        self.assertEqual(bodies, [body, body])
+
+
+if __name__ == "__main__":
+    unittest.main()
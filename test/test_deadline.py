@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import time
+import unittest
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from pyxtcp.deadline import RPCDeadlineExceededError, call_with_deadline, get_deadline, get_timeout
+from pyxtcp.tcp.tornado.multi_client import ClientConnectionItem, RPCClient
+from pyxtcp.tcp.tornado.server import RPCServer
+from pyxtcp.tcp.tornado.util import CONNECTION_TYPE_IN_REQUEST, RPCConnectionError, RPCMessage
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def test_current_deadline(self):
+        deadline = time.time() + 10
+        self.assertEqual(call_with_deadline(deadline, get_deadline), deadline)
+        self.assertIsNone(get_deadline())
+
+    def test_expired(self):
+        with self.assertRaises(RPCDeadlineExceededError):
+            call_with_deadline(time.time() - 1, get_deadline)
+        self.assertIsNone(get_deadline())
+
+    def test_get_timeout(self):
+        self.assertIsNone(get_timeout())
+        self.assertEqual(get_timeout(3), 3)
+        self.assertLessEqual(call_with_deadline(time.time() + 1, get_timeout, (3,)), 1)
+        self.assertLessEqual(call_with_deadline(time.time() + 10, get_timeout, (3,)), 3)
+
+    def test_inherited_by_requests(self):
+        def _request():
+            return ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", "xtcp"))
+
+        self.assertIsNone(_request().deadline)
+        self.assertLessEqual(call_with_deadline(time.time() + 1, _request).get_timeout(), 1)
+
+
+class ServerDeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+
+    def tearDown(self):
+        self.io_loop.close(all_fds=True)
+
+    def test_dropped_after_waiting_for_worker(self):
+        called = []
+
+        def _callback(message):
+            called.append((message.topic, get_deadline() is not None))
+            time.sleep(0.3)
+            return message.body
+
+        server = RPCServer(_callback, io_loop=self.io_loop, executor="thread", executor_max_workers=1)
+        server.listen(0, "127.0.0.1")
+        port = list(server._sockets.values())[0].getsockname()[1]
+        client = RPCClient("127.0.0.1", port, io_loop=self.io_loop, connect_timeout=5)
+
+        @gen.coroutine
+        def _call():
+            first = client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "first", "xtcp"),
+                                                      timeout=5))
+            yield gen.sleep(0.05)
+            #: the client stops waiting at the deadline too
+            with self.assertRaises(RPCConnectionError):
+                yield client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "second", "xtcp"),
+                                                        timeout=0.1))
+            response = yield first
+            yield gen.sleep(0.1)
+            raise gen.Return(response)
+
+        try:
+            response = self.io_loop.run_sync(_call, timeout=10)
+        finally:
+            client.close()
+            server.stop()
+
+        self.assertEqual(response.body, "xtcp")
+        self.assertEqual(called, [("first", True)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""The Tornado client against the asyncio server, which runs on its own
+Python 3 interpreter: ``PYXTCP_ASYNCIO_PYTHON``, python3 by default."""
+
+import json
+import os
+import socket
+import subprocess
+import time
+import unittest
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from pyxtcp.tcp.tornado.multi_client import ClientConnectionItem, RPCClient
+from pyxtcp.tcp.tornado.util import (
+    CONNECTION_TYPE_IN_REQUEST, RESPONSE_ERROR_TAG, RESPONSE_SUCCESS_TAG, RPCMessage,
+    add_message_deadline, message_utils,
+)
+
+ASYNCIO_PYTHON = os.environ.get("PYXTCP_ASYNCIO_PYTHON", "python3")
+PACKAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+ASYNCIO_SERVER = """
+import json, sys
+from pyxtcp.deadline import get_deadline
+from pyxtcp.tcp.asyncio import RPCServer
+
+def _callback(message):
+    return json.dumps({"body": message.body.decode("utf-8"), "deadline": get_deadline() is not None})
+
+RPCServer(_callback, keep_alive=True).run(int(sys.argv[1]), "127.0.0.1", use_uvloop=False)
+"""
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return True
+        except socket.error:
+            time.sleep(0.05)
+    return False
+
+
+class AsyncioServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.port = _free_port()
+        env = dict(os.environ, PYTHONPATH=PACKAGE_PATH)
+        try:
+            cls.server = subprocess.Popen([ASYNCIO_PYTHON, "-c", ASYNCIO_SERVER, str(cls.port)], env=env)
+        except OSError:
+            raise unittest.SkipTest("{} not found".format(ASYNCIO_PYTHON))
+        if not _wait_port(cls.port):
+            cls.tearDownClass()
+            raise unittest.SkipTest("asyncio server did not start")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+
+    def test_deadline_stripped(self):
+        io_loop = IOLoop()
+        client = RPCClient("127.0.0.1", self.port, io_loop=io_loop, connect_timeout=5)
+
+        @gen.coroutine
+        def _call():
+            response = yield client.fetch(ClientConnectionItem(
+                RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", '{"a":1}'), timeout=5))
+            raise gen.Return(response)
+
+        try:
+            response = io_loop.run_sync(_call, timeout=10)
+        finally:
+            client.close()
+            io_loop.close(all_fds=True)
+
+        self.assertEqual(response.topic, RESPONSE_SUCCESS_TAG, response.body)
+        self.assertEqual(json.loads(response.body), {"body": '{"a":1}', "deadline": True})
+
+    def test_expired_request(self):
+        tube = add_message_deadline(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", "xtcp", request_id=7), 0)
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+        try:
+            sock.sendall(b"".join(message_utils.encrypt_chunks(tube)))
+            response = b""
+            #: the header and the body end with the same delimiter
+            while response.count(message_utils.body_suffix) < 2:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                response += data
+        finally:
+            sock.close()
+
+        self.assertTrue(response.startswith(b"*7\"t"), response)
+        self.assertIn(b"\"t" + RESPONSE_ERROR_TAG + b"\"t", response)
+        self.assertIn(b"Deadline exceeded", response)
+
+
+if __name__ == "__main__":
+    unittest.main()
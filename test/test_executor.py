@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import functools
+import json
+import os
+import threading
+import unittest
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from pyxtcp.executor import CallbackExecutor, RPCExecutorError
+from pyxtcp.tcp.tornado.multi_client import ClientConnectionItem, RPCClient
+from pyxtcp.tcp.tornado.server import RPCServer
+from pyxtcp.tcp.tornado.util import (
+    CONNECTION_TYPE_IN_REQUEST, RESPONSE_ERROR_TAG, RPCMessage, Service,
+    server_callback_by_codec,
+)
+from pyxtcp.http.service import Service as HTTPService
+
+
+service = Service()
+http_service = HTTPService()
+
+
+class PidService(object):
+
+    @staticmethod
+    @service.with_f_rpc
+    def get_pid(name):
+        return {"name": name, "pid": os.getpid()}
+
+
+class CoroutineService(object):
+
+    @staticmethod
+    @service.with_f_rpc
+    @gen.coroutine
+    def get_thread(name):
+        yield gen.moment
+        raise gen.Return({"name": name, "thread": threading.current_thread().name})
+
+
+def _raise_on_load():
+    raise ImportError("class changed")
+
+
+class _Unloadable(object):
+    """Pickled in a worker, its loading fails in the parent."""
+
+    def __reduce__(self):
+        return _raise_on_load, ()
+
+
+class HTTPPidService(object):
+
+    @staticmethod
+    @http_service.with_f_rpc
+    def get_pid(name):
+        return [name, os.getpid()]
+
+
+class ProcessExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.executor = CallbackExecutor("process", max_workers=1)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        self.io_loop.close(all_fds=True)
+
+    def test_service_function(self):
+        self.executor.register(http_service)
+
+        @gen.coroutine
+        def _call():
+            result = yield self.executor.submit_call(
+                None, HTTPPidService.get_pid, kwargs={"name": "xtcp"},
+                service=http_service, func_key="HTTPPidService.get_pid")
+            raise gen.Return(result)
+
+        name, pid = self.io_loop.run_sync(_call, timeout=10)
+        self.assertEqual(name, "xtcp")
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(self.executor.pending_count, 0)
+
+    def test_unpicklable_call(self):
+        lock = threading.Lock()
+        with self.assertRaises(RPCExecutorError):
+            self.executor.submit(functools.partial(lock.acquire))
+        self.assertEqual(self.executor.pending_count, 0)
+
+    def test_unpicklable_result(self):
+        future = self.executor.submit_call(None, threading.Lock)
+        self.assertIsInstance(future.exception(timeout=10), RPCExecutorError)
+        self.assertEqual(self.executor.pending_count, 0)
+
+    def test_unloadable_result(self):
+        future = self.executor.submit_call(None, _Unloadable)
+        self.assertIsInstance(future.exception(timeout=10), RPCExecutorError)
+
+
+class ThreadExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+
+    def tearDown(self):
+        self.io_loop.close(all_fds=True)
+
+    def _fetch(self, server, topic, body):
+        server.listen(0, "127.0.0.1")
+        port = list(server._sockets.values())[0].getsockname()[1]
+        client = RPCClient("127.0.0.1", port, io_loop=self.io_loop)
+
+        @gen.coroutine
+        def _call():
+            response = yield client.fetch(ClientConnectionItem(
+                RPCMessage(CONNECTION_TYPE_IN_REQUEST, topic, body), timeout=5))
+            raise gen.Return(response)
+
+        try:
+            return self.io_loop.run_sync(_call, timeout=10)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_coroutine_server_callback(self):
+        @gen.coroutine
+        def _callback(message):
+            yield gen.moment
+            raise gen.Return(threading.current_thread().name)
+
+        server = RPCServer(_callback, io_loop=self.io_loop, executor="thread", executor_max_workers=1)
+        response = self._fetch(server, "thread", "xtcp")
+        self.assertEqual(response.body, threading.current_thread().name)
+
+    def test_coroutine_service_method(self):
+        executor = CallbackExecutor("thread", max_workers=1)
+        server = RPCServer(functools.partial(server_callback_by_codec, service, executor=executor),
+                           io_loop=self.io_loop)
+        try:
+            response = self._fetch(server, "CoroutineService.get_thread", json.dumps({"name": "xtcp"}))
+        finally:
+            executor.shutdown()
+        self.assertEqual(json.loads(response.body), {"name": "xtcp", "thread": threading.current_thread().name})
+
+    def test_future_in_worker(self):
+        def _callback(message):
+            return CoroutineService.get_thread(message.body)
+
+        server = RPCServer(_callback, io_loop=self.io_loop, executor="thread", executor_max_workers=1)
+        response = self._fetch(server, "thread", "xtcp")
+        self.assertEqual(response.topic, RESPONSE_ERROR_TAG)
+        self.assertIn("coroutines must run on the IOLoop", response.body)
+
+
+class ProcessServerTest(unittest.TestCase):
+
+    def test_tcp_server(self):
+        io_loop = IOLoop()
+        server = RPCServer(functools.partial(server_callback_by_codec, service), io_loop=io_loop,
+                           executor="process", executor_max_workers=1)
+        server.listen(0, "127.0.0.1")
+        port = list(server._sockets.values())[0].getsockname()[1]
+        client = RPCClient("127.0.0.1", port, io_loop=io_loop)
+
+        @gen.coroutine
+        def _call():
+            response = yield client.fetch(ClientConnectionItem(RPCMessage(
+                CONNECTION_TYPE_IN_REQUEST, "PidService.get_pid", json.dumps({"name": "xtcp"}))))
+            raise gen.Return(response)
+
+        try:
+            response = io_loop.run_sync(_call, timeout=10)
+        finally:
+            client.close()
+            server.stop()
+            server.executor.shutdown()
+            io_loop.close(all_fds=True)
+
+        self.assertNotEqual(response.topic, RESPONSE_ERROR_TAG, response.body)
+        result = json.loads(response.body)
+        self.assertEqual(result["name"], "xtcp")
+        self.assertNotEqual(result["pid"], os.getpid())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import functools
+import unittest
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from pyxtcp.fanout import gather, map_calls
+from pyxtcp.service import RPCServiceError, Service
+from pyxtcp.tcp.tornado.multi_client import RPCClient
+from pyxtcp.tcp.tornado.server import RPCServer
+from pyxtcp.tcp.tornado.simple_client import RPCClientHandler, SimpleRPCClient
+from pyxtcp.tcp.tornado.util import server_callback_by_codec
+
+service = Service()
+
+
+class CompanyService(object):
+
+    @staticmethod
+    @service.with_f_rpc
+    @gen.coroutine
+    def get_company(company_id):
+        yield gen.sleep(0.01)
+        if company_id < 0:
+            raise ValueError("company {} not found".format(company_id))
+        raise gen.Return({"company_id": company_id})
+
+
+class MapCallsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.running = 0
+        self.max_running = 0
+        self.started = []
+
+    def tearDown(self):
+        self.io_loop.close(all_fds=True)
+
+    @gen.coroutine
+    def _double(self, item):
+        self.started.append(item)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        yield gen.sleep(0.01 * (item % 3))
+        self.running -= 1
+        if item < 0:
+            raise ValueError(item)
+        raise gen.Return(item * 2)
+
+    def _run(self, func):
+        return self.io_loop.run_sync(func, timeout=5)
+
+    def test_results_in_order(self):
+        results = self._run(lambda: map_calls(self._double, range(10), concurrency=3, io_loop=self.io_loop))
+        self.assertEqual(results, [item * 2 for item in range(10)])
+        self.assertEqual(self.max_running, 3)
+
+    def test_unbounded(self):
+        self._run(lambda: map_calls(self._double, range(10), io_loop=self.io_loop))
+        self.assertEqual(self.max_running, 10)
+
+    def test_empty(self):
+        self.assertEqual(self._run(lambda: map_calls(self._double, [], io_loop=self.io_loop)), [])
+
+    def test_first_error(self):
+        with self.assertRaises(ValueError):
+            self._run(lambda: map_calls(self._double, [0, -1, 2, 3, 4], concurrency=2, io_loop=self.io_loop))
+        #: no call is started after the failed one
+        self.assertEqual(self.started, [0, -1, 2])
+
+    def test_raising_method(self):
+        def _method(item):
+            raise ValueError(item)
+
+        with self.assertRaises(ValueError):
+            self._run(lambda: map_calls(_method, [1], io_loop=self.io_loop))
+
+    def test_concurrency(self):
+        with self.assertRaises(ValueError):
+            map_calls(self._double, [1], concurrency=0)
+
+    def test_gather(self):
+        self.assertEqual(self._run(lambda: gather(self._double(2), self._double(1))), [4, 2])
+
+
+class ServiceProxyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+        self.server = RPCServer(functools.partial(server_callback_by_codec, service), io_loop=self.io_loop)
+        self.server.listen(0, "127.0.0.1")
+        self.port = list(self.server._sockets.values())[0].getsockname()[1]
+
+    def tearDown(self):
+        self.server.stop()
+        self.io_loop.clear_current()
+        self.io_loop.close(all_fds=True)
+
+    def _run(self, client, func):
+        try:
+            return self.io_loop.run_sync(functools.partial(func, RPCClientHandler(client)), timeout=5)
+        finally:
+            client.close()
+
+    def test_simple_client(self):
+        @gen.coroutine
+        def _call(handler):
+            company = handler.service_name("CompanyService")
+            result = yield company.get_company(company_id=1)
+            results = yield handler.map(lambda i: company.get_company(company_id=i), range(5))
+            raise gen.Return((result, results))
+
+        result, results = self._run(SimpleRPCClient("127.0.0.1", self.port, connect_timeout=5), _call)
+        self.assertEqual(result, {"company_id": 1})
+        self.assertEqual(results, [{"company_id": i} for i in range(5)])
+
+    def test_pooled_client(self):
+        @gen.coroutine
+        def _call(handler):
+            company = handler.service_name("CompanyService")
+            results = yield handler.gather(company.get_company(company_id=1), company.get_company(company_id=2))
+            raise gen.Return(results)
+
+        client = RPCClient("127.0.0.1", self.port, io_loop=self.io_loop, connect_timeout=5)
+        self.assertEqual(self._run(client, _call), [{"company_id": 1}, {"company_id": 2}])
+
+    def test_failed_call(self):
+        @gen.coroutine
+        def _call(handler):
+            yield handler.service_name("CompanyService").get_company(company_id=-1)
+
+        with self.assertRaises(RPCServiceError) as context:
+            self._run(SimpleRPCClient("127.0.0.1", self.port, connect_timeout=5), _call)
+        self.assertIn("company -1 not found", str(context.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import unittest
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from pyxtcp.tcp.tornado.multi_client import ClientConnectionItem, RPCClient
+from pyxtcp.tcp.tornado.multiplex_client import MultiplexRPCClient
+from pyxtcp.tcp.tornado.server import RPCServer
+from pyxtcp.tcp.tornado.util import (
+    BINARY_HEADER_SIZE, CONNECTION_TYPE_IN_REQUEST, CONNECTION_TYPE_IN_RESPONSE, FRAME_FORMAT_BINARY,
+    FRAME_FORMAT_TEXT, MAX_REQUEST_ID, PROTOCOL_VERSION_1, PROTOCOL_VERSION_2, RPCInputError, RPCMessage,
+    message_utils, read_body, read_frame_body, write_message,
+)
+
+
+def _done_future(result=None):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class _RecordingStream(object):
+    """Stands for an IOStream: keeps the written buffers, reads from `data`."""
+
+    def __init__(self, data=b""):
+        self.data = data
+        self.offset = 0
+        self.written = []
+        self.read = []
+
+    def write(self, data):
+        self.written.append(data)
+        return _done_future()
+
+    def read_bytes(self, num_bytes):
+        data = self.data[self.offset:self.offset + num_bytes]
+        self.offset += num_bytes
+        self.read.append(data)
+        return _done_future(data)
+
+
+class ZeroCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.large_body = b"x" * message_utils.zero_copy_threshold
+        self.small_body = b"x" * (message_utils.zero_copy_threshold - 1)
+
+    def _message(self, body):
+        return RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", body)
+
+    def test_write_large_body(self):
+        stream = _RecordingStream()
+        write_message(stream, self._message(self.large_body))
+        self.assertEqual(len(stream.written), 3)
+        self.assertIs(stream.written[1], self.large_body)
+        self.assertEqual(b"".join(stream.written), message_utils.encrypt(self._message(self.large_body)))
+
+    def test_write_small_body(self):
+        stream = _RecordingStream()
+        write_message(stream, self._message(self.small_body))
+        self.assertEqual(stream.written, [message_utils.encrypt(self._message(self.small_body))])
+
+    def test_read_large_body(self):
+        stream = _RecordingStream(self.large_body + message_utils.body_suffix)
+        body = read_body(stream, len(self.large_body)).result()
+        self.assertEqual(body, self.large_body)
+        #: the buffer read is not sliced again
+        self.assertIs(body, stream.read[0])
+
+    def test_read_small_body(self):
+        stream = _RecordingStream(self.small_body + message_utils.body_suffix)
+        self.assertEqual(read_body(stream, len(self.small_body)).result(), self.small_body)
+
+    def test_malformed_suffix(self):
+        for body in (self.small_body, self.large_body):
+            stream = _RecordingStream(body + b"xxxx")
+            with self.assertRaises(RPCInputError):
+                read_body(stream, len(body)).result()
+
+
+
+class MultiplexHeaderTest(unittest.TestCase):
+
+    def _parse(self, tube):
+        return message_utils.parse_header(CONNECTION_TYPE_IN_REQUEST, message_utils.encrypt_header(tube))
+
+    def test_round_trip(self):
+        #: the topic is length-prefixed, it may contain the item delimiter
+        topic = b"Company" + message_utils.header_item_delimiter + b"get"
+        header_tube = self._parse(RPCMessage(CONNECTION_TYPE_IN_REQUEST, topic, b"xtcp", request_id=7, flags=3))
+        self.assertEqual(header_tube.version, PROTOCOL_VERSION_2)
+        self.assertEqual((header_tube.topic, header_tube.request_id, header_tube.flags), (topic, 7, 3))
+        self.assertEqual(header_tube.body_len, 4)
+
+    def test_version_1(self):
+        header_tube = self._parse(RPCMessage(CONNECTION_TYPE_IN_REQUEST, b"echo", b"xtcp"))
+        self.assertEqual((header_tube.version, header_tube.request_id), (PROTOCOL_VERSION_1, None))
+
+    def test_malformed(self):
+        header = message_utils.encrypt_header(
+            RPCMessage(CONNECTION_TYPE_IN_REQUEST, b"echo", b"xtcp", request_id=MAX_REQUEST_ID + 1))
+        with self.assertRaises(RPCInputError):
+            message_utils.parse_header(CONNECTION_TYPE_IN_REQUEST, header)
+
+        header = message_utils.encrypt_header(RPCMessage(CONNECTION_TYPE_IN_REQUEST, b"echo", b"xtcp", request_id=1))
+        with self.assertRaises(RPCInputError):
+            message_utils.parse_header(CONNECTION_TYPE_IN_REQUEST, header.replace(b"echo", b"echoo"))
+
+
+class BinaryHeaderTest(unittest.TestCase):
+
+    def _round_trip(self, tube):
+        stream = _RecordingStream()
+        write_message(stream, tube, FRAME_FORMAT_BINARY)
+        data = b"".join(stream.written)
+        self.assertEqual(message_utils.sniff_frame_format(data[:1]), FRAME_FORMAT_BINARY)
+
+        header_tube = message_utils.parse_binary_header(CONNECTION_TYPE_IN_REQUEST, data[:BINARY_HEADER_SIZE])
+        body = read_frame_body(_RecordingStream(data[BINARY_HEADER_SIZE:]), header_tube).result()
+        return header_tube, body
+
+    def test_round_trip(self):
+        for body in (b"xtcp", b"x" * message_utils.zero_copy_threshold):
+            tube = RPCMessage(CONNECTION_TYPE_IN_REQUEST, b"Company.get", body, request_id=7, flags=3)
+            header_tube, read = self._round_trip(tube)
+            self.assertEqual((header_tube.topic, header_tube.request_id, header_tube.flags), (b"Company.get", 7, 3))
+            self.assertEqual(read, body)
+
+    def test_without_request_id(self):
+        header_tube, _ = self._round_trip(RPCMessage(CONNECTION_TYPE_IN_REQUEST, b"echo", b"xtcp"))
+        self.assertEqual(header_tube.request_id, 0)
+
+    def test_text_frame(self):
+        data = message_utils.encrypt(RPCMessage(CONNECTION_TYPE_IN_REQUEST, b"echo", b"xtcp"))
+        self.assertEqual(message_utils.sniff_frame_format(data[:1]), FRAME_FORMAT_TEXT)
+
+    def test_malformed(self):
+        stream = _RecordingStream()
+        write_message(stream, RPCMessage(CONNECTION_TYPE_IN_REQUEST, b"echo", b"xtcp"), FRAME_FORMAT_BINARY)
+        header = b"".join(stream.written)[:BINARY_HEADER_SIZE]
+        for malformed, connection_type in ((header[:-1], CONNECTION_TYPE_IN_REQUEST),
+                                           (b"xx" + header[2:], CONNECTION_TYPE_IN_REQUEST),
+                                           (header, CONNECTION_TYPE_IN_RESPONSE)):
+            with self.assertRaises(RPCInputError):
+                message_utils.parse_binary_header(connection_type, malformed)
+
+    def test_clients(self):
+        io_loop = IOLoop()
+        server = RPCServer(lambda message: message.body, io_loop=io_loop, keep_alive=True)
+        server.listen(0, "127.0.0.1")
+        port = list(server._sockets.values())[0].getsockname()[1]
+
+        @gen.coroutine
+        def _call(client):
+            response = yield client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", "xtcp")))
+            raise gen.Return(response)
+
+        try:
+            for client_class in (RPCClient, MultiplexRPCClient):
+                client = client_class("127.0.0.1", port, io_loop=io_loop, connect_timeout=5, binary_header=True)
+                try:
+                    self.assertEqual(io_loop.run_sync(lambda: _call(client), timeout=5).body, "xtcp")
+                finally:
+                    client.close()
+        finally:
+            server.stop()
+            io_loop.close(all_fds=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
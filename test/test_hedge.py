@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import unittest
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from pyxtcp.hedge import HedgePolicy, hedged_call
+from pyxtcp.tcp.tornado.multi_client import ClientConnectionItem, RPCClient
+from pyxtcp.tcp.tornado.server import RPCServer
+from pyxtcp.tcp.tornado.util import CONNECTION_TYPE_IN_REQUEST, RPCMessage
+
+
+def _policy(delay, **kwargs):
+    policy = HedgePolicy(min_samples=1, min_delay=delay, **kwargs)
+    policy.record(delay)
+    return policy
+
+
+class HedgePolicyTest(unittest.TestCase):
+
+    def test_no_delay_before_min_samples(self):
+        policy = HedgePolicy(min_samples=2)
+        policy.record(0.1)
+        self.assertIsNone(policy.get_delay())
+        policy.record(0.1)
+        self.assertEqual(policy.get_delay(), 0.1)
+
+    def test_percentile(self):
+        policy = HedgePolicy(percentile=50, min_samples=1, min_delay=0)
+        for seconds in (0.1, 0.2, 0.3, 0.4):
+            policy.record(seconds)
+        self.assertEqual(policy.get_delay(), 0.3)
+
+    def test_methods(self):
+        policy = HedgePolicy(methods=["CompanyService.get_company"])
+        self.assertTrue(policy.should_hedge("CompanyService.get_company"))
+        self.assertFalse(policy.should_hedge("CompanyService.update_company"))
+
+
+class HedgedCallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.attempts = []
+
+    def tearDown(self):
+        self.io_loop.close(all_fds=True)
+
+    def _send(self, attempt):
+        future = Future()
+        self.attempts.append(future)
+        return future
+
+    def test_first_answer_wins(self):
+        policy = _policy(0.01)
+
+        @gen.coroutine
+        def _call():
+            future = hedged_call(self._send, policy, self.io_loop)
+            yield gen.sleep(0.05)
+            self.assertEqual(len(self.attempts), 2)
+            self.attempts[1].set_result("second")
+            self.attempts[0].set_result("first")
+            result = yield future
+            raise gen.Return(result)
+
+        self.assertEqual(self.io_loop.run_sync(_call, timeout=5), "second")
+        self.assertEqual((policy.requests, policy.hedges), (1, 1))
+
+    def test_no_hedge_after_answer(self):
+        policy = _policy(0.05)
+
+        @gen.coroutine
+        def _call():
+            future = hedged_call(self._send, policy, self.io_loop)
+            self.attempts[0].set_result("first")
+            result = yield future
+            yield gen.sleep(0.1)
+            raise gen.Return(result)
+
+        self.assertEqual(self.io_loop.run_sync(_call, timeout=5), "first")
+        self.assertEqual(len(self.attempts), 1)
+
+    def test_failure_waits_for_running_attempts(self):
+        policy = _policy(0.01)
+
+        @gen.coroutine
+        def _call():
+            future = hedged_call(self._send, policy, self.io_loop)
+            yield gen.sleep(0.05)
+            self.attempts[0].set_exception(ValueError("first"))
+            yield gen.moment
+            self.assertFalse(future.done())
+            self.attempts[1].set_result("second")
+            result = yield future
+            raise gen.Return(result)
+
+        self.assertEqual(self.io_loop.run_sync(_call, timeout=5), "second")
+
+    def test_all_attempts_failed(self):
+        policy = _policy(0.01)
+
+        @gen.coroutine
+        def _call():
+            future = hedged_call(self._send, policy, self.io_loop)
+            yield gen.sleep(0.05)
+            self.attempts[0].set_exception(ValueError("first"))
+            self.attempts[1].set_exception(ValueError("second"))
+            yield future
+
+        with self.assertRaises(ValueError):
+            self.io_loop.run_sync(_call, timeout=5)
+
+
+class HedgedClientTest(unittest.TestCase):
+
+    def test_slow_request_hedged(self):
+        io_loop = IOLoop()
+        calls = []
+
+        @gen.coroutine
+        def _callback(message):
+            calls.append(message.body)
+            #: only the first request is slow
+            if len(calls) == 1:
+                yield gen.sleep(0.5)
+            raise gen.Return(message.body)
+
+        server = RPCServer(_callback, io_loop=io_loop, keep_alive=True)
+        server.listen(0, "127.0.0.1")
+        port = list(server._sockets.values())[0].getsockname()[1]
+        policy = _policy(0.05)
+        client = RPCClient("127.0.0.1", port, io_loop=io_loop, connect_timeout=5, hedge_policy=policy)
+
+        @gen.coroutine
+        def _call():
+            start_time = io_loop.time()
+            response = yield client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", "xtcp")))
+            self.assertLess(io_loop.time() - start_time, 0.4)
+            #: the late answer is dropped
+            yield gen.sleep(0.6)
+            raise gen.Return(response)
+
+        try:
+            response = io_loop.run_sync(_call, timeout=5)
+        finally:
+            client.close()
+            io_loop.close(all_fds=True)
+        self.assertEqual(response.body, "xtcp")
+        self.assertEqual(calls, ["xtcp", "xtcp"])
+        self.assertEqual(policy.hedges, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import unittest
+
+import tornado.httpserver
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+from pyxtcp.http.async_client import AsyncRPCClient
+from pyxtcp.http.client import RPCClient
+from pyxtcp.http.server import RPCServer
+from pyxtcp.http.service import Service
+from pyxtcp.http.util import RPCCallError, RPCConnectError, RPCRequestError
+
+service = Service()
+
+
+class SleepService(object):
+
+    running = 0
+    max_running = 0
+
+    @staticmethod
+    @service.with_f_rpc
+    @gen.coroutine
+    def sleep(seconds):
+        SleepService.running += 1
+        SleepService.max_running = max(SleepService.max_running, SleepService.running)
+        try:
+            yield gen.sleep(seconds)
+        finally:
+            SleepService.running -= 1
+        raise gen.Return(seconds)
+
+    @staticmethod
+    @service.with_f_rpc
+    def fail():
+        raise ValueError("failed")
+
+
+def serve(rpc_server, io_loop):
+    """Serve `rpc_server` on `io_loop`, return its port."""
+    sock, port = bind_unused_port()
+    rpc_server._server = tornado.httpserver.HTTPServer(rpc_server._get_application(), io_loop=io_loop)
+    rpc_server._server.add_sockets([sock])
+    return port
+
+
+class PayloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clients = [RPCClient("127.0.0.1:1"), AsyncRPCClient("127.0.0.1:1")]
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+
+    def test_positional_without_codec(self):
+        for client in self.clients:
+            with self.assertRaises(TypeError):
+                client.service_name("EchoService").echo(1)
+
+    def test_positional_and_keyword(self):
+        for client in self.clients:
+            with self.assertRaises(TypeError):
+                client.service_name("EchoService", codec="raw").echo(1, value=2)
+            with self.assertRaises(TypeError):
+                client.service_name("EchoService", codec="raw").echo(1, 2)
+
+    def test_batch_positional(self):
+        for client in self.clients:
+            batch = client.batch()
+            with self.assertRaises(TypeError):
+                batch.service_name("EchoService").echo(1)
+            self.assertEqual(batch.service_name("EchoService").echo(value=1), 0)
+            self.assertEqual(batch.calls, [{"method": "EchoService.echo", "kwargs": {"value": 1}}])
+
+
+
+class AsyncClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.server = RPCServer(0, metrics=None)
+        self.server.add_service(service)
+        self.address = "127.0.0.1:{}".format(serve(self.server, self.io_loop))
+        SleepService.max_running = 0
+
+    def tearDown(self):
+        self.server.start_draining()
+        self.io_loop.close(all_fds=True)
+
+    def _run(self, client, func):
+        try:
+            return self.io_loop.run_sync(lambda: func(client.service_name("SleepService")), timeout=5)
+        finally:
+            client.close()
+
+    def test_connections_reused(self):
+        client = AsyncRPCClient(self.address, io_loop=self.io_loop, metrics=None)
+
+        @gen.coroutine
+        def _call(sleep_service):
+            results = []
+            for _ in range(3):
+                result = yield sleep_service.sleep(seconds=0)
+                results.append(result)
+                self.assertEqual(len(client._idle_streams), 1)
+            raise gen.Return(results)
+
+        self.assertEqual(self._run(client, _call), [0, 0, 0])
+
+    def test_max_connections(self):
+        client = AsyncRPCClient(self.address, max_connections=2, io_loop=self.io_loop, metrics=None)
+
+        @gen.coroutine
+        def _call(sleep_service):
+            results = yield [sleep_service.sleep(seconds=0.05) for _ in range(6)]
+            self.assertEqual(len(client._idle_streams), 2)
+            raise gen.Return(results)
+
+        self.assertEqual(self._run(client, _call), [0.05] * 6)
+        self.assertEqual(SleepService.max_running, 2)
+
+    def test_failed_call(self):
+        client = AsyncRPCClient(self.address, io_loop=self.io_loop, metrics=None)
+
+        @gen.coroutine
+        def _call(sleep_service):
+            yield sleep_service.fail()
+
+        with self.assertRaises(RPCCallError):
+            self._run(client, _call)
+
+    def test_request_timeout(self):
+        client = AsyncRPCClient(self.address, request_timeout=0.05, io_loop=self.io_loop, metrics=None)
+
+        @gen.coroutine
+        def _call(sleep_service):
+            with self.assertRaises(RPCRequestError):
+                yield sleep_service.sleep(seconds=0.2)
+            #: the connection of the timed out request is not reused
+            self.assertEqual(len(client._idle_streams), 0)
+            yield gen.sleep(0.2)
+
+        self._run(client, _call)
+
+    def test_connect_error(self):
+        sock, port = bind_unused_port()
+        sock.close()
+        client = AsyncRPCClient("127.0.0.1:{}".format(port), io_loop=self.io_loop, metrics=None)
+
+        @gen.coroutine
+        def _call(sleep_service):
+            yield sleep_service.sleep(seconds=0)
+
+        with self.assertRaises(RPCConnectError):
+            self._run(client, _call)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import unittest
+
+import tornado.httpserver
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+from pyxtcp.http.async_client import AsyncRPCClient
+from pyxtcp.http.server import RPCInputError, RPCMethodError, RPCServer, _make_arguments_check
+from pyxtcp.http.service import Service
+from pyxtcp.http.util import RPCCallError, RPCRequestError
+
+
+class LazyService(object):
+
+    @staticmethod
+    def ping():
+        return "pong"
+
+
+def _company_service(service):
+
+    @service.register
+    class CompanyService(object):
+
+        @staticmethod
+        def get_company(company_id, fields=None):
+            return {"company_id": company_id, "fields": fields}
+
+    return CompanyService
+
+
+class DispatchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = Service()
+        _company_service(self.service)
+        self.server = RPCServer(0, metrics=None)
+        self.server.add_service(self.service)
+
+    def test_indexed(self):
+        entry = self.server._routes[("CompanyService", "get_company")]
+        self.assertIs(self.server._entries["CompanyService.get_company"], entry)
+        self.assertEqual(entry.method(1), {"company_id": 1, "fields": None})
+
+    def test_added_twice(self):
+        self.server.add_service(self.service)
+        self.assertEqual(len(self.server._services), 1)
+
+    def test_same_method_in_two_services(self):
+        other = Service()
+        _company_service(other)
+        with self.assertRaises(RPCMethodError):
+            self.server.add_service(other)
+
+    def test_registered_later(self):
+        self.service.register_lazy("LazyService", "{}:LazyService".format(__name__))
+        self.assertIsNone(self.server._routes.get(("LazyService", "ping")))
+
+        entry = self.server.index_method("LazyService.ping")
+        self.assertEqual(entry.method(), "pong")
+        self.assertIs(self.server._routes[("LazyService", "ping")], entry)
+        self.assertIsNone(self.server.index_method("LazyService.missing"))
+
+    def test_arguments_check(self):
+        check = _make_arguments_check("CompanyService.get_company", lambda company_id, fields=None: None)
+        check((), {"company_id": 1})
+        check((1,), {})
+        with self.assertRaises(RPCInputError):
+            check((), {})
+        with self.assertRaises(RPCInputError):
+            check((), {"company_id": 1, "name": "xtcp"})
+
+        self.assertIsNone(_make_arguments_check("CompanyService.get_company", len))
+
+
+class DispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        #: run last, after the server and the client are closed
+        self.addCleanup(self.io_loop.close, all_fds=True)
+        service = Service()
+        _company_service(service)
+        service.register_lazy("LazyService", "{}:LazyService".format(__name__))
+
+        server = RPCServer(0, metrics=None)
+        server.add_service(service)
+        sock, port = bind_unused_port()
+        server._server = tornado.httpserver.HTTPServer(server._get_application(), io_loop=self.io_loop)
+        server._server.add_sockets([sock])
+        self.addCleanup(server.start_draining)
+
+        self.client = AsyncRPCClient("127.0.0.1:{}".format(port), io_loop=self.io_loop, metrics=None)
+        self.addCleanup(self.client.close)
+
+    def _run(self, func):
+        return self.io_loop.run_sync(func, timeout=5)
+
+    def test_calls(self):
+        @gen.coroutine
+        def _call():
+            company = yield self.client.service_name("CompanyService").get_company(company_id=1)
+            pong = yield self.client.service_name("LazyService").ping()
+            raise gen.Return((company, pong))
+
+        self.assertEqual(self._run(_call), ({"company_id": 1, "fields": None}, "pong"))
+
+    def test_batch(self):
+        batch = self.client.batch()
+        batch.service_name("CompanyService").get_company(company_id=1)
+        batch.service_name("LazyService").ping()
+        batch.service_name("CompanyService").missing()
+
+        results = self._run(batch.execute)
+        self.assertEqual([result["s"] for result in results], [True, True, False])
+        self.assertEqual(results[1]["v"], "pong")
+
+    def test_errors(self):
+        company = self.client.service_name("CompanyService")
+        for call in (lambda: company.get_company(), lambda: company.get_company(company_id=1, name="xtcp")):
+            with self.assertRaises(RPCCallError):
+                self._run(call)
+        #: an unknown method is answered 500
+        with self.assertRaises(RPCRequestError):
+            self._run(lambda: company.missing())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import unittest
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+
+from pyxtcp.http.async_client import AsyncRPCClient
+from pyxtcp.metrics import (
+    OTHER_LABEL, PROMETHEUS_CONTENT_TYPE, Metrics, PeriodicExporter, disable_metrics, enable_metrics,
+    get_default_metrics, start_metrics_server,
+)
+from pyxtcp.tcp.tornado.multi_client import ClientConnectionItem, RPCClient
+from pyxtcp.tcp.tornado.multiplex_client import MultiplexRPCClient
+from pyxtcp.tcp.tornado.server import RPCServer
+from pyxtcp.tcp.tornado.util import CONNECTION_TYPE_IN_REQUEST, RPCMessage
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics(buckets=(0.1, 1), max_label_sets=2)
+
+    def test_snapshot(self):
+        self.metrics.inc("requests_total", (("method", "get"),))
+        self.metrics.inc("requests_total", (("method", "get"),), 2)
+        self.metrics.set_gauge("connections", 3)
+        self.metrics.gauge_callback("queued", lambda: 4)
+        for value in (0.05, 0.1, 0.5, 5):
+            self.metrics.observe("seconds", value)
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot["requests_total"], [({"method": "get"}, 3)])
+        self.assertEqual(snapshot["connections"], [({}, 3)])
+        self.assertEqual(snapshot["queued"], [({}, 4)])
+        self.assertEqual(snapshot["seconds"], [({}, {
+            "buckets": [(0.1, 2), (1, 3), ("+Inf", 4)], "sum": 5.65, "count": 4})])
+
+    def test_max_label_sets(self):
+        for method in ("a", "b", "c", "d"):
+            self.metrics.inc("requests_total", (("method", method),))
+        self.metrics.inc("requests_total", (("method", "a"),))
+
+        values = dict((labels["method"], value) for labels, value in self.metrics.snapshot()["requests_total"])
+        self.assertEqual(values, {"a": 2, "b": 1, OTHER_LABEL: 2})
+
+    def test_render_prometheus(self):
+        self.metrics.inc("pyxtcp_server_requests_total", (("method", 'say "hi"\n'), ("status", "ok")))
+        self.metrics.observe("pyxtcp_server_callback_seconds", 0.5, (("method", "get"),))
+
+        lines = self.metrics.render_prometheus().splitlines()
+        self.assertIn("# TYPE pyxtcp_server_requests_total counter", lines)
+        self.assertIn('pyxtcp_server_requests_total{method="say \\"hi\\"\\n",status="ok"} 1', lines)
+        self.assertIn("# HELP pyxtcp_server_callback_seconds TCP server callback time", lines)
+        self.assertIn('pyxtcp_server_callback_seconds_bucket{method="get",le="0.1"} 0', lines)
+        self.assertIn('pyxtcp_server_callback_seconds_bucket{method="get",le="+Inf"} 1', lines)
+        self.assertIn('pyxtcp_server_callback_seconds_count{method="get"} 1', lines)
+
+    def test_default_metrics(self):
+        self.addCleanup(disable_metrics)
+        self.assertIsNone(get_default_metrics())
+        self.assertIs(enable_metrics(self.metrics), self.metrics)
+
+        io_loop = IOLoop()
+        client = RPCClient("127.0.0.1", 1, io_loop=io_loop)
+        try:
+            self.assertIs(client.metrics, self.metrics)
+        finally:
+            client.close()
+            io_loop.close(all_fds=True)
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+        self.metrics = Metrics()
+        self.metrics.inc("pyxtcp_server_requests_total", (("method", "get"), ("status", "ok")))
+
+    def tearDown(self):
+        self.io_loop.clear_current()
+        self.io_loop.close(all_fds=True)
+
+    def test_metrics_server(self):
+        server = start_metrics_server(self.metrics, 0, "127.0.0.1")
+        port = list(server._sockets.values())[0].getsockname()[1]
+        http_client = AsyncHTTPClient(io_loop=self.io_loop, force_instance=True)
+        try:
+            response = self.io_loop.run_sync(
+                lambda: http_client.fetch("http://127.0.0.1:{}/metrics".format(port)), timeout=5)
+        finally:
+            http_client.close()
+            server.stop()
+        self.assertEqual(response.headers["Content-Type"], PROMETHEUS_CONTENT_TYPE)
+        self.assertEqual(response.body.decode("utf-8"), self.metrics.render_prometheus())
+
+    def test_periodic_exporter(self):
+        snapshots = []
+        exporter = PeriodicExporter(self.metrics, snapshots.append, interval=0.01)
+        exporter.start()
+        try:
+            self.io_loop.run_sync(lambda: gen.sleep(0.05), timeout=5)
+        finally:
+            exporter.stop()
+        self.assertTrue(snapshots)
+        self.assertEqual(snapshots[0], self.metrics.snapshot())
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def test_request_measured(self):
+        io_loop = IOLoop()
+        metrics = Metrics()
+        server = RPCServer(lambda message: message.body, io_loop=io_loop, metrics=metrics)
+        server.listen(0, "127.0.0.1")
+        port = list(server._sockets.values())[0].getsockname()[1]
+        client = RPCClient("127.0.0.1", port, io_loop=io_loop, connect_timeout=5, metrics=metrics)
+
+        @gen.coroutine
+        def _call():
+            response = yield client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", "xtcp")))
+            #: the write time is observed once the response is flushed
+            yield gen.sleep(0.01)
+            raise gen.Return(response)
+
+        try:
+            io_loop.run_sync(_call, timeout=5)
+        finally:
+            client.close()
+            server.stop()
+            io_loop.close(all_fds=True)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["pyxtcp_server_requests_total"], [({"method": "echo", "status": "ok"}, 1)])
+        [(labels, value)] = snapshot["pyxtcp_client_requests_total"]
+        self.assertEqual((labels["method"], labels["status"], value), ("echo", "ok", 1))
+        for name in ("pyxtcp_server_callback_seconds", "pyxtcp_server_write_seconds", "pyxtcp_client_request_seconds",
+                     "pyxtcp_client_connect_seconds"):
+            self.assertEqual([value["count"] for _, value in snapshot[name]], [1], name)
+
+
+class GaugeCallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.metrics = Metrics()
+
+    def tearDown(self):
+        self.io_loop.close(all_fds=True)
+
+    def _gauges(self):
+        snapshot = self.metrics.snapshot()
+        return snapshot.get("pyxtcp_client_connections", []) + snapshot.get("pyxtcp_client_queued_requests", [])
+
+    def test_removed_on_close(self):
+        clients = [
+            RPCClient("127.0.0.1", 1, io_loop=self.io_loop, metrics=self.metrics),
+            MultiplexRPCClient("127.0.0.1", 1, io_loop=self.io_loop, metrics=self.metrics),
+            AsyncRPCClient("127.0.0.1:1", metrics=self.metrics),
+        ]
+        self.assertEqual(len(self._gauges()), 5)
+
+        for client in clients:
+            client.close()
+        self.assertEqual(self._gauges(), [])
+
+    def test_same_labels(self):
+        first = RPCClient("127.0.0.1", 1, io_loop=self.io_loop, metrics=self.metrics)
+        second = RPCClient("127.0.0.1", 1, io_loop=self.io_loop, metrics=self.metrics)
+
+        #: the gauges registered again by `second` stay
+        first.close()
+        self.assertEqual(len(self._gauges()), 3)
+        second.close()
+        self.assertEqual(self.metrics.snapshot(), {})
+
+    def test_remove_unknown(self):
+        self.metrics.remove_gauge_callback("pyxtcp_client_connections", (("address", "x"),))
+        self.assertEqual(self.metrics.snapshot(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
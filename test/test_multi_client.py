@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import socket
+import unittest
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from pyxtcp.tcp.tornado.multi_client import ClientConnectionItem, RPCClient
+from pyxtcp.tcp.tornado.server import RPCServer
+from pyxtcp.tcp.tornado.util import CONNECTION_TYPE_IN_REQUEST, RPCConnectError, RPCConnectionError, RPCMessage
+
+
+def _item(body, **kwargs):
+    return ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "sleep", body), **kwargs)
+
+
+class RPCClientPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        #: run last, after the servers and clients are closed
+        self.addCleanup(self.io_loop.close, all_fds=True)
+        self.running = 0
+        self.max_running = 0
+
+    @gen.coroutine
+    def _callback(self, message):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        yield gen.sleep(float(message.body))
+        self.running -= 1
+        raise gen.Return(message.body)
+
+    def _client(self, keep_alive=True, **kwargs):
+        server = RPCServer(self._callback, io_loop=self.io_loop, keep_alive=keep_alive)
+        server.listen(0, "127.0.0.1")
+        port = list(server._sockets.values())[0].getsockname()[1]
+        self.addCleanup(server.stop)
+        client = RPCClient("127.0.0.1", port, io_loop=self.io_loop, connect_timeout=5, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def _run(self, func):
+        return self.io_loop.run_sync(func, timeout=5)
+
+    def test_connection_reused(self):
+        client = self._client()
+
+        @gen.coroutine
+        def _call():
+            for _ in range(5):
+                response = yield client.fetch(_item("0"))
+                self.assertEqual(response.body, "0")
+
+        self._run(_call)
+        self.assertEqual(len(client._connections), 1)
+
+    def test_reconnected_without_keep_alive(self):
+        client = self._client(keep_alive=False)
+
+        @gen.coroutine
+        def _call():
+            responses = []
+            for _ in range(3):
+                response = yield client.fetch(_item("0"))
+                responses.append(response.body)
+            raise gen.Return(responses)
+
+        self.assertEqual(self._run(_call), ["0"] * 3)
+
+    def test_max_clients(self):
+        client = self._client(max_clients=2)
+
+        @gen.coroutine
+        def _call():
+            responses = yield [client.fetch(_item("0.05", waiting_timeout=5)) for _ in range(6)]
+            raise gen.Return([response.body for response in responses])
+
+        self.assertEqual(self._run(_call), ["0.05"] * 6)
+        self.assertEqual(self.max_running, 2)
+        self.assertEqual(len(client._connections), 2)
+
+    def test_waiting_timeout(self):
+        client = self._client(max_clients=1)
+
+        @gen.coroutine
+        def _call():
+            first = client.fetch(_item("0.3"))
+            with self.assertRaises(RPCConnectionError):
+                yield client.fetch(_item("0", waiting_timeout=0.05))
+            response = yield first
+            raise gen.Return(response)
+
+        self.assertEqual(self._run(_call).body, "0.3")
+        self.assertEqual(len(client.queue), 0)
+
+    def test_closed_client(self):
+        client = self._client(max_clients=1)
+
+        @gen.coroutine
+        def _call():
+            running = client.fetch(_item("0.1"))
+            waiting = client.fetch(_item("0", waiting_timeout=5))
+            client.close()
+            with self.assertRaises(RPCConnectionError):
+                yield waiting
+            with self.assertRaises(RPCConnectionError):
+                yield client.fetch(_item("0"))
+            #: let the request already running settle before the loop is closed
+            try:
+                yield running
+            except RPCConnectionError:
+                pass
+
+        self._run(_call)
+
+    def test_connect_error(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        client = RPCClient("127.0.0.1", port, io_loop=self.io_loop, connect_timeout=5)
+
+        @gen.coroutine
+        def _call():
+            yield client.fetch(_item("0"))
+
+        try:
+            with self.assertRaises(RPCConnectError):
+                self._run(_call)
+        finally:
+            client.close()
+        self.assertEqual(len(client._connections), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
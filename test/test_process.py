@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+import unittest
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from pyxtcp.process import bind_server_sockets, run_workers, serve_forever
+from pyxtcp.tcp.tornado.multi_client import ClientConnectionItem, RPCClient
+from pyxtcp.tcp.tornado.server import RPCServer
+from pyxtcp.tcp.tornado.util import CONNECTION_TYPE_IN_REQUEST, RPCConnectionError, RPCMessage
+
+
+class BindServerSocketsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_tcp(self):
+        sockets = bind_server_sockets(0, "127.0.0.1")
+        try:
+            self.assertEqual(len(sockets), 1)
+            self.assertEqual(sockets[0].getsockname()[0], "127.0.0.1")
+        finally:
+            for sock in sockets:
+                sock.close()
+
+    @unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "SO_REUSEPORT is not supported")
+    def test_reuse_port(self):
+        first = bind_server_sockets(0, "127.0.0.1", reuse_port=True)
+        try:
+            second = bind_server_sockets(first[0].getsockname()[1], "127.0.0.1", reuse_port=True)
+            second[0].close()
+        finally:
+            first[0].close()
+
+    def test_local_address(self):
+        path = os.path.join(self.path, "xtcp.sock")
+        sockets = bind_server_sockets("unix://{}".format(path))
+        try:
+            self.assertEqual((len(sockets), sockets[0].family), (1, socket.AF_UNIX))
+            self.assertTrue(os.path.exists(path))
+        finally:
+            sockets[0].close()
+
+
+class RunWorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def _runs(self, task_id):
+        """Runs of the worker `task_id` so far, counted in files shared with the forked workers."""
+        return len([name for name in os.listdir(self.path) if name.startswith("{}-".format(task_id))])
+
+    def _record_run(self, task_id):
+        open(os.path.join(self.path, "{}-{}".format(task_id, os.getpid())), "w").close()
+
+    def test_workers_exit(self):
+        run_workers(3, self._record_run)
+        self.assertEqual([self._runs(task_id) for task_id in range(3)], [1, 1, 1])
+
+    def test_crashed_worker_restarted(self):
+        def _worker(task_id):
+            self._record_run(task_id)
+            if task_id == 1 and self._runs(task_id) < 3:
+                raise ValueError("crashed")
+
+        run_workers(2, _worker)
+        self.assertEqual([self._runs(task_id) for task_id in range(2)], [1, 3])
+
+    def test_killed_worker_restarted(self):
+        def _worker(task_id):
+            self._record_run(task_id)
+            if self._runs(task_id) < 2:
+                os.kill(os.getpid(), signal.SIGKILL)
+
+        run_workers(1, _worker)
+        self.assertEqual(self._runs(0), 2)
+
+    def test_max_restarts(self):
+        def _worker(task_id):
+            self._record_run(task_id)
+            raise ValueError("crashed")
+
+        with self.assertRaises(RuntimeError):
+            run_workers(1, _worker, max_restarts=2)
+        self.assertEqual(self._runs(0), 3)
+
+
+class ServeForeverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.addCleanup(self.io_loop.close, all_fds=True)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+        self.calls = []
+
+    def _serve(self, is_drained, shutdown_timeout):
+        self.io_loop.add_callback(os.kill, os.getpid(), signal.SIGTERM)
+        start_time = time.time()
+        serve_forever(lambda: self.calls.append("stop_accepting"), is_drained, shutdown_timeout, io_loop=self.io_loop)
+        return time.time() - start_time
+
+    def test_drained(self):
+        def _is_drained():
+            self.calls.append("is_drained")
+            return len(self.calls) > 3
+
+        self.assertLess(self._serve(_is_drained, 5), 1)
+        self.assertEqual(self.calls, ["stop_accepting"] + ["is_drained"] * 3)
+
+    def test_shutdown_timeout(self):
+        elapsed = self._serve(lambda: False, 0.2)
+        self.assertGreaterEqual(elapsed, 0.2)
+        self.assertLess(elapsed, 1)
+        self.assertEqual(self.calls, ["stop_accepting"])
+
+
+class PreforkServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.address = "unix://{}".format(os.path.join(self.path, "xtcp.sock"))
+
+    def _start(self, num_workers):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                #: every worker creates its own IOLoop
+                IOLoop.clear_current()
+                IOLoop.clear_instance()
+                RPCServer(lambda message: str(os.getpid())).run(self.address, num_workers=num_workers,
+                                                                 shutdown_timeout=1)
+            except BaseException:
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        return pid
+
+    def _worker_pids(self, count):
+        io_loop = IOLoop()
+        client = RPCClient(self.address, None, io_loop=io_loop, connect_timeout=1)
+
+        @gen.coroutine
+        def _call():
+            pids = []
+            while len(pids) < count:
+                try:
+                    response = yield client.fetch(ClientConnectionItem(
+                        RPCMessage(CONNECTION_TYPE_IN_REQUEST, "pid", ""), timeout=5))
+                except RPCConnectionError:
+                    #: not listening yet
+                    yield gen.sleep(0.05)
+                    continue
+                pids.append(int(response.body))
+            raise gen.Return(pids)
+
+        try:
+            return io_loop.run_sync(_call, timeout=10)
+        finally:
+            client.close()
+            io_loop.close(all_fds=True)
+
+    def test_workers(self):
+        pid = self._start(2)
+        try:
+            pids = set(self._worker_pids(20))
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            _, status = os.waitpid(pid, 0)
+
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.assertTrue(pids)
+        self.assertNotIn(pid, pids)
+        self.assertNotIn(os.getpid(), pids)
+        #: the workers are gone with their supervisor
+        for worker_pid in pids:
+            with self.assertRaises(OSError):
+                os.kill(worker_pid, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
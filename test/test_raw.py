@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import socket
+import sys
+import unittest
+
+#: raw/ is a script directory outside of the pyxtcp package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "raw"))
+
+from client import Context, XTCPClient  # noqa: E402
+from tcpserver import TCPServer  # noqa: E402
+from util import (  # noqa: E402
+    DELIMITER, EventLoop, MessageBuffer, RequestContext, ResponseContext, Storage, XTCPConnectionException,
+    XTCPContextException,
+)
+
+
+class MessageTest(unittest.TestCase):
+
+    def test_split(self):
+        buffer = MessageBuffer(1024)
+        self.assertEqual(buffer.feed(b"a" + DELIMITER + b"bc" + DELIMITER[:3]), [b"a"])
+        #: the delimiter was cut between two reads
+        self.assertEqual(buffer.feed(DELIMITER[3:] + b"d"), [b"bc"])
+        self.assertEqual(buffer.feed(DELIMITER + DELIMITER), [b"d", b""])
+
+    def test_max_size(self):
+        buffer = MessageBuffer(8)
+        self.assertEqual(buffer.feed(b"x" * 8), [])
+        with self.assertRaises(XTCPContextException):
+            buffer.feed(b"x")
+
+    def test_contexts(self):
+        request_context = RequestContext()
+        message = request_context.encrypt(Storage(method="echo", params={"text": "a\r\n\r\nb"}))
+        self.assertEqual(message.count(DELIMITER), 1)
+        request = request_context.decrypt(message[:-len(DELIMITER)])
+        self.assertEqual((request.method, request.params), ("echo", {"text": "a\r\n\r\nb"}))
+        for malformed in (b"{", b"[]", b'{"params": 1}'):
+            with self.assertRaises(XTCPContextException):
+                request_context.decrypt(malformed)
+
+        response_context = ResponseContext()
+        self.assertEqual(response_context.decrypt(response_context.encrypt([1])[:-len(DELIMITER)]), [1])
+        with self.assertRaises(XTCPContextException) as context:
+            response_context.decrypt(response_context.encrypt("failed", False)[:-len(DELIMITER)])
+        self.assertEqual(str(context.exception), "failed")
+
+
+class RawEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = EventLoop()
+        #: run last, after the server and the client are closed
+        self.addCleanup(self.io_loop.close)
+        self.calls = []
+
+        server = TCPServer(self._request_callback, io_loop=self.io_loop)
+        server.listen(0, "127.0.0.1")
+        self.port = list(server._sockets.values())[0].getsockname()[1]
+        self.addCleanup(server.stop)
+
+    def _request_callback(self, method, params):
+        self.calls.append(params)
+        if method == "fail":
+            raise ValueError("failed {}".format(params))
+        return params
+
+    def _client(self, **kwargs):
+        client = XTCPClient(io_loop=self.io_loop, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def _context(self, method, params, port=None, **kwargs):
+        context = Context("127.0.0.1", port or self.port, connect_timeout=5, **kwargs)
+        context.concat(method, params)
+        return context
+
+    def test_acquire(self):
+        client = self._client()
+        self.assertEqual(client.acquire(self._context("echo", {"text": "xtcp"})), {"text": "xtcp"})
+
+        context = self._context("echo", "xtcp")
+        context.concat("echo", "xtcp", lambda response: response.upper())
+        self.assertEqual(client.acquire(context), "XTCP")
+
+    def test_pipelined(self):
+        client = self._client(max_clients=2, max_pipeline=4)
+        contexts = [self._context("echo", index, waiting_timeout=5) for index in range(20)]
+        self.assertEqual(client.acquire_many(contexts), list(range(20)))
+        self.assertEqual(sorted(self.calls), list(range(20)))
+        self.assertEqual(len(client.connections[contexts[0].address]), 2)
+
+    def test_failed_request(self):
+        client = self._client(max_clients=1)
+        with self.assertRaises(XTCPContextException) as context:
+            client.acquire(self._context("fail", 1))
+        self.assertIn("failed 1", str(context.exception))
+        #: the connection is still used
+        self.assertEqual(client.acquire(self._context("echo", 2)), 2)
+        self.assertEqual(len(client.connections[("127.0.0.1", self.port, socket.AF_INET)]), 1)
+
+    def test_request_timeout(self):
+        #: accepts connections and never answers
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(1)
+        self.addCleanup(sock.close)
+
+        client = self._client()
+        with self.assertRaises(XTCPConnectionException):
+            client.acquire(self._context("echo", 1, port=sock.getsockname()[1], request_timeout=0.1))
+
+    def test_connect_error(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        client = self._client()
+        with self.assertRaises(XTCPConnectionException):
+            client.acquire(self._context("echo", 1, port=port))
+        self.assertEqual(client.connections[("127.0.0.1", port, socket.AF_INET)], [])
+
+    def test_closed_client(self):
+        client = self._client()
+        client.close()
+        with self.assertRaises(XTCPConnectionException):
+            client.acquire(self._context("echo", 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
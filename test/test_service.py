@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import json
+import unittest
+
+from pyxtcp.http.service import Service as HTTPService
+from pyxtcp.service import RPCServiceError, Service
+from pyxtcp.tcp.tornado.util import CONNECTION_TYPE_IN_REQUEST, RPCMessage, server_callback_by_codec
+from pyxtcp.tcp.tornado.util import Service as TCPService
+
+
+class LazyService(object):
+
+    @staticmethod
+    def ping():
+        return "pong"
+
+
+class ServiceTest(unittest.TestCase):
+
+    def test_shared_by_engines(self):
+        self.assertIs(HTTPService, Service)
+        self.assertIs(TCPService, Service)
+
+    def test_with_f_rpc(self):
+        service = Service()
+
+        class EchoService(object):
+
+            @staticmethod
+            @service.with_f_rpc
+            def echo(value):
+                return value
+
+        self.assertEqual(service.get_rpc_function("EchoService.echo")("xtcp"), "xtcp")
+        self.assertEqual(service.get_all_rpc_functions(), ["EchoService.echo"])
+
+    def test_with_f_rpc_outside_service(self):
+        service = Service()
+        with self.assertRaises(RPCServiceError):
+            service.with_f_rpc(lambda: None)
+
+    def test_register(self):
+        service = Service()
+
+        @service.register
+        class CompanyService(object):
+
+            @staticmethod
+            def get_company(company_id):
+                return company_id
+
+            @staticmethod
+            def _private():
+                pass
+
+        self.assertEqual(service.get_all_rpc_functions(), ["CompanyService.get_company"])
+        with self.assertRaises(RPCServiceError):
+            service.register(object)
+
+    def test_register_lazy(self):
+        service = Service()
+        service.register_lazy("LazyService", "{}:LazyService".format(__name__))
+        self.assertEqual(service.get_all_rpc_functions(), [])
+
+        self.assertIsNone(service.get_rpc_function("LazyService.missing"))
+        self.assertEqual(service.get_rpc_function("LazyService.ping")(), "pong")
+        self.assertEqual(service.get_all_rpc_functions(), ["LazyService.ping"])
+
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = Service()
+        self.calls = []
+        calls = self.calls
+
+        @self.service.register(cache={"get_company": 60})
+        class CompanyService(object):
+
+            @staticmethod
+            def get_company(company_id):
+                calls.append(company_id)
+                return {"company_id": company_id, "calls": len(calls)}
+
+            @staticmethod
+            def update_company(company_id):
+                calls.append(company_id)
+                return len(calls)
+
+    def _call(self, topic, **kwargs):
+        body = server_callback_by_codec(self.service, RPCMessage(CONNECTION_TYPE_IN_REQUEST, topic, json.dumps(kwargs)))
+        return json.loads(body)
+
+    def test_cached_response(self):
+        first = self._call("CompanyService.get_company", company_id=1)
+        self.assertEqual(self._call("CompanyService.get_company", company_id=1), first)
+        self.assertEqual(self._call("CompanyService.get_company", company_id=2)["calls"], 2)
+        self.assertEqual(self.calls, [1, 2])
+
+    def test_not_cached_method(self):
+        self._call("CompanyService.update_company", company_id=1)
+        self._call("CompanyService.update_company", company_id=1)
+        self.assertEqual(self.calls, [1, 1])
+
+    def test_invalidate(self):
+        self._call("CompanyService.get_company", company_id=1)
+        self._call("CompanyService.get_company", company_id=2)
+        self.service.invalidate("CompanyService.get_company", company_id=1)
+        self._call("CompanyService.get_company", company_id=1)
+        self._call("CompanyService.get_company", company_id=2)
+        self.assertEqual(self.calls, [1, 2, 1])
+
+        self.service.invalidate("CompanyService.get_company")
+        self._call("CompanyService.get_company", company_id=2)
+        self.assertEqual(self.calls, [1, 2, 1, 2])
+
+    def test_with_f_rpc_cache(self):
+        service = Service()
+        calls = self.calls
+
+        class EchoService(object):
+
+            @staticmethod
+            @service.with_f_rpc(cache=60)
+            def echo(value):
+                calls.append(value)
+                return value
+
+        for _ in range(2):
+            body = server_callback_by_codec(service, RPCMessage(CONNECTION_TYPE_IN_REQUEST, "EchoService.echo",
+                                                                '{"value": "xtcp"}'))
+            self.assertEqual(json.loads(body), "xtcp")
+        self.assertEqual(calls, ["xtcp"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import io
+import socket
+import unittest
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+
+from pyxtcp.tcp.tornado.multi_client import ClientConnectionItem, RPCClient
+from pyxtcp.tcp.tornado.multiplex_client import MultiplexRPCClient
+from pyxtcp.tcp.tornado.server import RPCServer
+from pyxtcp.tcp.tornado.util import (
+    CONNECTION_TYPE_IN_REQUEST, CONNECTION_TYPE_IN_RESPONSE, FLAG_STREAM, RESPONSE_SUCCESS_TAG, BodyStream,
+    RPCConnectionError, RPCMessage, is_busy_response, message_utils,
+)
+
+
+def listen(server):
+    server.listen(0, "127.0.0.1")
+    return list(server._sockets.values())[0].getsockname()[1]
+
+
+class KeepAliveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        #: run last, after the server and the streams are closed
+        self.addCleanup(self.io_loop.close, all_fds=True)
+        self.request = message_utils.encrypt(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", "xtcp"))
+        self.response = message_utils.encrypt(RPCMessage(CONNECTION_TYPE_IN_RESPONSE, RESPONSE_SUCCESS_TAG, "xtcp"))
+
+    def _requests(self, count, **kwargs):
+        """Send `count` requests one after another on one connection, return the responses
+        and whether the server closed the connection after them."""
+
+        server = RPCServer(lambda message: message.body, io_loop=self.io_loop, **kwargs)
+        port = listen(server)
+        self.addCleanup(server.stop)
+        stream = IOStream(socket.create_connection(("127.0.0.1", port)), io_loop=self.io_loop)
+        self.addCleanup(stream.close)
+
+        @gen.coroutine
+        def _call():
+            responses = []
+            for _ in range(count):
+                if stream.closed():
+                    break
+                yield stream.write(self.request)
+                response = yield stream.read_bytes(len(self.response))
+                responses.append(response)
+            try:
+                rest = yield gen.with_timeout(self.io_loop.time() + 0.5, stream.read_until_close(),
+                                              io_loop=self.io_loop)
+            except gen.TimeoutError:
+                raise gen.Return((responses, False))
+            raise gen.Return((responses + [rest] if rest else responses, True))
+
+        return self.io_loop.run_sync(_call, timeout=5)
+
+    def test_one_request_per_connection(self):
+        self.assertEqual(self._requests(1), ([self.response], True))
+
+    def test_keep_alive(self):
+        self.assertEqual(self._requests(3, keep_alive=True), ([self.response] * 3, False))
+
+    def test_max_requests(self):
+        self.assertEqual(self._requests(2, keep_alive=True, keep_alive_max_requests=2), ([self.response] * 2, True))
+
+    def test_idle_timeout(self):
+        self.assertEqual(self._requests(1, keep_alive=True, keep_alive_timeout=0.1), ([self.response], True))
+
+
+class DrainingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+
+    def tearDown(self):
+        self.io_loop.close(all_fds=True)
+
+    def test_multiplexed_request_finishes(self):
+        @gen.coroutine
+        def _slow_callback(message):
+            yield gen.sleep(0.5)
+            raise gen.Return(message.body)
+
+        server = RPCServer(_slow_callback, io_loop=self.io_loop)
+        client = MultiplexRPCClient("127.0.0.1", listen(server), io_loop=self.io_loop, connect_timeout=5)
+
+        @gen.coroutine
+        def _call():
+            future = client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "slow", "xtcp")))
+            yield gen.sleep(0.1)
+            server.start_draining()
+            self.assertFalse(server.is_drained())
+            response = yield future
+
+            #: the connection is closed once the request is answered
+            while not server.is_drained():
+                yield gen.sleep(0.01)
+            raise gen.Return(response)
+
+        try:
+            response = self.io_loop.run_sync(_call, timeout=5)
+        finally:
+            client.close()
+        self.assertEqual((response.topic, response.body), (RESPONSE_SUCCESS_TAG, "xtcp"))
+
+    def test_idle_connection_closed(self):
+        server = RPCServer(lambda message: message.body, io_loop=self.io_loop, keep_alive=True)
+        client = RPCClient("127.0.0.1", listen(server), io_loop=self.io_loop, connect_timeout=5)
+
+        @gen.coroutine
+        def _call():
+            response = yield client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", "xtcp")))
+            self.assertFalse(server.is_drained())
+            server.start_draining()
+            while not server.is_drained():
+                yield gen.sleep(0.01)
+            raise gen.Return(response)
+
+        try:
+            response = self.io_loop.run_sync(_call, timeout=5)
+        finally:
+            client.close()
+        self.assertEqual(response.body, "xtcp")
+
+
+class MultiplexClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+
+    def tearDown(self):
+        self.io_loop.close(all_fds=True)
+
+    def test_response_timeout(self):
+        @gen.coroutine
+        def _slow_callback(message):
+            yield gen.sleep(0.5)
+            raise gen.Return(message.body)
+
+        server = RPCServer(_slow_callback, io_loop=self.io_loop)
+        client = MultiplexRPCClient("127.0.0.1", listen(server), io_loop=self.io_loop, connect_timeout=5)
+
+        @gen.coroutine
+        def _call():
+            yield client.fetch(ClientConnectionItem(
+                RPCMessage(CONNECTION_TYPE_IN_REQUEST, "slow", "xtcp"), header_timeout=0.1))
+
+        try:
+            with self.assertRaises(RPCConnectionError):
+                self.io_loop.run_sync(_call, timeout=5)
+        finally:
+            client.close()
+
+    def test_answered_out_of_order(self):
+        @gen.coroutine
+        def _callback(message):
+            yield gen.sleep(float(message.body))
+            raise gen.Return(message.body)
+
+        server = RPCServer(_callback, io_loop=self.io_loop, keep_alive=True)
+        client = MultiplexRPCClient("127.0.0.1", listen(server), io_loop=self.io_loop, connect_timeout=5)
+        answered = []
+
+        @gen.coroutine
+        def _call():
+            futures = [client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "sleep", body),
+                                                         callback=lambda response: answered.append(response.body)))
+                       for body in ("0.3", "0.1", "0")]
+            responses = yield futures
+            self.assertEqual(len(server._connections), 1)
+            raise gen.Return([response.body for response in responses])
+
+        try:
+            self.assertEqual(self.io_loop.run_sync(_call, timeout=5), ["0.3", "0.1", "0"])
+        finally:
+            client.close()
+        self.assertEqual(answered, ["0", "0.1", "0.3"])
+
+    def test_connection_closed(self):
+        server = RPCServer(lambda message: message.body, io_loop=self.io_loop, keep_alive=True)
+        client = MultiplexRPCClient("127.0.0.1", listen(server), io_loop=self.io_loop, connect_timeout=5)
+
+        @gen.coroutine
+        def _call():
+            response = yield client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", "1")))
+            #: the next request opens a new connection
+            for connection in list(server._connections):
+                connection.close()
+            yield gen.sleep(0.05)
+            response = yield client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", "2")))
+            raise gen.Return(response)
+
+        try:
+            self.assertEqual(self.io_loop.run_sync(_call, timeout=5).body, "2")
+        finally:
+            client.close()
+
+
+class BodyStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+
+    def tearDown(self):
+        self.io_loop.close(all_fds=True)
+
+    def _run(self, func):
+        return self.io_loop.run_sync(func, timeout=5)
+
+    @gen.coroutine
+    def _read_all(self, stream):
+        chunks = []
+        while True:
+            chunk = yield stream.read_chunk()
+            if chunk is None:
+                raise gen.Return(chunks)
+            chunks.append(chunk)
+
+    def test_chunks_in_order(self):
+        stream = BodyStream(max_buffered_chunks=2)
+
+        @gen.coroutine
+        def _feed():
+            for index in range(5):
+                yield stream.feed(index)
+            stream.finish()
+
+        @gen.coroutine
+        def _call():
+            chunks, _ = yield [self._read_all(stream), _feed()]
+            raise gen.Return(chunks)
+
+        self.assertEqual(self._run(_call), list(range(5)))
+
+    def test_error_after_chunks(self):
+        stream = BodyStream()
+
+        @gen.coroutine
+        def _call():
+            yield stream.feed(b"x")
+            stream.finish(RPCConnectionError("failed"))
+            self.assertEqual((yield stream.read_chunk()), b"x")
+            with self.assertRaises(RPCConnectionError):
+                yield stream.read_chunk()
+
+        self._run(_call)
+
+    def test_closed_by_reader(self):
+        stream = BodyStream()
+
+        @gen.coroutine
+        def _call():
+            yield stream.feed(b"x")
+            stream.close()
+            fed = yield stream.feed(b"y")
+            raise gen.Return(fed)
+
+        self.assertFalse(self._run(_call))
+
+    def test_stalled_reader(self):
+        stream = BodyStream(max_buffered_chunks=1)
+
+        @gen.coroutine
+        def _call():
+            yield stream.feed(b"x", stall_timeout=0.05)
+            fed = yield stream.feed(b"y", stall_timeout=0.05)
+            raise gen.Return(fed)
+
+        self.assertFalse(self._run(_call))
+        with self.assertRaises(RPCConnectionError):
+            self._run(stream.read_chunk)
+
+
+class StreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        #: run last, after the server and the clients are closed
+        self.addCleanup(self.io_loop.close, all_fds=True)
+
+        server = RPCServer(self._callback, io_loop=self.io_loop, keep_alive=True, read_chunk_size=1024)
+        self.port = listen(server)
+        self.addCleanup(server.stop)
+
+    @gen.coroutine
+    def _callback(self, message):
+        if message.topic == "upload":
+            chunks = []
+            while True:
+                chunk = yield message.body.read_chunk()
+                if chunk is None:
+                    break
+                chunks.append(chunk)
+            raise gen.Return("{} {}".format(len(chunks), len(b"".join(chunks))))
+        if message.topic == "file":
+            raise gen.Return(io.BytesIO(b"x" * 2500))
+        raise gen.Return(b"x" * 1000 for _ in range(3))
+
+    def _clients(self):
+        for client_class in (RPCClient, MultiplexRPCClient):
+            client = client_class("127.0.0.1", self.port, io_loop=self.io_loop, connect_timeout=5)
+            self.addCleanup(client.close)
+            yield client
+
+    def _fetch(self, client, topic, body="", **kwargs):
+        return self.io_loop.run_sync(lambda: client.fetch(ClientConnectionItem(
+            RPCMessage(CONNECTION_TYPE_IN_REQUEST, topic, body), timeout=5, **kwargs)), timeout=5)
+
+    @gen.coroutine
+    def _read_all(self, stream):
+        chunks = []
+        while True:
+            chunk = yield stream.read_chunk()
+            if chunk is None:
+                raise gen.Return(chunks)
+            chunks.append(chunk)
+
+    def test_request_stream(self):
+        for client in self._clients():
+            response = self._fetch(client, "upload", (b"x" * 100 for _ in range(10)))
+            self.assertEqual(response.body, "10 1000")
+
+    def test_response_stream(self):
+        for client in self._clients():
+            for topic, sizes in (("download", [1000] * 3), ("file", [1024, 1024, 452])):
+                response = self._fetch(client, topic, stream_response=True)
+                chunks = self.io_loop.run_sync(lambda: self._read_all(response.body), timeout=5)
+                self.assertEqual([len(chunk) for chunk in chunks], sizes)
+
+    def test_joined_response(self):
+        #: the pooled client streams responses on request only, the body is joined otherwise
+        client = next(self._clients())
+        for _ in range(2):
+            response = self._fetch(client, "download")
+            self.assertEqual((response.body, response.flags & FLAG_STREAM), (b"x" * 3000, 0))
+        self.assertEqual(len(client._connections), 1)
+
+
+class StreamStallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+
+    def tearDown(self):
+        self.io_loop.close(all_fds=True)
+
+    def _stream_server(self):
+        def _callback(message):
+            if message.topic == "stream":
+                return (b"x" * 65536 for _ in range(100))
+            return message.body
+        return listen(RPCServer(_callback, io_loop=self.io_loop))
+
+    def _fetch_stream(self, client):
+        return client.fetch(ClientConnectionItem(
+            RPCMessage(CONNECTION_TYPE_IN_REQUEST, "stream", "xtcp"), timeout=5, stream_response=True))
+
+    def test_unread_response_stream(self):
+        client = MultiplexRPCClient("127.0.0.1", self._stream_server(), io_loop=self.io_loop, connect_timeout=5)
+
+        @gen.coroutine
+        def _call():
+            response = yield self._fetch_stream(client)
+            self.assertIsInstance(response.body, BodyStream)
+
+            #: nobody reads the stream, the other requests are answered anyway
+            echo = yield client.fetch(ClientConnectionItem(
+                RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", "xtcp"), timeout=1))
+            raise gen.Return(echo)
+
+        try:
+            echo = self.io_loop.run_sync(_call, timeout=5)
+        finally:
+            client.close()
+        self.assertEqual(echo.body, "xtcp")
+
+    def test_stalled_response_stream(self):
+        client = MultiplexRPCClient("127.0.0.1", self._stream_server(), io_loop=self.io_loop, connect_timeout=5,
+                                    stream_stall_timeout=0.2)
+
+        @gen.coroutine
+        def _call():
+            response = yield self._fetch_stream(client)
+            yield gen.sleep(0.5)
+            with self.assertRaises(RPCConnectionError):
+                while (yield response.body.read_chunk()) is not None:
+                    pass
+
+        try:
+            self.io_loop.run_sync(_call, timeout=5)
+        finally:
+            client.close()
+
+    def test_unread_request_stream(self):
+        @gen.coroutine
+        def _callback(message):
+            yield gen.sleep(0.5)
+            try:
+                while (yield message.body.read_chunk()) is not None:
+                    pass
+            except RPCConnectionError:
+                raise gen.Return("stalled")
+            raise gen.Return("read")
+
+        server = RPCServer(_callback, io_loop=self.io_loop, stream_stall_timeout=0.2)
+        client = MultiplexRPCClient("127.0.0.1", listen(server), io_loop=self.io_loop, connect_timeout=5)
+
+        @gen.coroutine
+        def _call():
+            response = yield client.fetch(ClientConnectionItem(RPCMessage(
+                CONNECTION_TYPE_IN_REQUEST, "upload", (b"x" * 65536 for _ in range(20))), timeout=5))
+            raise gen.Return(response)
+
+        try:
+            response = self.io_loop.run_sync(_call, timeout=5)
+        finally:
+            client.close()
+        self.assertEqual((response.topic, response.body), (RESPONSE_SUCCESS_TAG, "stalled"))
+
+
+class WriteBufferTest(unittest.TestCase):
+
+    def test_reading_paused(self):
+        io_loop = IOLoop()
+        calls = []
+
+        def _callback(message):
+            calls.append(message.request_id)
+            return b"x" * 1024 * 1024
+
+        server = RPCServer(_callback, io_loop=io_loop, keep_alive=True,
+                           write_buffer_high_watermark=1024 * 1024, write_buffer_low_watermark=256 * 1024)
+        sock = socket.create_connection(("127.0.0.1", listen(server)))
+        request_count = 50
+
+        @gen.coroutine
+        def _call():
+            sock.sendall(b"".join(b"".join(message_utils.encrypt_chunks(
+                RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", "xtcp", request_id=request_id)))
+                for request_id in range(request_count)))
+            yield gen.sleep(0.3)
+            paused_calls = len(calls)
+
+            #: read every response, the requests left are read again
+            sock.setblocking(False)
+            received = 0
+            while received < request_count * 1024 * 1024:
+                try:
+                    received += len(sock.recv(1024 * 1024))
+                except socket.error:
+                    yield gen.sleep(0.001)
+            raise gen.Return(paused_calls)
+
+        try:
+            paused_calls = io_loop.run_sync(_call, timeout=10)
+        finally:
+            sock.close()
+            io_loop.close(all_fds=True)
+        self.assertLess(paused_calls, request_count)
+        self.assertEqual(len(calls), request_count)
+
+
+class AdmissionControlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        #: run last, after the server and the clients are closed
+        self.addCleanup(self.io_loop.close, all_fds=True)
+        self.calls = []
+
+    @gen.coroutine
+    def _callback(self, message):
+        self.calls.append(message.body)
+        yield gen.sleep(float(message.body))
+        raise gen.Return(message.body)
+
+    def _client(self, port, client_class=RPCClient):
+        client = client_class("127.0.0.1", port, io_loop=self.io_loop, connect_timeout=5)
+        self.addCleanup(client.close)
+        return client
+
+    def _server(self, **kwargs):
+        server = RPCServer(self._callback, io_loop=self.io_loop, keep_alive=True, **kwargs)
+        port = listen(server)
+        self.addCleanup(server.stop)
+        return port
+
+    def _fetch(self, client, body):
+        return client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "sleep", body), timeout=5))
+
+    def test_max_inflight_requests(self):
+        client = self._client(self._server(max_inflight_requests=1), MultiplexRPCClient)
+
+        @gen.coroutine
+        def _call():
+            responses = yield [self._fetch(client, "0.2"), self._fetch(client, "0")]
+            after = yield self._fetch(client, "0")
+            raise gen.Return(responses + [after])
+
+        running, busy, after = self.io_loop.run_sync(_call, timeout=5)
+        self.assertEqual((running.topic, running.body), (RESPONSE_SUCCESS_TAG, "0.2"))
+        self.assertTrue(is_busy_response(busy))
+        self.assertFalse(is_busy_response(after))
+        #: the busy request was not run
+        self.assertEqual(self.calls, ["0.2", "0"])
+
+    def test_max_connections(self):
+        port = self._server(max_connections=1)
+        first, second = self._client(port), self._client(port)
+
+        @gen.coroutine
+        def _call():
+            first_response = yield self._fetch(first, "0")
+            #: the first connection is kept alive, the second is answered busy and closed
+            second_response = yield self._fetch(second, "0")
+            raise gen.Return((first_response, second_response))
+
+        first_response, second_response = self.io_loop.run_sync(_call, timeout=5)
+        self.assertFalse(is_busy_response(first_response))
+        self.assertTrue(is_busy_response(second_response))
+        self.assertEqual(self.calls, ["0"])
+
+        first.close()
+
+        @gen.coroutine
+        def _retry():
+            #: let the server see the first connection closed
+            yield gen.sleep(0.05)
+            response = yield self._fetch(second, "0")
+            raise gen.Return(response)
+
+        self.assertFalse(is_busy_response(self.io_loop.run_sync(_retry, timeout=5)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from pyxtcp.tcp.tornado.multi_client import ClientConnectionItem, RPCClient
+from pyxtcp.tcp.tornado.multiplex_client import MultiplexRPCClient
+from pyxtcp.tcp.tornado.server import RPCServer
+from pyxtcp.tcp.tornado.util import CONNECTION_TYPE_IN_REQUEST, RPCMessage
+from pyxtcp.transport import RECORD_ATTACH, RECORD_HEADER, RPCTransportError, ShmChannel, parse_local_address
+
+
+class LocalAddressTest(unittest.TestCase):
+
+    def test_unix(self):
+        address = parse_local_address("unix:///tmp/rpc.sock?threshold=1024")
+        self.assertEqual((address.scheme, address.path, address.threshold), ("unix", "/tmp/rpc.sock", 1024))
+
+    def test_shm(self):
+        address = parse_local_address("shm://rpc")
+        self.assertEqual(address.scheme, "shm")
+        self.assertEqual(address.path, os.path.join(tempfile.gettempdir(), "pyxtcp-rpc.sock"))
+
+    def test_not_local(self):
+        self.assertIsNone(parse_local_address("127.0.0.1"))
+        self.assertIsNone(parse_local_address(8001))
+
+    def test_malformed(self):
+        for address in ("shm://../rpc", "unix://", "shm://rpc?ring_size=0", "shm://rpc?threshold=x"):
+            with self.assertRaises(RPCTransportError):
+                parse_local_address(address)
+
+
+class ShmChannelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = ShmChannel(True, ring_size=1024, threshold=100)
+        self.server = ShmChannel(False, threshold=100)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def _send(self, sender, receiver, data):
+        chunks = sender.encode(data)
+        return b"".join(chunks), b"".join(receiver.feed(b"".join(chunks)))
+
+    def test_round_trip(self):
+        written, read = self._send(self.client, self.server, b"x" * 10)
+        self.assertEqual(read, b"x" * 10)
+        self.assertIn(b"x" * 10, written)
+
+        #: large writes only send their record
+        for sender, receiver in ((self.client, self.server), (self.server, self.client)):
+            data = os.urandom(600)
+            written, read = self._send(sender, receiver, data)
+            self.assertEqual(read, data)
+            self.assertNotIn(data, written)
+
+    def test_full_ring(self):
+        first = self.client.encode(b"a" * 600)
+        self.assertNotIn(b"a" * 600, first)
+        #: the first write is not read yet, the second one is sent inline
+        second = self.client.encode(b"b" * 600)
+        self.assertIn(b"b" * 600, second)
+        self.assertEqual(b"".join(self.server.feed(b"".join(first + second))), b"a" * 600 + b"b" * 600)
+
+    def test_partial_records(self):
+        written = b"".join(self.client.encode(b"x" * 10))
+        read = [chunk for byte in range(len(written)) for chunk in self.server.feed(written[byte:byte + 1])]
+        self.assertEqual(b"".join(read), b"x" * 10)
+
+    def test_plain_client(self):
+        self.assertEqual(self.server.feed(b"#abc"), [b"#abc"])
+        #: no segment, large writes stay inline
+        self.assertEqual(self.server.encode(b"x" * 600), [b"x" * 600])
+
+    def test_segment_removed(self):
+        path = self.client._path
+        self.assertTrue(os.path.exists(path))
+        self._send(self.client, self.server, b"x")
+        self.assertFalse(os.path.exists(path))
+
+    def test_foreign_segment_refused(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "pyxtcp-shm-foreign")
+            with open(path, "wb") as f:
+                f.write(b"\0" * 4096)
+            path = path.encode("utf-8")
+            with self.assertRaises(RPCTransportError):
+                self.server.feed(RECORD_HEADER.pack(RECORD_ATTACH, 0, len(path)) + path)
+            self.assertTrue(os.path.exists(path))
+        finally:
+            shutil.rmtree(directory)
+
+
+class LocalServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.name = "test-{}".format(uuid.uuid4().hex[:8])
+        self.path = parse_local_address("shm://{}".format(self.name)).path
+        self.server = RPCServer(lambda message: message.body, io_loop=self.io_loop, keep_alive=True)
+
+    def tearDown(self):
+        self.server.stop()
+        self.io_loop.close(all_fds=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _fetch(self, client, body):
+        @gen.coroutine
+        def _call():
+            response = yield client.fetch(ClientConnectionItem(RPCMessage(CONNECTION_TYPE_IN_REQUEST, "echo", body)))
+            raise gen.Return(response)
+
+        try:
+            return self.io_loop.run_sync(_call, timeout=5)
+        finally:
+            client.close()
+
+    def test_unix(self):
+        address = "unix://{}".format(self.path)
+        self.server.listen(address)
+        client = RPCClient(address, io_loop=self.io_loop, connect_timeout=5)
+        self.assertEqual(self._fetch(client, "xtcp").body, "xtcp")
+
+    def test_shm(self):
+        address = "shm://{}?threshold=1024".format(self.name)
+        self.server.listen(address)
+        body = "x" * 100000
+        for client_class in (RPCClient, MultiplexRPCClient):
+            client = client_class(address, io_loop=self.io_loop, connect_timeout=5)
+            self.assertEqual(self._fetch(client, body).body, body)
+
+    def test_unix_client_of_shm_server(self):
+        self.server.listen("shm://{}".format(self.name))
+        client = RPCClient("unix://{}".format(self.path), io_loop=self.io_loop, connect_timeout=5)
+        self.assertEqual(self._fetch(client, "xtcp").body, "xtcp")
+
+
+if __name__ == "__main__":
+    unittest.main()